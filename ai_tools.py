@@ -6,10 +6,13 @@
 - Inpainting (редактирование частей изображения)
 - Face Restore (улучшение лиц на фото)
 """
-import requests
 from io import BytesIO
-from settings import STABILITY_API_KEY
+from settings import STABILITY_API_KEY, STABILITY_API_BASE
+from providers import get_session, STABILITY
 from openai_helper import translate_to_english
+import log
+
+logger = log.get_logger(__name__)
 
 
 def upscale_image(image_input, scale_factor=2):
@@ -33,7 +36,7 @@ def upscale_image(image_input, scale_factor=2):
             image_bytes = image_input.read()
 
         # Stability.ai upscale endpoint
-        api_url = "https://api.stability.ai/v2beta/stable-image/upscale/conservative"
+        api_url = f"{STABILITY_API_BASE}/v2beta/stable-image/upscale/conservative"
 
         headers = {
             "authorization": f"Bearer {STABILITY_API_KEY}",
@@ -49,24 +52,24 @@ def upscale_image(image_input, scale_factor=2):
             "output_format": "png"
         }
 
-        print(f"[INFO] Upscaling image with {scale_factor}x...")
+        logger.info("Upscaling image with %sx...", scale_factor)
 
-        response = requests.post(api_url, headers=headers, files=files, data=data)
+        response = get_session(STABILITY).post(api_url, headers=headers, files=files, data=data, timeout=120)
 
         if response.status_code == 200:
             result = BytesIO(response.content)
             result.seek(0)
-            print(f"[INFO] Upscale successful")
+            logger.info("Upscale successful")
             return result
         else:
             error_msg = f"Upscale error: {response.status_code}"
-            print(f"[ERROR] {error_msg}")
-            print(f"[ERROR] Response: {response.text}")
+            logger.error(error_msg)
+            logger.error("Response: %.500s", response.text)
             return f"❌ Ошибка upscale: {response.status_code}"
 
     except Exception as e:
         error_msg = f"Upscale exception: {str(e)}"
-        print(f"[ERROR] {error_msg}")
+        logger.error(error_msg)
         return f"❌ Ошибка: {str(e)}"
 
 
@@ -90,7 +93,7 @@ def remove_background(image_input):
             image_bytes = image_input.read()
 
         # Stability.ai remove background endpoint
-        api_url = "https://api.stability.ai/v2beta/stable-image/edit/remove-background"
+        api_url = f"{STABILITY_API_BASE}/v2beta/stable-image/edit/remove-background"
 
         headers = {
             "authorization": f"Bearer {STABILITY_API_KEY}",
@@ -105,24 +108,24 @@ def remove_background(image_input):
             "output_format": "png"
         }
 
-        print("[INFO] Removing background...")
+        logger.info("Removing background...")
 
-        response = requests.post(api_url, headers=headers, files=files, data=data)
+        response = get_session(STABILITY).post(api_url, headers=headers, files=files, data=data, timeout=120)
 
         if response.status_code == 200:
             result = BytesIO(response.content)
             result.seek(0)
-            print("[INFO] Background removal successful")
+            logger.info("Background removal successful")
             return result
         else:
             error_msg = f"Remove background error: {response.status_code}"
-            print(f"[ERROR] {error_msg}")
-            print(f"[ERROR] Response: {response.text}")
+            logger.error(error_msg)
+            logger.error("Response: %.500s", response.text)
             return f"❌ Ошибка удаления фона: {response.status_code}"
 
     except Exception as e:
         error_msg = f"Remove background exception: {str(e)}"
-        print(f"[ERROR] {error_msg}")
+        logger.error(error_msg)
         return f"❌ Ошибка: {str(e)}"
 
 
@@ -148,7 +151,7 @@ def create_variations(image_input, prompt="", num_variations=1):
             image_bytes = image_input.read()
 
         # Используем image-to-image для создания вариаций
-        api_url = "https://api.stability.ai/v2beta/stable-image/generate/sd3"
+        api_url = f"{STABILITY_API_BASE}/v2beta/stable-image/generate/sd3"
 
         headers = {
             "authorization": f"Bearer {STABILITY_API_KEY}",
@@ -162,9 +165,9 @@ def create_variations(image_input, prompt="", num_variations=1):
         # Переводим промпт на английский, если он есть
         english_prompt = prompt if prompt else "variation of this image, slightly different"
         if prompt:
-            print(f"[INFO] Translating prompt: {prompt}")
+            logger.debug("Translating prompt: %s", prompt)
             english_prompt = translate_to_english(prompt)
-            print(f"[OK] Translated prompt: {english_prompt}")
+            logger.debug("Translated prompt: %s", english_prompt)
 
         # Используем низкий strength для создания вариаций
         data = {
@@ -175,24 +178,24 @@ def create_variations(image_input, prompt="", num_variations=1):
             "model": "sd3.5-large"
         }
 
-        print(f"[INFO] Creating {num_variations} variation(s)...")
+        logger.info("Creating %s variation(s)...", num_variations)
 
-        response = requests.post(api_url, headers=headers, files=files, data=data)
+        response = get_session(STABILITY).post(api_url, headers=headers, files=files, data=data, timeout=120)
 
         if response.status_code == 200:
             result = BytesIO(response.content)
             result.seek(0)
-            print("[INFO] Variation created successfully")
+            logger.info("Variation created successfully")
             return [result]
         else:
             error_msg = f"Variations error: {response.status_code}"
-            print(f"[ERROR] {error_msg}")
-            print(f"[ERROR] Response: {response.text}")
+            logger.error(error_msg)
+            logger.error("Response: %.500s", response.text)
             return f"❌ Ошибка создания вариаций: {response.status_code}"
 
     except Exception as e:
         error_msg = f"Variations exception: {str(e)}"
-        print(f"[ERROR] {error_msg}")
+        logger.error(error_msg)
         return f"❌ Ошибка: {str(e)}"
 
 
@@ -226,7 +229,7 @@ def inpaint_image(image_input, mask_input, prompt=""):
             mask_bytes = mask_input.read()
 
         # Stability.ai inpaint endpoint
-        api_url = "https://api.stability.ai/v2beta/stable-image/edit/inpaint"
+        api_url = f"{STABILITY_API_BASE}/v2beta/stable-image/edit/inpaint"
 
         headers = {
             "authorization": f"Bearer {STABILITY_API_KEY}",
@@ -241,33 +244,33 @@ def inpaint_image(image_input, mask_input, prompt=""):
         # Переводим промпт на английский, если он есть
         english_prompt = prompt if prompt else "improve and enhance the masked area"
         if prompt:
-            print(f"[INFO] Translating inpaint prompt: {prompt}")
+            logger.debug("Translating inpaint prompt: %s", prompt)
             english_prompt = translate_to_english(prompt)
-            print(f"[OK] Translated prompt: {english_prompt}")
+            logger.debug("Translated prompt: %s", english_prompt)
 
         data = {
             "prompt": english_prompt,
             "output_format": "png"
         }
 
-        print("[INFO] Inpainting image...")
+        logger.info("Inpainting image...")
 
-        response = requests.post(api_url, headers=headers, files=files, data=data)
+        response = get_session(STABILITY).post(api_url, headers=headers, files=files, data=data, timeout=120)
 
         if response.status_code == 200:
             result = BytesIO(response.content)
             result.seek(0)
-            print("[INFO] Inpainting successful")
+            logger.info("Inpainting successful")
             return result
         else:
             error_msg = f"Inpaint error: {response.status_code}"
-            print(f"[ERROR] {error_msg}")
-            print(f"[ERROR] Response: {response.text}")
+            logger.error(error_msg)
+            logger.error("Response: %.500s", response.text)
             return f"❌ Ошибка inpainting: {response.status_code}"
 
     except Exception as e:
         error_msg = f"Inpaint exception: {str(e)}"
-        print(f"[ERROR] {error_msg}")
+        logger.error(error_msg)
         return f"❌ Ошибка: {str(e)}"
 
 
@@ -291,7 +294,7 @@ def restore_face(image_input):
             image_bytes = image_input.read()
 
         # Используем creative upscale для улучшения деталей лица
-        api_url = "https://api.stability.ai/v2beta/stable-image/upscale/creative"
+        api_url = f"{STABILITY_API_BASE}/v2beta/stable-image/upscale/creative"
 
         headers = {
             "authorization": f"Bearer {STABILITY_API_KEY}",
@@ -308,24 +311,24 @@ def restore_face(image_input):
             "creativity": 0.3  # Низкая креативность для сохранения оригинала
         }
 
-        print("[INFO] Restoring faces...")
+        logger.info("Restoring faces...")
 
-        response = requests.post(api_url, headers=headers, files=files, data=data)
+        response = get_session(STABILITY).post(api_url, headers=headers, files=files, data=data, timeout=120)
 
         if response.status_code == 200:
             result = BytesIO(response.content)
             result.seek(0)
-            print("[INFO] Face restoration successful")
+            logger.info("Face restoration successful")
             return result
         else:
             error_msg = f"Face restore error: {response.status_code}"
-            print(f"[ERROR] {error_msg}")
-            print(f"[ERROR] Response: {response.text}")
+            logger.error(error_msg)
+            logger.error("Response: %.500s", response.text)
             return f"❌ Ошибка восстановления лица: {response.status_code}"
 
     except Exception as e:
         error_msg = f"Face restore exception: {str(e)}"
-        print(f"[ERROR] {error_msg}")
+        logger.error(error_msg)
         return f"❌ Ошибка: {str(e)}"
 
 
@@ -353,11 +356,11 @@ def outpaint_image(image_input, prompt="", left=0, right=0, up=0, down=0):
         # Переводим промпт на английский, если он есть
         english_prompt = prompt if prompt else "extend the image naturally"
         if prompt:
-            print(f"[INFO] Translating outpaint prompt: {prompt}")
+            logger.debug("Translating outpaint prompt: %s", prompt)
             english_prompt = translate_to_english(prompt)
-            print(f"[OK] Translated prompt: {english_prompt}")
+            logger.debug("Translated prompt: %s", english_prompt)
 
-        api_url = "https://api.stability.ai/v2beta/stable-image/edit/outpaint"
+        api_url = f"{STABILITY_API_BASE}/v2beta/stable-image/edit/outpaint"
 
         headers = {
             "authorization": f"Bearer {STABILITY_API_KEY}",
@@ -377,24 +380,24 @@ def outpaint_image(image_input, prompt="", left=0, right=0, up=0, down=0):
             "output_format": "png"
         }
 
-        print(f"[INFO] Outpainting image (L:{left}, R:{right}, U:{up}, D:{down})...")
+        logger.info("Outpainting image (L:%s, R:%s, U:%s, D:%s)...", left, right, up, down)
 
-        response = requests.post(api_url, headers=headers, files=files, data=data)
+        response = get_session(STABILITY).post(api_url, headers=headers, files=files, data=data, timeout=120)
 
         if response.status_code == 200:
             result = BytesIO(response.content)
             result.seek(0)
-            print("[INFO] Outpaint successful")
+            logger.info("Outpaint successful")
             return result
         else:
             error_msg = f"Outpaint error: {response.status_code}"
-            print(f"[ERROR] {error_msg}")
-            print(f"[ERROR] Response: {response.text}")
+            logger.error(error_msg)
+            logger.error("Response: %.500s", response.text)
             return f"❌ Ошибка outpaint: {response.status_code}"
 
     except Exception as e:
         error_msg = f"Outpaint exception: {str(e)}"
-        print(f"[ERROR] {error_msg}")
+        logger.error(error_msg)
         return f"❌ Ошибка: {str(e)}"
 
 
@@ -420,15 +423,15 @@ def search_and_recolor(image_input, search_prompt, recolor_prompt):
             image_bytes = image_input.read()
 
         # Переводим промпты на английский
-        print(f"[INFO] Translating search prompt: {search_prompt}")
+        logger.debug("Translating search prompt: %s", search_prompt)
         english_search = translate_to_english(search_prompt)
-        print(f"[OK] Translated search: {english_search}")
+        logger.debug("Translated search: %s", english_search)
 
-        print(f"[INFO] Translating recolor prompt: {recolor_prompt}")
+        logger.debug("Translating recolor prompt: %s", recolor_prompt)
         english_recolor = translate_to_english(recolor_prompt)
-        print(f"[OK] Translated recolor: {english_recolor}")
+        logger.debug("Translated recolor: %s", english_recolor)
 
-        api_url = "https://api.stability.ai/v2beta/stable-image/edit/search-and-recolor"
+        api_url = f"{STABILITY_API_BASE}/v2beta/stable-image/edit/search-and-recolor"
 
         headers = {
             "authorization": f"Bearer {STABILITY_API_KEY}",
@@ -445,24 +448,24 @@ def search_and_recolor(image_input, search_prompt, recolor_prompt):
             "output_format": "png"
         }
 
-        print(f"[INFO] Search and recolor: '{english_search}' -> '{english_recolor}'...")
+        logger.info("Search and recolor: '%s' -> '%s'...", english_search, english_recolor)
 
-        response = requests.post(api_url, headers=headers, files=files, data=data)
+        response = get_session(STABILITY).post(api_url, headers=headers, files=files, data=data, timeout=120)
 
         if response.status_code == 200:
             result = BytesIO(response.content)
             result.seek(0)
-            print("[INFO] Search and recolor successful")
+            logger.info("Search and recolor successful")
             return result
         else:
             error_msg = f"Search and recolor error: {response.status_code}"
-            print(f"[ERROR] {error_msg}")
-            print(f"[ERROR] Response: {response.text}")
+            logger.error(error_msg)
+            logger.error("Response: %.500s", response.text)
             return f"❌ Ошибка перекраски: {response.status_code}"
 
     except Exception as e:
         error_msg = f"Search and recolor exception: {str(e)}"
-        print(f"[ERROR] {error_msg}")
+        logger.error(error_msg)
         return f"❌ Ошибка: {str(e)}"
 
 
@@ -488,15 +491,15 @@ def search_and_replace(image_input, search_prompt, replace_prompt):
             image_bytes = image_input.read()
 
         # Переводим промпты на английский
-        print(f"[INFO] Translating search prompt: {search_prompt}")
+        logger.debug("Translating search prompt: %s", search_prompt)
         english_search = translate_to_english(search_prompt)
-        print(f"[OK] Translated search: {english_search}")
+        logger.debug("Translated search: %s", english_search)
 
-        print(f"[INFO] Translating replace prompt: {replace_prompt}")
+        logger.debug("Translating replace prompt: %s", replace_prompt)
         english_replace = translate_to_english(replace_prompt)
-        print(f"[OK] Translated replace: {english_replace}")
+        logger.debug("Translated replace: %s", english_replace)
 
-        api_url = "https://api.stability.ai/v2beta/stable-image/edit/search-and-replace"
+        api_url = f"{STABILITY_API_BASE}/v2beta/stable-image/edit/search-and-replace"
 
         headers = {
             "authorization": f"Bearer {STABILITY_API_KEY}",
@@ -513,24 +516,24 @@ def search_and_replace(image_input, search_prompt, replace_prompt):
             "output_format": "png"
         }
 
-        print(f"[INFO] Search and replace: '{english_search}' -> '{english_replace}'...")
+        logger.info("Search and replace: '%s' -> '%s'...", english_search, english_replace)
 
-        response = requests.post(api_url, headers=headers, files=files, data=data)
+        response = get_session(STABILITY).post(api_url, headers=headers, files=files, data=data, timeout=120)
 
         if response.status_code == 200:
             result = BytesIO(response.content)
             result.seek(0)
-            print("[INFO] Search and replace successful")
+            logger.info("Search and replace successful")
             return result
         else:
             error_msg = f"Search and replace error: {response.status_code}"
-            print(f"[ERROR] {error_msg}")
-            print(f"[ERROR] Response: {response.text}")
+            logger.error(error_msg)
+            logger.error("Response: %.500s", response.text)
             return f"❌ Ошибка замены: {response.status_code}"
 
     except Exception as e:
         error_msg = f"Search and replace exception: {str(e)}"
-        print(f"[ERROR] {error_msg}")
+        logger.error(error_msg)
         return f"❌ Ошибка: {str(e)}"
 
 
@@ -555,11 +558,11 @@ def erase_object(image_input, search_prompt):
             image_bytes = image_input.read()
 
         # Переводим промпт на английский
-        print(f"[INFO] Translating erase prompt: {search_prompt}")
+        logger.debug("Translating erase prompt: %s", search_prompt)
         english_search = translate_to_english(search_prompt)
-        print(f"[OK] Translated prompt: {english_search}")
+        logger.debug("Translated prompt: %s", english_search)
 
-        api_url = "https://api.stability.ai/v2beta/stable-image/edit/erase"
+        api_url = f"{STABILITY_API_BASE}/v2beta/stable-image/edit/erase"
 
         headers = {
             "authorization": f"Bearer {STABILITY_API_KEY}",
@@ -575,22 +578,22 @@ def erase_object(image_input, search_prompt):
             "output_format": "png"
         }
 
-        print(f"[INFO] Erasing object: '{english_search}'...")
+        logger.info("Erasing object: '%s'...", english_search)
 
-        response = requests.post(api_url, headers=headers, files=files, data=data)
+        response = get_session(STABILITY).post(api_url, headers=headers, files=files, data=data, timeout=120)
 
         if response.status_code == 200:
             result = BytesIO(response.content)
             result.seek(0)
-            print("[INFO] Erase successful")
+            logger.info("Erase successful")
             return result
         else:
             error_msg = f"Erase error: {response.status_code}"
-            print(f"[ERROR] {error_msg}")
-            print(f"[ERROR] Response: {response.text}")
+            logger.error(error_msg)
+            logger.error("Response: %.500s", response.text)
             return f"❌ Ошибка удаления: {response.status_code}"
 
     except Exception as e:
         error_msg = f"Erase exception: {str(e)}"
-        print(f"[ERROR] {error_msg}")
+        logger.error(error_msg)
         return f"❌ Ошибка: {str(e)}"
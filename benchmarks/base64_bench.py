@@ -0,0 +1,75 @@
+"""
+Бенчмарк разбора ответа Imagen: json.loads + base64.b64decode против image_buffer.loads_with_images
+
+Запуск из корня проекта:
+    python benchmarks/base64_bench.py [--iterations 20]
+
+Для ответов с 1 и 4 изображениями выводится среднее время разбора (мс)
+и пик выделенной памяти (tracemalloc).
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_buffer import loads_with_images
+
+IMAGE_SIZE = 2 * 1024 * 1024  # Примерный размер PNG 1024x1024
+
+
+def legacy_parse(body):
+    """Прежний разбор: весь ответ в строки Python, затем b64decode и BytesIO"""
+    data = json.loads(body)
+    return [BytesIO(base64.b64decode(p["bytesBase64Encoded"])) for p in data["predictions"]]
+
+
+def new_parse(body):
+    data = loads_with_images(body)
+    return [p["bytesBase64Encoded"] for p in data["predictions"]]
+
+
+def make_body(count):
+    predictions = [
+        {"mimeType": "image/png", "bytesBase64Encoded": base64.b64encode(os.urandom(IMAGE_SIZE)).decode()}
+        for _ in range(count)
+    ]
+    return json.dumps({"predictions": predictions}).encode()
+
+
+def measure(func, body, iterations):
+    func(body)  # Прогрев
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(body)
+    elapsed = (time.perf_counter() - start) / iterations * 1000
+
+    tracemalloc.start()
+    func(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'images':>6} | {'variant':<8} | {'ms/response':>11} | {'peak MB':>8}")
+    print('-' * 44)
+    for count in (1, 4):
+        body = make_body(count)
+        for name, func in (('legacy', legacy_parse), ('new', new_parse)):
+            ms, peak = measure(func, body, args.iterations)
+            print(f"{count:>6} | {name:<8} | {ms:>11.1f} | {peak / 1024 / 1024:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
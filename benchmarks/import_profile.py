@@ -0,0 +1,85 @@
+"""
+Профиль времени импорта модулей бота (python -X importtime)
+
+Запуск из корня проекта:
+    python benchmarks/import_profile.py [--module bot] [--top 25]
+
+Импортирует модуль в отдельном процессе с -X importtime и выводит общее
+время импорта, а также самые медленные модули по суммарному времени (вместе
+с зависимостями) и по собственному времени. Тяжёлые библиотеки (openai,
+google.cloud, gspread, PIL, bs4) не должны попадать в список: они
+загружаются при первом использовании.
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# import time: self [us] | cumulative | imported package
+LINE_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+HEAVY = ("openai", "google.cloud", "gspread", "oauth2client", "PIL", "bs4")
+
+
+def profile(module: str):
+    """Возвращает (код возврата, время процесса в секундах, [(модуль, self_us, cumulative_us, вложенность)])"""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True,
+    )
+    elapsed = time.perf_counter() - start
+
+    entries = []
+    for line in result.stderr.splitlines():
+        match = LINE_RE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            entries.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    if result.returncode != 0:
+        errors = [line for line in result.stderr.splitlines() if not line.startswith("import time:")]
+        print("\n".join(errors[-10:]), file=sys.stderr)
+    return result.returncode, elapsed, entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='bot')
+    parser.add_argument('--top', type=int, default=25)
+    args = parser.parse_args()
+
+    code, elapsed, entries = profile(args.module)
+    if not entries:
+        print("No -X importtime output")
+        sys.exit(1)
+
+    total = sum(cumulative for _, _, cumulative, depth in entries if depth == 0)
+    print(f"import {args.module}: {total / 1e6:.3f}s imports, {elapsed:.3f}s process, {len(entries)} modules")
+    if code != 0:
+        print(f"(import failed with exit code {code}: timings cover modules loaded before the error)")
+
+    print(f"\nTop {args.top} by cumulative time:")
+    for name, self_us, cumulative_us, _ in sorted(entries, key=lambda e: e[2], reverse=True)[:args.top]:
+        print(f"  {cumulative_us / 1000:9.1f} ms  {name}")
+
+    print(f"\nTop {args.top} by self time:")
+    for name, self_us, cumulative_us, _ in sorted(entries, key=lambda e: e[1], reverse=True)[:args.top]:
+        print(f"  {self_us / 1000:9.1f} ms  {name}")
+
+    loaded = sorted({
+        name for name, _, _, _ in entries
+        if any(name == heavy or name.startswith(heavy + ".") for heavy in HEAVY)
+    })
+    if loaded:
+        print("\nHeavy libraries loaded at import (should be lazy):")
+        for name in loaded:
+            print(f"  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,442 @@
+"""
+Нагрузочный бенчмарк бота с локальными заглушками провайдеров
+
+Запускает настоящие обработчики (bot.callbacks -> очередь задач -> helper)
+против локального HTTP-сервера, который изображает Stability, Google
+generativelanguage, OpenAI и Telegram Bot API с заданными задержками и долей
+ошибок. Ключи API и кредиты не нужны: базовые адреса подменяются через
+STABILITY_API_BASE, GOOGLE_AI_API_BASE, OPENAI_BASE_URL и TELEGRAM_API_BASE.
+
+Запуск из корня проекта:
+    python benchmarks/load_bench.py --scenario sd --requests 200 --concurrency 32
+    python benchmarks/load_bench.py --scenario imagen,nbp,upscale \\
+        --latency stability=800:0.3,google=600:0.2 --errors google=0.05
+
+Сценарии (callback_data, на которую "нажимает" виртуальный пользователь):
+    sd       - "generate" (Stability SD 3.5 через очередь)
+    imagen   - "imgfmt_1:1" (Imagen 4 через очередь)
+    nbp      - "imgfmt_1:1" (Nano Banana Pro через очередь)
+    upscale  - "edit_upscale" (редактирование загруженного фото)
+
+Задержка заглушки: "сервис=медиана_мс[:sigma]" (логнормальное распределение),
+доля ошибок: "сервис=доля" (ответ 503). Сервисы: stability, google, openai, telegram.
+
+Выводятся p50/p95/p99 задержки от нажатия кнопки до завершения обработки
+(включая ожидание в очереди), генераций в секунду и число запросов к заглушкам.
+Остальные настройки бота (JOB_WORKERS, JOB_PROVIDER_LIMITS, PROVIDER_RATE_LIMITS
+и т.д.) берутся из окружения, как при обычном запуске.
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import itertools
+import json
+import math
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SERVICES = ("stability", "google", "openai", "telegram")
+DEFAULT_LATENCY = "stability=1500:0.3,google=1200:0.3,openai=400:0.3,telegram=30:0.2"
+
+# Сценарий -> (callback_data, задача идёт через очередь генераций)
+SCENARIOS = {
+    "sd": ("generate", True),
+    "imagen": ("imgfmt_1:1", True),
+    "nbp": ("imgfmt_1:1", True),
+    "upscale": ("edit_upscale", False),
+}
+
+
+def parse_map(value: str, cast=float):
+    """ "stability=800:0.3,google=600" -> {"stability": "800:0.3", ...} с приведением типа"""
+    result = {}
+    for item in value.split(","):
+        if "=" in item:
+            key, val = item.split("=", 1)
+            result[key.strip()] = cast(val.strip())
+    return result
+
+
+def parse_latency(value: str) -> dict:
+    def cast(val):
+        median, _, sigma = val.partition(":")
+        return float(median), float(sigma or 0)
+    return parse_map(value, cast)
+
+
+def make_image() -> bytes:
+    """PNG 1024x1024, который заглушки отдают как результат генерации"""
+    from PIL import Image
+
+    image = Image.linear_gradient("L").resize((1024, 1024)).convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+
+# ===== Заглушки провайдеров =====
+
+class StandInServer(ThreadingHTTPServer):
+    """HTTP-сервер, изображающий все внешние API бота"""
+
+    daemon_threads = True
+
+    def __init__(self, latency: dict, errors: dict, image: bytes):
+        super().__init__(("127.0.0.1", 0), _StandInHandler)
+        self.latency = latency
+        self.errors = errors
+        self.image = image
+        self.image_b64 = base64.b64encode(image).decode("ascii")
+        self.counts = Counter()
+        self.ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def record(self, key: str):
+        with self._lock:
+            self.counts[key] += 1
+
+    def next_id(self) -> int:
+        with self._lock:
+            return next(self.ids)
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive для пулов соединений клиентов
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _service(self) -> str:
+        if self.path.startswith("/v2beta/"):
+            return "stability"
+        if self.path.startswith("/v1beta/"):
+            return "google"
+        if self.path.startswith("/v1/"):
+            return "openai"
+        return "telegram"
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        service = self._service()
+        server = self.server
+        server.record(service)
+
+        median, sigma = server.latency.get(service, (0, 0))
+        if median > 0:
+            time.sleep(random.lognormvariate(math.log(median), sigma) / 1000)
+
+        if random.random() < server.errors.get(service, 0):
+            server.record(f"{service}_errors")
+            if service == "telegram":
+                return self._json({"ok": False, "error_code": 502, "description": "Bad Gateway"}, 502)
+            return self._json({"error": {"code": 503, "message": "stand-in overloaded"}}, 503)
+
+        getattr(self, f"_{service}")(body)
+
+    def _send(self, payload: bytes, content_type: str, status: int = 200, headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _json(self, data, status: int = 200):
+        self._send(json.dumps(data).encode(), "application/json", status)
+
+    # --- Stability ---
+
+    def _stability(self, body):
+        if "application/json" in (self.headers.get("Accept") or ""):
+            return self._json({"image": self.server.image_b64, "finish_reason": "SUCCESS", "seed": 0})
+        self._send(self.server.image, "image/png", headers={"finish-reason": "SUCCESS", "seed": "0"})
+
+    # --- Google generativelanguage ---
+
+    def _google(self, body):
+        if self.path.split("?")[0].endswith(":predict"):
+            try:
+                count = json.loads(body).get("parameters", {}).get("sampleCount", 1)
+            except ValueError:
+                count = 1
+            prediction = {"mimeType": "image/png", "bytesBase64Encoded": self.server.image_b64}
+            return self._json({"predictions": [prediction] * count})
+
+        # generateContent: текст (Gemini Vision) и изображение (Nano Banana Pro)
+        parts = [
+            {"text": "A cinematic photo of a cat floating in space, high detail"},
+            {"inlineData": {"mimeType": "image/png", "data": self.server.image_b64}},
+        ]
+        self._json({"candidates": [{"content": {"role": "model", "parts": parts}, "finishReason": "STOP"}]})
+
+    # --- OpenAI ---
+
+    def _openai(self, body):
+        if "/images/" in self.path:
+            return self._json({"created": int(time.time()), "data": [{"b64_json": self.server.image_b64}]})
+        self._json({
+            "id": f"chatcmpl-bench{self.server.next_id()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "gpt-4o",
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "A cat floating in space, cinematic lighting"},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20},
+        })
+
+    # --- Telegram Bot API ---
+
+    def _message(self, **extra) -> dict:
+        return {
+            "message_id": self.server.next_id(),
+            "date": int(time.time()),
+            "chat": {"id": 1, "type": "private"},
+            **extra,
+        }
+
+    def _photo_message(self) -> dict:
+        n = self.server.next_id()
+        return self._message(photo=[{"file_id": f"bench-{n}", "file_unique_id": f"u{n}", "width": 1024, "height": 1024}])
+
+    def _telegram(self, body):
+        method = self.path.split("?")[0].rsplit("/", 1)[-1]
+        self.server.record(f"telegram.{method}")
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+                      "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": True}
+        elif method == "sendPhoto":
+            result = self._photo_message()
+        elif method == "sendMediaGroup":
+            count = max(1, len(re.findall(rb'"type":\s*"photo"', body)))
+            result = [self._photo_message() for _ in range(count)]
+        elif method in ("sendMessage", "editMessageText", "editMessageCaption", "editMessageReplyMarkup"):
+            result = self._message(text="ok")
+        else:
+            result = True  # answerCallbackQuery, deleteMessage, sendChatAction, ...
+        self._json({"ok": True, "result": result})
+
+
+# ===== Виртуальные пользователи =====
+
+def _callback_update(uid: int, data: str, n: int) -> dict:
+    user = {"id": uid, "is_bot": False, "first_name": "Bench", "username": f"bench{uid}"}
+    return {
+        "update_id": n,
+        "callback_query": {
+            "id": str(n),
+            "from": user,
+            "chat_instance": str(uid),
+            "data": data,
+            "message": {
+                "message_id": n,
+                "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Bench"},
+                "text": "bench",
+            },
+        },
+    }
+
+
+def _prepare_state(session: dict, scenario: str, n: int, image: bytes):
+    """Параметры сессии, которые пользователь выбрал бы перед нажатием кнопки"""
+    from image_buffer import ImageBuffer
+
+    session.update({
+        "prompt": f"кот в космосе, вариант {n}",  # Разные промпты - кеш перевода не срабатывает
+        "gpt_model": "gpt-4o",
+        "images": [],
+        "negative_prompt": "",
+    })
+    if scenario == "sd":
+        session.update({"model": "sd3.5-large", "format": "1:1", "style": "none", "additional_params": {}})
+    elif scenario == "imagen":
+        session.update({"engine": "imagen", "imagen_model": "imagen-4-fast", "imagen_format": "1:1"})
+    elif scenario == "nbp":
+        session.update({"engine": "nano_banana_pro", "imagen_format": "1:1", "nbp_reference_images": []})
+    elif scenario == "upscale":
+        session["edit_image"] = ImageBuffer(image)
+
+
+async def run_scenario(app, scenario: str, total: int, concurrency: int, image: bytes, update_ids):
+    import bot
+    from jobs import generation_queue
+    from state import user_state
+    from telegram import Update
+    from telegram.ext import CallbackContext
+    from user_limits import add_generations
+
+    data, queued = SCENARIOS[scenario]
+    latencies = []
+    errors = Counter()
+    counter = itertools.count()
+
+    async def virtual_user(uid: int):
+        add_generations(uid, total * 10)
+        while True:
+            n = next(counter)
+            if n >= total:
+                return
+            _prepare_state(user_state[uid], scenario, n, image)
+            update = Update.de_json(_callback_update(uid, data, next(update_ids)), app.bot)
+            context = CallbackContext(app, chat_id=uid, user_id=uid)
+
+            start = time.perf_counter()
+            try:
+                await bot.callbacks(update, context)
+                # Задача из очереди завершается позже обработчика callback
+                while queued and generation_queue.user_jobs(uid):
+                    await asyncio.sleep(0.005)
+            except Exception as e:
+                errors[type(e).__name__] += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    base_uid = 10_000_000 + 100_000 * list(SCENARIOS).index(scenario)
+    started = time.perf_counter()
+    await asyncio.gather(*(virtual_user(base_uid + i) for i in range(concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def percentile(values, pct: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+async def main_async(args, server: StandInServer, image: bytes):
+    from telegram.ext import ApplicationBuilder
+    from jobs import generation_queue
+    import providers
+
+    base = server.base_url
+    app = (
+        ApplicationBuilder()
+        .token(os.environ["TELEGRAM_BOT_TOKEN"])
+        .base_url(f"{base}/bot")
+        .base_file_url(f"{base}/file/bot")
+        .build()
+    )
+    await app.initialize()
+    generation_queue.start()
+
+    update_ids = itertools.count(1)
+    results = []
+    try:
+        for scenario in args.scenario:
+            before = Counter(server.counts)
+            latencies, errors, elapsed = await run_scenario(
+                app, scenario, args.requests, args.concurrency, image, update_ids
+            )
+            calls = Counter(server.counts)
+            calls.subtract(before)
+            results.append((scenario, latencies, errors, elapsed, +calls))
+    finally:
+        await generation_queue.stop()
+        await app.shutdown()
+        providers.shutdown()
+
+    print(f"\nconcurrency={args.concurrency}, requests per scenario={args.requests}")
+    print(f"{'scenario':<9} | {'done':>5} | {'errors':>6} | {'p50 ms':>8} | {'p95 ms':>8} | {'p99 ms':>8} | {'gen/s':>7} | {'photos':>6}")
+    print("-" * 82)
+    for scenario, latencies, errors, elapsed, calls in results:
+        photos = calls["telegram.sendPhoto"] + calls["telegram.sendMediaGroup"]
+        print(
+            f"{scenario:<9} | {len(latencies):>5} | {sum(errors.values()):>6} | "
+            f"{percentile(latencies, 50) * 1000:>8.0f} | {percentile(latencies, 95) * 1000:>8.0f} | "
+            f"{percentile(latencies, 99) * 1000:>8.0f} | {len(latencies) / elapsed:>7.2f} | {photos:>6}"
+        )
+
+    print("\nStand-in requests:")
+    for scenario, _, errors, _, calls in results:
+        services = ", ".join(f"{name}={calls[name]}" for name in SERVICES if calls[name])
+        failed = ", ".join(f"{name}={calls[f'{name}_errors']}" for name in SERVICES if calls[f"{name}_errors"])
+        print(f"  {scenario}: {services}" + (f" | injected errors: {failed}" if failed else ""))
+        if errors:
+            print(f"  {scenario} handler exceptions: {dict(errors)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", default="sd,imagen,nbp,upscale",
+                        type=lambda value: [item.strip() for item in value.split(",") if item.strip()])
+    parser.add_argument("--requests", type=int, default=100, help="Запросов на сценарий")
+    parser.add_argument("--concurrency", type=int, default=16, help="Одновременных пользователей")
+    parser.add_argument("--latency", default=DEFAULT_LATENCY, help="Задержка заглушек: сервис=медиана_мс[:sigma]")
+    parser.add_argument("--errors", default="", help="Доля ошибок заглушек: сервис=доля")
+    parser.add_argument("--seed", type=int, default=None, help="Seed генератора задержек и ошибок")
+    parser.add_argument("--verbose", action="store_true", help="Показывать вывод бота")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.scenario if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(unknown)} (available: {', '.join(SCENARIOS)})")
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    image = make_image()
+    server = StandInServer(parse_latency(args.latency), parse_map(args.errors), image)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Окружение задаётся до импорта модулей бота: settings читает его при импорте
+    workdir = tempfile.mkdtemp(prefix="load_bench_")
+    base = server.base_url
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": "123456:bench",
+        "STABILITY_API_KEY": "bench",
+        "GOOGLE_AI_API_KEY": "bench",
+        "OPENAI_API_KEY": "bench",
+        "STABILITY_API_BASE": base,
+        "GOOGLE_AI_API_BASE": base,
+        "OPENAI_BASE_URL": f"{base}/v1",
+        "TELEGRAM_API_BASE": base,
+        "USE_GCS": "false",
+        "GSHEETS_LOGGING": "false",
+        "RESULT_CACHE": "false",
+        "DB_PATH": os.path.join(workdir, "bench.db"),
+        "SESSION_CACHE_DIR": os.path.join(workdir, "session_cache"),
+        "TG_FILE_CACHE_DIR": os.path.join(workdir, "tg_file_cache"),
+    })
+    # Без явной настройки ограничитель запросов не мешает измерять сам бот
+    os.environ.setdefault("PROVIDER_RATE_LIMITS", "")
+    # Лог бота (log.py) без --verbose - только ошибки
+    os.environ.setdefault("LOG_LEVEL", "DEBUG" if args.verbose else "ERROR")
+
+    print(f"Stand-ins on {base}, data in {workdir}")
+    try:
+        asyncio.run(main_async(args, server, image))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Бенчмарк наложения watermark: прежняя реализация против watermark.add_watermark
+
+Запуск из корня проекта:
+    python benchmarks/watermark_bench.py [--iterations 20]
+
+Для каждого размера изображения выводится среднее время на изображение (мс)
+и размер результата для прежней реализации (PNG) и новой (JPEG, WEBP, PNG).
+"""
+
+import argparse
+import os
+import sys
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+import watermark
+
+SIZES = [(1024, 1024), (1536, 1024), (2048, 2048)]
+
+
+def legacy_add_watermark(image_bytes, watermark_path=watermark.WATERMARK_PATH, offset=watermark.WATERMARK_OFFSET):
+    """Прежняя реализация (без логирования): watermark готовится заново для каждого изображения"""
+    image_bytes.seek(0)
+    base_image = Image.open(image_bytes)
+    if base_image.mode != 'RGBA':
+        base_image = base_image.convert('RGBA')
+
+    wm = Image.open(watermark_path)
+    if wm.mode != 'RGBA':
+        wm = wm.convert('RGBA')
+    wm = wm.resize((int(wm.width * 0.8), int(wm.height * 0.8)), Image.Resampling.LANCZOS)
+
+    new_data = []
+    for r, g, b, a in wm.getdata():
+        new_data.append((r, g, b, int(255 * 0.7) if a > 0 else 0))
+    wm.putdata(new_data)
+
+    position = (base_image.width - wm.width - offset, base_image.height - wm.height - offset)
+    transparent = Image.new('RGBA', base_image.size, (0, 0, 0, 0))
+    transparent.paste(wm, position, wm)
+    watermarked = Image.alpha_composite(base_image, transparent).convert('RGB')
+
+    output = BytesIO()
+    watermarked.save(output, format='PNG', quality=95)
+    output.seek(0)
+    return output
+
+
+def make_image(size):
+    """Тестовое изображение с шумом (близко к реальной генерации по сжимаемости)"""
+    image = Image.frombytes('RGB', size, os.urandom(size[0] * size[1] * 3))
+    buffer = BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer
+
+
+def measure(func, source, iterations):
+    result = func(source)  # Прогрев (в том числе кеш watermark)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        result = func(source)
+    elapsed = (time.perf_counter() - start) / iterations * 1000
+    return elapsed, result.getbuffer().nbytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    variants = [
+        ('legacy PNG', legacy_add_watermark),
+        ('new JPEG', lambda src: watermark.add_watermark(src, output_format='JPEG')),
+        ('new WEBP', lambda src: watermark.add_watermark(src, output_format='WEBP')),
+        ('new PNG', lambda src: watermark.add_watermark(src, output_format='PNG')),
+    ]
+
+    print(f"{'size':>11} | {'variant':<10} | {'ms/image':>9} | {'bytes':>10}")
+    print('-' * 50)
+    for size in SIZES:
+        source = make_image(size)
+        for name, func in variants:
+            ms, nbytes = measure(func, source, args.iterations)
+            print(f"{size[0]:>5}x{size[1]:<5} | {name:<10} | {ms:>9.1f} | {nbytes:>10}")
+
+
+if __name__ == '__main__':
+    main()
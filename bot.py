@@ -1,10 +1,21 @@
+import time
+
+# Отсчёт времени старта - до импорта модулей бота (см. post_init)
+STARTED_AT = time.monotonic()
+
+import asyncio
+import random
 import sys
 import os
 import fcntl
 import atexit
+import log
+
+logger = log.get_logger("bot")  # Не __name__: при запуске скрипта это "__main__"
 
 # ===== ЗАЩИТА ОТ ЗАПУСКА НЕСКОЛЬКИХ КОПИЙ =====
 LOCK_FILE = "/tmp/imagegen_bot.lock"
+lock_file_handle = None
 
 def acquire_lock():
     """Получает блокировку для предотвращения запуска нескольких копий бота"""
@@ -14,16 +25,16 @@ def acquire_lock():
         fcntl.flock(lock_file_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
         lock_file_handle.write(str(os.getpid()))
         lock_file_handle.flush()
-        print(f"[LOCK] Bot lock acquired, PID: {os.getpid()}")
+        logger.info("Bot lock acquired, PID: %s", os.getpid())
         return True
     except IOError:
         # Читаем PID запущенного процесса
         try:
             with open(LOCK_FILE, 'r') as f:
                 existing_pid = f.read().strip()
-            print(f"[LOCK ERROR] Bot is already running! PID: {existing_pid}")
+            logger.error("Bot is already running! PID: %s", existing_pid)
         except:
-            print("[LOCK ERROR] Bot is already running!")
+            logger.error("Bot is already running!")
         return False
 
 def release_lock():
@@ -35,29 +46,31 @@ def release_lock():
             lock_file_handle.close()
         if os.path.exists(LOCK_FILE):
             os.remove(LOCK_FILE)
-        print("[LOCK] Bot lock released")
+        logger.info("Bot lock released")
     except:
         pass
 
-# Проверяем блокировку при старте
-if not acquire_lock():
-    print("Exiting: another instance is running")
-    sys.exit(1)
-
-# Регистрируем освобождение блокировки при выходе
-atexit.register(release_lock)
+# Блокировка захватывается в main() только в режиме polling: в режиме
+# webhook работает несколько процессов-воркеров одновременно
 # ===== КОНЕЦ ЗАЩИТЫ =====
 
-from telegram.ext import ApplicationBuilder, MessageHandler, CommandHandler, CallbackQueryHandler, InlineQueryHandler, PreCheckoutQueryHandler, filters
-from telegram import BotCommand, BotCommandScopeDefault, BotCommandScopeChat, InlineQueryResultArticle, InputTextMessageContent, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+from telegram.ext import ApplicationBuilder, TypeHandler, MessageHandler, CommandHandler, CallbackQueryHandler, InlineQueryHandler, PreCheckoutQueryHandler, filters
+from telegram import Update, BotCommand, BotCommandScopeDefault, BotCommandScopeChat, InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
 from io import BytesIO
 from state import user_state
 from utils import extract_text_from_url
-from keyboards import gpt_model_kb, image_engine_kb, dalle_model_kb, dalle_size_kb, dalle_quality_kb, model_kb, format_kb, style_kb, confirm_kb, actions_kb, summary_kb, negative_prompt_kb, presets_main_kb, presets_list_kb, preset_actions_kb, packages_kb, payment_method_kb, edit_actions_kb, skip_kb, aspect_ratio_kb, fidelity_kb, style_guide_regenerate_kb, shot_kb, angle_kb, lighting_kb, additional_settings_kb, imagen_format_kb, imagen_model_kb, subject_type_kb, reference_upload_kb, nbp_upload_kb
+from keyboards import gpt_model_kb, image_engine_kb, dalle_model_kb, dalle_size_kb, dalle_quality_kb, model_kb, format_kb, style_kb, confirm_kb, actions_kb, summary_kb, negative_prompt_kb, presets_main_kb, presets_list_kb, preset_actions_kb, packages_kb, payment_method_kb, edit_actions_kb, skip_kb, aspect_ratio_kb, fidelity_kb, style_guide_regenerate_kb, shot_kb, angle_kb, lighting_kb, additional_settings_kb, imagen_format_kb, imagen_model_kb, subject_type_kb, reference_upload_kb, nbp_upload_kb, plural_ru
 from dream_api import generate_dream
 from dalle_api import generate_with_dalle
 from dalle_gen_helper import generate_dalle_image
+from dream_gen_helper import generate_dream_image
+from jobs import generation_queue, enqueue_generation
 from imagen_api import generate_with_imagen
+from engine_router import send_variants
+import reference_images
+import telegram_files
+import metrics
+import result_cache
 from imagen_gen_helper import generate_imagen_image
 from imagen3_custom_helper import generate_imagen3_custom_image
 from nano_banana_pro_helper import generate_nano_banana_pro_image
@@ -67,29 +80,32 @@ from style_transfer import apply_style_transfer  # Legacy Stability AI
 from style_guide import generate_with_style_guide  # Legacy Stability AI
 from style_transfer_imagen import apply_style_transfer_imagen, generate_with_style_guide_imagen
 from sketch import generate_from_sketch
-from user_limits import can_generate, use_generation, get_user_stats, get_all_users, add_generations, register_referral, reward_referrer, get_referral_stats
-from image_library import add_to_history, get_user_history, get_favorites, toggle_favorite, search_history, get_history_stats, clear_history
+from user_limits import can_generate, use_generation, try_use_generation, refund_generation, get_user_stats, get_all_users, add_generations, register_referral, reward_referrer, get_referral_stats
+from image_library import add_to_history, get_user_history, get_generation, get_favorites, toggle_favorite, search_history, get_history_stats, clear_history
 from presets import create_preset, get_user_presets, get_preset, delete_preset
 from watermark import add_watermark
 from payments import get_all_packages_message, format_package_message, create_cryptobot_invoice, get_package_info, PACKAGES
 from ai_tools import upscale_image, remove_background, create_variations, inpaint_image, restore_face, outpaint_image, search_and_recolor, search_and_replace, erase_object
-from settings import TELEGRAM_BOT_TOKEN, WEBAPP_URL, USE_GCS
-from gcs_helper import upload_image as gcs_upload_image
+from settings import TELEGRAM_BOT_TOKEN, TELEGRAM_API_BASE, WEBAPP_URL, USE_GCS, CONCURRENT_UPDATES, BOT_MODE, VARIANTS_COUNT
 import gsheets_logger as gsl
 import gcs_helper as gcs
 import gcs_advanced as gcsa
+from callback_router import router
 from keyboards_addon import library_kb_extended, library_filters_kb, image_actions_kb, pagination_kb, export_options_kb, confirm_delete_kb
+from providers import run_blocking, get_session, STABILITY, GOOGLE, OPENAI, CRYPTOBOT, WEB
 
 # ID администратора
 ADMIN_ID = 65876198
 
+# Фоновые задачи старта (ссылки держатся, чтобы задачи не собрал GC)
+_background_tasks = set()
+
 async def upload_image_to_webapp(context, file_path_or_bytesio, user_id):
     """
     Загружает изображение на веб-сервер для Mini App
     Возвращает URL для открытия Mini App или None при ошибке
     Использует Google Cloud Storage если USE_GCS=True
     """
-    import requests
     import base64
     from requests.exceptions import ConnectionError, Timeout
 
@@ -104,23 +120,21 @@ async def upload_image_to_webapp(context, file_path_or_bytesio, user_id):
 
         # Если включен GCS - загружаем напрямую в Google Cloud Storage
         if USE_GCS:
-            print(f"[INFO] Uploading image to Google Cloud Storage...")
-
-            # Загружаем в GCS
-            gcs_image_url = gcs_upload_image(
-                image_bytes,
-                folder="inpaint",
-                filename=None,  # Автоматическая генерация имени
-                content_type="image/png"
-            )
+            logger.info("Uploading image to Google Cloud Storage...")
+
+            # Загружаем в GCS по содержимому: то же изображение из библиотеки
+            # или повторное открытие редактора не загружается заново
+            # Пока ссылка на изображение открыта в редакторе, blob не удаляется
+            content = gcs.upload_content(image_bytes, holder=f"editor:{user_id}", hold_seconds=gcs.EDITOR_HOLD_SECONDS)
+            gcs_image_url = gcs.get_public_url(content) if content else None
 
             if gcs_image_url:
                 # Формируем URL для Mini App с GCS изображением
                 webapp_url = f"{WEBAPP_URL}/static/inpaint_editor.html?v=20251203094000&image={gcs_image_url}&user_id={user_id}"
-                print(f"[OK] Image uploaded to GCS, webapp URL: {webapp_url}")
+                logger.info("Image uploaded to GCS, webapp URL: %s", webapp_url)
                 return webapp_url
             else:
-                print(f"[ERROR] Failed to upload image to GCS")
+                logger.error("Failed to upload image to GCS")
                 return None
 
         # Иначе используем старый метод через веб-сервер
@@ -128,10 +142,12 @@ async def upload_image_to_webapp(context, file_path_or_bytesio, user_id):
         image_b64 = base64.b64encode(image_bytes).decode('utf-8')
         image_data_url = f"data:image/png;base64,{image_b64}"
 
-        print(f"[INFO] Uploading image to webapp: {WEBAPP_URL}")
+        logger.info("Uploading image to webapp: %s", WEBAPP_URL)
 
         # Отправляем на веб-сервер
-        response = requests.post(
+        response = await run_blocking(
+            WEB,
+            get_session(WEB).post,
             f"{WEBAPP_URL}/upload_image",
             json={
                 'user_id': str(user_id),
@@ -147,25 +163,23 @@ async def upload_image_to_webapp(context, file_path_or_bytesio, user_id):
 
             # Формируем URL для Mini App
             webapp_url = f"{WEBAPP_URL}/static/inpaint_editor.html?v=20251203094000&image={image_url}&user_id={user_id}"
-            print(f"[OK] Image uploaded successfully, webapp URL: {webapp_url}")
+            logger.info("Image uploaded successfully, webapp URL: %s", webapp_url)
             return webapp_url
         else:
-            print(f"[ERROR] Failed to upload image to webapp: {response.status_code}")
-            print(f"[ERROR] Response: {response.text}")
+            logger.error("Failed to upload image to webapp: %s", response.status_code)
+            logger.error("Response: %.500s", response.text)
             return None
 
     except ConnectionError as e:
-        print(f"[ERROR] Cannot connect to webapp server at {WEBAPP_URL}")
-        print(f"[ERROR] Make sure webapp_server.py is running!")
-        print(f"[ERROR] Details: {e}")
+        logger.error("Cannot connect to webapp server at %s", WEBAPP_URL)
+        logger.error("Make sure webapp_server.py is running!")
+        logger.error("Details: %s", e)
         return None
     except Timeout as e:
-        print(f"[ERROR] Webapp server timeout: {e}")
+        logger.error("Webapp server timeout: %s", e)
         return None
     except Exception as e:
-        print(f"[ERROR] Exception uploading image to webapp: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Exception uploading image to webapp: %s", e)
         return None
 
 async def setup_commands(application):
@@ -176,6 +190,7 @@ async def setup_commands(application):
         BotCommand("start", "Начать работу с ботом"),
         BotCommand("new", "Создать новое изображение"),
         BotCommand("getprompt", "🔍 Получить промпт по фото"),
+        BotCommand("seed", "📌 Закрепить seed (повтор изображения)"),
         BotCommand("editmy", "Редактировать мое изображение"),
         BotCommand("styletransfer", "Перенос стиля между изображениями"),
         BotCommand("styleguide", "Генерация по стилю референса"),
@@ -370,6 +385,33 @@ async def getprompt_command(update, context):
         parse_mode="HTML"
     )
 
+async def seed_command(update, context):
+    """Команда /seed - закрепить seed для генераций Stable Diffusion (/seed 123, /seed off)"""
+    uid = update.effective_user.id
+    st = user_state[uid]
+    arg = context.args[0].lower() if context.args else ""
+
+    if arg in ("off", "выкл"):
+        st.pop("pinned_seed", None)
+        await update.message.reply_text("🎲 Seed откреплён: каждая генерация будет новой.")
+        return
+
+    if arg.isdigit() and int(arg) <= result_cache.MAX_SEED:
+        st["pinned_seed"] = int(arg)
+    elif not arg:
+        st["pinned_seed"] = st.get("pinned_seed", random.randint(0, result_cache.MAX_SEED))
+    else:
+        await update.message.reply_text(f"❌ Seed должен быть числом от 0 до {result_cache.MAX_SEED}")
+        return
+
+    await update.message.reply_text(
+        f"📌 Seed закреплён: <code>{st['pinned_seed']}</code>\n\n"
+        "С тем же промптом и параметрами Stable Diffusion повторит изображение "
+        "(повтор отдаётся из кеша мгновенно).\n"
+        "Открепить: /seed off",
+        parse_mode="HTML"
+    )
+
 async def profile_command(update, context):
     """Команда /profile - показать профиль пользователя"""
     uid = update.effective_user.id
@@ -518,8 +560,7 @@ async def library_command(update, context):
 
     # Получаем статистику избранного
     try:
-        fav_images = gcsa.get_user_images_filtered(uid, category='favorites', limit=1000)
-        fav_count = len(fav_images)
+        fav_count = gcsa.count_user_images(uid, category='favorites')
     except:
         fav_count = 0
 
@@ -548,80 +589,6 @@ async def library_command(update, context):
         reply_markup=library_kb_extended()
     )
 
-async def library_show_category(update, context, category=None):
-    """Показать изображения из категории"""
-    from telegram import InputMediaPhoto
-    import gcs_helper as gcs
-    
-    query = update.callback_query
-    await query.answer()
-    
-    uid = query.from_user.id
-    
-    # Определяем категорию
-    if query.data == 'lib_show_generated':
-        category = 'generated'
-        cat_name = 'Созданные'
-    elif query.data == 'lib_show_uploaded':
-        category = 'uploaded'
-        cat_name = 'Загруженные'
-    elif query.data == 'lib_show_edited':
-        category = 'edited'
-        cat_name = 'Отредактированные'
-    else:
-        category = None
-        cat_name = 'Все'
-    
-    # Получаем изображения
-    images = gcs.get_user_images(uid, category=category, limit=10)
-    
-    if not images:
-        await query.edit_message_text(
-            f'📁 <b>{cat_name}</b>\n\nВ этой категории пока нет изображений.',
-            parse_mode='HTML'
-        )
-        return
-    
-    # Формируем сообщение
-    msg = f'📁 <b>{cat_name}</b>\n\nНайдено изображений: {len(images)}\n\nОтправляю последние 10...'
-    await query.edit_message_text(msg, parse_mode='HTML')
-    
-    # Отправляем изображения (по 10 штук в media group)
-    media_group = []
-    for i, img in enumerate(images[:10]):
-        try:
-            media_group.append(InputMediaPhoto(media=img['url']))
-            
-            # Отправляем группами по 10
-            if len(media_group) == 10 or i == len(images) - 1:
-                await context.bot.send_media_group(
-                    chat_id=uid,
-                    media=media_group
-                )
-                media_group = []
-        except Exception as e:
-            print(f'[ERROR] Failed to send image: {e}')
-    
-    # Возвращаемся к главному меню библиотеки
-    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-    keyboard = [
-        [
-            InlineKeyboardButton('🎨 Созданные', callback_data='lib_show_generated'),
-            InlineKeyboardButton('📤 Загруженные', callback_data='lib_show_uploaded')
-        ],
-        [
-            InlineKeyboardButton('✏️ Отредактированные', callback_data='lib_show_edited'),
-            InlineKeyboardButton('📁 Все', callback_data='lib_show_all')
-        ]
-    ]
-    
-    await context.bot.send_message(
-        chat_id=uid,
-        text='✅ Изображения отправлены!\n\nВыберите другую категорию или вернитесь к главному меню.',
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode='HTML'
-    )
-
 async def presets_command(update, context):
     """Команда /presets - управление пресетами"""
     uid = update.effective_user.id
@@ -768,7 +735,7 @@ async def admin_add_command(update, context):
                 text=f"🎁 Админ дарит вам +{amount} бесплатных генераций!"
             )
         except Exception as e:
-            print(f"[WARNING] Could not send notification to user {target_user_id}: {e}")
+            logger.warning("Could not send notification to user %s: %s", target_user_id, e)
 
     except ValueError:
         await update.message.reply_text("❌ USER_ID и AMOUNT должны быть числами.")
@@ -845,7 +812,7 @@ async def handle_message(update, context):
         await update.message.reply_text("⏳ <b>Обработка изображения...</b>\n\nЭто может занять до минуты.", parse_mode="HTML")
 
         # Выполняем inpaint
-        result = inpaint_image(
+        result = await run_blocking(STABILITY, inpaint_image,
             user_state[uid]["edit_image"],
             user_state[uid]["inpaint_mask"],
             prompt
@@ -862,9 +829,9 @@ async def handle_message(update, context):
         if USE_GCS and result:
             try:
                 gcs.save_user_image(uid, result, category='edited')
-                print(f'[GCS] Edited image saved to library')
+                logger.info("Edited image saved to library")
             except Exception as e:
-                print(f'[ERROR] Failed to save edited image: {e}')
+                logger.error("Failed to save edited image: %s", e)
             await context.bot.send_photo(uid, watermarked)
             await context.bot.send_message(
                 uid,
@@ -902,19 +869,26 @@ async def handle_message(update, context):
     # Проверяем, используется ли Nano Banana Pro - обработка загрузки референсных фото
     if user_state.get(uid, {}).get("engine") == "nano_banana_pro" and update.message.photo:
         # Скачиваем фото
-        photo = update.message.photo[-1]  # Берём самое большое
-        file = await photo.get_file()
+        # Вариант размера не меньше того, что использует модель (из кеша, если фото уже скачивали)
+        photo_bytes = await telegram_files.download(update.message.photo, size=reference_images.max_side("nano_banana_pro"))
 
-        # Загружаем в BytesIO
-        photo_bytes = await file.download_as_bytearray()
-        photo_io = BytesIO(photo_bytes)
-        photo_io.seek(0)
+        # Уменьшаем до разрешения модели и кешируем base64 (reference_images.py)
+        photo_io = await asyncio.get_running_loop().run_in_executor(
+            None, reference_images.prepare, photo_bytes, "nano_banana_pro"
+        )
 
         # Добавляем в список референсов
         if "nbp_reference_images" not in user_state[uid]:
             user_state[uid]["nbp_reference_images"] = []
 
-        if len(user_state[uid]["nbp_reference_images"]) < 4:
+        if reference_images.is_duplicate(user_state[uid]["nbp_reference_images"], photo_io):
+            num_refs = len(user_state[uid]["nbp_reference_images"])
+            await update.message.reply_text(
+                f"⚠️ Это фото уже загружено ({num_refs}/4)\n\n"
+                f"📝 Загрузите другое фото или введите промпт для генерации",
+                reply_markup=nbp_upload_kb(num_refs)
+            )
+        elif len(user_state[uid]["nbp_reference_images"]) < 4:
             user_state[uid]["nbp_reference_images"].append(photo_io)
             num_refs = len(user_state[uid]["nbp_reference_images"])
 
@@ -936,18 +910,26 @@ async def handle_message(update, context):
     # Проверяем, используется ли Imagen 3 Custom - обработка загрузки референсных фото
     if user_state.get(uid, {}).get("engine") == "imagen3_custom" and update.message.photo:
         # Скачиваем фото
-        photo = update.message.photo[-1]  # Берём самое большое
-        file = await photo.get_file()
+        # Вариант размера не меньше того, что использует модель (из кеша, если фото уже скачивали)
+        photo_bytes = await telegram_files.download(update.message.photo, size=reference_images.max_side("imagen3_custom"))
 
-        # Загружаем в BytesIO
-        photo_bytes = await file.download_as_bytearray()
-        photo_io = BytesIO(photo_bytes)
-        photo_io.seek(0)
+        # Уменьшаем до разрешения модели и кешируем base64 (reference_images.py)
+        photo_io = await asyncio.get_running_loop().run_in_executor(
+            None, reference_images.prepare, photo_bytes, "imagen3_custom"
+        )
 
         # Добавляем в список референсов
         if "reference_images" not in user_state[uid]:
             user_state[uid]["reference_images"] = []
 
+        if reference_images.is_duplicate(user_state[uid]["reference_images"], photo_io):
+            await update.message.reply_text(
+                f"⚠️ Это фото уже загружено ({len(user_state[uid]['reference_images'])}/4)\n\n"
+                f"💬 Загрузите другое фото или введите промпт для генерации",
+                reply_markup=reference_upload_kb()
+            )
+            return
+
         user_state[uid]["reference_images"].append(photo_io)
 
         num_refs = len(user_state[uid]["reference_images"])
@@ -965,9 +947,7 @@ async def handle_message(update, context):
     # Проверяем режим /editmy
     if user_state.get(uid, {}).get("mode") == "editmy" and update.message.photo:
         # Загружаем фото
-        file = await update.message.photo[-1].get_file()
-        photo_bytes = await file.download_as_bytearray()
-        photo_io = BytesIO(photo_bytes)
+        photo_io = await telegram_files.download(update.message.photo)
         photo_io.seek(0)
 
         # Сохраняем изображение в состоянии
@@ -978,9 +958,9 @@ async def handle_message(update, context):
             try:
                 photo_io.seek(0)
                 gcs.save_user_image(uid, photo_io, category='uploaded')
-                print(f'[GCS] Uploaded image saved to library')
+                logger.info("Uploaded image saved to library")
             except Exception as e:
-                print(f'[ERROR] Failed to save uploaded image: {e}')
+                logger.error("Failed to save uploaded image: %s", e)
 
         user_state[uid]["mode"] = None
 
@@ -995,9 +975,7 @@ async def handle_message(update, context):
     # Обработка фото для команды /getprompt
     if user_state.get(uid, {}).get("mode") == "getprompt" and update.message.photo:
         # Скачиваем фото
-        file = await update.message.photo[-1].get_file()
-        photo_bytes = await file.download_as_bytearray()
-        photo_io = BytesIO(photo_bytes)
+        photo_io = await telegram_files.download(update.message.photo)
 
         # Сообщение о начале обработки
         msg = await update.message.reply_text(
@@ -1008,7 +986,7 @@ async def handle_message(update, context):
 
         try:
             # Анализируем изображение с помощью Gemini Vision
-            generated_prompt = analyze_image_for_prompt(photo_io)
+            generated_prompt = await run_blocking(GOOGLE, analyze_image_for_prompt, photo_io)
 
             # Отправляем результат
             await msg.edit_text(
@@ -1022,7 +1000,7 @@ async def handle_message(update, context):
 
         except Exception as e:
             error_msg = str(e)
-            print(f"[GetPrompt Error] {error_msg}")
+            logger.error(error_msg)
             await msg.edit_text(
                 f"❌ <b>Ошибка при анализе изображения:</b>\n\n"
                 f"{error_msg}\n\n"
@@ -1040,9 +1018,7 @@ async def handle_message(update, context):
 
         # Обработка загрузки init_image
         if st_state["step"] == "init_image" and update.message.photo:
-            file = await update.message.photo[-1].get_file()
-            photo_bytes = await file.download_as_bytearray()
-            st_state["init_image"] = BytesIO(photo_bytes)
+            st_state["init_image"] = await telegram_files.download(update.message.photo)
             st_state["step"] = "style_image"
             await update.message.reply_text(
                 "✅ Исходное изображение получено!\n\n"
@@ -1053,9 +1029,7 @@ async def handle_message(update, context):
 
         # Обработка загрузки style_image
         if st_state["step"] == "style_image" and update.message.photo:
-            file = await update.message.photo[-1].get_file()
-            photo_bytes = await file.download_as_bytearray()
-            st_state["style_image"] = BytesIO(photo_bytes)
+            st_state["style_image"] = await telegram_files.download(update.message.photo)
             st_state["step"] = "prompt"
             await update.message.reply_text(
                 "✅ Изображение стиля получено!\n\n"
@@ -1075,7 +1049,7 @@ async def handle_message(update, context):
             await update.message.reply_text("⏳ Применение стиля через Imagen...")
 
             try:
-                result = apply_style_transfer_imagen(
+                result = await run_blocking(GOOGLE, apply_style_transfer_imagen,
                     init_image=st_state["init_image"],
                     style_image=st_state["style_image"],
                     prompt=st_state.get("prompt", ""),
@@ -1095,7 +1069,7 @@ async def handle_message(update, context):
                     await update.message.reply_text("❌ Не удалось получить изображение")
 
             except Exception as e:
-                print(f"[Style Transfer Error] {e}")
+                logger.error(e)
                 await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
             # Очищаем состояние
@@ -1108,9 +1082,7 @@ async def handle_message(update, context):
 
         # Обработка загрузки style_image
         if sg_state["step"] == "style_image" and update.message.photo:
-            file = await update.message.photo[-1].get_file()
-            photo_bytes = await file.download_as_bytearray()
-            sg_state["style_image"] = BytesIO(photo_bytes)
+            sg_state["style_image"] = await telegram_files.download(update.message.photo)
             sg_state["step"] = "prompt"
             await update.message.reply_text(
                 "✅ Изображение стиля получено!\n\n"
@@ -1134,7 +1106,7 @@ async def handle_message(update, context):
             await update.message.reply_text("⏳ Генерация изображения в стиле референса через Imagen...")
 
             try:
-                result = generate_with_style_guide_imagen(
+                result = await run_blocking(GOOGLE, generate_with_style_guide_imagen,
                     style_image=sg_state["style_image"],
                     prompt=sg_state["prompt"],
                     aspect_ratio="1:1"
@@ -1165,7 +1137,7 @@ async def handle_message(update, context):
                     await update.message.reply_text("❌ Не удалось получить изображение")
 
             except Exception as e:
-                print(f"[Style Guide Error] {e}")
+                logger.error(e)
                 await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
             # Очищаем состояние
@@ -1178,9 +1150,8 @@ async def handle_message(update, context):
 
         # Обработка загрузки sketch_image
         if sk_state["step"] == "sketch_image" and update.message.photo:
-            file = await update.message.photo[-1].get_file()
-            downloaded_file = await file.download_to_drive()
-            sk_state["sketch_image"] = downloaded_file
+            # В памяти, а не во временном файле (download_to_drive оставлял файлы на диске)
+            sk_state["sketch_image"] = await telegram_files.download(update.message.photo)
             sk_state["step"] = "prompt"
             await update.message.reply_text(
                 "✅ Набросок получен!\n\n"
@@ -1233,8 +1204,8 @@ async def handle_message(update, context):
                     # Все параметры собраны, запускаем генерацию
                     await update.message.reply_text("⏳ Генерация изображения из наброска...")
 
-                    result = generate_from_sketch(
-                        image_path=sk_state["sketch_image"],
+                    result = await run_blocking(STABILITY, generate_from_sketch,
+                        image=sk_state["sketch_image"],
                         prompt=sk_state["prompt"],
                         negative_prompt=sk_state.get("negative_prompt", ""),
                         control_strength=sk_state.get("control_strength", 0.5)
@@ -1262,9 +1233,7 @@ async def handle_message(update, context):
     # Обработка загрузки маски для inpainting
     if update.message.photo and user_state[uid].get("waiting_for_inpaint_mask"):
         # Получаем файл маски
-        file = await update.message.photo[-1].get_file()
-        mask_bytes = await file.download_as_bytearray()
-        mask_io = BytesIO(mask_bytes)
+        mask_io = await telegram_files.download(update.message.photo)
 
         # Сохраняем маску
         user_state[uid]["inpaint_mask"] = mask_io
@@ -1293,7 +1262,7 @@ async def handle_message(update, context):
         await update.message.reply_text("⏳ <b>Inpainting...</b>\n\n🎨 Обрабатываем изображение...", parse_mode="HTML")
 
         # Выполняем inpainting
-        result = inpaint_image(st["last_image"], st["inpaint_mask"], prompt=inpaint_prompt)
+        result = await run_blocking(STABILITY, inpaint_image, st["last_image"], st["inpaint_mask"], prompt=inpaint_prompt)
 
         if isinstance(result, str):
             # Ошибка
@@ -1306,9 +1275,9 @@ async def handle_message(update, context):
         if USE_GCS and result:
             try:
                 gcs.save_user_image(uid, result, category='edited')
-                print(f'[GCS] Edited image saved to library')
+                logger.info("Edited image saved to library")
             except Exception as e:
-                print(f'[ERROR] Failed to save edited image: {e}')
+                logger.error("Failed to save edited image: %s", e)
             await context.bot.send_photo(uid, watermarked)
             await update.message.reply_text(
                 f"✅ <b>Inpainting завершен!</b>\n\n"
@@ -1358,25 +1327,32 @@ async def handle_message(update, context):
 
         # Переводим новый промпт и генерируем
         gpt_model = user_state[uid].get("gpt_model", "gpt-4o")
-        final_english_prompt = build_final_prompt(text, st["saved_params"], gpt_model)
+        with metrics.span("translate", engine="sd", model=gpt_model):
+            final_english_prompt = await run_blocking(OPENAI, build_final_prompt, text, st["saved_params"], gpt_model)
 
         await update.message.reply_text("⏳ Генерация изображения...")
 
         # Переводим negative prompt на английский если он есть
         english_negative = ""
         if st.get("negative_prompt"):
-            english_negative = translate_to_english(st["negative_prompt"], gpt_model)
+            with metrics.span("translate_negative", engine="sd", model=gpt_model):
+                english_negative = await run_blocking(OPENAI, translate_to_english, st["negative_prompt"], gpt_model)
 
         images = st["images"]
-        output = generate_dream(final_english_prompt, images, format_ratio=st["saved_params"]["format"], model=st["saved_params"]["model"], style=st["saved_params"].get("style"), negative_prompt=english_negative)
+        with metrics.span("provider", engine="sd", model=st["saved_params"]["model"]):
+            output = await run_blocking(STABILITY, generate_dream, final_english_prompt, images, format_ratio=st["saved_params"]["format"], model=st["saved_params"]["model"], style=st["saved_params"].get("style"), negative_prompt=english_negative)
 
         last_generated = None
+        last_file_id = None  # file_id отправленного изображения (история, индекс GCS)
         for item in output:
             try:
                 # Добавляем watermark
-                watermarked_image = add_watermark(item)
-                await context.bot.send_photo(uid, watermarked_image)
+                with metrics.span("watermark", engine="sd", model=st["saved_params"]["model"]):
+                    watermarked_image = add_watermark(item)
+                with metrics.span("telegram_upload", engine="sd", model=st["saved_params"]["model"]):
+                    message = await context.bot.send_photo(uid, watermarked_image)
                 last_generated = item  # Сохраняем оригинал для AI функций
+                last_file_id = telegram_files.sent_file_id(message)
             except:
                 await context.bot.send_message(uid, item)
 
@@ -1384,13 +1360,15 @@ async def handle_message(update, context):
         remaining = use_generation(uid)
 
         # Сохраняем в библиотеку
-        add_to_history(
-            user_id=uid,
-            prompt=text,
-            english_prompt=final_english_prompt,
-            params=st["saved_params"],
-            negative_prompt=st.get("negative_prompt", "")
-        )
+        with metrics.span("history", engine="sd", model=st["saved_params"]["model"]):
+            add_to_history(
+                user_id=uid,
+                prompt=text,
+                english_prompt=final_english_prompt,
+                params=st["saved_params"],
+                negative_prompt=st.get("negative_prompt", ""),
+                file_id=last_file_id
+            )
 
         # Сохраняем новый промпт, последнее изображение и снова включаем режим refinement
         user_state[uid]["last_english_prompt"] = final_english_prompt
@@ -1399,7 +1377,7 @@ async def handle_message(update, context):
         # Сохраняем в GCS библиотеку
         if USE_GCS and last_generated:
             try:
-                gcs.save_user_image(uid, last_generated, category='generated')
+                gcs.save_user_image(uid, last_generated, category='generated', file_id=last_file_id)
                 # Сохраняем метаданные
                 try:
                     images = gcsa.get_user_images_filtered(uid, category='generated', limit=1)
@@ -1412,10 +1390,10 @@ async def handle_message(update, context):
                             metadata['prompt'] = final_prompt
                         gcsa.save_image_metadata(uid, blob_name, metadata)
                 except Exception as e:
-                    print(f'[ERROR] Failed to save metadata: {e}')
-                print(f'[GCS] Image saved to user library')
+                    logger.error("Failed to save metadata: %s", e)
+                logger.info("Image saved to user library")
             except Exception as e:
-                print(f'[ERROR] Failed to save to library: {e}')
+                logger.error("Failed to save to library: %s", e)
         user_state[uid]["in_refinement_mode"] = True
 
         await context.bot.send_message(
@@ -1528,7 +1506,7 @@ Quality: {st['quality']}"""
 
         await update.message.reply_text(f"⏳ <b>Search & Recolor...</b>\n\n🎨 Ищем '{search_prompt}' и перекрашиваем в '{recolor_prompt}'...", parse_mode="HTML")
 
-        result = search_and_recolor(user_state[uid]["edit_image"], search_prompt, recolor_prompt)
+        result = await run_blocking(STABILITY, search_and_recolor, user_state[uid]["edit_image"], search_prompt, recolor_prompt)
 
         if isinstance(result, str):
             await update.message.reply_text(result)
@@ -1539,9 +1517,9 @@ Quality: {st['quality']}"""
         if USE_GCS and result:
             try:
                 gcs.save_user_image(uid, result, category='edited')
-                print(f'[GCS] Edited image saved to library')
+                logger.info("Edited image saved to library")
             except Exception as e:
-                print(f'[ERROR] Failed to save edited image: {e}')
+                logger.error("Failed to save edited image: %s", e)
             await context.bot.send_photo(uid, watermarked, caption="✅ Объект перекрашен!")
         return
 
@@ -1570,7 +1548,7 @@ Quality: {st['quality']}"""
 
         await update.message.reply_text(f"⏳ <b>Search & Replace...</b>\n\n🔄 Заменяем '{search_prompt}' на '{replace_prompt}'...", parse_mode="HTML")
 
-        result = search_and_replace(user_state[uid]["edit_image"], search_prompt, replace_prompt)
+        result = await run_blocking(STABILITY, search_and_replace, user_state[uid]["edit_image"], search_prompt, replace_prompt)
 
         if isinstance(result, str):
             await update.message.reply_text(result)
@@ -1581,9 +1559,9 @@ Quality: {st['quality']}"""
         if USE_GCS and result:
             try:
                 gcs.save_user_image(uid, result, category='edited')
-                print(f'[GCS] Edited image saved to library')
+                logger.info("Edited image saved to library")
             except Exception as e:
-                print(f'[ERROR] Failed to save edited image: {e}')
+                logger.error("Failed to save edited image: %s", e)
             await context.bot.send_photo(uid, watermarked, caption="✅ Объект заменен!")
         return
 
@@ -1597,7 +1575,7 @@ Quality: {st['quality']}"""
 
         await update.message.reply_text(f"⏳ <b>Erase...</b>\n\n🗑️ Удаляем '{text}'...", parse_mode="HTML")
 
-        result = erase_object(user_state[uid]["edit_image"], text)
+        result = await run_blocking(STABILITY, erase_object, user_state[uid]["edit_image"], text)
 
         if isinstance(result, str):
             await update.message.reply_text(result)
@@ -1608,9 +1586,9 @@ Quality: {st['quality']}"""
         if USE_GCS and result:
             try:
                 gcs.save_user_image(uid, result, category='edited')
-                print(f'[GCS] Edited image saved to library')
+                logger.info("Edited image saved to library")
             except Exception as e:
-                print(f'[ERROR] Failed to save edited image: {e}')
+                logger.error("Failed to save edited image: %s", e)
             await context.bot.send_photo(uid, watermarked, caption="✅ Объект удален!")
         return
 
@@ -1709,7 +1687,7 @@ Quality: {st['quality']}"""
     # Обычный новый запрос
     if text.startswith("http"):
         await update.message.reply_text("🔍 Анализирую страницу с помощью ChatGPT...")
-        summary = extract_text_from_url(text)
+        summary = await run_blocking(WEB, extract_text_from_url, text)
 
         # Сохраняем саммари и показываем с кнопками
         user_state[uid]["prompt"] = summary
@@ -1726,8 +1704,6 @@ Quality: {st['quality']}"""
 
 async def library_show_category(update, context, category=None):
     """Показать изображения из категории"""
-    from telegram import InputMediaPhoto
-
     query = update.callback_query
     uid = update.effective_user.id
 
@@ -1764,18 +1740,18 @@ async def library_show_category(update, context, category=None):
             )
             return
 
-        # Формируем media group
-        media_group = []
+        # Формируем подписи
+        captions = []
         for img in images[:10]:
             caption = f"📄 {img['name']}"
             if img.get('metadata', {}).get('prompt'):
                 prompt = img['metadata']['prompt'][:100]
                 caption += f"\n💬 {prompt}"
 
-            media_group.append(InputMediaPhoto(media=img['url'], caption=caption))
+            captions.append(caption)
 
-        # Отправляем изображения
-        await context.bot.send_media_group(uid, media_group)
+        # Отправляем изображения (уже отправленные - по file_id)
+        await telegram_files.send_library_images(context.bot, uid, images, captions)
 
         # Показываем кнопки с информацией
         category_emoji = {
@@ -1787,7 +1763,7 @@ async def library_show_category(update, context, category=None):
         }
         emoji = category_emoji.get(category, '📁')
 
-        total_count = len(gcsa.get_user_images_filtered(uid, category=category, limit=1000))
+        total_count = gcsa.count_user_images(uid, category=category)
 
         msg = f'{emoji} Показано: {len(images)} из {total_count}'
 
@@ -1803,1453 +1779,1482 @@ async def library_show_category(update, context, category=None):
             reply_markup=library_kb_extended()
         )
 
-async def callbacks(update, context):
-    query = update.callback_query
-    uid = query.from_user.id
-    data = query.data
 
-    # Debug logging
-    print(f"[DEBUG] Callback received - User: {uid}, Data: {data}")
+# Вспомогательная функция для показа финального промпта
+async def show_final_prompt(query, uid):
+    st = user_state[uid]
+
+    # Переводим параметры на русский для отображения
+    format_ru = {
+        "1:1": "1:1 (квадрат)",
+        "21:9": "21:9 (ультра-широкий)",
+        "16:9": "16:9 (горизонтально)",
+        "3:2": "3:2",
+        "5:4": "5:4",
+        "4:5": "4:5",
+        "2:3": "2:3",
+        "9:16": "9:16 (вертикально)",
+        "9:21": "9:21 (ультра-вертикально)"
+    }
 
-    # Обработка кнопки "➕ 10 генераций" (только для админа)
-        # Обработка библиотеки изображений
-    if data.startswith('lib_show_'):
-        await library_show_category(update, context)
-        return
+    model_ru = {
+        "sd3.5-large": "SD 3.5 Large (лучшее качество)",
+        "sd3.5-large-turbo": "SD 3.5 Large Turbo (быстро + качество)",
+        "sd3.5-medium": "SD 3.5 Medium (баланс)",
+        "sd3.5-flash": "SD 3.5 Flash (макс. скорость)"
+    }
 
-    if data.startswith("admin_add10_"):
-        if uid != ADMIN_ID:
-            await query.answer("❌ У вас нет прав для этого действия.", show_alert=True)
-            return
+    style_ru = {
+        "none": "Без стиля",
+        "3d-model": "3D Model",
+        "analog-film": "Analog Film",
+        "anime": "Anime",
+        "cinematic": "Cinematic",
+        "comic-book": "Comic Book",
+        "digital-art": "Digital Art",
+        "enhance": "Enhance",
+        "fantasy-art": "Fantasy Art",
+        "isometric": "Isometric",
+        "line-art": "Line Art",
+        "low-poly": "Low Poly",
+        "modeling-compound": "Modeling Compound",
+        "neon-punk": "Neon Punk",
+        "origami": "Origami",
+        "photographic": "Photographic",
+        "pixel-art": "Pixel Art",
+        "tile-texture": "Tile Texture"
+    }
 
-        target_user_id = int(data[12:])  # Убираем "admin_add10_"
-        remaining = add_generations(target_user_id, 10)
+    # Формируем красивый предпросмотр с эмодзи
+    final_prompt_ru = f"""📝 <b>Предпросмотр генерации</b>
 
-        await query.answer("✅ Добавлено 10 генераций", show_alert=True)
+💬 <b>Промпт:</b>
+<i>{st['prompt']}</i>
 
-        # Отправляем уведомление пользователю
-        try:
-            await context.bot.send_message(
-                chat_id=target_user_id,
-                text="🎁 Админ дарит вам +10 бесплатных генераций!"
-            )
-        except Exception as e:
-            pass
+━━━━━━━━━━━━━━━
+⚙️ <b>Параметры:</b>
 
-        return
+🎨 <b>Модель:</b> {model_ru.get(st['model'], st['model'])}
+📐 <b>Формат:</b> {format_ru.get(st['format'], st['format'])}"""
 
-    # Обработка кнопки "Редактировать" для саммари URL
-    if data == "edit_summary":
-        user_state[uid]["awaiting_summary_edit"] = True
-        await query.edit_message_text(
-            "✏️ Отправьте новое описание для изображения.\n\n"
-            "Текущее описание будет заменено."
-        )
-        return
+    # Показываем стиль только если он не "none"
+    if st.get("style", "none") != "none":
+        final_prompt_ru += f"\n🖌 <b>Стиль:</b> {style_ru.get(st.get('style', 'none'), st.get('style', 'none'))}"
+
+    # Показываем дополнительные параметры (вид, положение камеры, освещение) если они были выбраны
+    additional_params = st.get("additional_params", {})
+
+    shot_ru = {
+        "establishing": "Обзорный план",
+        "pov": "От первого лица",
+        "wide": "Широкий",
+        "full body": "Во весь рост",
+        "medium": "Средний",
+        "closeup": "Крупный план",
+        "extreme closeup": "Экстремально крупный",
+        "over the shoulder": "Через плечо"
+    }
 
-    # Обработка кнопки "Продолжить" для саммари URL
-    if data == "continue_summary":
-        await query.edit_message_text("Выбери модель:", reply_markup=model_kb())
-        return
+    angle_ru = {
+        "low angle": "Нижний ракурс",
+        "high angle": "Верхний ракурс",
+        "ground level": "На уровне земли",
+        "overhead": "Сверху",
+        "aerial shot": "Аэросъемка",
+        "drone shot": "Съемка с дрона",
+        "birds eye view": "С высоты птичьего полета",
+        "wide angle": "Широкоугольный объектив",
+        "fisheye lens": "Рыбий глаз"
+    }
 
-    # Обработка выбора движка генерации
-    if data.startswith("engine_"):
-        engine = data[7:]  # Убираем "engine_"
-        user_state[uid]["engine"] = engine
-
-        if engine == "sd":
-            # Stable Diffusion - показываем выбор GPT модели
-            await query.edit_message_text("Выбери GPT модель для обработки промпта:", reply_markup=gpt_model_kb())
-        elif engine == "dalle":
-            # DALL-E - показываем выбор модели DALL-E
-            await query.edit_message_text("Выбери модель DALL-E:", reply_markup=dalle_model_kb())
-        elif engine == "imagen":
-            # Nano Banana 4 (Google Imagen 4) - показываем выбор модели
-            await query.edit_message_text(
-                "🍌 <b>Nano Banana (Imagen 4)</b>\n\n"
-                "Выберите версию модели:\n\n"
-                "🍌 <b>Стандарт</b> - баланс качества и скорости\n"
-                "💎 <b>Ultra</b> - максимальное качество (медленнее)\n"
-                "⚡ <b>Fast</b> - быстрая генерация",
-                reply_markup=imagen_model_kb(),
-                parse_mode="HTML"
-            )
-        elif engine == "nano_banana_pro":
-            # Nano Banana Pro - инициализация
-            user_state[uid]["nbp_reference_images"] = []  # Инициализация списка референсов
-            await query.edit_message_text(
-                "🍌💎 <b>Nano Banana Pro</b>\n\n"
-                "Мультимодальная генерация с поддержкой референсных изображений.\n\n"
-                "📸 <b>Опционально:</b> Загрузите 1-4 фото для использования в качестве референса\n"
-                "💬 Или сразу введите промпт для обычной генерации\n\n"
-                "<i>Референсные изображения помогут модели понять желаемый стиль, композицию или объекты.</i>",
-                reply_markup=nbp_upload_kb(0),
-                parse_mode="HTML"
-            )
-        elif engine == "imagen3_custom":
-            # Imagen 3 Customization - инициализация и выбор типа субъекта
-            user_state[uid]["reference_images"] = []  # Инициализация списка референсов
-            await query.edit_message_text(
-                "👤 <b>Imagen 3 Customization</b>\n\n"
-                "Генерация изображений на основе референсного фото.\n\n"
-                "📸 <b>Шаг 1:</b> Выберите тип субъекта",
-                reply_markup=subject_type_kb(),
-                parse_mode="HTML"
-            )
-        return
+    lighting_ru = {
+        "colored gel": "Цветные гели",
+        "chiaroscuro": "Кьяроскуро",
+        "studio lighting": "Студийное освещение",
+        "silhouette": "Силуэт",
+        "iridescent": "Радужное свечение",
+        "golden hour": "Золотой час",
+        "long exposure": "Длинная выдержка",
+        "dramatic light": "Драматичный свет"
+    }
 
-    # Обработка выбора модели DALL-E
-    if data.startswith("dallemodel_"):
-        dalle_model = data[11:]  # Убираем "dallemodel_"
-        user_state[uid]["dalle_model"] = dalle_model
-        await query.edit_message_text(f"Выбери размер изображения:", reply_markup=dalle_size_kb(dalle_model))
-        return
+    if additional_params.get("shot"):
+        final_prompt_ru += f"\n🎬 <b>Вид:</b> {shot_ru.get(additional_params['shot'], additional_params['shot'])}"
 
-    # Обработка выбора размера DALL-E
-    if data.startswith("dallesize_"):
-        dalle_size = data[10:]  # Убираем "dallesize_"
-        user_state[uid]["dalle_size"] = dalle_size
+    if additional_params.get("angle"):
+        final_prompt_ru += f"\n📐 <b>Ракурс:</b> {angle_ru.get(additional_params['angle'], additional_params['angle'])}"
 
-        # Если DALL-E 3, показываем выбор качества
-        if user_state[uid].get("dalle_model") == "dall-e-3":
-            await query.edit_message_text("Выбери качество:", reply_markup=dalle_quality_kb())
-        else:
-            # Для DALL-E 2 сразу генерируем
-            await generate_dalle_image(query, uid)
-        return
+    if additional_params.get("lighting"):
+        final_prompt_ru += f"\n💡 <b>Освещение:</b> {lighting_ru.get(additional_params['lighting'], additional_params['lighting'])}"
 
-    # Обработка выбора качества DALL-E 3
-    if data.startswith("dallequal_"):
-        dalle_quality = data[10:]  # Убираем "dallequal_"
-        user_state[uid]["dalle_quality"] = dalle_quality
-        await generate_dalle_image(query, uid)
-        return
+    if st.get("negative_prompt"):
+        final_prompt_ru += f"\n🚫 <b>Negative Prompt:</b> <code>{st['negative_prompt']}</code>"
 
-    # Обработка выбора формата Imagen
-    # Обработка выбора модели Imagen
-    if data.startswith("imagen_model_"):
-        model_type = data.replace("imagen_model_", "")
+    final_prompt_ru += "\n━━━━━━━━━━━━━━━"
 
-        # Маппинг выбора в ключ модели
-        model_map = {
-            "standard": "imagen-4",
-            "ultra": "imagen-4-ultra",
-            "fast": "imagen-4-fast"
-        }
+    # Показываем финальный промпт на русском с кнопками подтверждения
+    await query.edit_message_text(
+        final_prompt_ru,
+        reply_markup=confirm_kb(),
+        parse_mode="HTML"
+    )
 
-        user_state[uid]["imagen_model"] = model_map.get(model_type, "imagen-4")
 
-        # Показываем выбор формата
-        model_names = {
-            "standard": "🍌 Imagen 4 (стандарт)",
-            "ultra": "💎 Imagen 4 Ultra",
-            "fast": "⚡ Imagen 4 Fast"
-        }
+# Обработка библиотеки изображений
+@router.prefix("lib_show_")
+async def cb_lib_show(update, context, query, uid, data):
+    await library_show_category(update, context)
 
-        await query.edit_message_text(
-            f"{model_names.get(model_type, '🍌 Imagen 4')}\n\nВыбери формат изображения:",
-            reply_markup=imagen_format_kb()
-        )
+
+# Обработка кнопки "➕ 10 генераций" (только для админа)
+@router.prefix("admin_add10_")
+async def cb_admin_add10(update, context, query, uid, data):
+    if uid != ADMIN_ID:
+        await query.answer("❌ У вас нет прав для этого действия.", show_alert=True)
         return
 
-    if data.startswith("imgfmt_"):
-        imagen_format = data[7:]  # Убираем "imgfmt_"
-        user_state[uid]["imagen_format"] = imagen_format
+    target_user_id = int(data[12:])  # Убираем "admin_add10_"
+    remaining = add_generations(target_user_id, 10)
 
-        # Проверяем движок
-        engine = user_state[uid].get("engine")
-        if engine == "imagen3_custom":
-            await generate_imagen3_custom_image(query, uid)
-        elif engine == "nano_banana_pro":
-            await generate_nano_banana_pro_image(query, uid)
-        else:
-            await generate_imagen_image(query, uid)
-        return
+    await query.answer("✅ Добавлено 10 генераций", show_alert=True)
 
-    # Обработчики для Nano Banana Pro
-    if data == "nbp_clear":
-        user_state[uid]["nbp_reference_images"] = []
-        await query.edit_message_text(
-            "🗑 Референсы очищены!\n\n"
-            "📤 Загрузите фото или 📝 введите промпт",
-            reply_markup=nbp_upload_kb(0)
+    # Отправляем уведомление пользователю
+    try:
+        await context.bot.send_message(
+            chat_id=target_user_id,
+            text="🎁 Админ дарит вам +10 бесплатных генераций!"
         )
-        return
+    except Exception as e:
+        pass
 
-    if data == "nbp_continue":
-        await query.edit_message_text(
-            "📝 Введите промпт для генерации\n\n"
-            f"Референсов загружено: {len(user_state[uid].get('nbp_reference_images', []))}"
-        )
-        return
 
-    if data == "nbp_noop":
-        # Ничего не делаем, просто информационная кнопка
-        await query.answer()
-        return
+# Обработка кнопки "Редактировать" для саммари URL
+@router.exact("edit_summary")
+async def cb_edit_summary(update, context, query, uid, data):
+    user_state[uid]["awaiting_summary_edit"] = True
+    await query.edit_message_text(
+        "✏️ Отправьте новое описание для изображения.\n\n"
+        "Текущее описание будет заменено."
+    )
 
-    # Обработка выбора типа субъекта для Imagen 3 Custom
-    if data.startswith("subject_"):
-        subject = data.replace("subject_", "")
-        user_state[uid]["subject_type"] = subject
 
-        subject_names = {
-            "person": "Человек 👤",
-            "animal": "Животное 🐾",
-            "product": "Продукт 📦",
-            "default": "Другое 🎨"
-        }
+# Обработка кнопки "Продолжить" для саммари URL
+@router.exact("continue_summary")
+async def cb_continue_summary(update, context, query, uid, data):
+    await query.edit_message_text("Выбери модель:", reply_markup=model_kb())
 
+
+# Обработка выбора движка генерации
+@router.prefix("engine_")
+async def cb_engine(update, context, query, uid, data):
+    engine = data[7:]  # Убираем "engine_"
+    user_state[uid]["engine"] = engine
+
+    if engine == "sd":
+        # Stable Diffusion - показываем выбор GPT модели
+        await query.edit_message_text("Выбери GPT модель для обработки промпта:", reply_markup=gpt_model_kb())
+    elif engine == "dalle":
+        # DALL-E - показываем выбор модели DALL-E
+        await query.edit_message_text("Выбери модель DALL-E:", reply_markup=dalle_model_kb())
+    elif engine == "imagen":
+        # Nano Banana 4 (Google Imagen 4) - показываем выбор модели
         await query.edit_message_text(
-            f"✅ Выбран тип: <b>{subject_names.get(subject, 'Unknown')}</b>\n\n"
-            f"📤 <b>Шаг 2:</b> Отправьте 1-4 референсных фото\n\n"
-            f"<b>Требования к фото:</b>\n"
-            f"• Объект по центру, занимает >50% кадра\n"
-            f"• Хорошее освещение\n"
-            f"• Фронтальный ракурс\n"
-            f"• Без препятствий (очки, маски и т.д.)\n\n"
-            f"После загрузки фото введите промпт для генерации.",
-            reply_markup=reference_upload_kb(),
+            "🍌 <b>Nano Banana (Imagen 4)</b>\n\n"
+            "Выберите версию модели:\n\n"
+            "🍌 <b>Стандарт</b> - баланс качества и скорости\n"
+            "💎 <b>Ultra</b> - максимальное качество (медленнее)\n"
+            "⚡ <b>Fast</b> - быстрая генерация",
+            reply_markup=imagen_model_kb(),
             parse_mode="HTML"
         )
-        return
-
-    # Обработка кнопок управления референсами
-    if data == "ref_clear":
-        user_state[uid]["reference_images"] = []
+    elif engine == "nano_banana_pro":
+        # Nano Banana Pro - инициализация
+        user_state[uid]["nbp_reference_images"] = []  # Инициализация списка референсов
         await query.edit_message_text(
-            "🗑 Референсы очищены.\n\n"
-            "📤 Отправьте новые фото для генерации.",
-            reply_markup=reference_upload_kb(),
+            "🍌💎 <b>Nano Banana Pro</b>\n\n"
+            "Мультимодальная генерация с поддержкой референсных изображений.\n\n"
+            "📸 <b>Опционально:</b> Загрузите 1-4 фото для использования в качестве референса\n"
+            "💬 Или сразу введите промпт для обычной генерации\n\n"
+            "<i>Референсные изображения помогут модели понять желаемый стиль, композицию или объекты.</i>",
+            reply_markup=nbp_upload_kb(0),
             parse_mode="HTML"
         )
-        return
-
-    if data == "ref_done":
-        if not user_state[uid].get("reference_images"):
-            await query.answer("❌ Сначала загрузите хотя бы 1 фото!", show_alert=True)
-            return
-
+    elif engine == "imagen3_custom":
+        # Imagen 3 Customization - инициализация и выбор типа субъекта
+        user_state[uid]["reference_images"] = []  # Инициализация списка референсов
         await query.edit_message_text(
-            f"✅ Загружено фото: {len(user_state[uid].get('reference_images', []))}\n\n"
-            f"📝 Теперь отправьте промпт для генерации.\n\n"
-            f"<b>Пример:</b>\n"
-            f"<i>standing on a beach at sunset</i>\n\n"
-            f"Маркер [1] будет добавлен автоматически.",
+            "👤 <b>Imagen 3 Customization</b>\n\n"
+            "Генерация изображений на основе референсного фото.\n\n"
+            "📸 <b>Шаг 1:</b> Выберите тип субъекта",
+            reply_markup=subject_type_kb(),
             parse_mode="HTML"
         )
-        return
 
-    # Обработка выбора GPT модели
-    if data.startswith("gptmodel_"):
-        user_state[uid]["gpt_model"] = data[9:]  # Убираем "gptmodel_"
-        await query.edit_message_text("Выбери модель SD 3.5:", reply_markup=model_kb())
-        return
 
-    # Обработка выбора модели
-    if data.startswith("model_"):
-        user_state[uid]["model"] = data[6:]  # Убираем "model_"
-        await query.edit_message_text("Выбери формат:", reply_markup=format_kb())
-        return
+# Обработка выбора модели DALL-E
+@router.prefix("dallemodel_")
+async def cb_dallemodel(update, context, query, uid, data):
+    dalle_model = data[11:]  # Убираем "dallemodel_"
+    user_state[uid]["dalle_model"] = dalle_model
+    await query.edit_message_text(f"Выбери размер изображения:", reply_markup=dalle_size_kb(dalle_model))
 
-    # Вспомогательная функция для показа финального промпта
-    async def show_final_prompt(query, uid):
-        st = user_state[uid]
 
-        # Переводим параметры на русский для отображения
-        format_ru = {
-            "1:1": "1:1 (квадрат)",
-            "21:9": "21:9 (ультра-широкий)",
-            "16:9": "16:9 (горизонтально)",
-            "3:2": "3:2",
-            "5:4": "5:4",
-            "4:5": "4:5",
-            "2:3": "2:3",
-            "9:16": "9:16 (вертикально)",
-            "9:21": "9:21 (ультра-вертикально)"
-        }
+# Обработка выбора размера DALL-E
+@router.prefix("dallesize_")
+async def cb_dallesize(update, context, query, uid, data):
+    dalle_size = data[10:]  # Убираем "dallesize_"
+    user_state[uid]["dalle_size"] = dalle_size
 
-        model_ru = {
-            "sd3.5-large": "SD 3.5 Large (лучшее качество)",
-            "sd3.5-large-turbo": "SD 3.5 Large Turbo (быстро + качество)",
-            "sd3.5-medium": "SD 3.5 Medium (баланс)",
-            "sd3.5-flash": "SD 3.5 Flash (макс. скорость)"
-        }
+    # Если DALL-E 3, показываем выбор качества
+    if user_state[uid].get("dalle_model") == "dall-e-3":
+        await query.edit_message_text("Выбери качество:", reply_markup=dalle_quality_kb())
+    else:
+        # Для DALL-E 2 сразу генерируем
+        await enqueue_generation(query, uid, OPENAI, lambda job: generate_dalle_image(job.query, job.user_id))
 
-        style_ru = {
-            "none": "Без стиля",
-            "3d-model": "3D Model",
-            "analog-film": "Analog Film",
-            "anime": "Anime",
-            "cinematic": "Cinematic",
-            "comic-book": "Comic Book",
-            "digital-art": "Digital Art",
-            "enhance": "Enhance",
-            "fantasy-art": "Fantasy Art",
-            "isometric": "Isometric",
-            "line-art": "Line Art",
-            "low-poly": "Low Poly",
-            "modeling-compound": "Modeling Compound",
-            "neon-punk": "Neon Punk",
-            "origami": "Origami",
-            "photographic": "Photographic",
-            "pixel-art": "Pixel Art",
-            "tile-texture": "Tile Texture"
-        }
 
-        # Формируем красивый предпросмотр с эмодзи
-        final_prompt_ru = f"""📝 <b>Предпросмотр генерации</b>
+# Обработка выбора качества DALL-E 3
+@router.prefix("dallequal_")
+async def cb_dallequal(update, context, query, uid, data):
+    dalle_quality = data[10:]  # Убираем "dallequal_"
+    user_state[uid]["dalle_quality"] = dalle_quality
+    await enqueue_generation(query, uid, OPENAI, lambda job: generate_dalle_image(job.query, job.user_id))
 
-💬 <b>Промпт:</b>
-<i>{st['prompt']}</i>
 
-━━━━━━━━━━━━━━━
-⚙️ <b>Параметры:</b>
+# Обработка выбора формата Imagen
+# Обработка выбора модели Imagen
+@router.prefix("imagen_model_")
+async def cb_imagen_model(update, context, query, uid, data):
+    model_type = data.replace("imagen_model_", "")
 
-🎨 <b>Модель:</b> {model_ru.get(st['model'], st['model'])}
-📐 <b>Формат:</b> {format_ru.get(st['format'], st['format'])}"""
+    # Маппинг выбора в ключ модели
+    model_map = {
+        "standard": "imagen-4",
+        "ultra": "imagen-4-ultra",
+        "fast": "imagen-4-fast"
+    }
 
-        # Показываем стиль только если он не "none"
-        if st.get("style", "none") != "none":
-            final_prompt_ru += f"\n🖌 <b>Стиль:</b> {style_ru.get(st.get('style', 'none'), st.get('style', 'none'))}"
-
-        # Показываем дополнительные параметры (вид, положение камеры, освещение) если они были выбраны
-        additional_params = st.get("additional_params", {})
-
-        shot_ru = {
-            "establishing": "Обзорный план",
-            "pov": "От первого лица",
-            "wide": "Широкий",
-            "full body": "Во весь рост",
-            "medium": "Средний",
-            "closeup": "Крупный план",
-            "extreme closeup": "Экстремально крупный",
-            "over the shoulder": "Через плечо"
-        }
+    user_state[uid]["imagen_model"] = model_map.get(model_type, "imagen-4")
 
-        angle_ru = {
-            "low angle": "Нижний ракурс",
-            "high angle": "Верхний ракурс",
-            "ground level": "На уровне земли",
-            "overhead": "Сверху",
-            "aerial shot": "Аэросъемка",
-            "drone shot": "Съемка с дрона",
-            "birds eye view": "С высоты птичьего полета",
-            "wide angle": "Широкоугольный объектив",
-            "fisheye lens": "Рыбий глаз"
-        }
+    # Показываем выбор формата
+    model_names = {
+        "standard": "🍌 Imagen 4 (стандарт)",
+        "ultra": "💎 Imagen 4 Ultra",
+        "fast": "⚡ Imagen 4 Fast"
+    }
 
-        lighting_ru = {
-            "colored gel": "Цветные гели",
-            "chiaroscuro": "Кьяроскуро",
-            "studio lighting": "Студийное освещение",
-            "silhouette": "Силуэт",
-            "iridescent": "Радужное свечение",
-            "golden hour": "Золотой час",
-            "long exposure": "Длинная выдержка",
-            "dramatic light": "Драматичный свет"
-        }
+    await query.edit_message_text(
+        f"{model_names.get(model_type, '🍌 Imagen 4')}\n\nВыбери формат изображения:",
+        reply_markup=imagen_format_kb(variants=user_state[uid].get("variants", 1))
+    )
 
-        if additional_params.get("shot"):
-            final_prompt_ru += f"\n🎬 <b>Вид:</b> {shot_ru.get(additional_params['shot'], additional_params['shot'])}"
 
-        if additional_params.get("angle"):
-            final_prompt_ru += f"\n📐 <b>Ракурс:</b> {angle_ru.get(additional_params['angle'], additional_params['angle'])}"
+# Переключатель режима "N вариантов" для Imagen
+@router.exact("imgvariants")
+async def cb_imgvariants(update, context, query, uid, data):
+    variants = 1 if user_state[uid].get("variants", 1) > 1 else VARIANTS_COUNT
+    user_state[uid]["variants"] = variants
+    await query.edit_message_reply_markup(reply_markup=imagen_format_kb(variants=variants))
 
-        if additional_params.get("lighting"):
-            final_prompt_ru += f"\n💡 <b>Освещение:</b> {lighting_ru.get(additional_params['lighting'], additional_params['lighting'])}"
 
-        if st.get("negative_prompt"):
-            final_prompt_ru += f"\n🚫 <b>Negative Prompt:</b> <code>{st['negative_prompt']}</code>"
+@router.prefix("imgfmt_")
+async def cb_imgfmt(update, context, query, uid, data):
+    imagen_format = data[7:]  # Убираем "imgfmt_"
+    user_state[uid]["imagen_format"] = imagen_format
 
-        final_prompt_ru += "\n━━━━━━━━━━━━━━━"
+    # Проверяем движок
+    engine = user_state[uid].get("engine")
+    if engine == "imagen3_custom":
+        run = lambda job: generate_imagen3_custom_image(job.query, job.user_id)
+    elif engine == "nano_banana_pro":
+        run = lambda job: generate_nano_banana_pro_image(job.query, job.user_id)
+    else:
+        # Количество вариантов фиксируется при нажатии, а не при запуске задачи из очереди
+        variants = user_state[uid].get("variants", 1)
+        run = lambda job: generate_imagen_image(job.query, job.user_id, variants=variants)
+    await enqueue_generation(query, uid, GOOGLE, run)
+
+
+# Обработчики для Nano Banana Pro
+@router.exact("nbp_clear")
+async def cb_nbp_clear(update, context, query, uid, data):
+    user_state[uid]["nbp_reference_images"] = []
+    await query.edit_message_text(
+        "🗑 Референсы очищены!\n\n"
+        "📤 Загрузите фото или 📝 введите промпт",
+        reply_markup=nbp_upload_kb(0)
+    )
 
-        # Показываем финальный промпт на русском с кнопками подтверждения
-        await query.edit_message_text(
-            final_prompt_ru,
-            reply_markup=confirm_kb(),
-            parse_mode="HTML"
-        )
 
-    if data.startswith("fmt_"):
-        user_state[uid]["format"] = data[4:]
+@router.exact("nbp_continue")
+async def cb_nbp_continue(update, context, query, uid, data):
+    await query.edit_message_text(
+        "📝 Введите промпт для генерации\n\n"
+        f"Референсов загружено: {len(user_state[uid].get('nbp_reference_images', []))}"
+    )
 
-        # Показываем выбор стиля
-        await query.edit_message_text("🎨 Выбери стиль:", reply_markup=style_kb())
-        return
 
-    if data.startswith("style_"):
-        user_state[uid]["style"] = data[6:]
+@router.exact("nbp_noop")
+async def cb_nbp_noop(update, context, query, uid, data):
+    # Ничего не делаем, просто информационная кнопка
+    await query.answer()
 
-        # Инициализируем дополнительные параметры
-        user_state[uid]["additional_params"] = {
-            "shot": "",
-            "angle": "",
-            "lighting": ""
-        }
 
-        # Предлагаем добавить дополнительные параметры (вид, положение камеры, освещение)
-        await query.edit_message_text(
-            "💡 <b>Хотите дополнительно указать вид, положение камеры и освещение?</b>",
-            reply_markup=additional_settings_kb(),
-            parse_mode="HTML"
-        )
-        return
+# Обработка выбора типа субъекта для Imagen 3 Custom
+@router.prefix("subject_")
+async def cb_subject(update, context, query, uid, data):
+    subject = data.replace("subject_", "")
+    user_state[uid]["subject_type"] = subject
 
-    # Обработка кнопки "Редактировать"
-    if data == "edit_prompt":
-        user_state[uid]["awaiting_edit"] = True
-        await query.edit_message_text(
-            "✏️ Отправьте новый текст промпта.\n\n"
-            "Текущий промпт будет заменен, но все выбранные параметры сохранятся."
-        )
-        return
+    subject_names = {
+        "person": "Человек 👤",
+        "animal": "Животное 🐾",
+        "product": "Продукт 📦",
+        "default": "Другое 🎨"
+    }
 
-    # Обработка кнопки "Создать"
-    if data == "generate":
-        # Проверяем лимит генераций
-        can_gen, remaining = can_generate(uid)
-        if not can_gen:
-            await query.answer(
-                "❌ Вы исчерпали лимит бесплатных генераций (10 шт). "
-                "Свяжитесь с поддержкой для продления.",
-                show_alert=True
-            )
-            return
+    await query.edit_message_text(
+        f"✅ Выбран тип: <b>{subject_names.get(subject, 'Unknown')}</b>\n\n"
+        f"📤 <b>Шаг 2:</b> Отправьте 1-4 референсных фото\n\n"
+        f"<b>Требования к фото:</b>\n"
+        f"• Объект по центру, занимает >50% кадра\n"
+        f"• Хорошее освещение\n"
+        f"• Фронтальный ракурс\n"
+        f"• Без препятствий (очки, маски и т.д.)\n\n"
+        f"После загрузки фото введите промпт для генерации.",
+        reply_markup=reference_upload_kb(),
+        parse_mode="HTML"
+    )
 
-        st = user_state[uid]
 
-        await query.edit_message_text("⏳ <b>Шаг 1/3:</b> Обработка промпта с помощью ChatGPT-4o...", parse_mode="HTML")
+# Обработка кнопок управления референсами
+@router.exact("ref_clear")
+async def cb_ref_clear(update, context, query, uid, data):
+    user_state[uid]["reference_images"] = []
+    await query.edit_message_text(
+        "🗑 Референсы очищены.\n\n"
+        "📤 Отправьте новые фото для генерации.",
+        reply_markup=reference_upload_kb(),
+        parse_mode="HTML"
+    )
 
-        # Формируем финальный промпт на английском с учетом всех параметров
-        params = {
-            'model': st['model'],
-            'format': st['format'],
-            'style': st['style'],
-            'additional_params': st.get('additional_params', {})
-        }
 
-        # Сохраняем параметры для кнопок More/Reload
-        user_state[uid]["saved_params"] = params.copy()
+@router.exact("ref_done")
+async def cb_ref_done(update, context, query, uid, data):
+    if not user_state[uid].get("reference_images"):
+        await query.answer("❌ Сначала загрузите хотя бы 1 фото!", show_alert=True)
+        return
 
-        # Переводим и формируем промпт для генерации
-        gpt_model = user_state[uid].get("gpt_model", "gpt-4o")
-        final_english_prompt = build_final_prompt(st['prompt'], params, gpt_model)
-
-        # Определяем примерное время в зависимости от модели
-        time_estimates = {
-            "sd3.5-large": "~45 сек",
-            "sd3.5-large-turbo": "~30 сек",
-            "sd3.5-medium": "~25 сек",
-            "sd3.5-flash": "~15 сек"
-        }
+    await query.edit_message_text(
+        f"✅ Загружено фото: {len(user_state[uid].get('reference_images', []))}\n\n"
+        f"📝 Теперь отправьте промпт для генерации.\n\n"
+        f"<b>Пример:</b>\n"
+        f"<i>standing on a beach at sunset</i>\n\n"
+        f"Маркер [1] будет добавлен автоматически.",
+        parse_mode="HTML"
+    )
 
-        estimate = time_estimates.get(st['model'], "~30 сек")
 
-        await query.edit_message_text(
-            f"⏳ <b>Шаг 2/3:</b> Генерация изображения...\n\n"
-            f"🎨 Модель: {st['model']}\n"
-            f"⏱ Примерное время: {estimate}",
-            parse_mode="HTML"
-        )
+# Обработка выбора GPT модели
+@router.prefix("gptmodel_")
+async def cb_gptmodel(update, context, query, uid, data):
+    user_state[uid]["gpt_model"] = data[9:]  # Убираем "gptmodel_"
+    await query.edit_message_text("Выбери модель SD 3.5:", reply_markup=model_kb())
 
-        images = st["images"]
 
-        # Переводим negative prompt на английский если он есть
-        english_negative = ""
-        if st.get("negative_prompt"):
-            english_negative = translate_to_english(st["negative_prompt"], gpt_model)
+# Обработка выбора модели
+@router.prefix("model_")
+async def cb_model(update, context, query, uid, data):
+    user_state[uid]["model"] = data[6:]  # Убираем "model_"
+    await query.edit_message_text("Выбери формат:", reply_markup=format_kb())
 
-        # Передаем формат, модель, стиль и negative prompt для генерации
-        output = generate_dream(final_english_prompt, images, format_ratio=st['format'], model=st['model'], style=st.get('style'), negative_prompt=english_negative)
 
-        await query.edit_message_text("⏳ <b>Шаг 3/3:</b> Отправка результата...", parse_mode="HTML")
+@router.prefix("fmt_")
+async def cb_fmt(update, context, query, uid, data):
+    user_state[uid]["format"] = data[4:]
 
-        last_generated = None
-        for item in output:
-            try:
-                # Добавляем watermark
-                watermarked_image = add_watermark(item)
-                await context.bot.send_photo(uid, watermarked_image)
-                last_generated = item  # Сохраняем оригинал для AI функций
-            except:
-                await context.bot.send_message(uid, item)
+    # Показываем выбор стиля
+    await query.edit_message_text("🎨 Выбери стиль:", reply_markup=style_kb())
 
-        # Используем одну генерацию
-        remaining = use_generation(uid)
 
-        # Сохраняем в библиотеку
-        add_to_history(
-            user_id=uid,
-            prompt=st['prompt'],
-            english_prompt=final_english_prompt,
-            params=params,
-            negative_prompt=st.get('negative_prompt', '')
-        )
+@router.prefix("style_")
+async def cb_style(update, context, query, uid, data):
+    user_state[uid]["style"] = data[6:]
 
-        # Сохраняем промпт и изображение для возможности refinement и AI функций
-        user_state[uid]["last_english_prompt"] = final_english_prompt
-        user_state[uid]["last_image"] = last_generated
+    # Инициализируем дополнительные параметры
+    user_state[uid]["additional_params"] = {
+        "shot": "",
+        "angle": "",
+        "lighting": ""
+    }
 
-        # Сохраняем в GCS библиотеку
-        if USE_GCS and last_generated:
-            try:
-                gcs.save_user_image(uid, last_generated, category='generated')
-                # Сохраняем метаданные
-                try:
-                    images = gcsa.get_user_images_filtered(uid, category='generated', limit=1)
-                    if images:
-                        blob_name = images[0]['blob_name']
-                        metadata = {'operation_type': 'generation'}
-                        if 'prompt' in locals():
-                            metadata['prompt'] = prompt
-                        elif 'final_prompt' in locals():
-                            metadata['prompt'] = final_prompt
-                        gcsa.save_image_metadata(uid, blob_name, metadata)
-                except Exception as e:
-                    print(f'[ERROR] Failed to save metadata: {e}')
-                print(f'[GCS] Image saved to user library')
-            except Exception as e:
-                print(f'[ERROR] Failed to save to library: {e}')
-        user_state[uid]["in_refinement_mode"] = True
+    # Предлагаем добавить дополнительные параметры (вид, положение камеры, освещение)
+    await query.edit_message_text(
+        "💡 <b>Хотите дополнительно указать вид, положение камеры и освещение?</b>",
+        reply_markup=additional_settings_kb(),
+        parse_mode="HTML"
+    )
 
-        # Логируем генерацию в Google Sheets
-        gsl.log_generation(
-            user_id=uid,
-            username=query.from_user.username or "",
-            engine="sd",
-            model=st['model'],
-            prompt_ru=st['prompt'],
-            prompt_en=final_english_prompt,
-            format_ratio=st['format'],
-            style=st.get('style', ''),
-            additional_params=st.get('additional_params', {}),
-            negative_prompt=st.get('negative_prompt', ''),
-            success=last_generated is not None,
-            error="" if last_generated else "Generation failed"
-        )
 
-        # Обновляем счетчики пользователя в Google Sheets
-        gsl.update_user_generations(uid, increment=1, remaining=remaining)
+# Обработка кнопки "Редактировать"
+@router.exact("edit_prompt")
+async def cb_edit_prompt(update, context, query, uid, data):
+    user_state[uid]["awaiting_edit"] = True
+    await query.edit_message_text(
+        "✏️ Отправьте новый текст промпта.\n\n"
+        "Текущий промпт будет заменен, но все выбранные параметры сохранятся."
+    )
 
-        # Отправляем сообщение с промптом и кнопками действий
-        await context.bot.send_message(
-            uid,
-            f"✅ Изображение готово\n\n<code>{final_english_prompt}</code>\n\n💎 Осталось генераций: {remaining}",
-            parse_mode="HTML",
-            reply_markup=actions_kb()
+
+# Обработка кнопки "Создать"
+@router.exact("generate")
+async def cb_generate(update, context, query, uid, data):
+    await enqueue_dream_generation(query, uid, variants=1)
+
+
+# Генерация нескольких вариантов (отправляются одним альбомом)
+@router.exact("generate_variants")
+async def cb_generate_variants(update, context, query, uid, data):
+    await enqueue_dream_generation(query, uid, variants=VARIANTS_COUNT)
+
+
+async def enqueue_dream_generation(query, uid, variants):
+    """Ставит в очередь генерацию Stability.ai (variants - количество вариантов)"""
+    # Проверяем лимит генераций
+    can_gen, remaining = can_generate(uid)
+    if not can_gen:
+        await query.answer(
+            "❌ Вы исчерпали лимит бесплатных генераций (10 шт). "
+            "Свяжитесь с поддержкой для продления.",
+            show_alert=True
         )
         return
 
-    # Обработка кнопки "Modify" - вернуться к редактированию параметров
-    if data == "action_modify":
-        user_state[uid]["in_refinement_mode"] = False
-        await query.edit_message_text("Выбери модель:", reply_markup=model_kb())
-        return
+    st = user_state[uid]
 
-    # Обработка кнопки "Reference this" - сохранить как референс
-    if data == "action_reference":
-        await query.answer("🖼️ Функция в разработке. Скоро можно будет использовать как референс!")
-        return
+    # Сохраняем параметры для кнопок More/Reload
+    user_state[uid]["saved_params"] = {
+        'model': st['model'],
+        'format': st['format'],
+        'style': st['style'],
+        'additional_params': st.get('additional_params', {})
+    }
 
-    # Обработка кнопки "More like this" - генерация похожего
-    if data == "action_more":
-        # Проверяем лимит генераций
-        can_gen, remaining_check = can_generate(uid)
-        if not can_gen:
-            await query.answer(
-                "❌ Вы исчерпали лимит бесплатных генераций (10 шт). "
-                "Свяжитесь с поддержкой для продления.",
-                show_alert=True
-            )
-            return
+    # Снимок параметров: пока задача ждёт в очереди, пользователь может их менять
+    job_params = {
+        'prompt': st['prompt'],
+        'model': st['model'],
+        'format': st['format'],
+        'style': st['style'],
+        'additional_params': dict(st.get('additional_params', {})),
+        'negative_prompt': st.get('negative_prompt', ''),
+        'gpt_model': st.get('gpt_model', 'gpt-4o'),
+        'images': list(st['images']),
+        'variants': variants,
+        # Закреплённый seed (/seed) или seed генерации из истории (один раз, см. lib_reuse_)
+        'seed': st.get('pinned_seed', st.pop('seed', None)),
+    }
+    await enqueue_generation(query, uid, STABILITY, generate_dream_image, job_params)
 
-        st = user_state[uid]
-        if not st.get("saved_params"):
-            await query.answer("❌ Нет сохраненных параметров")
-            return
 
-        await query.edit_message_text("⏳ <b>Шаг 1/3:</b> Обработка промпта с помощью ChatGPT-4o...", parse_mode="HTML")
+# Обработка кнопки "Modify" - вернуться к редактированию параметров
+@router.exact("action_modify")
+async def cb_action_modify(update, context, query, uid, data):
+    user_state[uid]["in_refinement_mode"] = False
+    await query.edit_message_text("Выбери модель:", reply_markup=model_kb())
 
-        # Добавляем вариативность к промпту
-        varied_prompt = st["prompt"] + ", вариация, другая композиция"
 
-        # Используем сохраненные параметры
-        gpt_model = user_state[uid].get("gpt_model", "gpt-4o")
-        final_english_prompt = build_final_prompt(varied_prompt, st["saved_params"], gpt_model)
-
-        # Определяем примерное время
-        time_estimates = {
-            "sd3.5-large": "~45 сек",
-            "sd3.5-large-turbo": "~30 сек",
-            "sd3.5-medium": "~25 сек",
-            "sd3.5-flash": "~15 сек"
-        }
-        estimate = time_estimates.get(st["saved_params"]["model"], "~30 сек")
+# Обработка кнопки "Reference this" - сохранить как референс
+@router.exact("action_reference")
+async def cb_action_reference(update, context, query, uid, data):
+    await query.answer("🖼️ Функция в разработке. Скоро можно будет использовать как референс!")
 
-        await query.edit_message_text(
-            f"⏳ <b>Шаг 2/3:</b> Генерация похожего изображения...\n\n"
-            f"🎨 Модель: {st['saved_params']['model']}\n"
-            f"⏱ Примерное время: {estimate}",
-            parse_mode="HTML"
+
+# Обработка кнопки "More like this" - генерация похожего
+@router.exact("action_more")
+async def cb_action_more(update, context, query, uid, data):
+    # Проверяем лимит генераций
+    can_gen, remaining_check = can_generate(uid)
+    if not can_gen:
+        await query.answer(
+            "❌ Вы исчерпали лимит бесплатных генераций (10 шт). "
+            "Свяжитесь с поддержкой для продления.",
+            show_alert=True
         )
+        return
 
-        # Переводим negative prompt на английский если он есть
-        english_negative = ""
-        if st.get("negative_prompt"):
-            english_negative = translate_to_english(st["negative_prompt"], gpt_model)
+    st = user_state[uid]
+    if not st.get("saved_params"):
+        await query.answer("❌ Нет сохраненных параметров")
+        return
 
-        images = st["images"]
-        output = generate_dream(final_english_prompt, images, format_ratio=st["saved_params"]["format"], model=st["saved_params"]["model"], style=st["saved_params"].get("style"), negative_prompt=english_negative)
+    await query.edit_message_text("⏳ <b>Шаг 1/3:</b> Обработка промпта с помощью ChatGPT-4o...", parse_mode="HTML")
 
-        await query.edit_message_text("⏳ <b>Шаг 3/3:</b> Отправка результата...", parse_mode="HTML")
+    # Добавляем вариативность к промпту
+    varied_prompt = st["prompt"] + ", вариация, другая композиция"
 
-        last_generated = None
-        for item in output:
-            try:
-                # Добавляем watermark
+    # Используем сохраненные параметры
+    gpt_model = user_state[uid].get("gpt_model", "gpt-4o")
+    with metrics.span("translate", engine="sd", model=gpt_model):
+        final_english_prompt = await run_blocking(OPENAI, build_final_prompt, varied_prompt, st["saved_params"], gpt_model)
+
+    # Определяем примерное время
+    time_estimates = {
+        "sd3.5-large": "~45 сек",
+        "sd3.5-large-turbo": "~30 сек",
+        "sd3.5-medium": "~25 сек",
+        "sd3.5-flash": "~15 сек"
+    }
+    estimate = time_estimates.get(st["saved_params"]["model"], "~30 сек")
+
+    await query.edit_message_text(
+        f"⏳ <b>Шаг 2/3:</b> Генерация похожего изображения...\n\n"
+        f"🎨 Модель: {st['saved_params']['model']}\n"
+        f"⏱ Примерное время: {estimate}",
+        parse_mode="HTML"
+    )
+
+    # Переводим negative prompt на английский если он есть
+    english_negative = ""
+    if st.get("negative_prompt"):
+        with metrics.span("translate_negative", engine="sd", model=gpt_model):
+            english_negative = await run_blocking(OPENAI, translate_to_english, st["negative_prompt"], gpt_model)
+
+    images = st["images"]
+    with metrics.span("provider", engine="sd", model=st["saved_params"]["model"]):
+        output = await run_blocking(STABILITY, generate_dream, final_english_prompt, images, format_ratio=st["saved_params"]["format"], model=st["saved_params"]["model"], style=st["saved_params"].get("style"), negative_prompt=english_negative)
+
+    await query.edit_message_text("⏳ <b>Шаг 3/3:</b> Отправка результата...", parse_mode="HTML")
+
+    last_generated = None
+    last_file_id = None  # file_id отправленного изображения (история, индекс GCS)
+    for item in output:
+        try:
+            # Добавляем watermark
+            with metrics.span("watermark", engine="sd", model=st["saved_params"]["model"]):
                 watermarked_image = add_watermark(item)
-                await context.bot.send_photo(uid, watermarked_image)
-                last_generated = item  # Сохраняем оригинал для AI функций
-            except:
-                await context.bot.send_message(uid, item)
+            with metrics.span("telegram_upload", engine="sd", model=st["saved_params"]["model"]):
+                message = await context.bot.send_photo(uid, watermarked_image)
+            last_generated = item  # Сохраняем оригинал для AI функций
+            last_file_id = telegram_files.sent_file_id(message)
+        except:
+            await context.bot.send_message(uid, item)
 
-        # Используем одну генерацию
-        remaining = use_generation(uid)
+    # Используем одну генерацию
+    remaining = use_generation(uid)
 
-        # Сохраняем в библиотеку
+    # Сохраняем в библиотеку
+    with metrics.span("history", engine="sd", model=st["saved_params"]["model"]):
         add_to_history(
             user_id=uid,
             prompt=varied_prompt,
             english_prompt=final_english_prompt,
             params=st["saved_params"],
-            negative_prompt=st.get("negative_prompt", "")
+            negative_prompt=st.get("negative_prompt", ""),
+            file_id=last_file_id
         )
 
-        # Сохраняем промпт и изображение для возможности refinement и AI функций
-        user_state[uid]["last_english_prompt"] = final_english_prompt
-        user_state[uid]["last_image"] = last_generated
+    # Сохраняем промпт и изображение для возможности refinement и AI функций
+    user_state[uid]["last_english_prompt"] = final_english_prompt
+    user_state[uid]["last_image"] = last_generated
 
-        # Сохраняем в GCS библиотеку
-        if USE_GCS and last_generated:
+    # Сохраняем в GCS библиотеку
+    if USE_GCS and last_generated:
+        try:
+            gcs.save_user_image(uid, last_generated, category='generated', file_id=last_file_id)
+            # Сохраняем метаданные
             try:
-                gcs.save_user_image(uid, last_generated, category='generated')
-                # Сохраняем метаданные
-                try:
-                    images = gcsa.get_user_images_filtered(uid, category='generated', limit=1)
-                    if images:
-                        blob_name = images[0]['blob_name']
-                        metadata = {'operation_type': 'generation'}
-                        if 'prompt' in locals():
-                            metadata['prompt'] = prompt
-                        elif 'final_prompt' in locals():
-                            metadata['prompt'] = final_prompt
-                        gcsa.save_image_metadata(uid, blob_name, metadata)
-                except Exception as e:
-                    print(f'[ERROR] Failed to save metadata: {e}')
-                print(f'[GCS] Image saved to user library')
+                images = gcsa.get_user_images_filtered(uid, category='generated', limit=1)
+                if images:
+                    blob_name = images[0]['blob_name']
+                    metadata = {'operation_type': 'generation'}
+                    if 'prompt' in locals():
+                        metadata['prompt'] = prompt
+                    elif 'final_prompt' in locals():
+                        metadata['prompt'] = final_prompt
+                    gcsa.save_image_metadata(uid, blob_name, metadata)
             except Exception as e:
-                print(f'[ERROR] Failed to save to library: {e}')
-        user_state[uid]["in_refinement_mode"] = True
+                logger.error("Failed to save metadata: %s", e)
+            logger.info("Image saved to user library")
+        except Exception as e:
+            logger.error("Failed to save to library: %s", e)
+    user_state[uid]["in_refinement_mode"] = True
 
-        await context.bot.send_message(
-            uid,
-            f"✅ Изображение готово\n\n<code>{final_english_prompt}</code>\n\n💎 Осталось генераций: {remaining}",
-            parse_mode="HTML",
-            reply_markup=actions_kb()
+    await context.bot.send_message(
+        uid,
+        f"✅ Изображение готово\n\n<code>{final_english_prompt}</code>\n\n💎 Осталось генераций: {remaining}",
+        parse_mode="HTML",
+        reply_markup=actions_kb()
+    )
+
+
+# Обработка кнопки "Reload" - повторная генерация с теми же параметрами
+@router.exact("action_reload")
+async def cb_action_reload(update, context, query, uid, data):
+    # Проверяем лимит генераций
+    can_gen, remaining_check = can_generate(uid)
+    if not can_gen:
+        await query.answer(
+            "❌ Вы исчерпали лимит бесплатных генераций (10 шт). "
+            "Свяжитесь с поддержкой для продления.",
+            show_alert=True
         )
         return
 
-    # Обработка кнопки "Reload" - повторная генерация с теми же параметрами
-    if data == "action_reload":
-        # Проверяем лимит генераций
-        can_gen, remaining_check = can_generate(uid)
-        if not can_gen:
-            await query.answer(
-                "❌ Вы исчерпали лимит бесплатных генераций (10 шт). "
-                "Свяжитесь с поддержкой для продления.",
-                show_alert=True
-            )
-            return
+    st = user_state[uid]
+    if not st.get("saved_params"):
+        await query.answer("❌ Нет сохраненных параметров")
+        return
 
-        st = user_state[uid]
-        if not st.get("saved_params"):
-            await query.answer("❌ Нет сохраненных параметров")
-            return
+    await query.edit_message_text("⏳ <b>Шаг 1/3:</b> Обработка промпта с помощью ChatGPT-4o...", parse_mode="HTML")
 
-        await query.edit_message_text("⏳ <b>Шаг 1/3:</b> Обработка промпта с помощью ChatGPT-4o...", parse_mode="HTML")
+    # Используем те же параметры
+    gpt_model = user_state[uid].get("gpt_model", "gpt-4o")
+    with metrics.span("translate", engine="sd", model=gpt_model):
+        final_english_prompt = await run_blocking(OPENAI, build_final_prompt, st["prompt"], st["saved_params"], gpt_model)
 
-        # Используем те же параметры
-        gpt_model = user_state[uid].get("gpt_model", "gpt-4o")
-        final_english_prompt = build_final_prompt(st["prompt"], st["saved_params"], gpt_model)
-
-        # Определяем примерное время
-        time_estimates = {
-            "sd3.5-large": "~45 сек",
-            "sd3.5-large-turbo": "~30 сек",
-            "sd3.5-medium": "~25 сек",
-            "sd3.5-flash": "~15 сек"
-        }
-        estimate = time_estimates.get(st["saved_params"]["model"], "~30 сек")
+    # Определяем примерное время
+    time_estimates = {
+        "sd3.5-large": "~45 сек",
+        "sd3.5-large-turbo": "~30 сек",
+        "sd3.5-medium": "~25 сек",
+        "sd3.5-flash": "~15 сек"
+    }
+    estimate = time_estimates.get(st["saved_params"]["model"], "~30 сек")
 
-        await query.edit_message_text(
-            f"⏳ <b>Шаг 2/3:</b> Повторная генерация...\n\n"
-            f"🎨 Модель: {st['saved_params']['model']}\n"
-            f"⏱ Примерное время: {estimate}",
-            parse_mode="HTML"
-        )
+    await query.edit_message_text(
+        f"⏳ <b>Шаг 2/3:</b> Повторная генерация...\n\n"
+        f"🎨 Модель: {st['saved_params']['model']}\n"
+        f"⏱ Примерное время: {estimate}",
+        parse_mode="HTML"
+    )
 
-        # Переводим negative prompt на английский если он есть
-        english_negative = ""
-        if st.get("negative_prompt"):
-            english_negative = translate_to_english(st["negative_prompt"], gpt_model)
+    # Переводим negative prompt на английский если он есть
+    english_negative = ""
+    if st.get("negative_prompt"):
+        with metrics.span("translate_negative", engine="sd", model=gpt_model):
+            english_negative = await run_blocking(OPENAI, translate_to_english, st["negative_prompt"], gpt_model)
 
-        images = st["images"]
-        output = generate_dream(final_english_prompt, images, format_ratio=st["saved_params"]["format"], model=st["saved_params"]["model"], style=st["saved_params"].get("style"), negative_prompt=english_negative)
+    images = st["images"]
+    with metrics.span("provider", engine="sd", model=st["saved_params"]["model"]):
+        output = await run_blocking(STABILITY, generate_dream, final_english_prompt, images, format_ratio=st["saved_params"]["format"], model=st["saved_params"]["model"], style=st["saved_params"].get("style"), negative_prompt=english_negative)
 
-        await query.edit_message_text("⏳ <b>Шаг 3/3:</b> Отправка результата...", parse_mode="HTML")
+    await query.edit_message_text("⏳ <b>Шаг 3/3:</b> Отправка результата...", parse_mode="HTML")
 
-        last_generated = None
-        for item in output:
-            try:
-                # Добавляем watermark
+    last_generated = None
+    last_file_id = None  # file_id отправленного изображения (история, индекс GCS)
+    for item in output:
+        try:
+            # Добавляем watermark
+            with metrics.span("watermark", engine="sd", model=st["saved_params"]["model"]):
                 watermarked_image = add_watermark(item)
-                await context.bot.send_photo(uid, watermarked_image)
-                last_generated = item  # Сохраняем оригинал для AI функций
-            except:
-                await context.bot.send_message(uid, item)
+            with metrics.span("telegram_upload", engine="sd", model=st["saved_params"]["model"]):
+                message = await context.bot.send_photo(uid, watermarked_image)
+            last_generated = item  # Сохраняем оригинал для AI функций
+            last_file_id = telegram_files.sent_file_id(message)
+        except:
+            await context.bot.send_message(uid, item)
 
-        # Используем одну генерацию
-        remaining = use_generation(uid)
+    # Используем одну генерацию
+    remaining = use_generation(uid)
 
-        # Сохраняем в библиотеку
+    # Сохраняем в библиотеку
+    with metrics.span("history", engine="sd", model=st["saved_params"]["model"]):
         add_to_history(
             user_id=uid,
             prompt=st["prompt"],
             english_prompt=final_english_prompt,
             params=st["saved_params"],
-            negative_prompt=st.get("negative_prompt", "")
+            negative_prompt=st.get("negative_prompt", ""),
+            file_id=last_file_id
         )
 
-        # Сохраняем промпт и изображение для возможности refinement и AI функций
-        user_state[uid]["last_english_prompt"] = final_english_prompt
-        user_state[uid]["last_image"] = last_generated
+    # Сохраняем промпт и изображение для возможности refinement и AI функций
+    user_state[uid]["last_english_prompt"] = final_english_prompt
+    user_state[uid]["last_image"] = last_generated
 
-        # Сохраняем в GCS библиотеку
-        if USE_GCS and last_generated:
+    # Сохраняем в GCS библиотеку
+    if USE_GCS and last_generated:
+        try:
+            gcs.save_user_image(uid, last_generated, category='generated', file_id=last_file_id)
+            # Сохраняем метаданные
             try:
-                gcs.save_user_image(uid, last_generated, category='generated')
-                # Сохраняем метаданные
-                try:
-                    images = gcsa.get_user_images_filtered(uid, category='generated', limit=1)
-                    if images:
-                        blob_name = images[0]['blob_name']
-                        metadata = {'operation_type': 'generation'}
-                        if 'prompt' in locals():
-                            metadata['prompt'] = prompt
-                        elif 'final_prompt' in locals():
-                            metadata['prompt'] = final_prompt
-                        gcsa.save_image_metadata(uid, blob_name, metadata)
-                except Exception as e:
-                    print(f'[ERROR] Failed to save metadata: {e}')
-                print(f'[GCS] Image saved to user library')
+                images = gcsa.get_user_images_filtered(uid, category='generated', limit=1)
+                if images:
+                    blob_name = images[0]['blob_name']
+                    metadata = {'operation_type': 'generation'}
+                    if 'prompt' in locals():
+                        metadata['prompt'] = prompt
+                    elif 'final_prompt' in locals():
+                        metadata['prompt'] = final_prompt
+                    gcsa.save_image_metadata(uid, blob_name, metadata)
             except Exception as e:
-                print(f'[ERROR] Failed to save to library: {e}')
-        user_state[uid]["in_refinement_mode"] = True
-
-        await context.bot.send_message(
-            uid,
-            f"✅ Изображение готово\n\n<code>{final_english_prompt}</code>\n\n💎 Осталось генераций: {remaining}",
-            parse_mode="HTML",
-            reply_markup=actions_kb()
-        )
-        return
-
-    # Обработка кнопки "Upscale"
-    if data == "action_upscale":
-        st = user_state[uid]
-        if not st.get("last_image"):
-            await query.answer("❌ Нет изображения для upscale")
-            return
-
-        await query.edit_message_text("⏳ <b>Upscaling изображения...</b>\n\n🔍 Увеличиваем разрешение...", parse_mode="HTML")
+                logger.error("Failed to save metadata: %s", e)
+            logger.info("Image saved to user library")
+        except Exception as e:
+            logger.error("Failed to save to library: %s", e)
+    user_state[uid]["in_refinement_mode"] = True
 
-        # Upscale последнего изображения
-        result = upscale_image(st["last_image"])
+    await context.bot.send_message(
+        uid,
+        f"✅ Изображение готово\n\n<code>{final_english_prompt}</code>\n\n💎 Осталось генераций: {remaining}",
+        parse_mode="HTML",
+        reply_markup=actions_kb()
+    )
 
-        if isinstance(result, str):
-            # Ошибка
-            await query.edit_message_text(result)
-        else:
-            # Успех - отправляем upscaled изображение
-            watermarked = add_watermark(result)
 
-        # Сохраняем отредактированное изображение в библиотеку
-        if USE_GCS and result:
-            try:
-                gcs.save_user_image(uid, result, category='edited')
-                print(f'[GCS] Edited image saved to library')
-            except Exception as e:
-                print(f'[ERROR] Failed to save edited image: {e}')
-            await context.bot.send_photo(uid, watermarked)
-            await context.bot.send_message(
-                uid,
-                "✅ <b>Upscale завершен!</b>\n\n🔍 Разрешение увеличено",
-                parse_mode="HTML",
-                reply_markup=actions_kb()
-            )
+# Обработка кнопки "Upscale"
+@router.exact("action_upscale")
+async def cb_action_upscale(update, context, query, uid, data):
+    st = user_state[uid]
+    if not st.get("last_image"):
+        await query.answer("❌ Нет изображения для upscale")
         return
 
-    # Обработка кнопки "Variations"
-    if data == "action_variations":
-        st = user_state[uid]
-        if not st.get("last_image"):
-            await query.answer("❌ Нет изображения для создания вариаций")
-            return
+    await query.edit_message_text("⏳ <b>Upscaling изображения...</b>\n\n🔍 Увеличиваем разрешение...", parse_mode="HTML")
 
-        # Проверяем лимит
-        can_gen, remaining_check = can_generate(uid)
-        if not can_gen:
-            await query.answer(
-                "❌ Вы исчерпали лимит бесплатных генераций (10 шт). "
-                "Свяжитесь с поддержкой для продления.",
-                show_alert=True
-            )
-            return
+    # Upscale последнего изображения
+    with metrics.span("provider", engine="upscale", model="stability"):
+        result = await run_blocking(STABILITY, upscale_image, st["last_image"])
 
-        await query.edit_message_text("⏳ <b>Создание вариации...</b>\n\n🎭 Генерируем похожее изображение...", parse_mode="HTML")
+    if isinstance(result, str):
+        # Ошибка
+        await query.edit_message_text(result)
+    else:
+        # Успех - отправляем upscaled изображение
+        watermarked = add_watermark(result)
 
-        # Создаем вариацию
-        result = create_variations(st["last_image"], prompt=st.get("prompt", ""))
+    # Сохраняем отредактированное изображение в библиотеку
+    if USE_GCS and result:
+        try:
+            gcs.save_user_image(uid, result, category='edited')
+            logger.info("Edited image saved to library")
+        except Exception as e:
+            logger.error("Failed to save edited image: %s", e)
+        await context.bot.send_photo(uid, watermarked)
+        await context.bot.send_message(
+            uid,
+            "✅ <b>Upscale завершен!</b>\n\n🔍 Разрешение увеличено",
+            parse_mode="HTML",
+            reply_markup=actions_kb()
+        )
 
-        if isinstance(result, str):
-            # Ошибка
-            await query.edit_message_text(result)
-        else:
-            # Успех
-            for item in result:
-                watermarked = add_watermark(item)
 
-                # Сохраняем отредактированное изображение в библиотеку
-                if USE_GCS and watermarked:
-                    try:
-                        gcs.save_user_image(uid, watermarked, category='edited')
-                        print(f'[GCS] Edited image (variation) saved to library')
-                    except Exception as e:
-                        print(f'[ERROR] Failed to save edited image: {e}')
+# Обработка кнопки "Variations"
+@router.exact("action_variations")
+async def cb_action_variations(update, context, query, uid, data):
+    await create_variations_for_user(context, query, uid, count=1)
 
-                await context.bot.send_photo(uid, watermarked)
 
-            # Используем одну генерацию
-            remaining = use_generation(uid)
+# Обработка кнопки "N вариаций": несколько вариаций за одно нажатие
+@router.exact("action_variations_n")
+async def cb_action_variations_n(update, context, query, uid, data):
+    await create_variations_for_user(context, query, uid, count=VARIANTS_COUNT)
 
-            await context.bot.send_message(
-                uid,
-                f"✅ <b>Вариация создана!</b>\n\n💎 Осталось генераций: {remaining}",
-                parse_mode="HTML",
-                reply_markup=actions_kb()
-            )
+
+async def create_variations_for_user(context, query, uid, count):
+    """Создаёт count вариаций последнего изображения (каждая вариация - отдельная генерация)"""
+    st = user_state[uid]
+    source = st.get("last_image")
+    if not source:
+        await query.answer("❌ Нет изображения для создания вариаций")
         return
 
-    # Обработка кнопки "Remove Background"
-    if data == "action_remove_bg":
-        st = user_state[uid]
-        if not st.get("last_image"):
-            await query.answer("❌ Нет изображения для удаления фона")
-            return
+    # Списываем генерации заранее и атомарно (как в очереди SD); если на все
+    # вариации не хватает остатка, делаем одну
+    reserved, remaining = try_use_generation(uid, count)
+    if not reserved and count > 1:
+        count = 1
+        reserved, remaining = try_use_generation(uid)
+    if not reserved:
+        await query.answer(
+            "❌ Вы исчерпали лимит бесплатных генераций (10 шт). "
+            "Свяжитесь с поддержкой для продления.",
+            show_alert=True
+        )
+        return
 
-        await query.edit_message_text("⏳ <b>Удаление фона...</b>\n\n🖌️ Обрабатываем изображение...", parse_mode="HTML")
+    delivered = 0
+    try:
+        await query.edit_message_text(
+            f"⏳ <b>Создание вариаций...</b>\n\n🎭 Генерируем "
+            f"{count} {plural_ru(count, 'похожее изображение', 'похожих изображения', 'похожих изображений')}...",
+            parse_mode="HTML"
+        )
 
-        # Удаляем фон
-        result = remove_background(st["last_image"])
+        # Вариации создаются параллельно (Stability возвращает одно изображение за запрос).
+        # У каждого запроса свой буфер: параллельные потоки не должны делить позицию чтения
+        source_bytes = source.getvalue() if isinstance(source, BytesIO) else None
+        results = await asyncio.gather(*(
+            run_blocking(
+                STABILITY, create_variations,
+                BytesIO(source_bytes) if source_bytes is not None else source,
+                prompt=st.get("prompt", "")
+            )
+            for _ in range(count)
+        ), return_exceptions=True)
+        variations = [item for result in results if isinstance(result, list) for item in result][:count]
 
-        if isinstance(result, str):
+        if not variations:
             # Ошибка
-            await query.edit_message_text(result)
-        else:
-            # Успех - отправляем изображение без фона
-            # Для PNG с прозрачностью не добавляем watermark, чтобы не портить прозрачность
+            error = next((result for result in results if isinstance(result, str)), None)
+            await query.edit_message_text(error or f"❌ Ошибка создания вариаций: {results[0]}")
+            return
+
+        # Успех
+        watermarked_images = []
+        for item in variations:
+            watermarked = add_watermark(item)
+            watermarked_images.append(watermarked)
 
             # Сохраняем отредактированное изображение в библиотеку
-            if USE_GCS and result:
+            if USE_GCS and watermarked:
                 try:
-                    gcs.save_user_image(uid, result, category='edited')
-                    print(f'[GCS] Edited image (remove_bg) saved to library')
+                    gcs.save_user_image(uid, watermarked, category='edited')
+                    logger.info("Edited image (variation) saved to library")
                 except Exception as e:
-                    print(f'[ERROR] Failed to save edited image: {e}')
+                    logger.error("Failed to save edited image: %s", e)
 
-            await context.bot.send_document(uid, result, filename="no_bg.png")
-            await context.bot.send_message(
-                uid,
-                "✅ <b>Фон удален!</b>\n\n🖌️ Изображение с прозрачным фоном готово",
-                parse_mode="HTML",
-                reply_markup=actions_kb()
-            )
-        return
+        await send_variants(context.bot, uid, watermarked_images)
+        delivered = len(variations)
+    finally:
+        # Не созданные или не отправленные вариации не списываются
+        if delivered < count:
+            remaining = refund_generation(uid, count - delivered)
 
-    # Обработка кнопки "Face Restore"
-    if data == "action_face_restore":
-        st = user_state[uid]
-        if not st.get("last_image"):
-            await query.answer("❌ Нет изображения для восстановления лица")
-            return
+    await context.bot.send_message(
+        uid,
+        f"✅ <b>Вариации созданы: {delivered}</b>\n\n💎 Осталось генераций: {remaining}",
+        parse_mode="HTML",
+        reply_markup=actions_kb()
+    )
 
-        await query.edit_message_text("⏳ <b>Восстановление лица...</b>\n\n👤 Улучшаем детали лица...", parse_mode="HTML")
 
-        # Восстанавливаем лицо
-        result = restore_face(st["last_image"])
+# Обработка кнопки "Remove Background"
+@router.exact("action_remove_bg")
+async def cb_action_remove_bg(update, context, query, uid, data):
+    st = user_state[uid]
+    if not st.get("last_image"):
+        await query.answer("❌ Нет изображения для удаления фона")
+        return
 
-        if isinstance(result, str):
-            # Ошибка
-            await query.edit_message_text(result)
-        else:
-            # Успех - отправляем улучшенное изображение
-            watermarked = add_watermark(result)
+    await query.edit_message_text("⏳ <b>Удаление фона...</b>\n\n🖌️ Обрабатываем изображение...", parse_mode="HTML")
+
+    # Удаляем фон
+    with metrics.span("provider", engine="remove_background", model="stability"):
+        result = await run_blocking(STABILITY, remove_background, st["last_image"])
+
+    if isinstance(result, str):
+        # Ошибка
+        await query.edit_message_text(result)
+    else:
+        # Успех - отправляем изображение без фона
+        # Для PNG с прозрачностью не добавляем watermark, чтобы не портить прозрачность
 
         # Сохраняем отредактированное изображение в библиотеку
         if USE_GCS and result:
             try:
                 gcs.save_user_image(uid, result, category='edited')
-                print(f'[GCS] Edited image saved to library')
+                logger.info("Edited image (remove_bg) saved to library")
             except Exception as e:
-                print(f'[ERROR] Failed to save edited image: {e}')
-            await context.bot.send_photo(uid, watermarked)
-            await context.bot.send_message(
-                uid,
-                "✅ <b>Лицо восстановлено!</b>\n\n👤 Детали лица улучшены",
-                parse_mode="HTML",
-                reply_markup=actions_kb()
-            )
+                logger.error("Failed to save edited image: %s", e)
+
+        await context.bot.send_document(uid, result, filename="no_bg.png")
+        await context.bot.send_message(
+            uid,
+            "✅ <b>Фон удален!</b>\n\n🖌️ Изображение с прозрачным фоном готово",
+            parse_mode="HTML",
+            reply_markup=actions_kb()
+        )
+
+
+# Обработка кнопки "Face Restore"
+@router.exact("action_face_restore")
+async def cb_action_face_restore(update, context, query, uid, data):
+    st = user_state[uid]
+    if not st.get("last_image"):
+        await query.answer("❌ Нет изображения для восстановления лица")
         return
 
-    # Обработка кнопки "Inpaint"
-    if data == "edit_inpaint":
-        print(f"[DEBUG] edit_inpaint called for user {uid}")
-        from telegram import InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+    await query.edit_message_text("⏳ <b>Восстановление лица...</b>\n\n👤 Улучшаем детали лица...", parse_mode="HTML")
 
-        st = user_state[uid]
-        print(f"[DEBUG] User state keys: {list(st.keys())}")
-        print(f"[DEBUG] last_image exists: {st.get('last_image') is not None}")
-        print(f"[DEBUG] edit_image exists: {st.get('edit_image') is not None}")
-        # Проверяем наличие изображения (может быть в last_image или edit_image)
-        image_source = st.get("last_image") or st.get("edit_image")
-        print(f"[DEBUG] image_source found: {image_source is not None}")
-        if not image_source:
-            await query.answer("❌ Нет изображения для inpainting")
-            return
+    # Восстанавливаем лицо
+    with metrics.span("provider", engine="restore_face", model="stability"):
+        result = await run_blocking(STABILITY, restore_face, st["last_image"])
 
-        await query.edit_message_text("⏳ <b>Загрузка редактора маски...</b>", parse_mode="HTML")
+    if isinstance(result, str):
+        # Ошибка
+        await query.edit_message_text(result)
+    else:
+        # Успех - отправляем улучшенное изображение
+        watermarked = add_watermark(result)
 
-        # Загружаем изображение на веб-сервер
-        webapp_url = await upload_image_to_webapp(context, image_source, uid)
+    # Сохраняем отредактированное изображение в библиотеку
+    if USE_GCS and result:
+        try:
+            gcs.save_user_image(uid, result, category='edited')
+            logger.info("Edited image saved to library")
+        except Exception as e:
+            logger.error("Failed to save edited image: %s", e)
+        await context.bot.send_photo(uid, watermarked)
+        await context.bot.send_message(
+            uid,
+            "✅ <b>Лицо восстановлено!</b>\n\n👤 Детали лица улучшены",
+            parse_mode="HTML",
+            reply_markup=actions_kb()
+        )
 
-        if not webapp_url:
-            # Веб-сервер недоступен - показываем инструкцию
-            await query.edit_message_text(
-                "❌ <b>Редактор маски недоступен</b>\n\n"
-                "Веб-сервер для Mini App не запущен.\n\n"
-                "<b>Альтернативный метод:</b>\n"
-                "1. Откройте изображение в графическом редакторе\n"
-                "2. Закрасьте БЕЛЫМ цветом область для изменения\n"
-                "3. Остальное закрасьте ЧЕРНЫМ\n"
-                "4. Сохраните как маску и отправьте боту\n\n"
-                "<b>Для администратора:</b>\n"
-                "Запустите <code>python webapp_server.py</code> для использования интерактивного редактора.",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("◀️ Назад", callback_data="action_new")]
-                ])
-            )
-            return
 
-        # Сохраняем изображение для обработки
-        user_state[uid]["edit_image"] = image_source
-        user_state[uid]["waiting_for_inpaint_mask"] = True
+# Обработка кнопки "Inpaint"
+@router.exact("edit_inpaint")
+async def cb_edit_inpaint(update, context, query, uid, data):
+    logger.debug("edit_inpaint called for user %s", uid)
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+
+    st = user_state[uid]
+    logger.debug("User state keys: %s", list(st.keys()))
+    logger.debug("last_image exists: %s", st.get('last_image') is not None)
+    logger.debug("edit_image exists: %s", st.get('edit_image') is not None)
+    # Проверяем наличие изображения (может быть в last_image или edit_image)
+    image_source = st.get("last_image") or st.get("edit_image")
+    logger.debug("image_source found: %s", image_source is not None)
+    if not image_source:
+        await query.answer("❌ Нет изображения для inpainting")
+        return
+
+    await query.edit_message_text("⏳ <b>Загрузка редактора маски...</b>", parse_mode="HTML")
 
-        # Создаем кнопку для открытия Mini App
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🎨 Открыть редактор", web_app=WebAppInfo(url=webapp_url))],
-            [InlineKeyboardButton("✅ Завершить", callback_data="inpaint_complete")],
-            [InlineKeyboardButton("❌ Отмена", callback_data="action_new")]
-        ])
+    # Загружаем изображение на веб-сервер
+    webapp_url = await upload_image_to_webapp(context, image_source, uid)
 
+    if not webapp_url:
+        # Веб-сервер недоступен - показываем инструкцию
         await query.edit_message_text(
-            "🎨 <b>Редактор маски готов!</b>\n\n"
-            "Нажмите кнопку ниже, чтобы открыть интерактивный редактор.\n\n"
-            "В редакторе:\n"
-            "• Закрасьте область, которую нужно изменить\n"
-            "• Используйте ползунок для изменения размера кисти\n"
-            "• Нажмите ✅ Готово когда закончите\n\n"
-            "После создания маски отправьте описание того, что должно появиться на закрашенной области.",
+            "❌ <b>Редактор маски недоступен</b>\n\n"
+            "Веб-сервер для Mini App не запущен.\n\n"
+            "<b>Альтернативный метод:</b>\n"
+            "1. Откройте изображение в графическом редакторе\n"
+            "2. Закрасьте БЕЛЫМ цветом область для изменения\n"
+            "3. Остальное закрасьте ЧЕРНЫМ\n"
+            "4. Сохраните как маску и отправьте боту\n\n"
+            "<b>Для администратора:</b>\n"
+            "Запустите <code>python webapp_server.py</code> для использования интерактивного редактора.",
             parse_mode="HTML",
-            reply_markup=keyboard
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("◀️ Назад", callback_data="action_new")]
+            ])
         )
         return
 
-    if data == "action_inpaint":
-        print(f"[DEBUG] action_inpaint called for user {uid}")
-        from telegram import InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+    # Сохраняем изображение для обработки
+    user_state[uid]["edit_image"] = image_source
+    user_state[uid]["waiting_for_inpaint_mask"] = True
 
-        st = user_state[uid]
-        print(f"[DEBUG] User state keys: {list(st.keys())}")
-        print(f"[DEBUG] last_image exists: {st.get('last_image') is not None}")
-        print(f"[DEBUG] edit_image exists: {st.get('edit_image') is not None}")
-        # Проверяем наличие изображения (может быть в last_image или edit_image)
-        image_source = st.get("last_image") or st.get("edit_image")
-        print(f"[DEBUG] image_source found: {image_source is not None}")
-        if not image_source:
-            await query.answer("❌ Нет изображения для inpainting")
-            return
+    # Создаем кнопку для открытия Mini App
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🎨 Открыть редактор", web_app=WebAppInfo(url=webapp_url))],
+        [InlineKeyboardButton("✅ Завершить", callback_data="inpaint_complete")],
+        [InlineKeyboardButton("❌ Отмена", callback_data="action_new")]
+    ])
 
-        await query.edit_message_text("⏳ <b>Загрузка редактора маски...</b>", parse_mode="HTML")
+    await query.edit_message_text(
+        "🎨 <b>Редактор маски готов!</b>\n\n"
+        "Нажмите кнопку ниже, чтобы открыть интерактивный редактор.\n\n"
+        "В редакторе:\n"
+        "• Закрасьте область, которую нужно изменить\n"
+        "• Используйте ползунок для изменения размера кисти\n"
+        "• Нажмите ✅ Готово когда закончите\n\n"
+        "После создания маски отправьте описание того, что должно появиться на закрашенной области.",
+        parse_mode="HTML",
+        reply_markup=keyboard
+    )
 
-        # Загружаем изображение на веб-сервер
-        webapp_url = await upload_image_to_webapp(context, image_source, uid)
 
-        if not webapp_url:
-            # Веб-сервер недоступен - показываем инструкцию
-            await query.edit_message_text(
-                "❌ <b>Редактор маски недоступен</b>\n\n"
-                "Веб-сервер для Mini App не запущен.\n\n"
-                "<b>Альтернативный метод:</b>\n"
-                "1. Откройте изображение в графическом редакторе\n"
-                "2. Закрасьте БЕЛЫМ цветом область для изменения\n"
-                "3. Остальное закрасьте ЧЕРНЫМ\n"
-                "4. Сохраните как маску и отправьте боту\n\n"
-                "<b>Для администратора:</b>\n"
-                "Запустите <code>python webapp_server.py</code> для использования интерактивного редактора.",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("◀️ Назад", callback_data="action_new")]
-                ])
-            )
-            return
+@router.exact("action_inpaint")
+async def cb_action_inpaint(update, context, query, uid, data):
+    logger.debug("action_inpaint called for user %s", uid)
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+
+    st = user_state[uid]
+    logger.debug("User state keys: %s", list(st.keys()))
+    logger.debug("last_image exists: %s", st.get('last_image') is not None)
+    logger.debug("edit_image exists: %s", st.get('edit_image') is not None)
+    # Проверяем наличие изображения (может быть в last_image или edit_image)
+    image_source = st.get("last_image") or st.get("edit_image")
+    logger.debug("image_source found: %s", image_source is not None)
+    if not image_source:
+        await query.answer("❌ Нет изображения для inpainting")
+        return
 
-        # Сохраняем last_image в edit_image для обработки
-        user_state[uid]["edit_image"] = image_source
-        user_state[uid]["waiting_for_inpaint_mask"] = True
+    await query.edit_message_text("⏳ <b>Загрузка редактора маски...</b>", parse_mode="HTML")
 
-        # Создаем кнопку для открытия Mini App
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🎨 Открыть редактор", web_app=WebAppInfo(url=webapp_url))],
-            [InlineKeyboardButton("✅ Завершить", callback_data="inpaint_complete")],
-            [InlineKeyboardButton("❌ Отмена", callback_data="action_new")]
-        ])
+    # Загружаем изображение на веб-сервер
+    webapp_url = await upload_image_to_webapp(context, image_source, uid)
 
+    if not webapp_url:
+        # Веб-сервер недоступен - показываем инструкцию
         await query.edit_message_text(
-            "🎨 <b>Inpainting - редактирование части изображения</b>\n\n"
-            "Нажмите кнопку ниже, чтобы открыть редактор маски.\n\n"
-            "В редакторе:\n"
-            "• Закрасьте кисточкой область, которую хотите изменить\n"
-            "• Используйте ползунок для изменения размера кисти\n"
-            "• Нажмите 'Готово' когда закончите\n\n"
-            "После этого вам нужно будет описать, что должно быть на закрашенной области.",
-            reply_markup=keyboard,
-            parse_mode="HTML"
+            "❌ <b>Редактор маски недоступен</b>\n\n"
+            "Веб-сервер для Mini App не запущен.\n\n"
+            "<b>Альтернативный метод:</b>\n"
+            "1. Откройте изображение в графическом редакторе\n"
+            "2. Закрасьте БЕЛЫМ цветом область для изменения\n"
+            "3. Остальное закрасьте ЧЕРНЫМ\n"
+            "4. Сохраните как маску и отправьте боту\n\n"
+            "<b>Для администратора:</b>\n"
+            "Запустите <code>python webapp_server.py</code> для использования интерактивного редактора.",
+            parse_mode="HTML",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("◀️ Назад", callback_data="action_new")]
+            ])
         )
         return
 
-    # Обработка кнопки "Сохранить как пресет"
-    # Обработка кнопки "✅ Завершить" для inpaint
-    if data == "inpaint_complete":
-        import requests
-        
-        # Получаем pending mask с сервера
-        try:
-            response = requests.get(f'https://imagegen.tools.uspeshnyy.ru/get_pending_mask/{uid}', timeout=10)
-            if response.status_code == 200:
-                mask_data = response.json()
-                mask_id = mask_data.get('mask_id')
-                
-                if not mask_id:
-                    await query.answer("Маска не найдена. Нажмите 'Готово' в редакторе.", show_alert=True)
-                    return
-                
-                # Получаем саму маску
-                mask_response = requests.get(f'https://imagegen.tools.uspeshnyy.ru/get_mask/{mask_id}', timeout=10)
-                if mask_response.status_code != 200:
-                    await query.answer("Не удалось получить маску", show_alert=True)
-                    return
-                
-                mask_full_data = mask_response.json()
-                mask_data_url = mask_full_data.get('mask')
-                original_width = mask_full_data.get('original_width')
-                original_height = mask_full_data.get('original_height')
-                
-                # Декодируем
-                import base64
-                from io import BytesIO
-                mask_b64 = mask_data_url.split(',')[1]
-                mask_bytes = base64.b64decode(mask_b64)
-                mask_image = BytesIO(mask_bytes)
+    # Сохраняем last_image в edit_image для обработки
+    user_state[uid]["edit_image"] = image_source
+    user_state[uid]["waiting_for_inpaint_mask"] = True
+
+    # Создаем кнопку для открытия Mini App
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🎨 Открыть редактор", web_app=WebAppInfo(url=webapp_url))],
+        [InlineKeyboardButton("✅ Завершить", callback_data="inpaint_complete")],
+        [InlineKeyboardButton("❌ Отмена", callback_data="action_new")]
+    ])
+
+    await query.edit_message_text(
+        "🎨 <b>Inpainting - редактирование части изображения</b>\n\n"
+        "Нажмите кнопку ниже, чтобы открыть редактор маски.\n\n"
+        "В редакторе:\n"
+        "• Закрасьте кисточкой область, которую хотите изменить\n"
+        "• Используйте ползунок для изменения размера кисти\n"
+        "• Нажмите 'Готово' когда закончите\n\n"
+        "После этого вам нужно будет описать, что должно быть на закрашенной области.",
+        reply_markup=keyboard,
+        parse_mode="HTML"
+    )
+
+
+# Обработка кнопки "Сохранить как пресет"
+# Обработка кнопки "✅ Завершить" для inpaint
+@router.exact("inpaint_complete")
+async def cb_inpaint_complete(update, context, query, uid, data):
+    # Получаем pending mask с сервера
+    try:
+        response = await run_blocking(WEB, get_session(WEB).get, f'https://imagegen.tools.uspeshnyy.ru/get_pending_mask/{uid}', timeout=10)
+        if response.status_code == 200:
+            mask_data = response.json()
+            mask_id = mask_data.get('mask_id')
+            
+            if not mask_id:
+                await query.answer("Маска не найдена. Нажмите 'Готово' в редакторе.", show_alert=True)
+                return
+            
+            # Получаем саму маску
+            mask_response = await run_blocking(WEB, get_session(WEB).get, f'https://imagegen.tools.uspeshnyy.ru/get_mask/{mask_id}', timeout=10)
+            if mask_response.status_code != 200:
+                await query.answer("Не удалось получить маску", show_alert=True)
+                return
+            
+            mask_full_data = mask_response.json()
+            mask_data_url = mask_full_data.get('mask')
+            original_width = mask_full_data.get('original_width')
+            original_height = mask_full_data.get('original_height')
+            
+            # Декодируем
+            import base64
+            from io import BytesIO
+            mask_b64 = mask_data_url.split(',')[1]
+            mask_bytes = base64.b64decode(mask_b64)
+            mask_image = BytesIO(mask_bytes)
+            mask_image.seek(0)
+            
+            # Масштабируем обратно если нужно
+            if original_width and original_height:
+                from PIL import Image
+                img = Image.open(mask_image)
+                img_resized = img.resize((original_width, original_height), Image.Resampling.LANCZOS)
+                mask_image = BytesIO()
+                img_resized.save(mask_image, format='PNG')
                 mask_image.seek(0)
-                
-                # Масштабируем обратно если нужно
-                if original_width and original_height:
-                    from PIL import Image
-                    img = Image.open(mask_image)
-                    img_resized = img.resize((original_width, original_height), Image.Resampling.LANCZOS)
-                    mask_image = BytesIO()
-                    img_resized.save(mask_image, format='PNG')
-                    mask_image.seek(0)
-                
-                # Сохраняем в user_state
-                user_state[uid]["inpaint_mask"] = mask_image
-                user_state[uid]["waiting_for_inpaint_prompt"] = True
-                
-                await query.edit_message_text(
-                    "✅ Маска получена!\n\nТеперь опишите, что должно быть на закрашенной области.",
-                    parse_mode='HTML'
-                )
-            else:
-                await query.answer("Маска не найдена. Сначала нажмите 'Готово' в редакторе.", show_alert=True)
-        except Exception as e:
-            await query.answer(f"Ошибка: {e}", show_alert=True)
-            import traceback
-            traceback.print_exc()
-        return
+            
+            # Сохраняем в user_state
+            user_state[uid]["inpaint_mask"] = mask_image
+            user_state[uid]["waiting_for_inpaint_prompt"] = True
+            
+            await query.edit_message_text(
+                "✅ Маска получена!\n\nТеперь опишите, что должно быть на закрашенной области.",
+                parse_mode='HTML'
+            )
+        else:
+            await query.answer("Маска не найдена. Сначала нажмите 'Готово' в редакторе.", show_alert=True)
+    except Exception as e:
+        await query.answer(f"Ошибка: {e}", show_alert=True)
+        logger.exception("Failed to fetch mask")
 
-    if data == "action_save_preset":
-        st = user_state[uid]
-        if not st.get("saved_params"):
-            await query.answer("❌ Нет сохраненных параметров")
-            return
 
-        user_state[uid]["awaiting_preset_name"] = True
-        await query.edit_message_text(
-            "💾 <b>Сохранить пресет</b>\n\n"
-            "Введите название для пресета (например: 'Портрет 4K', 'Пейзаж cinematic'):",
-            parse_mode="HTML"
-        )
+@router.exact("action_save_preset")
+async def cb_action_save_preset(update, context, query, uid, data):
+    st = user_state[uid]
+    if not st.get("saved_params"):
+        await query.answer("❌ Нет сохраненных параметров")
         return
 
-    # Обработка кнопки "New image" - начать сначала
-    if data == "action_new":
-        user_state.pop(uid, None)  # Это автоматически очищает in_refinement_mode
-        await query.edit_message_text("🆕 Готов к новому изображению!\n\nПришли текст, ссылку или фото с описанием.")
-        return
+    user_state[uid]["awaiting_preset_name"] = True
+    await query.edit_message_text(
+        "💾 <b>Сохранить пресет</b>\n\n"
+        "Введите название для пресета (например: 'Портрет 4K', 'Пейзаж cinematic'):",
+        parse_mode="HTML"
+    )
 
-    # Обработка кнопок дополнительных параметров (вид, положение камеры, освещение)
-    if data == "want_additional":
-        # Показываем диалог выбора вида (shots)
-        await query.edit_message_text(
-            "🎬 <b>Вид</b>\n\nВыберите вид съемки:",
-            reply_markup=shot_kb(),
-            parse_mode="HTML"
-        )
-        return
 
-    if data == "skip_additional":
-        # Пропускаем дополнительные параметры и переходим к negative prompt
-        await query.edit_message_text(
-            "🚫 <b>Negative Prompt</b>\n\n"
-            "Хотите указать, что НЕ должно быть на изображении?\n\n"
-            "<i>Например:</i>\n"
-            "<blockquote>Не используйте искажения, мультяшные эффекты, размытие или водяные знаки.</blockquote>",
-            reply_markup=negative_prompt_kb(),
-            parse_mode="HTML"
-        )
-        return
+# Обработка кнопки "New image" - начать сначала
+@router.exact("action_new")
+async def cb_action_new(update, context, query, uid, data):
+    user_state.pop(uid, None)  # Это автоматически очищает in_refinement_mode
+    await query.edit_message_text("🆕 Готов к новому изображению!\n\nПришли текст, ссылку или фото с описанием.")
 
-    # Обработка выбора вида (shots)
-    if data.startswith("shot_"):
-        user_state[uid]["additional_params"]["shot"] = data[5:]
-        # Показываем диалог выбора положения камеры
-        await query.edit_message_text(
-            "📐 <b>Положение камеры</b>\n\nВыберите ракурс:",
-            reply_markup=angle_kb(),
-            parse_mode="HTML"
-        )
-        return
 
-    if data == "skip_shot":
-        user_state[uid]["additional_params"]["shot"] = ""
-        # Показываем диалог выбора положения камеры
-        await query.edit_message_text(
-            "📐 <b>Положение камеры</b>\n\nВыберите ракурс:",
-            reply_markup=angle_kb(),
-            parse_mode="HTML"
-        )
-        return
+# Обработка кнопок дополнительных параметров (вид, положение камеры, освещение)
+@router.exact("want_additional")
+async def cb_want_additional(update, context, query, uid, data):
+    # Показываем диалог выбора вида (shots)
+    await query.edit_message_text(
+        "🎬 <b>Вид</b>\n\nВыберите вид съемки:",
+        reply_markup=shot_kb(),
+        parse_mode="HTML"
+    )
 
-    # Обработка выбора положения камеры
-    if data.startswith("angle_"):
-        user_state[uid]["additional_params"]["angle"] = data[6:]
-        # Показываем диалог выбора освещения
-        await query.edit_message_text(
-            "💡 <b>Освещение</b>\n\nВыберите тип освещения:",
-            reply_markup=lighting_kb(),
-            parse_mode="HTML"
-        )
-        return
 
-    if data == "skip_angle":
-        user_state[uid]["additional_params"]["angle"] = ""
-        # Показываем диалог выбора освещения
-        await query.edit_message_text(
-            "💡 <b>Освещение</b>\n\nВыберите тип освещения:",
-            reply_markup=lighting_kb(),
-            parse_mode="HTML"
-        )
-        return
+@router.exact("skip_additional")
+async def cb_skip_additional(update, context, query, uid, data):
+    # Пропускаем дополнительные параметры и переходим к negative prompt
+    await query.edit_message_text(
+        "🚫 <b>Negative Prompt</b>\n\n"
+        "Хотите указать, что НЕ должно быть на изображении?\n\n"
+        "<i>Например:</i>\n"
+        "<blockquote>Не используйте искажения, мультяшные эффекты, размытие или водяные знаки.</blockquote>",
+        reply_markup=negative_prompt_kb(),
+        parse_mode="HTML"
+    )
 
-    # Обработка выбора освещения
-    if data.startswith("light_"):
-        user_state[uid]["additional_params"]["lighting"] = data[6:]
-        # Переходим к negative prompt
-        await query.edit_message_text(
-            "🚫 <b>Negative Prompt</b>\n\n"
-            "Хотите указать, что НЕ должно быть на изображении?\n\n"
-            "<i>Например:</i>\n"
-            "<blockquote>Не используйте искажения, мультяшные эффекты, размытие или водяные знаки.</blockquote>",
-            reply_markup=negative_prompt_kb(),
-            parse_mode="HTML"
-        )
-        return
 
-    if data == "skip_lighting":
-        user_state[uid]["additional_params"]["lighting"] = ""
-        # Переходим к negative prompt
-        await query.edit_message_text(
-            "🚫 <b>Negative Prompt</b>\n\n"
-            "Хотите указать, что НЕ должно быть на изображении?\n\n"
-            "<i>Например:</i>\n"
-            "<blockquote>Не используйте искажения, мультяшные эффекты, размытие или водяные знаки.</blockquote>",
-            reply_markup=negative_prompt_kb(),
-            parse_mode="HTML"
-        )
-        return
+# Обработка выбора вида (shots)
+@router.prefix("shot_")
+async def cb_shot(update, context, query, uid, data):
+    user_state[uid]["additional_params"]["shot"] = data[5:]
+    # Показываем диалог выбора положения камеры
+    await query.edit_message_text(
+        "📐 <b>Положение камеры</b>\n\nВыберите ракурс:",
+        reply_markup=angle_kb(),
+        parse_mode="HTML"
+    )
+
+
+@router.exact("skip_shot")
+async def cb_skip_shot(update, context, query, uid, data):
+    user_state[uid]["additional_params"]["shot"] = ""
+    # Показываем диалог выбора положения камеры
+    await query.edit_message_text(
+        "📐 <b>Положение камеры</b>\n\nВыберите ракурс:",
+        reply_markup=angle_kb(),
+        parse_mode="HTML"
+    )
+
+
+# Обработка выбора положения камеры
+@router.prefix("angle_")
+async def cb_angle(update, context, query, uid, data):
+    user_state[uid]["additional_params"]["angle"] = data[6:]
+    # Показываем диалог выбора освещения
+    await query.edit_message_text(
+        "💡 <b>Освещение</b>\n\nВыберите тип освещения:",
+        reply_markup=lighting_kb(),
+        parse_mode="HTML"
+    )
+
+
+@router.exact("skip_angle")
+async def cb_skip_angle(update, context, query, uid, data):
+    user_state[uid]["additional_params"]["angle"] = ""
+    # Показываем диалог выбора освещения
+    await query.edit_message_text(
+        "💡 <b>Освещение</b>\n\nВыберите тип освещения:",
+        reply_markup=lighting_kb(),
+        parse_mode="HTML"
+    )
+
+
+# Обработка выбора освещения
+@router.prefix("light_")
+async def cb_light(update, context, query, uid, data):
+    user_state[uid]["additional_params"]["lighting"] = data[6:]
+    # Переходим к negative prompt
+    await query.edit_message_text(
+        "🚫 <b>Negative Prompt</b>\n\n"
+        "Хотите указать, что НЕ должно быть на изображении?\n\n"
+        "<i>Например:</i>\n"
+        "<blockquote>Не используйте искажения, мультяшные эффекты, размытие или водяные знаки.</blockquote>",
+        reply_markup=negative_prompt_kb(),
+        parse_mode="HTML"
+    )
+
+
+@router.exact("skip_lighting")
+async def cb_skip_lighting(update, context, query, uid, data):
+    user_state[uid]["additional_params"]["lighting"] = ""
+    # Переходим к negative prompt
+    await query.edit_message_text(
+        "🚫 <b>Negative Prompt</b>\n\n"
+        "Хотите указать, что НЕ должно быть на изображении?\n\n"
+        "<i>Например:</i>\n"
+        "<blockquote>Не используйте искажения, мультяшные эффекты, размытие или водяные знаки.</blockquote>",
+        reply_markup=negative_prompt_kb(),
+        parse_mode="HTML"
+    )
+
+
+# Обработка кнопок negative prompt
+@router.exact("add_negative")
+async def cb_add_negative(update, context, query, uid, data):
+    user_state[uid]["awaiting_negative_prompt"] = True
+    await query.edit_message_text(
+        "🚫 <b>Введите Negative Prompt</b>\n\n"
+        "Напишите, что НЕ должно быть на изображении.\n\n"
+        "<i>Примеры: blurry, low quality, distorted, ugly, bad anatomy</i>",
+        parse_mode="HTML"
+    )
+
+
+@router.exact("skip_negative")
+async def cb_skip_negative(update, context, query, uid, data):
+    user_state[uid]["negative_prompt"] = ""
+    await show_final_prompt(query, uid)
 
-    # Обработка кнопок negative prompt
-    if data == "add_negative":
-        user_state[uid]["awaiting_negative_prompt"] = True
-        await query.edit_message_text(
-            "🚫 <b>Введите Negative Prompt</b>\n\n"
-            "Напишите, что НЕ должно быть на изображении.\n\n"
-            "<i>Примеры: blurry, low quality, distorted, ugly, bad anatomy</i>",
-            parse_mode="HTML"
-        )
-        return
 
-    if data == "skip_negative":
-        user_state[uid]["negative_prompt"] = ""
-        await show_final_prompt(query, uid)
-        return
+# Обработка кнопок пресетов
+@router.exact("presets_list")
+async def cb_presets_list(update, context, query, uid, data):
+    user_presets = get_user_presets(uid)
 
-    # Обработка кнопок пресетов
-    if data == "presets_list":
-        user_presets = get_user_presets(uid)
+    msg = "💾 <b>Мои пресеты</b>\n\n"
+    if user_presets:
+        msg += "Выберите пресет для просмотра:\n\n"
+    else:
+        msg += "У вас пока нет сохраненных пресетов.\n\nСоздайте пресет, сохранив текущие настройки генерации!"
+
+    await query.edit_message_text(
+        msg,
+        reply_markup=presets_list_kb(user_presets),
+        parse_mode="HTML"
+    )
 
-        msg = "💾 <b>Мои пресеты</b>\n\n"
-        if user_presets:
-            msg += "Выберите пресет для просмотра:\n\n"
-        else:
-            msg += "У вас пока нет сохраненных пресетов.\n\nСоздайте пресет, сохранив текущие настройки генерации!"
 
+@router.exact("presets_save_current")
+async def cb_presets_save_current(update, context, query, uid, data):
+    # Проверяем, есть ли сохраненные параметры в state
+    if "saved_params" in user_state[uid]:
+        user_state[uid]["awaiting_preset_name"] = True
         await query.edit_message_text(
-            msg,
-            reply_markup=presets_list_kb(user_presets),
+            "💾 <b>Сохранить пресет</b>\n\n"
+            "Введите название для пресета (например: 'Портрет 4K', 'Пейзаж cinematic'):",
             parse_mode="HTML"
         )
-        return
+    else:
+        await query.answer(
+            "❌ Нет параметров для сохранения. Сначала создайте изображение!",
+            show_alert=True
+        )
 
-    if data == "presets_save_current":
-        # Проверяем, есть ли сохраненные параметры в state
-        if "saved_params" in user_state[uid]:
-            user_state[uid]["awaiting_preset_name"] = True
-            await query.edit_message_text(
-                "💾 <b>Сохранить пресет</b>\n\n"
-                "Введите название для пресета (например: 'Портрет 4K', 'Пейзаж cinematic'):",
-                parse_mode="HTML"
-            )
-        else:
-            await query.answer(
-                "❌ Нет параметров для сохранения. Сначала создайте изображение!",
-                show_alert=True
-            )
-        return
 
-    if data == "presets_back":
-        await query.message.delete()
-        # Вызываем команду presets заново
-        await presets_command(update, context)
-        return
+@router.exact("presets_back")
+async def cb_presets_back(update, context, query, uid, data):
+    await query.message.delete()
+    # Вызываем команду presets заново
+    await presets_command(update, context)
 
-    if data.startswith("preset_load_"):
-        preset_name = data[12:]  # Убираем "preset_load_"
-        preset_data = get_preset(uid, preset_name)
 
-        if not preset_data:
-            await query.answer("Пресет не найден", show_alert=True)
-            return
+@router.prefix("preset_load_")
+async def cb_preset_load(update, context, query, uid, data):
+    preset_name = data[12:]  # Убираем "preset_load_"
+    preset_data = get_preset(uid, preset_name)
 
-        # Форматируем данные для отображения
-        model_ru = {
-            "sd3.5-large": "SD 3.5 Large",
-            "sd3.5-large-turbo": "SD 3.5 Large Turbo",
-            "sd3.5-medium": "SD 3.5 Medium",
-            "sd3.5-flash": "SD 3.5 Flash"
-        }
+    if not preset_data:
+        await query.answer("Пресет не найден", show_alert=True)
+        return
 
-        format_ru = {
-            "1:1": "1:1 (квадрат)",
-            "21:9": "21:9 (ультра-широкий)",
-            "16:9": "16:9 (горизонтально)",
-            "3:2": "3:2",
-            "5:4": "5:4",
-            "4:5": "4:5",
-            "2:3": "2:3",
-            "9:16": "9:16 (вертикально)",
-            "9:21": "9:21 (ультра-вертикально)"
-        }
+    # Форматируем данные для отображения
+    model_ru = {
+        "sd3.5-large": "SD 3.5 Large",
+        "sd3.5-large-turbo": "SD 3.5 Large Turbo",
+        "sd3.5-medium": "SD 3.5 Medium",
+        "sd3.5-flash": "SD 3.5 Flash"
+    }
 
-        msg = f"""📌 <b>Пресет: {preset_name}</b>
+    format_ru = {
+        "1:1": "1:1 (квадрат)",
+        "21:9": "21:9 (ультра-широкий)",
+        "16:9": "16:9 (горизонтально)",
+        "3:2": "3:2",
+        "5:4": "5:4",
+        "4:5": "4:5",
+        "2:3": "2:3",
+        "9:16": "9:16 (вертикально)",
+        "9:21": "9:21 (ультра-вертикально)"
+    }
+
+    msg = f"""📌 <b>Пресет: {preset_name}</b>
 
 🎨 Модель: {model_ru.get(preset_data['model'], preset_data['model'])}
 📐 Формат: {format_ru.get(preset_data['format'], preset_data['format'])}
 🖌 Стиль: {preset_data.get('style', 'none')}"""
 
-        if preset_data.get('negative_prompt'):
-            msg += f"\n🚫 Negative: {preset_data['negative_prompt']}"
+    if preset_data.get('negative_prompt'):
+        msg += f"\n🚫 Negative: {preset_data['negative_prompt']}"
 
-        await query.edit_message_text(
-            msg,
-            reply_markup=preset_actions_kb(preset_name),
-            parse_mode="HTML"
-        )
+    await query.edit_message_text(
+        msg,
+        reply_markup=preset_actions_kb(preset_name),
+        parse_mode="HTML"
+    )
+
+
+@router.prefix("preset_apply_")
+async def cb_preset_apply(update, context, query, uid, data):
+    preset_name = data[13:]  # Убираем "preset_apply_"
+    preset_data = get_preset(uid, preset_name)
+
+    if not preset_data:
+        await query.answer("Пресет не найден", show_alert=True)
         return
 
-    if data.startswith("preset_apply_"):
-        preset_name = data[13:]  # Убираем "preset_apply_"
-        preset_data = get_preset(uid, preset_name)
+    # Применяем пресет к текущему state
+    user_state[uid]["model"] = preset_data["model"]
+    user_state[uid]["format"] = preset_data["format"]
+    user_state[uid]["style"] = preset_data.get("style", "none")
+    user_state[uid]["negative_prompt"] = preset_data.get("negative_prompt", "")
+
+    await query.answer(f"✅ Пресет '{preset_name}' применен!", show_alert=True)
+    await query.edit_message_text(
+        f"✅ <b>Пресет применен!</b>\n\n"
+        f"Теперь используйте /new для создания изображения с этими параметрами.",
+        parse_mode="HTML"
+    )
 
-        if not preset_data:
-            await query.answer("Пресет не найден", show_alert=True)
-            return
 
-        # Применяем пресет к текущему state
-        user_state[uid]["model"] = preset_data["model"]
-        user_state[uid]["format"] = preset_data["format"]
-        user_state[uid]["style"] = preset_data.get("style", "none")
-        user_state[uid]["negative_prompt"] = preset_data.get("negative_prompt", "")
+@router.prefix("preset_delete_")
+async def cb_preset_delete(update, context, query, uid, data):
+    preset_name = data[14:]  # Убираем "preset_delete_"
+
+    success = delete_preset(uid, preset_name)
+
+    if success:
+        await query.answer(f"✅ Пресет '{preset_name}' удален", show_alert=True)
+        # Возвращаемся к списку пресетов
+        user_presets = get_user_presets(uid)
+        msg = "💾 <b>Мои пресеты</b>\n\n"
+        if user_presets:
+            msg += "Выберите пресет для просмотра:\n\n"
+        else:
+            msg += "У вас больше нет сохраненных пресетов."
 
-        await query.answer(f"✅ Пресет '{preset_name}' применен!", show_alert=True)
         await query.edit_message_text(
-            f"✅ <b>Пресет применен!</b>\n\n"
-            f"Теперь используйте /new для создания изображения с этими параметрами.",
+            msg,
+            reply_markup=presets_list_kb(user_presets),
             parse_mode="HTML"
         )
-        return
+    else:
+        await query.answer("❌ Ошибка при удалении пресета", show_alert=True)
 
-    if data.startswith("preset_delete_"):
-        preset_name = data[14:]  # Убираем "preset_delete_"
 
-        success = delete_preset(uid, preset_name)
+@router.exact("preset_none")
+async def cb_preset_none(update, context, query, uid, data):
+    # Заглушка для кнопки "Нет пресетов"
+    await query.answer("Создайте первый пресет!", show_alert=True)
 
-        if success:
-            await query.answer(f"✅ Пресет '{preset_name}' удален", show_alert=True)
-            # Возвращаемся к списку пресетов
-            user_presets = get_user_presets(uid)
-            msg = "💾 <b>Мои пресеты</b>\n\n"
-            if user_presets:
-                msg += "Выберите пресет для просмотра:\n\n"
-            else:
-                msg += "У вас больше нет сохраненных пресетов."
 
-            await query.edit_message_text(
-                msg,
-                reply_markup=presets_list_kb(user_presets),
-                parse_mode="HTML"
-            )
-        else:
-            await query.answer("❌ Ошибка при удалении пресета", show_alert=True)
-        return
+# Обработка кнопок покупки генераций
+@router.prefix("package_")
+async def cb_package(update, context, query, uid, data):
+    package_id = data[8:]  # Убираем "package_"
+    package = get_package_info(package_id)
 
-    if data == "preset_none":
-        # Заглушка для кнопки "Нет пресетов"
-        await query.answer("Создайте первый пресет!", show_alert=True)
+    if not package:
+        await query.answer("❌ Пакет не найден", show_alert=True)
         return
 
-    # Обработка кнопок покупки генераций
-    if data.startswith("package_"):
-        package_id = data[8:]  # Убираем "package_"
-        package = get_package_info(package_id)
+    msg = f"""{format_package_message(package_id)}
 
-        if not package:
-            await query.answer("❌ Пакет не найден", show_alert=True)
-            return
+Выберите способ оплаты:"""
 
-        msg = f"""{format_package_message(package_id)}
+    await query.edit_message_text(
+        msg,
+        reply_markup=payment_method_kb(package_id),
+        parse_mode="HTML"
+    )
 
-Выберите способ оплаты:"""
 
-        await query.edit_message_text(
-            msg,
-            reply_markup=payment_method_kb(package_id),
-            parse_mode="HTML"
-        )
+@router.prefix("pay_stars_")
+async def cb_pay_stars(update, context, query, uid, data):
+    package_id = data[10:]  # Убираем "pay_stars_"
+    package = get_package_info(package_id)
+
+    if not package:
+        await query.answer("❌ Пакет не найден", show_alert=True)
         return
 
-    if data.startswith("pay_stars_"):
-        package_id = data[10:]  # Убираем "pay_stars_"
-        package = get_package_info(package_id)
+    # Создаем invoice для Telegram Stars
+    from telegram import LabeledPrice
 
-        if not package:
-            await query.answer("❌ Пакет не найден", show_alert=True)
-            return
+    title = f"{package['name']} - {package['description']}"
+    description = f"Пакет {package['generations']} генераций"
+    payload = f"{uid}:{package_id}"
+    currency = "XTR"  # Telegram Stars
+    prices = [LabeledPrice("Генерации", package["stars"])]
 
-        # Создаем invoice для Telegram Stars
-        from telegram import LabeledPrice
-
-        title = f"{package['name']} - {package['description']}"
-        description = f"Пакет {package['generations']} генераций"
-        payload = f"{uid}:{package_id}"
-        currency = "XTR"  # Telegram Stars
-        prices = [LabeledPrice("Генерации", package["stars"])]
-
-        await context.bot.send_invoice(
-            chat_id=uid,
-            title=title,
-            description=description,
-            payload=payload,
-            provider_token="",  # Пусто для Stars
-            currency=currency,
-            prices=prices
-        )
+    await context.bot.send_invoice(
+        chat_id=uid,
+        title=title,
+        description=description,
+        payload=payload,
+        provider_token="",  # Пусто для Stars
+        currency=currency,
+        prices=prices
+    )
 
-        await query.answer("✅ Инвойс создан! Проверьте чат", show_alert=True)
-        return
+    await query.answer("✅ Инвойс создан! Проверьте чат", show_alert=True)
 
-    if data.startswith("pay_crypto_"):
-        package_id = data[11:]  # Убираем "pay_crypto_"
-        package = get_package_info(package_id)
 
-        if not package:
-            await query.answer("❌ Пакет не найден", show_alert=True)
-            return
+@router.prefix("pay_crypto_")
+async def cb_pay_crypto(update, context, query, uid, data):
+    package_id = data[11:]  # Убираем "pay_crypto_"
+    package = get_package_info(package_id)
 
-        # Создаем invoice через CryptoBot
-        invoice = create_cryptobot_invoice(uid, package_id)
+    if not package:
+        await query.answer("❌ Пакет не найден", show_alert=True)
+        return
 
-        if not invoice:
-            await query.edit_message_text(
-                "❌ <b>Ошибка создания инвойса</b>\n\n"
-                "Попробуйте позже или выберите Telegram Stars.",
-                parse_mode="HTML"
-            )
-            return
+    # Создаем invoice через CryptoBot
+    invoice = await run_blocking(CRYPTOBOT, create_cryptobot_invoice, uid, package_id)
+
+    if not invoice:
+        await query.edit_message_text(
+            "❌ <b>Ошибка создания инвойса</b>\n\n"
+            "Попробуйте позже или выберите Telegram Stars.",
+            parse_mode="HTML"
+        )
+        return
 
-        # Получаем ссылку на оплату
-        pay_url = invoice.get("pay_url") or invoice.get("bot_invoice_url")
+    # Получаем ссылку на оплату
+    pay_url = invoice.get("pay_url") or invoice.get("bot_invoice_url")
 
-        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("💰 Оплатить", url=pay_url)],
-            [InlineKeyboardButton("◀️ Назад", callback_data="buy_packages")]
-        ])
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("💰 Оплатить", url=pay_url)],
+        [InlineKeyboardButton("◀️ Назад", callback_data="buy_packages")]
+    ])
 
-        msg = f"""💰 <b>Оплата через CryptoBot</b>
+    msg = f"""💰 <b>Оплата через CryptoBot</b>
 
 📦 Пакет: {package['name']}
 💎 Генераций: {package['generations']}
@@ -3258,94 +3263,98 @@ async def callbacks(update, context):
 Нажмите кнопку ниже для оплаты.
 После оплаты генерации будут добавлены автоматически."""
 
-        await query.edit_message_text(
-            msg,
-            reply_markup=keyboard,
-            parse_mode="HTML"
-        )
-        return
+    await query.edit_message_text(
+        msg,
+        reply_markup=keyboard,
+        parse_mode="HTML"
+    )
+
 
-    if data == "buy_packages":
-        # Возврат к списку пакетов
-        stats = get_user_stats(uid)
-        remaining = stats["remaining"]
+@router.exact("buy_packages")
+async def cb_buy_packages(update, context, query, uid, data):
+    # Возврат к списку пакетов
+    stats = get_user_stats(uid)
+    remaining = stats["remaining"]
 
-        msg = f"""💎 <b>Купить генерации</b>
+    msg = f"""💎 <b>Купить генерации</b>
 
 📊 <b>Ваш баланс:</b> {remaining} генераций
 
 {get_all_packages_message()}"""
 
-        await query.edit_message_text(
-            msg,
-            reply_markup=packages_kb(),
-            parse_mode="HTML"
-        )
-        return
+    await query.edit_message_text(
+        msg,
+        reply_markup=packages_kb(),
+        parse_mode="HTML"
+    )
 
-    if data == "buy_back":
-        # Закрыть меню покупки
-        await query.message.delete()
-        return
 
-    # Обработка кнопок библиотеки
-    if data.startswith("lib_history_"):
-        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+@router.exact("buy_back")
+async def cb_buy_back(update, context, query, uid, data):
+    # Закрыть меню покупки
+    await query.message.delete()
 
-        offset = int(data.split("_")[-1])
-        history = get_user_history(uid, limit=5, offset=offset)
 
-        if not history:
-            await query.answer("История пуста")
-            return
+# Обработка кнопок библиотеки
+@router.prefix("lib_history_")
+async def cb_lib_history(update, context, query, uid, data):
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-        msg = "📜 <b>История генераций:</b>\n\nНажмите на запись для деталей:"
+    offset = int(data.split("_")[-1])
+    # Берём на одну запись больше, чтобы знать, есть ли следующая страница
+    history = get_user_history(uid, limit=6, offset=offset)
+    has_more = len(history) > 5
+    history = history[:5]
 
-        # Кнопки для каждого элемента истории
-        keyboard = []
-        for i, gen in enumerate(history):
-            date = gen['date'][:10]  # Только дата
-            prompt_preview = gen['prompt'][:35] + "..." if len(gen['prompt']) > 35 else gen['prompt']
-            fav_mark = "⭐ " if gen.get('is_favorite', False) else ""
-            button_text = f"{fav_mark}{prompt_preview} ({date})"
-            keyboard.append([InlineKeyboardButton(button_text, callback_data=f"lib_view_{gen['id']}")])
+    if not history:
+        await query.answer("История пуста")
+        return
 
-        # Кнопки навигации
-        nav_buttons = []
-        if offset > 0:
-            nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"lib_history_{offset-5}"))
-        if len(history) == 5:  # Возможно есть еще
-            nav_buttons.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"lib_history_{offset+5}"))
-        if nav_buttons:
-            keyboard.append(nav_buttons)
+    msg = "📜 <b>История генераций:</b>\n\nНажмите на запись для деталей:"
 
-        keyboard.append([InlineKeyboardButton("🔙 К библиотеке", callback_data="lib_main")])
+    # Кнопки для каждого элемента истории
+    keyboard = []
+    for i, gen in enumerate(history):
+        date = gen['date'][:10]  # Только дата
+        prompt_preview = gen['prompt'][:35] + "..." if len(gen['prompt']) > 35 else gen['prompt']
+        fav_mark = "⭐ " if gen.get('is_favorite', False) else ""
+        button_text = f"{fav_mark}{prompt_preview} ({date})"
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"lib_view_{gen['id']}")])
 
-        await query.edit_message_text(
-            msg,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="HTML"
-        )
-        return
+    # Кнопки навигации
+    nav_buttons = []
+    if offset > 0:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"lib_history_{offset-5}"))
+    if has_more:
+        nav_buttons.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"lib_history_{offset+5}"))
+    if nav_buttons:
+        keyboard.append(nav_buttons)
 
-    # Просмотр деталей элемента истории
-    if data.startswith("lib_view_"):
-        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    keyboard.append([InlineKeyboardButton("🔙 К библиотеке", callback_data="lib_main")])
 
-        gen_id = float(data[9:])  # ID генерации (timestamp)
-        history = get_user_history(uid, limit=100)  # Получаем всю историю
+    await query.edit_message_text(
+        msg,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="HTML"
+    )
 
-        # Находим нужный элемент
-        gen = next((g for g in history if g['id'] == gen_id), None)
 
-        if not gen:
-            await query.answer("Запись не найдена", show_alert=True)
-            return
+# Просмотр деталей элемента истории
+@router.prefix("lib_view_")
+async def cb_lib_view(update, context, query, uid, data):
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-        date = gen['date'][:16].replace('T', ' ')
-        fav_mark = "⭐ " if gen.get('is_favorite', False) else ""
+    gen_id = float(data[9:])  # ID генерации (timestamp)
+    gen = get_generation(uid, gen_id)
+
+    if not gen:
+        await query.answer("Запись не найдена", show_alert=True)
+        return
+
+    date = gen['date'][:16].replace('T', ' ')
+    fav_mark = "⭐ " if gen.get('is_favorite', False) else ""
 
-        msg = f"""📝 <b>Детали генерации</b> {fav_mark}
+    msg = f"""📝 <b>Детали генерации</b> {fav_mark}
 
 💬 <b>Промпт:</b>
 <i>{gen['prompt']}</i>
@@ -3359,489 +3368,432 @@ async def callbacks(update, context):
 🎨 <b>Модель:</b> {gen['model']}
 📐 <b>Формат:</b> {gen['format']}"""
 
-        if gen.get('style') and gen['style'] != 'none':
-            msg += f"\n🖌 <b>Стиль:</b> {gen['style']}"
+    if gen.get('style') and gen['style'] != 'none':
+        msg += f"\n🖌 <b>Стиль:</b> {gen['style']}"
 
-        if gen.get('negative_prompt'):
-            msg += f"\n🚫 <b>Negative:</b> <code>{gen['negative_prompt']}</code>"
+    if gen.get('negative_prompt'):
+        msg += f"\n🚫 <b>Negative:</b> <code>{gen['negative_prompt']}</code>"
 
-        msg += f"\n\n📅 <b>Дата:</b> {date}"
+    msg += f"\n\n📅 <b>Дата:</b> {date}"
 
-        keyboard = [
-            [InlineKeyboardButton("🔄 Использовать снова", callback_data=f"lib_reuse_{gen_id}")],
-            [InlineKeyboardButton("🔙 К истории", callback_data="lib_history_0")]
-        ]
+    keyboard = [
+        [InlineKeyboardButton("🔄 Использовать снова", callback_data=f"lib_reuse_{gen_id}")],
+        [InlineKeyboardButton("🔙 К истории", callback_data="lib_history_0")]
+    ]
 
-        await query.edit_message_text(
-            msg,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="HTML"
-        )
+    await query.edit_message_text(
+        msg,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="HTML"
+    )
+
+
+# Повторное использование промпта из истории
+@router.prefix("lib_reuse_")
+async def cb_lib_reuse(update, context, query, uid, data):
+    gen_id = float(data[10:])  # ID генерации
+    gen = get_generation(uid, gen_id)
+
+    if not gen:
+        await query.answer("Запись не найдена", show_alert=True)
         return
 
-    # Повторное использование промпта из истории
-    if data.startswith("lib_reuse_"):
-        gen_id = float(data[10:])  # ID генерации
-        history = get_user_history(uid, limit=100)
+    # Загружаем параметры в state
+    user_state[uid]["prompt"] = gen['prompt']
+    user_state[uid]["model"] = gen['model']
+    user_state[uid]["format"] = gen['format']
+    user_state[uid]["style"] = gen.get('style', 'none')
+    user_state[uid]["negative_prompt"] = gen.get('negative_prompt', '')
+    user_state[uid]["seed"] = gen.get('seed')  # Тот же seed - то же изображение (из кеша, если включен)
 
-        gen = next((g for g in history if g['id'] == gen_id), None)
+    await query.answer("✅ Параметры загружены!", show_alert=True)
 
-        if not gen:
-            await query.answer("Запись не найдена", show_alert=True)
-            return
+    # Показываем предпросмотр
+    await show_final_prompt(query, uid)
 
-        # Загружаем параметры в state
-        user_state[uid]["prompt"] = gen['prompt']
-        user_state[uid]["model"] = gen['model']
-        user_state[uid]["format"] = gen['format']
-        user_state[uid]["style"] = gen.get('style', 'none')
-        user_state[uid]["negative_prompt"] = gen.get('negative_prompt', '')
 
-        await query.answer("✅ Параметры загружены!", show_alert=True)
+@router.exact("lib_favorites")
+async def cb_lib_favorites(update, context, query, uid, data):
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-        # Показываем предпросмотр
-        await show_final_prompt(query, uid)
-        return
+    favorites = get_favorites(uid)
 
-    if data == "lib_favorites":
-        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    if not favorites:
+        await query.answer("У вас нет избранных генераций", show_alert=True)
+        return
 
-        favorites = get_favorites(uid)
+    msg = "⭐ <b>Избранное:</b>\n\n"
+    for i, gen in enumerate(favorites[:10], 1):
+        date = gen['date'][:16].replace('T', ' ')
+        prompt_preview = gen['prompt'][:50] + "..." if len(gen['prompt']) > 50 else gen['prompt']
+        msg += f"{i}. <b>{prompt_preview}</b>\n"
+        msg += f"   📅 {date} | {gen['model']}\n"
+        msg += f"   <code>{gen['english_prompt'][:60]}...</code>\n\n"
 
-        if not favorites:
-            await query.answer("У вас нет избранных генераций", show_alert=True)
-            return
+    keyboard = [[InlineKeyboardButton("🔙 К библиотеке", callback_data="lib_main")]]
 
-        msg = "⭐ <b>Избранное:</b>\n\n"
-        for i, gen in enumerate(favorites[:10], 1):
-            date = gen['date'][:16].replace('T', ' ')
-            prompt_preview = gen['prompt'][:50] + "..." if len(gen['prompt']) > 50 else gen['prompt']
-            msg += f"{i}. <b>{prompt_preview}</b>\n"
-            msg += f"   📅 {date} | {gen['model']}\n"
-            msg += f"   <code>{gen['english_prompt'][:60]}...</code>\n\n"
+    await query.edit_message_text(
+        msg,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="HTML"
+    )
 
-        keyboard = [[InlineKeyboardButton("🔙 К библиотеке", callback_data="lib_main")]]
 
-        await query.edit_message_text(
-            msg,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="HTML"
-        )
-        return
+@router.exact("lib_search")
+async def cb_lib_search(update, context, query, uid, data):
+    user_state[uid]["awaiting_library_search"] = True
+    await query.edit_message_text(
+        "🔍 <b>Поиск по истории</b>\n\n"
+        "Отправьте текст для поиска по промптам:",
+        parse_mode="HTML"
+    )
 
-    if data == "lib_search":
-        user_state[uid]["awaiting_library_search"] = True
-        await query.edit_message_text(
-            "🔍 <b>Поиск по истории</b>\n\n"
-            "Отправьте текст для поиска по промптам:",
-            parse_mode="HTML"
-        )
-        return
 
-    if data == "lib_clear":
-        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+@router.exact("lib_clear")
+async def cb_lib_clear(update, context, query, uid, data):
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ Да, очистить", callback_data="lib_clear_confirm"),
-                InlineKeyboardButton("❌ Отмена", callback_data="lib_main")
-            ]
+    keyboard = [
+        [
+            InlineKeyboardButton("✅ Да, очистить", callback_data="lib_clear_confirm"),
+            InlineKeyboardButton("❌ Отмена", callback_data="lib_main")
         ]
+    ]
 
-        await query.edit_message_text(
-            "⚠️ <b>Очистка истории</b>\n\n"
-            "Удалить всю историю генераций (кроме избранного)?\n\n"
-            "Это действие нельзя отменить!",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="HTML"
-        )
-        return
+    await query.edit_message_text(
+        "⚠️ <b>Очистка истории</b>\n\n"
+        "Удалить всю историю генераций (кроме избранного)?\n\n"
+        "Это действие нельзя отменить!",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="HTML"
+    )
 
-    if data == "lib_clear_confirm":
-        clear_history(uid)
-        await query.edit_message_text(
-            "✅ История очищена!\n\n"
-            "Избранные генерации сохранены."
-        )
-        return
 
-    if data == "lib_main":
-        # Возврат к главному экрану библиотеки
-        await query.message.delete()
-        await library_command(update, context)
-        return
+@router.exact("lib_clear_confirm")
+async def cb_lib_clear_confirm(update, context, query, uid, data):
+    clear_history(uid)
+    await query.edit_message_text(
+        "✅ История очищена!\n\n"
+        "Избранные генерации сохранены."
+    )
 
-    # Обработчики для /editmy кнопок
-    if data == "edit_reference":
-        if not user_state.get(uid, {}).get("edit_image"):
-            await query.answer("❌ Нет загруженного изображения", show_alert=True)
-            return
 
-        # Сохраняем как референс для следующей генерации
-        user_state[uid]["images"] = [user_state[uid]["edit_image"]]
-        await query.answer("✅ Изображение сохранено как референс!")
-        await query.edit_message_text("✅ Изображение сохранено как референс для следующей генерации!")
-        return
+@router.exact("lib_main")
+async def cb_lib_main(update, context, query, uid, data):
+    # Возврат к главному экрану библиотеки
+    await query.message.delete()
+    await library_command(update, context)
 
-    if data == "edit_upscale":
-        if not user_state.get(uid, {}).get("edit_image"):
-            await query.answer("❌ Нет загруженного изображения", show_alert=True)
-            return
 
-        await query.edit_message_text("⏳ <b>Upscale...</b>\n\n🔍 Увеличиваем разрешение изображения...", parse_mode="HTML")
+# Обработчики для /editmy кнопок
+@router.exact("edit_reference")
+async def cb_edit_reference(update, context, query, uid, data):
+    if not user_state.get(uid, {}).get("edit_image"):
+        await query.answer("❌ Нет загруженного изображения", show_alert=True)
+        return
 
-        result = upscale_image(user_state[uid]["edit_image"])
+    # Сохраняем как референс для следующей генерации
+    user_state[uid]["images"] = [user_state[uid]["edit_image"]]
+    await query.answer("✅ Изображение сохранено как референс!")
+    await query.edit_message_text("✅ Изображение сохранено как референс для следующей генерации!")
 
-        if isinstance(result, str):
-            await query.edit_message_text(result)
-        else:
-            watermarked = add_watermark(result)
 
-        # Сохраняем отредактированное изображение в библиотеку
-        if USE_GCS and result:
-            try:
-                gcs.save_user_image(uid, result, category='edited')
-                print(f'[GCS] Edited image saved to library')
-            except Exception as e:
-                print(f'[ERROR] Failed to save edited image: {e}')
-            await context.bot.send_photo(uid, watermarked, caption="✅ Upscale завершен!")
-            await query.message.delete()
+@router.exact("edit_upscale")
+async def cb_edit_upscale(update, context, query, uid, data):
+    if not user_state.get(uid, {}).get("edit_image"):
+        await query.answer("❌ Нет загруженного изображения", show_alert=True)
         return
 
-    if data == "edit_remove_bg":
-        if not user_state.get(uid, {}).get("edit_image"):
-            await query.answer("❌ Нет загруженного изображения", show_alert=True)
-            return
+    await query.edit_message_text("⏳ <b>Upscale...</b>\n\n🔍 Увеличиваем разрешение изображения...", parse_mode="HTML")
 
-        await query.edit_message_text("⏳ <b>Remove Background...</b>\n\n🖌️ Удаляем фон...", parse_mode="HTML")
+    with metrics.span("provider", engine="upscale", model="stability"):
+        result = await run_blocking(STABILITY, upscale_image, user_state[uid]["edit_image"])
 
-        result = remove_background(user_state[uid]["edit_image"])
+    if isinstance(result, str):
+        await query.edit_message_text(result)
+    else:
+        watermarked = add_watermark(result)
 
-        if isinstance(result, str):
-            await query.edit_message_text(result)
-        else:
+    # Сохраняем отредактированное изображение в библиотеку
+    if USE_GCS and result:
+        try:
+            gcs.save_user_image(uid, result, category='edited')
+            logger.info("Edited image saved to library")
+        except Exception as e:
+            logger.error("Failed to save edited image: %s", e)
+        await context.bot.send_photo(uid, watermarked, caption="✅ Upscale завершен!")
+        await query.message.delete()
 
-            # Сохраняем отредактированное изображение в библиотеку
-            if USE_GCS and result:
-                try:
-                    gcs.save_user_image(uid, result, category='edited')
-                    print(f'[GCS] Edited image (remove_bg) saved to library')
-                except Exception as e:
-                    print(f'[ERROR] Failed to save edited image: {e}')
 
-            await context.bot.send_photo(uid, result, caption="✅ Фон удален!")
-            await query.message.delete()
+@router.exact("edit_remove_bg")
+async def cb_edit_remove_bg(update, context, query, uid, data):
+    if not user_state.get(uid, {}).get("edit_image"):
+        await query.answer("❌ Нет загруженного изображения", show_alert=True)
         return
 
-    if data == "edit_face_restore":
-        if not user_state.get(uid, {}).get("edit_image"):
-            await query.answer("❌ Нет загруженного изображения", show_alert=True)
-            return
+    await query.edit_message_text("⏳ <b>Remove Background...</b>\n\n🖌️ Удаляем фон...", parse_mode="HTML")
 
-        await query.edit_message_text("⏳ <b>Face Restore...</b>\n\n👤 Улучшаем качество лиц...", parse_mode="HTML")
+    with metrics.span("provider", engine="remove_background", model="stability"):
+        result = await run_blocking(STABILITY, remove_background, user_state[uid]["edit_image"])
 
-        result = restore_face(user_state[uid]["edit_image"])
-
-        if isinstance(result, str):
-            await query.edit_message_text(result)
-        else:
-            watermarked = add_watermark(result)
+    if isinstance(result, str):
+        await query.edit_message_text(result)
+    else:
 
         # Сохраняем отредактированное изображение в библиотеку
         if USE_GCS and result:
             try:
                 gcs.save_user_image(uid, result, category='edited')
-                print(f'[GCS] Edited image saved to library')
+                logger.info("Edited image (remove_bg) saved to library")
             except Exception as e:
-                print(f'[ERROR] Failed to save edited image: {e}')
-            await context.bot.send_photo(uid, watermarked, caption="✅ Лица улучшены!")
-            await query.message.delete()
-        return
+                logger.error("Failed to save edited image: %s", e)
 
-    if data == "edit_inpaint":
-        from telegram import InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+        await context.bot.send_photo(uid, result, caption="✅ Фон удален!")
+        await query.message.delete()
 
-        if not user_state.get(uid, {}).get("edit_image"):
-            await query.answer("❌ Нет загруженного изображения", show_alert=True)
-            return
 
-        await query.edit_message_text("⏳ <b>Загрузка редактора маски...</b>", parse_mode="HTML")
+@router.exact("edit_face_restore")
+async def cb_edit_face_restore(update, context, query, uid, data):
+    if not user_state.get(uid, {}).get("edit_image"):
+        await query.answer("❌ Нет загруженного изображения", show_alert=True)
+        return
 
-        # Загружаем изображение на веб-сервер
-        webapp_url = await upload_image_to_webapp(context, user_state[uid]["edit_image"], uid)
+    await query.edit_message_text("⏳ <b>Face Restore...</b>\n\n👤 Улучшаем качество лиц...", parse_mode="HTML")
 
-        if not webapp_url:
-            # Веб-сервер недоступен - показываем инструкцию
-            await query.edit_message_text(
-                "❌ <b>Редактор маски недоступен</b>\n\n"
-                "Веб-сервер для Mini App не запущен.\n\n"
-                "<b>Альтернативный метод:</b>\n"
-                "1. Откройте изображение в графическом редакторе\n"
-                "2. Закрасьте БЕЛЫМ цветом область для изменения\n"
-                "3. Остальное закрасьте ЧЕРНЫМ\n"
-                "4. Сохраните как маску и отправьте боту\n\n"
-                "<b>Для администратора:</b>\n"
-                "Запустите <code>python webapp_server.py</code> для использования интерактивного редактора.",
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("◀️ Назад", callback_data="action_new")]
-                ])
-            )
-            return
+    with metrics.span("provider", engine="restore_face", model="stability"):
+        result = await run_blocking(STABILITY, restore_face, user_state[uid]["edit_image"])
+
+    if isinstance(result, str):
+        await query.edit_message_text(result)
+    else:
+        watermarked = add_watermark(result)
 
-        # Устанавливаем флаг ожидания маски от Mini App
-        user_state[uid]["waiting_for_inpaint_mask"] = True
+    # Сохраняем отредактированное изображение в библиотеку
+    if USE_GCS and result:
+        try:
+            gcs.save_user_image(uid, result, category='edited')
+            logger.info("Edited image saved to library")
+        except Exception as e:
+            logger.error("Failed to save edited image: %s", e)
+        await context.bot.send_photo(uid, watermarked, caption="✅ Лица улучшены!")
+        await query.message.delete()
 
-        # Создаем кнопку для открытия Mini App
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🎨 Открыть редактор", web_app=WebAppInfo(url=webapp_url))],
-            [InlineKeyboardButton("✅ Завершить", callback_data="inpaint_complete")],
-            [InlineKeyboardButton("❌ Отмена", callback_data="action_new")]
-        ])
 
-        await query.edit_message_text(
-            "🎨 <b>Inpainting - редактирование части изображения</b>\n\n"
-            "Нажмите кнопку ниже, чтобы открыть редактор маски.\n\n"
-            "В редакторе:\n"
-            "• Закрасьте кисточкой область, которую хотите изменить\n"
-            "• Используйте ползунок для изменения размера кисти\n"
-            "• Нажмите 'Готово' когда закончите\n\n"
-            "После этого вам нужно будет описать, что должно быть на закрашенной области.",
-            reply_markup=keyboard,
-            parse_mode="HTML"
-        )
+@router.exact("edit_outpaint")
+async def cb_edit_outpaint(update, context, query, uid, data):
+    if not user_state.get(uid, {}).get("edit_image"):
+        await query.answer("❌ Нет загруженного изображения", show_alert=True)
         return
 
-    if data == "edit_outpaint":
-        if not user_state.get(uid, {}).get("edit_image"):
-            await query.answer("❌ Нет загруженного изображения", show_alert=True)
-            return
+    await query.edit_message_text("⏳ <b>Outpaint...</b>\n\n🖼️ Расширяем изображение (200px во все стороны)...", parse_mode="HTML")
 
-        await query.edit_message_text("⏳ <b>Outpaint...</b>\n\n🖼️ Расширяем изображение (200px во все стороны)...", parse_mode="HTML")
+    result = await run_blocking(STABILITY, outpaint_image, user_state[uid]["edit_image"], left=200, right=200, up=200, down=200)
 
-        result = outpaint_image(user_state[uid]["edit_image"], left=200, right=200, up=200, down=200)
+    if isinstance(result, str):
+        await query.edit_message_text(result)
+    else:
+        watermarked = add_watermark(result)
 
-        if isinstance(result, str):
-            await query.edit_message_text(result)
-        else:
-            watermarked = add_watermark(result)
+    # Сохраняем отредактированное изображение в библиотеку
+    if USE_GCS and result:
+        try:
+            gcs.save_user_image(uid, result, category='edited')
+            logger.info("Edited image saved to library")
+        except Exception as e:
+            logger.error("Failed to save edited image: %s", e)
+        await context.bot.send_photo(uid, watermarked, caption="✅ Изображение расширено!")
+        await query.message.delete()
 
-        # Сохраняем отредактированное изображение в библиотеку
-        if USE_GCS and result:
-            try:
-                gcs.save_user_image(uid, result, category='edited')
-                print(f'[GCS] Edited image saved to library')
-            except Exception as e:
-                print(f'[ERROR] Failed to save edited image: {e}')
-            await context.bot.send_photo(uid, watermarked, caption="✅ Изображение расширено!")
-            await query.message.delete()
-        return
 
-    if data == "edit_search_recolor":
-        user_state[uid]["awaiting_search_recolor_search"] = True
-        await query.edit_message_text(
-            "🎨 <b>Search & Recolor</b>\n\n"
-            "Шаг 1/2: Опишите объект, который нужно найти и перекрасить.\n\n"
-            "Например: 'красное платье', 'синяя машина', 'зеленое дерево'",
-            parse_mode="HTML"
-        )
-        return
+@router.exact("edit_search_recolor")
+async def cb_edit_search_recolor(update, context, query, uid, data):
+    user_state[uid]["awaiting_search_recolor_search"] = True
+    await query.edit_message_text(
+        "🎨 <b>Search & Recolor</b>\n\n"
+        "Шаг 1/2: Опишите объект, который нужно найти и перекрасить.\n\n"
+        "Например: 'красное платье', 'синяя машина', 'зеленое дерево'",
+        parse_mode="HTML"
+    )
 
-    if data == "edit_search_replace":
-        user_state[uid]["awaiting_search_replace_search"] = True
-        await query.edit_message_text(
-            "🔄 <b>Search & Replace</b>\n\n"
-            "Шаг 1/2: Опишите объект, который нужно найти и заменить.\n\n"
-            "Например: 'кошка', 'дерево', 'машина'",
-            parse_mode="HTML"
-        )
-        return
 
-    if data == "edit_erase":
-        user_state[uid]["awaiting_erase_prompt"] = True
-        await query.edit_message_text(
-            "🗑️ <b>Erase Object</b>\n\n"
-            "Опишите объект, который нужно удалить с изображения.\n\n"
-            "Например: 'человек слева', 'провода', 'мусор на земле'",
-            parse_mode="HTML"
-        )
-        return
+@router.exact("edit_search_replace")
+async def cb_edit_search_replace(update, context, query, uid, data):
+    user_state[uid]["awaiting_search_replace_search"] = True
+    await query.edit_message_text(
+        "🔄 <b>Search & Replace</b>\n\n"
+        "Шаг 1/2: Опишите объект, который нужно найти и заменить.\n\n"
+        "Например: 'кошка', 'дерево', 'машина'",
+        parse_mode="HTML"
+    )
 
-    # Обработка кнопки "Пропустить" для negative prompt в style guide
-    if data == "skip":
-        if user_state[uid].get("style_guide", {}).get("active"):
-            sg_state = user_state[uid]["style_guide"]
-            if sg_state["step"] == "negative_prompt":
-                sg_state["negative_prompt"] = ""
-                sg_state["step"] = "aspect_ratio"
-                await query.edit_message_text(
-                    "<b>Aspect Ratio</b> (формат изображения):",
-                    parse_mode="HTML",
-                    reply_markup=aspect_ratio_kb()
-                )
-        return
 
-    # Обработка выбора aspect ratio
-    if data.startswith("ar_"):
-        if user_state[uid].get("style_guide", {}).get("active"):
-            sg_state = user_state[uid]["style_guide"]
-            sg_state["aspect_ratio"] = data[3:]  # Убираем "ar_"
-            sg_state["step"] = "fidelity"
-            await query.edit_message_text(
-                "<b>Fidelity</b> (точность следования стилю, 0.1-1.0):\n"
-                "Выберите или введите свое значение",
-                parse_mode="HTML",
-                reply_markup=fidelity_kb()
-            )
-        return
+@router.exact("edit_erase")
+async def cb_edit_erase(update, context, query, uid, data):
+    user_state[uid]["awaiting_erase_prompt"] = True
+    await query.edit_message_text(
+        "🗑️ <b>Erase Object</b>\n\n"
+        "Опишите объект, который нужно удалить с изображения.\n\n"
+        "Например: 'человек слева', 'провода', 'мусор на земле'",
+        parse_mode="HTML"
+    )
 
-    # Обработка выбора fidelity
-    if data.startswith("fid_"):
-        if user_state[uid].get("style_guide", {}).get("active"):
-            sg_state = user_state[uid]["style_guide"]
-            fidelity_value = float(data[4:])  # Убираем "fid_"
-            sg_state["fidelity"] = fidelity_value
 
-            # Все параметры собраны, запускаем генерацию
-            await query.edit_message_text("⏳ Генерация изображения в стиле референса...")
-
-            result = generate_with_style_guide(
-                image_path=sg_state["style_image"],
-                prompt=sg_state["prompt"],
-                negative_prompt=sg_state.get("negative_prompt", ""),
-                aspect_ratio=sg_state.get("aspect_ratio", "1:1"),
-                fidelity=fidelity_value
+# Обработка кнопки "Пропустить" для negative prompt в style guide
+@router.exact("skip")
+async def cb_skip(update, context, query, uid, data):
+    if user_state[uid].get("style_guide", {}).get("active"):
+        sg_state = user_state[uid]["style_guide"]
+        if sg_state["step"] == "negative_prompt":
+            sg_state["negative_prompt"] = ""
+            sg_state["step"] = "aspect_ratio"
+            await query.edit_message_text(
+                "<b>Aspect Ratio</b> (формат изображения):",
+                parse_mode="HTML",
+                reply_markup=aspect_ratio_kb()
             )
 
-            if isinstance(result, str):
-                # Ошибка
-                await context.bot.send_message(uid, f"❌ {result}")
-            else:
-                # Успех - отправляем изображение с watermark
-                watermarked_image = add_watermark(result)
-                await context.bot.send_photo(uid, watermarked_image)
-
-                # Сохраняем параметры для возможности повторной генерации
-                user_state[uid]["last_sg_params"] = {
-                    "style_image": sg_state["style_image"],
-                    "prompt": sg_state["prompt"],
-                    "negative_prompt": sg_state.get("negative_prompt", ""),
-                    "aspect_ratio": sg_state.get("aspect_ratio", "1:1"),
-                    "fidelity": fidelity_value
-                }
-
-                await context.bot.send_message(
-                    uid,
-                    "✅ Style Guide генерация завершена!",
-                    reply_markup=style_guide_regenerate_kb()
-                )
-
-            # Очищаем состояние
-            user_state[uid]["style_guide"] = {"active": False}
-        return
 
-    # Обработка кнопки "Новая генерация в этом стиле"
-    if data == "sg_regenerate":
-        if "last_sg_params" in user_state[uid]:
-            params = user_state[uid]["last_sg_params"]
-            await query.edit_message_text("⏳ Генерация нового изображения в этом стиле...")
-
-            result = generate_with_style_guide(
-                image_path=params["style_image"],
-                prompt=params["prompt"],
-                negative_prompt=params.get("negative_prompt", ""),
-                aspect_ratio=params.get("aspect_ratio", "1:1"),
-                fidelity=params.get("fidelity", 0.5)
-            )
+# Обработка выбора aspect ratio
+@router.prefix("ar_")
+async def cb_ar(update, context, query, uid, data):
+    if user_state[uid].get("style_guide", {}).get("active"):
+        sg_state = user_state[uid]["style_guide"]
+        sg_state["aspect_ratio"] = data[3:]  # Убираем "ar_"
+        sg_state["step"] = "fidelity"
+        await query.edit_message_text(
+            "<b>Fidelity</b> (точность следования стилю, 0.1-1.0):\n"
+            "Выберите или введите свое значение",
+            parse_mode="HTML",
+            reply_markup=fidelity_kb()
+        )
 
-            if isinstance(result, str):
-                # Ошибка
-                await context.bot.send_message(uid, f"❌ {result}")
-            else:
-                # Успех - отправляем изображение с watermark
-                watermarked_image = add_watermark(result)
-                await context.bot.send_photo(uid, watermarked_image)
-                await context.bot.send_message(
-                    uid,
-                    "✅ Style Guide генерация завершена!",
-                    reply_markup=style_guide_regenerate_kb()
-                )
-        return
 
+# Обработка выбора fidelity
+@router.prefix("fid_")
+async def cb_fid(update, context, query, uid, data):
+    if user_state[uid].get("style_guide", {}).get("active"):
+        sg_state = user_state[uid]["style_guide"]
+        fidelity_value = float(data[4:])  # Убираем "fid_"
+        sg_state["fidelity"] = fidelity_value
+
+        # Все параметры собраны, запускаем генерацию
+        await query.edit_message_text("⏳ Генерация изображения в стиле референса...")
+
+        result = await run_blocking(STABILITY, generate_with_style_guide,
+            image_path=sg_state["style_image"],
+            prompt=sg_state["prompt"],
+            negative_prompt=sg_state.get("negative_prompt", ""),
+            aspect_ratio=sg_state.get("aspect_ratio", "1:1"),
+            fidelity=fidelity_value
+        )
 
-    # ==================== РАСШИРЕННЫЕ ОБРАБОТЧИКИ БИБЛИОТЕКИ ====================
+        if isinstance(result, str):
+            # Ошибка
+            await context.bot.send_message(uid, f"❌ {result}")
+        else:
+            # Успех - отправляем изображение с watermark
+            watermarked_image = add_watermark(result)
+            await context.bot.send_photo(uid, watermarked_image)
+
+            # Сохраняем параметры для возможности повторной генерации
+            user_state[uid]["last_sg_params"] = {
+                "style_image": sg_state["style_image"],
+                "prompt": sg_state["prompt"],
+                "negative_prompt": sg_state.get("negative_prompt", ""),
+                "aspect_ratio": sg_state.get("aspect_ratio", "1:1"),
+                "fidelity": fidelity_value
+            }
 
-    # Показ избранного
-    if data == 'lib_show_favorites':
-        try:
-            images = gcsa.get_user_images_filtered(uid, category='favorites', limit=10)
-            if not images:
-                await query.edit_message_text('⭐ Избранное пусто\n\nДобавьте изображения в избранное!', reply_markup=library_kb_extended())
-                return
+            await context.bot.send_message(
+                uid,
+                "✅ Style Guide генерация завершена!",
+                reply_markup=style_guide_regenerate_kb()
+            )
 
-            # Отправляем изображения
-            media_group = []
-            for img in images:
-                media_group.append({'type': 'photo', 'media': img['url'], 'caption': f"⭐ {img['name']}"})
+        # Очищаем состояние
+        user_state[uid]["style_guide"] = {"active": False}
+
+
+# Обработка кнопки "Новая генерация в этом стиле"
+@router.exact("sg_regenerate")
+async def cb_sg_regenerate(update, context, query, uid, data):
+    if "last_sg_params" in user_state[uid]:
+        params = user_state[uid]["last_sg_params"]
+        await query.edit_message_text("⏳ Генерация нового изображения в этом стиле...")
+
+        result = await run_blocking(STABILITY, generate_with_style_guide,
+            image_path=params["style_image"],
+            prompt=params["prompt"],
+            negative_prompt=params.get("negative_prompt", ""),
+            aspect_ratio=params.get("aspect_ratio", "1:1"),
+            fidelity=params.get("fidelity", 0.5)
+        )
 
-            if media_group:
-                from telegram import InputMediaPhoto
-                await context.bot.send_media_group(uid, [InputMediaPhoto(media=m['media'], caption=m.get('caption', '')) for m in media_group[:10]])
+        if isinstance(result, str):
+            # Ошибка
+            await context.bot.send_message(uid, f"❌ {result}")
+        else:
+            # Успех - отправляем изображение с watermark
+            watermarked_image = add_watermark(result)
+            await context.bot.send_photo(uid, watermarked_image)
+            await context.bot.send_message(
+                uid,
+                "✅ Style Guide генерация завершена!",
+                reply_markup=style_guide_regenerate_kb()
+            )
 
-            await query.edit_message_text(f'⭐ Избранное ({len(images)} изображений)', reply_markup=library_kb_extended())
-        except Exception as e:
-            await query.edit_message_text(f'❌ Ошибка: {e}', reply_markup=library_kb_extended())
-        return
 
-    # Меню фильтров
-    if data == 'lib_filters':
-        await query.edit_message_text(
-            '🔍 <b>Фильтры по дате</b>\n\nВыберите период:',
-            parse_mode='HTML',
-            reply_markup=library_filters_kb()
-        )
-        return
+# ==================== РАСШИРЕННЫЕ ОБРАБОТЧИКИ БИБЛИОТЕКИ ====================
 
-    # Фильтры по дате
-    if data.startswith('lib_filter_'):
-        days_map = {'1': 1, '7': 7, '30': 30, 'all': None}
-        filter_key = data.replace('lib_filter_', '')
-        days = days_map.get(filter_key)
+# Меню фильтров
+@router.exact("lib_filters")
+async def cb_lib_filters(update, context, query, uid, data):
+    await query.edit_message_text(
+        '🔍 <b>Фильтры по дате</b>\n\nВыберите период:',
+        parse_mode='HTML',
+        reply_markup=library_filters_kb()
+    )
 
-        try:
-            images = gcsa.get_user_images_filtered(uid, days=days, limit=10)
-            period_text = {1: 'за сегодня', 7: 'за неделю', 30: 'за месяц', None: 'за всё время'}
 
-            if not images:
-                await query.edit_message_text(
-                    f'📅 Изображений {period_text[days]} не найдено',
-                    reply_markup=library_filters_kb()
-                )
-                return
+# Фильтры по дате
+@router.prefix("lib_filter_")
+async def cb_lib_filter(update, context, query, uid, data):
+    days_map = {'1': 1, '7': 7, '30': 30, 'all': None}
+    filter_key = data.replace('lib_filter_', '')
+    days = days_map.get(filter_key)
 
-            # Отправляем изображения
-            from telegram import InputMediaPhoto
-            media_group = [InputMediaPhoto(media=img['url'], caption=f"{img['name']}") for img in images[:10]]
-            await context.bot.send_media_group(uid, media_group)
+    try:
+        images = gcsa.get_user_images_filtered(uid, days=days, limit=10)
+        period_text = {1: 'за сегодня', 7: 'за неделю', 30: 'за месяц', None: 'за всё время'}
 
+        if not images:
             await query.edit_message_text(
-                f'📅 Найдено {len(images)} изображений {period_text[days]}',
+                f'📅 Изображений {period_text[days]} не найдено',
                 reply_markup=library_filters_kb()
             )
-        except Exception as e:
-            await query.edit_message_text(f'❌ Ошибка: {e}', reply_markup=library_filters_kb())
-        return
+            return
 
-    # Возврат к библиотеке
-    if data == 'lib_back':
-        stats = gcs.get_user_stats(uid)
-        try:
-            fav_images = gcsa.get_user_images_filtered(uid, category='favorites', limit=1000)
-            fav_count = len(fav_images)
-        except:
-            fav_count = 0
+        # Отправляем изображения
+        await telegram_files.send_library_images(context.bot, uid, images)
+
+        await query.edit_message_text(
+            f'📅 Найдено {len(images)} изображений {period_text[days]}',
+            reply_markup=library_filters_kb()
+        )
+    except Exception as e:
+        await query.edit_message_text(f'❌ Ошибка: {e}', reply_markup=library_filters_kb())
+
+
+# Возврат к библиотеке
+@router.exact("lib_back")
+async def cb_lib_back(update, context, query, uid, data):
+    stats = gcs.get_user_stats(uid)
+    try:
+        fav_count = gcsa.count_user_images(uid, category='favorites')
+    except:
+        fav_count = 0
 
-        lib_msg = f'''📚 <b>Библиотека изображений</b>
+    lib_msg = f'''📚 <b>Библиотека изображений</b>
 
 📊 <b>Статистика:</b>
 🎨 Созданные: {stats['generated']}
@@ -3851,166 +3803,200 @@ async def callbacks(update, context):
 ━━━━━━━━━━━━━━━━━
 📁 Всего: {stats['total']} изображений'''
 
-        await query.edit_message_text(lib_msg, parse_mode='HTML', reply_markup=library_kb_extended())
-        return
+    await query.edit_message_text(lib_msg, parse_mode='HTML', reply_markup=library_kb_extended())
 
-    # Pagination обработчик
-    if data.startswith('lib_page_'):
-        parts = data.split('_')
-        if len(parts) >= 4:
-            category = parts[2]
-            page = int(parts[3])
 
-            try:
-                offset = page * 10
-                images = gcsa.get_user_images_filtered(
-                    uid,
-                    category=category if category != 'all' else None,
-                    limit=10,
-                    offset=offset
+# Pagination обработчик
+@router.prefix("lib_page_")
+async def cb_lib_page(update, context, query, uid, data):
+    parts = data.split('_')
+    if len(parts) >= 4:
+        category = parts[2]
+        page = int(parts[3])
+
+        try:
+            offset = page * 10
+            images = gcsa.get_user_images_filtered(
+                uid,
+                category=category if category != 'all' else None,
+                limit=10,
+                offset=offset
+            )
+
+            if images:
+                await telegram_files.send_library_images(context.bot, uid, images)
+
+                total_count = gcsa.count_user_images(uid, category=category if category != 'all' else None)
+                total_pages = (total_count + 9) // 10
+
+                await query.edit_message_text(
+                    f'Страница {page + 1}/{total_pages}',
+                    reply_markup=pagination_kb(page, total_pages, category)
                 )
+            else:
+                await query.answer('Больше нет изображений')
+        except Exception as e:
+            await query.answer(f'Ошибка: {e}', show_alert=True)
 
-                if images:
-                    from telegram import InputMediaPhoto
-                    media_group = [InputMediaPhoto(media=img['url'], caption=img['name']) for img in images]
-                    await context.bot.send_media_group(uid, media_group)
 
-                    total_count = len(gcsa.get_user_images_filtered(uid, category=category if category != 'all' else None, limit=1000))
-                    total_pages = (total_count + 9) // 10
+# Поиск по тегам
+@router.exact("lib_tags")
+async def cb_lib_tags(update, context, query, uid, data):
+    user_state[uid]['awaiting_tag_search'] = True
+    await query.edit_message_text(
+        '🏷️ <b>Поиск по тегам</b>\n\nВведите теги через пробел для поиска',
+        parse_mode='HTML'
+    )
 
-                    await query.edit_message_text(
-                        f'Страница {page + 1}/{total_pages}',
-                        reply_markup=pagination_kb(page, total_pages, category)
-                    )
-                else:
-                    await query.answer('Больше нет изображений')
-            except Exception as e:
-                await query.answer(f'Ошибка: {e}', show_alert=True)
-        return
 
+# Статистика операций
+@router.exact("lib_stats")
+async def cb_lib_stats(update, context, query, uid, data):
+    try:
+        op_stats = gcsa.get_operation_stats(uid, days=30)
 
-    # Поиск по тегам
-    if data == 'lib_tags':
-        user_state[uid]['awaiting_tag_search'] = True
-        await query.edit_message_text(
-            '🏷️ <b>Поиск по тегам</b>\n\nВведите теги через пробел для поиска',
-            parse_mode='HTML'
-        )
-        return
-    # Статистика операций
-    if data == 'lib_stats':
-        try:
-            op_stats = gcsa.get_operation_stats(uid, days=30)
+        stats_text = '📊 <b>Статистика операций (30 дней)</b>\n\n'
+        if op_stats:
+            for op, count in sorted(op_stats.items(), key=lambda x: x[1], reverse=True):
+                stats_text += f'• {op}: {count}\n'
+        else:
+            stats_text += 'Нет данных'
 
-            stats_text = '📊 <b>Статистика операций (30 дней)</b>\n\n'
-            if op_stats:
-                for op, count in sorted(op_stats.items(), key=lambda x: x[1], reverse=True):
-                    stats_text += f'• {op}: {count}\n'
-            else:
-                stats_text += 'Нет данных'
+        await query.edit_message_text(stats_text, parse_mode='HTML', reply_markup=library_kb_extended())
+    except Exception as e:
+        await query.edit_message_text(f'❌ Ошибка: {e}', reply_markup=library_kb_extended())
 
-            await query.edit_message_text(stats_text, parse_mode='HTML', reply_markup=library_kb_extended())
-        except Exception as e:
-            await query.edit_message_text(f'❌ Ошибка: {e}', reply_markup=library_kb_extended())
-        return
 
-    # Меню экспорта
-    if data == 'lib_export':
-        await query.edit_message_text(
-            '📦 <b>Экспорт изображений</b>\n\nВыберите что экспортировать:',
-            parse_mode='HTML',
-            reply_markup=export_options_kb()
-        )
-        return
+# Меню экспорта
+@router.exact("lib_export")
+async def cb_lib_export(update, context, query, uid, data):
+    await query.edit_message_text(
+        '📦 <b>Экспорт изображений</b>\n\nВыберите что экспортировать:',
+        parse_mode='HTML',
+        reply_markup=export_options_kb()
+    )
 
-    # Экспорт изображений
-    if data.startswith('export_'):
-        category_map = {
-            'export_all': None,
-            'export_generated': 'generated',
-            'export_edited': 'edited',
-            'export_favorites': 'favorites'
-        }
-        category = category_map.get(data)
 
-        await query.edit_message_text('⏳ Создаю архив...')
+# Экспорт изображений
+@router.prefix("export_")
+async def cb_export(update, context, query, uid, data):
+    category_map = {
+        'export_all': None,
+        'export_generated': 'generated',
+        'export_edited': 'edited',
+        'export_favorites': 'favorites'
+    }
+    category = category_map.get(data)
+
+    await query.edit_message_text('⏳ Создаю архив...')
 
+    async def report_progress(done, total):
         try:
-            zip_buffer = gcsa.export_user_images(uid, category=category)
-            if zip_buffer:
-                category_name = category or 'all'
+            await query.edit_message_text(f'⏳ Создаю архив... {done}/{total}')
+        except Exception:
+            pass
+
+    try:
+        import gcs_export
+        category_name = category or 'all'
+        parts_sent = 0
+        async for part_number, part_file, count in gcs_export.export_user_images(uid, category=category, progress=report_progress):
+            with part_file:
+                suffix = f'_{part_number}' if part_number > 1 else ''
+                caption = '📦 Архив готов!' if part_number == 1 else f'📦 Архив, часть {part_number}'
                 await context.bot.send_document(
                     uid,
-                    zip_buffer,
-                    filename=f'images_{category_name}_{uid}.zip',
-                    caption='📦 Архив готов!'
+                    part_file,
+                    filename=f'images_{category_name}_{uid}{suffix}.zip',
+                    caption=f'{caption} ({count} изобр.)'
                 )
-                await query.message.delete()
-            else:
-                await query.edit_message_text('❌ Не удалось создать архив', reply_markup=export_options_kb())
-        except Exception as e:
-            await query.edit_message_text(f'❌ Ошибка: {e}', reply_markup=export_options_kb())
-        return
+            parts_sent += 1
+
+        if parts_sent:
+            await query.message.delete()
+        else:
+            await query.edit_message_text('❌ Не удалось создать архив', reply_markup=export_options_kb())
+    except Exception as e:
+        await query.edit_message_text(f'❌ Ошибка: {e}', reply_markup=export_options_kb())
 
-    # Toggle избранного
-    if data.startswith('img_fav_') or data.startswith('img_unfav_'):
-        blob_name = data.replace('img_fav_', '').replace('img_unfav_', '')
 
-        try:
-            success = gcsa.toggle_favorite(uid, blob_name)
-            if success:
-                action = 'добавлено в' if 'fav_' in data else 'удалено из'
-                await query.answer(f'✅ Изображение {action} избранное!')
-            else:
-                await query.answer('❌ Ошибка', show_alert=True)
-        except Exception as e:
-            await query.answer(f'❌ {e}', show_alert=True)
-        return
+# Toggle избранного
+@router.prefix("img_fav_", "img_unfav_")
+async def cb_img_fav(update, context, query, uid, data):
+    blob_name = data.replace('img_fav_', '').replace('img_unfav_', '')
 
-    # Поделиться ссылкой
-    if data.startswith('img_share_'):
-        blob_name = data.replace('img_share_', '')
-        public_url = gcs.get_public_url(blob_name)
-        await query.answer()
-        await context.bot.send_message(
-            uid,
-            f'🔗 <b>Публичная ссылка:</b>\n\n<code>{public_url}</code>\n\nСкопируйте и отправьте кому угодно!',
-            parse_mode='HTML'
-        )
-        return
+    try:
+        success = gcsa.toggle_favorite(uid, blob_name)
+        if success:
+            action = 'добавлено в' if 'fav_' in data else 'удалено из'
+            await query.answer(f'✅ Изображение {action} избранное!')
+        else:
+            await query.answer('❌ Ошибка', show_alert=True)
+    except Exception as e:
+        await query.answer(f'❌ {e}', show_alert=True)
 
-    # Удаление изображения
-    if data.startswith('img_delete_') and not data.startswith('img_delete_confirm_'):
-        blob_name = data.replace('img_delete_', '')
-        await query.edit_message_text(
-            '🗑️ <b>Удалить изображение?</b>\n\nЭто действие необратимо!',
-            parse_mode='HTML',
-            reply_markup=confirm_delete_kb(blob_name)
-        )
-        return
 
-    # Подтверждение удаления
-    if data.startswith('img_delete_confirm_'):
-        blob_name = data.replace('img_delete_confirm_', '')
+# Поделиться ссылкой
+@router.prefix("img_share_")
+async def cb_img_share(update, context, query, uid, data):
+    blob_name = data.replace('img_share_', '')
+    public_url = gcs.get_image_url(blob_name)
+    await query.answer()
+    await context.bot.send_message(
+        uid,
+        f'🔗 <b>Публичная ссылка:</b>\n\n<code>{public_url}</code>\n\nСкопируйте и отправьте кому угодно!',
+        parse_mode='HTML'
+    )
+
+
+# Удаление изображения
+@router.prefix("img_delete_")
+async def cb_img_delete(update, context, query, uid, data):
+    blob_name = data.replace('img_delete_', '')
+    await query.edit_message_text(
+        '🗑️ <b>Удалить изображение?</b>\n\nЭто действие необратимо!',
+        parse_mode='HTML',
+        reply_markup=confirm_delete_kb(blob_name)
+    )
+
+
+# Подтверждение удаления
+@router.prefix("img_delete_confirm_")
+async def cb_img_delete_confirm(update, context, query, uid, data):
+    blob_name = data.replace('img_delete_confirm_', '')
+
+    try:
+        success = gcs.delete_user_image(uid, blob_name)
+        if success:
+            await query.edit_message_text('✅ Изображение удалено', reply_markup=library_kb_extended())
+        else:
+            await query.edit_message_text('❌ Ошибка удаления', reply_markup=library_kb_extended())
+    except Exception as e:
+        await query.edit_message_text(f'❌ {e}', reply_markup=library_kb_extended())
+
+
+# Добавление тегов
+@router.prefix("img_tags_")
+async def cb_img_tags(update, context, query, uid, data):
+    blob_name = data.replace('img_tags_', '')
+    user_state[uid]['awaiting_tags_for'] = blob_name
+    await query.edit_message_text(
+        '🏷️ <b>Добавить теги</b>\n\nОтправьте теги через пробел\nНапример: пейзаж горы закат'
+    , parse_mode='HTML')
+
+
+async def callbacks(update, context):
+    query = update.callback_query
+    uid = query.from_user.id
+    data = query.data
+
+    # Debug logging
+    logger.debug("Callback received - User: %s, Data: %s", uid, data)
+
+    if not await router.dispatch(update, context):
+        logger.warning("Unhandled callback: %s", data)
 
-        try:
-            success = gcs.delete_user_image(uid, blob_name)
-            if success:
-                await query.edit_message_text('✅ Изображение удалено', reply_markup=library_kb_extended())
-            else:
-                await query.edit_message_text('❌ Ошибка удаления', reply_markup=library_kb_extended())
-        except Exception as e:
-            await query.edit_message_text(f'❌ {e}', reply_markup=library_kb_extended())
-        return
 
-    # Добавление тегов
-    if data.startswith('img_tags_'):
-        blob_name = data.replace('img_tags_', '')
-        user_state[uid]['awaiting_tags_for'] = blob_name
-        await query.edit_message_text(
-            '🏷️ <b>Добавить теги</b>\n\nОтправьте теги через пробел\nНапример: пейзаж горы закат'
-        , parse_mode='HTML')
-        return
 async def precheckout_callback(update, context):
     """Обработка pre-checkout для Telegram Stars"""
     query = update.pre_checkout_query
@@ -4046,10 +4032,10 @@ async def successful_payment(update, context):
             parse_mode="HTML"
         )
 
-        print(f"[INFO] Payment processed: User {user_id} bought {package_id} package")
+        logger.info("Payment processed: User %s bought %s package", user_id, package_id)
 
     except Exception as e:
-        print(f"[ERROR] Payment processing error: {e}")
+        logger.error("Payment processing error: %s", e)
         await update.message.reply_text(
             "❌ Ошибка обработки платежа. Свяжитесь с поддержкой."
         )
@@ -4104,6 +4090,18 @@ async def inline_query(update, context):
             )
         )
 
+        # Изображение, уже отправленное ботом, - по file_id, без повторной загрузки
+        if gen.get('file_id'):
+            results.append(
+                InlineQueryResultCachedPhoto(
+                    id=f"photo_{gen['id']}",
+                    photo_file_id=gen['file_id'],
+                    title=title,
+                    description=f"{description} ({date})",
+                    caption=gen['prompt'][:1024]
+                )
+            )
+
     # Если запрос пустой и нет результатов
     if not results:
         results.append(
@@ -4121,9 +4119,8 @@ async def inline_query(update, context):
 
 async def handle_web_app_data(update, context):
     import json
-    print("[DEBUG] handle_web_app_data called!")
+    logger.debug("handle_web_app_data called!")
     import base64
-    import requests
 
     uid = update.effective_user.id
 
@@ -4137,7 +4134,7 @@ async def handle_web_app_data(update, context):
             return
 
         try:
-            response = requests.get(f'https://imagegen.tools.uspeshnyy.ru/get_mask/{mask_id}', timeout=10)
+            response = await run_blocking(WEB, get_session(WEB).get, f'https://imagegen.tools.uspeshnyy.ru/get_mask/{mask_id}', timeout=10)
             if response.status_code != 200:
                 await update.message.reply_text("Не удалось получить маску с сервера")
                 return
@@ -4178,17 +4175,90 @@ async def handle_web_app_data(update, context):
 
     except Exception as e:
         await update.message.reply_text(f"Ошибка обработки маски: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Mask processing failed")
+
+
+async def set_commands_in_background(application):
+    try:
+        await setup_commands(application)
+        logger.info("Menu commands set successfully")
+    except Exception as e:
+        logger.warning("Failed to set menu commands: %s", e)
 
 
 async def post_init(application):
     """Вызывается после инициализации приложения"""
-    await setup_commands(application)
-    print("Menu commands set successfully")
+    # Меню команд и проверка вкладок Google Sheets - сетевые запросы, которые
+    # не нужны для ответа на первое обновление: выполняются в фоне
+    task = asyncio.create_task(set_commands_in_background(application))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    gsl.start_background_init()
+
+    # Запускаем воркеры очереди генераций
+    generation_queue.start()
+
+    # Метрики: длительности этапов (metrics.span) и текущее состояние компонентов
+    import engine_router
+    from settings import RESULT_CACHE
+    metrics.register_collector("queue", generation_queue.stats)
+    metrics.register_collector("engine", engine_router.stats, label="engine")
+    metrics.register_collector("sessions", user_state.stats)
+    metrics.register_collector("tg_files", telegram_files.stats)
+    metrics.register_collector("callback", lambda: {
+        item["handler"]: {"calls": item["calls"], "seconds_total": item["total"], "seconds_max": item["max"]}
+        for item in router.stats()
+    }, label="handler")
+    if RESULT_CACHE:
+        metrics.register_collector("result_cache", result_cache.stats)
+    if USE_GCS:
+        metrics.register_collector("gcs_content", gcs.content_stats)
+    metrics.register_collector("log", log.stats)
+    metrics.start_server()
+
+    logger.info("Startup took %.2fs", time.monotonic() - STARTED_AT)
+
+
+async def bind_log_context(update, context):
+    """Добавляет update_id и user_id ко всем записям лога при обработке обновления"""
+    user = update.effective_user if isinstance(update, Update) else None
+    log.bind(update_id=getattr(update, "update_id", None), user_id=user.id if user else None)
+
+
+async def post_shutdown(application):
+    """Вызывается при остановке приложения"""
+    import providers
+    await generation_queue.stop()
+    providers.shutdown()
+    metrics.stop_server()
 
 def main():
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).post_init(post_init).build()
+    if BOT_MODE != "webhook":
+        # Проверяем блокировку при старте
+        if not acquire_lock():
+            logger.error("Exiting: another instance is running")
+            sys.exit(1)
+
+        # Регистрируем освобождение блокировки при выходе
+        atexit.register(release_lock)
+
+    # concurrent_updates: обработчики ждут ответа провайдеров в пулах потоков,
+    # поэтому обновления разных пользователей обрабатываются параллельно
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_BASE:
+        # Локальный Bot API сервер (или заглушка бенчмарка)
+        builder = builder.base_url(f"{TELEGRAM_API_BASE}/bot").base_file_url(f"{TELEGRAM_API_BASE}/file/bot")
+    app = builder.build()
+
+    # Идентификаторы корреляции для логов: группа -1 выполняется раньше остальных
+    # обработчиков в той же задаче, поэтому поля видны во всех их записях
+    app.add_handler(TypeHandler(Update, bind_log_context), group=-1)
 
     # Регистрируем обработчики команд
     app.add_handler(CommandHandler("start", start))
@@ -4202,6 +4272,7 @@ def main():
     app.add_handler(CommandHandler("lib", library_command))
     app.add_handler(CommandHandler("prompts", prompts_command))
     app.add_handler(CommandHandler("getprompt", getprompt_command))
+    app.add_handler(CommandHandler("seed", seed_command))
     app.add_handler(CommandHandler("expiry", expiry_command))
     app.add_handler(CommandHandler("presets", presets_command))
     app.add_handler(CommandHandler("buy", buy_command))
@@ -4220,12 +4291,17 @@ def main():
     app.add_handler(PreCheckoutQueryHandler(precheckout_callback))
     app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment))
 
-    print("Bot started successfully...")
-    print("Inline mode enabled - users can use @botname in any chat")
-    print("Payment system enabled - Telegram Stars + CryptoBot")
+    logger.info("Bot started successfully...")
+    logger.info("Inline mode enabled - users can use @botname in any chat")
+    logger.info("Payment system enabled - Telegram Stars + CryptoBot")
+
+    if BOT_MODE == "webhook":
+        # Обновления приходят от приёмника webhook.py (см. webhook.py)
+        import webhook
+        webhook.run_worker(app)
+        return
 
     # Запуск с обработкой конфликта Telegram API
-    import time
     from telegram.error import Conflict
 
     max_retries = 5
@@ -4237,11 +4313,11 @@ def main():
             break
         except Conflict as e:
             if attempt < max_retries - 1:
-                print(f"[CONFLICT] Telegram API conflict detected. Retry {attempt + 1}/{max_retries} in {retry_delay} seconds...")
+                logger.warning("Telegram API conflict detected. Retry %s/%s in %s seconds...", attempt + 1, max_retries, retry_delay)
                 time.sleep(retry_delay)
                 retry_delay *= 2  # Увеличиваем задержку при каждой попытке
             else:
-                print(f"[CONFLICT] Failed after {max_retries} attempts. Exiting.")
+                logger.warning("Failed after %s attempts. Exiting.", max_retries)
                 raise
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+"""
+Маршрутизация нажатий inline-кнопок (callback_data)
+
+Обработчики регистрируются декораторами:
+
+    @router.exact("generate")          # callback_data == "generate"
+    @router.prefix("lib_view_")        # callback_data.startswith("lib_view_")
+
+Точные совпадения ищутся в словаре, префиксы - в префиксном дереве
+(выбирается самый длинный подходящий префикс), поэтому выбор обработчика
+не зависит от количества зарегистрированных кнопок. Для каждого
+обработчика собирается статистика вызовов и времени выполнения.
+"""
+
+import time
+
+_HANDLER = None  # Ключ узла префиксного дерева, под которым хранится обработчик
+
+
+class CallbackRouter:
+    """Таблица обработчиков callback_data"""
+
+    def __init__(self):
+        self._exact = {}
+        self._trie = {}
+        self._stats = {}  # имя обработчика -> [вызовы, суммарное время, максимум]
+
+    def exact(self, *keys):
+        """Регистрирует обработчик для точных значений callback_data"""
+        def decorator(handler):
+            for key in keys:
+                if key in self._exact:
+                    raise ValueError(f"Callback '{key}' is already handled by {self._exact[key].__name__}")
+                self._exact[key] = handler
+            return handler
+        return decorator
+
+    def prefix(self, *prefixes):
+        """Регистрирует обработчик для callback_data, начинающихся с префикса"""
+        def decorator(handler):
+            for prefix in prefixes:
+                node = self._trie
+                for char in prefix:
+                    node = node.setdefault(char, {})
+                if _HANDLER in node:
+                    raise ValueError(f"Callback prefix '{prefix}' is already handled by {node[_HANDLER].__name__}")
+                node[_HANDLER] = handler
+            return handler
+        return decorator
+
+    def include(self, other: "CallbackRouter"):
+        """Добавляет обработчики другого роутера (например, из модуля отдельной функции бота)"""
+        for key, handler in other._exact.items():
+            self.exact(key)(handler)
+
+        def walk(node, prefix):
+            if _HANDLER in node:
+                self.prefix(prefix)(node[_HANDLER])
+            for char, child in node.items():
+                if char is not _HANDLER:
+                    walk(child, prefix + char)
+
+        walk(other._trie, "")
+
+    def resolve(self, data: str):
+        """Возвращает обработчик для callback_data (или None)"""
+        handler = self._exact.get(data)
+        if handler is not None:
+            return handler
+
+        # Самый длинный зарегистрированный префикс
+        node = self._trie
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                break
+            if _HANDLER in node:
+                handler = node[_HANDLER]
+        return handler
+
+    async def dispatch(self, update, context) -> bool:
+        """
+        Вызывает обработчик нажатой кнопки
+
+        Обработчик получает (update, context, query, uid, data).
+
+        Returns:
+            False если для callback_data нет обработчика
+        """
+        query = update.callback_query
+        data = query.data or ""
+        handler = self.resolve(data)
+        if handler is None:
+            return False
+
+        start = time.perf_counter()
+        try:
+            await handler(update, context, query, query.from_user.id, data)
+        finally:
+            elapsed = time.perf_counter() - start
+            stats = self._stats.setdefault(handler.__name__, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+        return True
+
+    def stats(self) -> list:
+        """Статистика обработчиков, отсортированная по суммарному времени"""
+        return sorted(
+            (
+                {"handler": name, "calls": calls, "total": total, "avg": total / calls, "max": maximum}
+                for name, (calls, total, maximum) in self._stats.items()
+            ),
+            key=lambda item: item["total"],
+            reverse=True
+        )
+
+
+# Общий роутер бота
+router = CallbackRouter()
@@ -7,12 +7,12 @@
 - DALL-E 3 (dall-e-3) - Deprecated (until May 12, 2026)
 - DALL-E 2 (dall-e-2) - Deprecated (until May 12, 2026)
 """
-import requests
 import io
-from openai import OpenAI
-from settings import OPENAI_API_KEY
+from providers import get_session, guarded_call, OPENAI
+from openai_helper import get_client
+import log
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+logger = log.get_logger(__name__)
 
 def generate_with_dalle(prompt: str, model: str = "gpt-image-1.5", size: str = "1024x1024", quality: str = "standard"):
     """
@@ -36,11 +36,11 @@ def generate_with_dalle(prompt: str, model: str = "gpt-image-1.5", size: str = "
         BytesIO объект с изображением или строка с ошибкой
     """
     try:
-        print(f"[INFO] Generating image with DALL-E...")
-        print(f"[INFO] Model: {model}")
-        print(f"[INFO] Size: {size}")
-        print(f"[INFO] Quality: {quality}")
-        print(f"[INFO] Prompt: {prompt[:100]}...")
+        logger.info("Generating image with DALL-E...")
+        logger.debug("Model: %s", model)
+        logger.debug("Size: %s", size)
+        logger.debug("Quality: %s", quality)
+        logger.debug("Prompt: %s...", prompt[:100])
 
         # Параметры для DALL-E 3
         params = {
@@ -55,30 +55,28 @@ def generate_with_dalle(prompt: str, model: str = "gpt-image-1.5", size: str = "
             params["quality"] = quality
 
         # Генерируем изображение
-        response = client.images.generate(**params)
+        response = guarded_call(OPENAI, get_client().images.generate, **params)
 
         # Получаем URL изображения
         image_url = response.data[0].url
-        print(f"[OK] Image generated, URL: {image_url}")
+        logger.info("Image generated, URL: %s", image_url)
 
         # Скачиваем изображение
-        print(f"[INFO] Downloading image from URL...")
-        img_response = requests.get(image_url, timeout=30)
+        logger.info("Downloading image from URL...")
+        img_response = get_session(OPENAI).get(image_url, timeout=30)
 
         if img_response.status_code != 200:
-            print(f"[ERROR] Failed to download image: {img_response.status_code}")
+            logger.error("Failed to download image: %s", img_response.status_code)
             return f"Ошибка загрузки изображения: {img_response.status_code}"
 
         image_bytes = img_response.content
-        print(f"[OK] Image downloaded successfully! Size: {len(image_bytes)} bytes")
+        logger.info("Image downloaded successfully! Size: %s bytes", len(image_bytes))
 
         # Возвращаем BytesIO объект
         return io.BytesIO(image_bytes)
 
     except Exception as e:
-        print(f"[ERROR] DALL-E generation failed: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("DALL-E generation failed: %s", e)
         return f"Ошибка генерации: {str(e)}"
 
 
@@ -1,3 +1,8 @@
+import log
+
+logger = log.get_logger(__name__)
+
+
 async def generate_dalle_image(query, uid):
     """Генерирует изображение через OpenAI (GPT Image / DALL-E)"""
     from state import user_state
@@ -7,6 +12,11 @@ async def generate_dalle_image(query, uid):
     from image_library import add_to_history
     from keyboards import actions_kb
     from openai_helper import translate_to_english
+    from providers import run_blocking, OPENAI
+    from telegram_files import sent_file_id
+    from settings import USE_GCS
+    import gcs_helper as gcs
+    import metrics
 
     st = user_state[uid]
 
@@ -31,7 +41,8 @@ async def generate_dalle_image(query, uid):
     gpt_model = st.get("gpt_model", "gpt-4o")
 
     await query.edit_message_text("⏳ Перевод промпта с помощью ChatGPT...")
-    english_prompt = translate_to_english(prompt, gpt_model)
+    with metrics.span("translate", engine="dalle", model=gpt_model):
+        english_prompt = await run_blocking(OPENAI, translate_to_english, prompt, gpt_model)
 
     # Эмодзи для разных моделей
     model_emoji = {
@@ -53,7 +64,8 @@ async def generate_dalle_image(query, uid):
     await query.edit_message_text(f"{model_emoji} Генерация изображения через {model_name}...")
 
     # Генерируем через DALL-E
-    result = generate_with_dalle(english_prompt, dalle_model, dalle_size, dalle_quality)
+    with metrics.span("provider", engine="dalle", model=dalle_model, size=dalle_size):
+        result = await run_blocking(OPENAI, generate_with_dalle, english_prompt, dalle_model, dalle_size, dalle_quality)
 
     # Проверяем результат
     if isinstance(result, str):
@@ -65,22 +77,35 @@ async def generate_dalle_image(query, uid):
     remaining = use_generation(uid)
 
     # Добавляем watermark
-    watermarked = add_watermark(result)
+    with metrics.span("watermark", engine="dalle", model=dalle_model):
+        watermarked = add_watermark(result)
 
     # Отправляем изображение
-    await query.message.reply_photo(
-        photo=watermarked,
-        caption=f"{model_emoji} <b>{model_name}</b>\n\n"
-                f"<b>Промпт:</b> {prompt}\n"
-                f"<b>Размер:</b> {dalle_size}\n"
-                f"<b>Качество:</b> {dalle_quality}\n\n"
-                f"💎 Осталось генераций: {remaining}",
-        reply_markup=actions_kb(),
-        parse_mode="HTML"
-    )
+    with metrics.span("telegram_upload", engine="dalle", model=dalle_model):
+        message = await query.message.reply_photo(
+            photo=watermarked,
+            caption=f"{model_emoji} <b>{model_name}</b>\n\n"
+                    f"<b>Промпт:</b> {prompt}\n"
+                    f"<b>Размер:</b> {dalle_size}\n"
+                    f"<b>Качество:</b> {dalle_quality}\n\n"
+                    f"💎 Осталось генераций: {remaining}",
+            reply_markup=actions_kb(),
+            parse_mode="HTML"
+        )
+
+    file_id = sent_file_id(message)  # Повторная отправка из библиотеки - без загрузки
 
     # Сохраняем в историю
-    add_to_history(uid, prompt, dalle_model, model_name)
+    with metrics.span("history", engine="dalle", model=dalle_model):
+        add_to_history(uid, prompt, english_prompt, {"model": dalle_model, "format": dalle_size}, file_id=file_id)
+
+    # Сохраняем в GCS библиотеку
+    if USE_GCS:
+        with metrics.span("gcs_save", engine="dalle", model=dalle_model):
+            try:
+                gcs.save_user_image(uid, result, category='generated', file_id=file_id)
+            except Exception as e:
+                logger.error("Failed to save to library: %s", e)
 
     # Сохраняем параметры для повторной генерации
     st["saved_params"] = {
@@ -0,0 +1,83 @@
+"""
+Общее хранилище SQLite для данных бота (лимиты, история и т.д.)
+
+Одна база в режиме WAL: читатели не блокируют писателя, а каждая
+операция модулей хранения - это одна короткая транзакция по индексу.
+Соединения создаются отдельно для каждого потока (обработчики бота
+и пулы потоков провайдеров работают параллельно).
+"""
+
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from settings import DB_PATH
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_initialized = set()
+
+
+def get_connection() -> sqlite3.Connection:
+    """Возвращает соединение текущего потока (создаётся при первом обращении)"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        # isolation_level=None: транзакции открываются явно через transaction()
+        conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        conn.execute("PRAGMA foreign_keys=ON")
+        _local.conn = conn
+    return conn
+
+
+@contextmanager
+def transaction():
+    """
+    Транзакция с немедленной блокировкой на запись (BEGIN IMMEDIATE)
+
+    Проверка и изменение внутри одной транзакции атомарны относительно
+    других потоков и процессов, работающих с той же базой.
+    """
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    else:
+        conn.execute("COMMIT")
+
+
+def ensure_schema(name: str, init_func):
+    """
+    Один раз за процесс выполняет init_func(conn) для модуля хранения name
+
+    init_func создаёт таблицы (CREATE TABLE IF NOT EXISTS) и при
+    необходимости переносит данные из старых JSON-файлов.
+    """
+    if name in _initialized:
+        return
+    with _schema_lock:
+        if name in _initialized:
+            return
+        init_func(get_connection())
+        _initialized.add(name)
+
+
+def get_meta(key: str, default=None):
+    """Читает служебное значение (например, отметку о миграции)"""
+    conn = get_connection()
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row["value"] if row else default
+
+
+def set_meta(key: str, value: str):
+    """Записывает служебное значение"""
+    conn = get_connection()
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
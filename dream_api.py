@@ -1,9 +1,14 @@
 import requests
 import io
 import base64
-from settings import STABILITY_API_KEY
+from settings import STABILITY_API_KEY, STABILITY_API_BASE
+from providers import get_session, STABILITY
+import log
 
-def generate_dream(prompt: str, images=None, format_ratio="1:1", model="sd3.5-large", style=None, negative_prompt=""):
+logger = log.get_logger(__name__)
+
+
+def generate_dream(prompt: str, images=None, format_ratio="1:1", model="sd3.5-large", style=None, negative_prompt="", seed=None):
     """
     Генерирует изображение через Stability.ai (Stable Diffusion 3.5)
 
@@ -14,15 +19,16 @@ def generate_dream(prompt: str, images=None, format_ratio="1:1", model="sd3.5-la
         model: Модель для генерации (sd3.5-large, sd3.5-large-turbo, sd3.5-medium, sd3.5-flash)
         style: Стиль изображения (опционально)
         negative_prompt: Negative prompt (что НЕ должно быть на изображении)
+        seed: Seed генерации (0-4294967294); с одинаковым seed и параметрами результат повторяется
     """
     try:
-        print(f"[INFO] Generating image with Stability.ai...")
-        print(f"[INFO] Model: {model}")
-        print(f"[INFO] Format: {format_ratio}")
-        print(f"[INFO] Style: {style}")
-        print(f"[INFO] Prompt: {prompt[:100]}...")
+        logger.info("Generating image with Stability.ai...")
+        logger.debug("Model: %s", model)
+        logger.debug("Format: %s", format_ratio)
+        logger.debug("Style: %s", style)
+        logger.debug("Prompt: %s...", prompt[:100])
         if negative_prompt:
-            print(f"[INFO] Negative Prompt: {negative_prompt[:100]}...")
+            logger.debug("Negative Prompt: %s...", negative_prompt[:100])
 
         # API endpoint для SD 3.5
         model_map = {
@@ -33,7 +39,7 @@ def generate_dream(prompt: str, images=None, format_ratio="1:1", model="sd3.5-la
         }
 
         engine_id = model_map.get(model, "sd3.5-large")
-        api_url = f"https://api.stability.ai/v2beta/stable-image/generate/sd3"
+        api_url = f"{STABILITY_API_BASE}/v2beta/stable-image/generate/sd3"
 
         headers = {
             "Authorization": f"Bearer {STABILITY_API_KEY}",
@@ -56,8 +62,13 @@ def generate_dream(prompt: str, images=None, format_ratio="1:1", model="sd3.5-la
         if negative_prompt:
             data["negative_prompt"] = negative_prompt
 
+        # Фиксированный seed (иначе Stability выбирает случайный)
+        if seed is not None:
+            data["seed"] = int(seed)
+            logger.debug("Seed: %s", seed)
+
         # Отправляем запрос
-        response = requests.post(
+        response = get_session(STABILITY).post(
             api_url,
             headers=headers,
             files={"none": ''},  # Пустой файл для корректной работы multipart
@@ -67,23 +78,21 @@ def generate_dream(prompt: str, images=None, format_ratio="1:1", model="sd3.5-la
 
         if response.status_code != 200:
             error_msg = response.text
-            print(f"[ERROR] Stability.ai API error: {response.status_code}")
-            print(f"[ERROR] Response: {error_msg}")
+            logger.error("Stability.ai API error: %s", response.status_code)
+            logger.error("Response: %.500s", error_msg)
             return [f"Ошибка генерации: {response.status_code}. Проверьте баланс API или параметры."]
 
         # В новом API возвращается напрямую изображение
         image_bytes = response.content
 
-        print(f"[OK] Image generated successfully! Size: {len(image_bytes)} bytes")
+        logger.info("Image generated successfully! Size: %s bytes", len(image_bytes))
 
         # Возвращаем BytesIO объект для отправки в Telegram
         return [io.BytesIO(image_bytes)]
 
     except requests.exceptions.Timeout:
-        print(f"[ERROR] Request timeout")
+        logger.error("Request timeout")
         return ["Превышено время ожидания. Попробуйте еще раз."]
     except Exception as e:
-        print(f"[ERROR] Exception in generate_dream: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Exception in generate_dream: %s", e)
         return [f"Ошибка: {str(e)}"]
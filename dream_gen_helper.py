@@ -0,0 +1,226 @@
+"""
+Helper function for generating images with Stability.ai (SD 3.5) from the job queue
+"""
+
+import log
+
+logger = log.get_logger(__name__)
+
+
+async def generate_dream_image(job):
+    """Генерирует изображение через Stability.ai по задаче из очереди (jobs.GenerationJob)"""
+    from state import user_state
+    from user_limits import try_use_generation, refund_generation
+    import random
+    import engine_router
+    import result_cache
+    import metrics
+    from watermark import add_watermark
+    from image_library import add_to_history
+    from keyboards import actions_kb
+    from openai_helper import build_final_prompt, translate_to_english
+    from providers import run_blocking, ProviderBusyError, OPENAI
+    from telegram_files import sent_file_id
+    from settings import USE_GCS
+    import gsheets_logger as gsl
+    import gcs_helper as gcs
+    import gcs_advanced as gcsa
+
+    query = job.query
+    bot = job.bot
+    uid = job.user_id
+    st = job.params  # Снимок параметров на момент нажатия "Генерировать"
+
+    # Списываем генерации заранее и атомарно: лимит мог закончиться,
+    # пока задача ждала в очереди, или его уже заняла другая задача.
+    # Каждый вариант - отдельная генерация; если на все не хватает, делаем один
+    variants = st.get('variants', 1)
+    reserved, remaining = try_use_generation(uid, variants)
+    if not reserved and variants > 1:
+        variants = 1
+        reserved, remaining = try_use_generation(uid)
+    if not reserved:
+        await query.edit_message_text(
+            "❌ Вы исчерпали лимит бесплатных генераций. "
+            "Используйте /buy для покупки дополнительных генераций."
+        )
+        return
+
+    try:
+        await query.edit_message_text("⏳ <b>Шаг 1/3:</b> Обработка промпта с помощью ChatGPT-4o...", parse_mode="HTML")
+
+        params = {
+            'model': st['model'],
+            'format': st['format'],
+            'style': st['style'],
+            'additional_params': st.get('additional_params', {})
+        }
+
+        # Переводим и формируем промпт для генерации
+        gpt_model = st.get("gpt_model", "gpt-4o")
+        with metrics.span("translate", engine="sd", model=gpt_model):
+            final_english_prompt = await run_blocking(OPENAI, build_final_prompt, st['prompt'], params, gpt_model)
+
+        # Определяем примерное время в зависимости от модели
+        time_estimates = {
+            "sd3.5-large": "~45 сек",
+            "sd3.5-large-turbo": "~30 сек",
+            "sd3.5-medium": "~25 сек",
+            "sd3.5-flash": "~15 сек"
+        }
+
+        estimate = time_estimates.get(st['model'], "~30 сек")
+
+        await query.edit_message_text(
+            f"⏳ <b>Шаг 2/3:</b> Генерация изображения...\n\n"
+            f"🎨 Модель: {st['model']}\n"
+            f"⏱ Примерное время: {estimate}",
+            parse_mode="HTML"
+        )
+
+        # Переводим negative prompt на английский если он есть
+        english_negative = ""
+        if st.get("negative_prompt"):
+            with metrics.span("translate_negative", engine="sd", model=gpt_model):
+                english_negative = await run_blocking(OPENAI, translate_to_english, st["negative_prompt"], gpt_model)
+
+        # Seed всегда задаём явно: он сохраняется в истории, и повтор из истории
+        # (или с закреплённым /seed) даёт то же изображение - в том числе из кеша
+        seed = st.get('seed')
+        if seed is None:
+            seed = random.randint(0, result_cache.MAX_SEED)
+        cache_key = None
+        if variants == 1:
+            cache_key = result_cache.cache_key(
+                "stability", st['model'], final_english_prompt, st['format'],
+                st.get('style'), english_negative, seed
+            )
+        cached = result_cache.get(cache_key)
+
+        # Передаем формат, модель, стиль и negative prompt для генерации;
+        # при ошибке или долгом ответе изображение вернёт резервный движок
+        if cached is not None:
+            output, served_model = [cached], st['model']
+        else:
+            try:
+                with metrics.span("provider", engine="sd", model=st['model'], variants=variants):
+                    output, served_model = await engine_router.generate_variants(
+                        final_english_prompt, st['format'], preferred=st['model'], count=variants,
+                        images=st["images"], style=st.get('style'), negative_prompt=english_negative, seed=seed,
+                        seed_pinned=st.get('seed') is not None
+                    )
+            except ProviderBusyError:
+                raise
+            except Exception as e:
+                # Как и раньше, текст ошибки отправляется пользователю вместо изображения
+                output, served_model = [str(e)], st['model']
+            if served_model == st['model'] and not isinstance(output[0], str):
+                result_cache.put(cache_key, output[0], engine=served_model)
+        if served_model != st['model']:
+            params['model'] = served_model
+        served_engine = engine_router.engine_family(served_model, default="sd")
+
+        await query.edit_message_text("⏳ <b>Шаг 3/3:</b> Отправка результата...", parse_mode="HTML")
+
+        last_generated = None
+        generated = []
+        file_ids = []  # file_id отправленных изображений - повторная отправка без загрузки
+        delivered = 0
+        if len(output) > 1:
+            # Несколько вариантов - одним альбомом
+            with metrics.span("watermark", engine=served_engine, model=served_model):
+                watermarked = [add_watermark(item) for item in output]
+            with metrics.span("telegram_upload", engine=served_engine, model=served_model):
+                messages = await engine_router.send_variants(bot, uid, watermarked)
+            generated = list(output)
+            file_ids = [sent_file_id(message) for message in messages]
+            last_generated = output[-1]
+            delivered = len(output)
+        else:
+            for item in output:
+                try:
+                    # Добавляем watermark
+                    with metrics.span("watermark", engine=served_engine, model=served_model):
+                        watermarked_image = add_watermark(item)
+                    with metrics.span("telegram_upload", engine=served_engine, model=served_model):
+                        message = await bot.send_photo(uid, watermarked_image)
+                    last_generated = item  # Сохраняем оригинал для AI функций
+                    generated.append(item)
+                    file_ids.append(sent_file_id(message))
+                    delivered += 1
+                except:
+                    await bot.send_message(uid, item)
+    except Exception:
+        # Ошибка до отправки результата - возвращаем списанные попытки
+        refund_generation(uid, variants)
+        raise
+
+    # Часть вариантов (или вся генерация) не удалась - возвращаем списанные попытки
+    if delivered < variants:
+        remaining = refund_generation(uid, variants - delivered)
+
+    # Сохраняем в библиотеку
+    with metrics.span("history", engine=served_engine, model=params['model']):
+        add_to_history(
+            user_id=uid,
+            prompt=st['prompt'],
+            english_prompt=final_english_prompt,
+            params=params,
+            negative_prompt=st.get('negative_prompt', ''),
+            seed=seed,
+            file_id=file_ids[-1] if file_ids else None
+        )
+
+    # Сохраняем промпт и изображение для возможности refinement и AI функций
+    user_state[uid]["last_english_prompt"] = final_english_prompt
+    user_state[uid]["last_image"] = last_generated
+
+    # Сохраняем в GCS библиотеку (каждый вариант)
+    with metrics.span("gcs_save", engine=served_engine, model=params['model']):
+        for item, file_id in zip(generated, file_ids) if USE_GCS else []:
+            try:
+                gcs.save_user_image(uid, item, category='generated', file_id=file_id)
+                # Сохраняем метаданные
+                try:
+                    images = gcsa.get_user_images_filtered(uid, category='generated', limit=1)
+                    if images:
+                        blob_name = images[0]['blob_name']
+                        metadata = {'operation_type': 'generation', 'prompt': st['prompt']}
+                        gcsa.save_image_metadata(uid, blob_name, metadata)
+                except Exception as e:
+                    logger.error("Failed to save metadata: %s", e)
+                logger.info("Image saved to user library")
+            except Exception as e:
+                logger.error("Failed to save to library: %s", e)
+    user_state[uid]["in_refinement_mode"] = True
+
+    # Логируем генерацию в Google Sheets
+    with metrics.span("sheets_log", engine=served_engine, model=params['model']):
+        gsl.log_generation(
+            user_id=uid,
+            username=job.username,
+            engine=served_engine,
+            model=params['model'],
+            prompt_ru=st['prompt'],
+            prompt_en=final_english_prompt,
+            format_ratio=st['format'],
+            style=st.get('style', ''),
+            additional_params=st.get('additional_params', {}),
+            negative_prompt=st.get('negative_prompt', ''),
+            success=last_generated is not None,
+            error="" if last_generated else "Generation failed"
+        )
+
+        # Обновляем остаток генераций в Google Sheets (счётчик увеличивает log_generation)
+        gsl.update_user_generations(uid, increment=0, remaining=remaining)
+
+    # Отправляем сообщение с промптом и кнопками действий
+    served_note = ""
+    if params['model'] != st['model']:
+        served_note = f"\n\nℹ️ Создано резервным движком: {engine_router.engine_label(params['model'])}"
+    await bot.send_message(
+        uid,
+        f"✅ Изображение готово{served_note}\n\n<code>{final_english_prompt}</code>\n\n💎 Осталось генераций: {remaining}",
+        parse_mode="HTML",
+        reply_markup=actions_kb()
+    )
@@ -0,0 +1,367 @@
+"""
+Выбор движка генерации: резервные движки и hedged-запросы
+
+generate() запускает выбранный пользователем движок и, если он:
+- завершился ошибкой или недоступен (открыт circuit breaker провайдера,
+  большая доля ошибок за последние ENGINE_STATS_TTL секунд) - сразу
+  пробует следующий движок из ENGINE_FALLBACK_CHAIN (ENGINE_FALLBACK);
+- отвечает дольше ENGINE_HEDGE_PERCENTILE-го перцентиля своей задержки -
+  параллельно запускает следующий движок (ENGINE_HEDGING) и отдаёт
+  результат того, кто ответит первым. Второй запрос отменяется.
+
+Резервные движки включены по умолчанию (срабатывают только после ошибки
+и ничего не стоят), hedging - выключен. Imagen может уступить запрос SD
+3.5, а вот SD заменяется на Imagen, только если в запросе нет стиля,
+негативного промпта, исходных изображений и фиксированного seed: Imagen
+их не принимает и вернул бы не то изображение, которое выбрал пользователь.
+
+Блокирующий HTTP-вызов в потоке провайдера прервать нельзя: отменённый
+запрос дорабатывает в фоне, его результат отбрасывается, а задержка
+всё равно попадает в статистику движка.
+"""
+
+import asyncio
+import time
+from collections import deque
+
+from providers import run_blocking, is_available, ProviderBusyError, GOOGLE, STABILITY
+from settings import (
+    ENGINE_FALLBACK_CHAIN, ENGINE_FALLBACK, ENGINE_HEDGING, ENGINE_HEDGE_PERCENTILE,
+    ENGINE_HEDGE_MIN_DELAY, ENGINE_HEDGE_DEFAULT_DELAY, ENGINE_MAX_ERROR_RATE
+)
+import log
+
+logger = log.get_logger(__name__)
+
+STATS_WINDOW = 50  # Сколько последних запросов движка учитывать
+ENGINE_STATS_TTL = 600  # Ошибки старше этого не влияют на выбор движка (сек)
+MIN_SAMPLES = 5  # Меньше запросов - статистике ещё нельзя доверять
+
+# Stability не поддерживает 4:3 и 3:4 - берём ближайшие форматы
+SD_ASPECT_RATIO_MAP = {
+    "4:3": "5:4",
+    "3:4": "4:5",
+}
+
+
+class EngineError(Exception):
+    """Движок не вернул изображение"""
+
+
+def _imagen(model: str):
+    def run(prompt, aspect_ratio, num_images=1, **options):
+        from imagen_api import generate_with_imagen
+        return generate_with_imagen(prompt, aspect_ratio, num_images, model=model)
+    return run
+
+
+def _stability(model: str):
+    def run(prompt, aspect_ratio, num_images=1, images=None, style=None, negative_prompt="", seed=None, **options):
+        from dream_api import generate_dream
+        # Stability возвращает одно изображение за запрос - на num_images делаем несколько
+        output = []
+        for index in range(max(1, num_images)):
+            output += generate_dream(
+                prompt, images, format_ratio=SD_ASPECT_RATIO_MAP.get(aspect_ratio, aspect_ratio),
+                model=model, style=style, negative_prompt=negative_prompt,
+                seed=None if seed is None else (seed + index) % 4294967295
+            )
+            # generate_dream возвращает текст ошибки вместо изображения
+            errors = [item for item in output if isinstance(item, str)]
+            if errors:
+                raise EngineError(errors[0])
+        return output
+    return run
+
+
+# Движок -> (провайдер, блокирующая функция, название для пользователя)
+ENGINES = {
+    "imagen-4-fast": (GOOGLE, _imagen("imagen-4-fast"), "⚡ Imagen 4 Fast"),
+    "imagen-4": (GOOGLE, _imagen("imagen-4"), "🍌 Imagen 4"),
+    "imagen-4-ultra": (GOOGLE, _imagen("imagen-4-ultra"), "💎 Imagen 4 Ultra"),
+    "sd3.5-large": (STABILITY, _stability("sd3.5-large"), "🎨 SD 3.5 Large"),
+    "sd3.5-large-turbo": (STABILITY, _stability("sd3.5-large-turbo"), "🎨 SD 3.5 Large Turbo"),
+    "sd3.5-medium": (STABILITY, _stability("sd3.5-medium"), "🎨 SD 3.5 Medium"),
+    "sd3.5-flash": (STABILITY, _stability("sd3.5-flash"), "🎨 SD 3.5 Flash"),
+}
+
+# Провайдер -> семейство движков (для логов и метрик)
+ENGINE_FAMILIES = {
+    GOOGLE: "imagen",
+    STABILITY: "sd",
+}
+
+# Параметры Stability, которые Imagen не поддерживает (seed_pinned - seed задан пользователем,
+# а не выбран случайно для кеша)
+_STABILITY_ONLY_OPTIONS = ("images", "style", "negative_prompt", "seed_pinned")
+
+# Сколько изображений движок возвращает за один запрос (Imagen - sampleCount до 4);
+# для остальных движков варианты запрашиваются параллельно
+NATIVE_BATCH = {
+    "imagen-4-fast": 4,
+    "imagen-4": 4,
+    "imagen-4-ultra": 4,
+}
+
+
+class _EngineStats:
+    """Задержки успешных запросов и исходы последних запросов движка"""
+
+    def __init__(self):
+        self.latencies = deque(maxlen=STATS_WINDOW)
+        self.outcomes = deque(maxlen=STATS_WINDOW)  # (время, успех)
+        self.requests = 0
+        self.failures = 0
+        self.hedges = 0
+        self.wins = 0
+
+    def record(self, latency: float, ok: bool):
+        self.requests += 1
+        self.outcomes.append((time.monotonic(), ok))
+        if ok:
+            self.latencies.append(latency)
+        else:
+            self.failures += 1
+
+    def error_rate(self) -> float:
+        cutoff = time.monotonic() - ENGINE_STATS_TTL
+        recent = [ok for at, ok in self.outcomes if at >= cutoff]
+        if len(recent) < MIN_SAMPLES:
+            return 0.0
+        return recent.count(False) / len(recent)
+
+    def percentile(self, pct: int):
+        if len(self.latencies) < MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, len(ordered) * pct // 100)]
+
+
+_stats = {name: _EngineStats() for name in ENGINES}
+
+
+def engine_label(engine: str) -> str:
+    """Название движка для сообщений пользователю"""
+    return ENGINES[engine][2] if engine in ENGINES else engine
+
+
+def engine_family(engine: str, default: str = None) -> str:
+    """Семейство движка ("imagen", "sd") по его провайдеру"""
+    if engine not in ENGINES:
+        return default
+    return ENGINE_FAMILIES.get(ENGINES[engine][0], default)
+
+
+def is_healthy(engine: str) -> bool:
+    """Провайдер движка доступен, и доля недавних ошибок не больше ENGINE_MAX_ERROR_RATE"""
+    provider = ENGINES[engine][0]
+    return is_available(provider) and _stats[engine].error_rate() <= ENGINE_MAX_ERROR_RATE
+
+
+def _can_replace(preferred: str, engine: str, options: dict) -> bool:
+    """Может ли engine выполнить запрос к preferred с теми же параметрами"""
+    if ENGINES[preferred][0] != STABILITY or ENGINES[engine][0] == STABILITY:
+        return True
+    # SD -> Imagen: только если запрос не использует параметры Stability
+    return not any(options.get(key) for key in _STABILITY_ONLY_OPTIONS)
+
+
+def candidates(preferred: str, options: dict = None) -> list:
+    """
+    Порядок движков для запроса: выбранный пользователем, затем движки
+    ENGINE_FALLBACK_CHAIN, которые выполнят запрос с теми же параметрами
+
+    Неработающие движки переносятся в конец (если работающих нет,
+    порядок сохраняется - хотя бы одна попытка будет сделана).
+    """
+    options = options or {}
+    order = [preferred] if preferred in ENGINES else []
+    if ENGINE_FALLBACK or not order:
+        order += [
+            name for name in ENGINE_FALLBACK_CHAIN
+            if name in ENGINES and name not in order and (not order or _can_replace(preferred, name, options))
+        ]
+    if not ENGINE_FALLBACK:
+        order = order[:1]
+
+    healthy = [name for name in order if is_healthy(name)]
+    return healthy + [name for name in order if name not in healthy]
+
+
+def hedge_delay(engine: str) -> float:
+    """Через сколько секунд без ответа запускать следующий движок"""
+    latency = _stats[engine].percentile(ENGINE_HEDGE_PERCENTILE)
+    if latency is None:
+        return ENGINE_HEDGE_DEFAULT_DELAY
+    return max(ENGINE_HEDGE_MIN_DELAY, latency)
+
+
+def _start(engine: str, prompt: str, aspect_ratio: str, num_images: int, options: dict):
+    """
+    Запускает запрос к движку и возвращает задачу
+
+    Сам вызов в потоке провайдера защищён от отмены (shield): при отмене
+    hedged-запроса его задержка всё равно записывается в статистику.
+    """
+    provider, func, _ = ENGINES[engine]
+    started = time.monotonic()
+    call = asyncio.ensure_future(run_blocking(provider, func, prompt, aspect_ratio, num_images, **options))
+
+    def record(future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if isinstance(error, ProviderBusyError):
+            return  # Запрос не отправлялся - не влияет на задержку и долю ошибок
+        _stats[engine].record(time.monotonic() - started, error is None and bool(future.result()))
+
+    call.add_done_callback(record)
+    return asyncio.ensure_future(asyncio.shield(call))
+
+
+async def generate(prompt: str, aspect_ratio: str, preferred: str, num_images: int = 1, **options):
+    """
+    Генерирует изображения выбранным движком с резервными движками и hedging
+
+    Args:
+        prompt: Промпт на английском
+        aspect_ratio: Формат (1:1, 16:9, ...)
+        preferred: Движок, выбранный пользователем (ключ ENGINES)
+        num_images: Количество изображений
+        **options: Параметры Stability (images, style, negative_prompt, seed, seed_pinned)
+
+    Returns:
+        (список BytesIO, движок, который вернул результат)
+
+    Raises:
+        Ошибка последнего движка, если ни один не вернул изображение
+    """
+    queue = deque(candidates(preferred, options))
+    pending = {}
+    last_error = None
+    hedge_at = None
+
+    def launch():
+        nonlocal hedge_at
+        if not queue:
+            return False
+        engine = queue.popleft()
+        pending[_start(engine, prompt, aspect_ratio, num_images, options)] = engine
+        hedge_at = time.monotonic() + hedge_delay(engine) if ENGINE_HEDGING and queue else None
+        return True
+
+    launch()
+    try:
+        while pending:
+            timeout = max(0.0, hedge_at - time.monotonic()) if hedge_at is not None else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                # Не больше одного hedged-запроса одновременно
+                slow = list(pending.values())[-1]
+                launch()
+                hedge_at = None
+                _stats[slow].hedges += 1
+                logger.info("%s is slow, hedging with %s", slow, list(pending.values())[-1])
+                continue
+
+            for task in done:
+                engine = pending.pop(task)
+                try:
+                    images = task.result()
+                except Exception as e:
+                    last_error = e
+                    logger.warning("%s failed: %s", engine, e)
+                    continue
+                if images:
+                    if engine != preferred:
+                        logger.info("Served by %s instead of %s", engine, preferred)
+                    _stats[engine].wins += 1
+                    return images, engine
+                last_error = EngineError(f"{engine_label(engine)}: пустой ответ")
+
+            # Все запущенные движки завершились ошибкой - сразу пробуем следующий
+            if not pending:
+                launch()
+    finally:
+        for task in pending:
+            task.cancel()
+
+    raise last_error or EngineError("Нет доступных движков генерации")
+
+
+async def generate_variants(prompt: str, aspect_ratio: str, preferred: str, count: int, **options):
+    """
+    Генерирует count вариантов изображения
+
+    Если движок умеет возвращать несколько изображений за запрос, делается
+    один запрос; иначе count запросов выполняются параллельно (каждый со
+    своими резервными движками). Варианты, которые не удалось получить,
+    пропускаются.
+
+    Returns:
+        (список BytesIO, движок первого варианта)
+
+    Raises:
+        Ошибка генерации, если не получено ни одного варианта
+    """
+    if count <= 1 or NATIVE_BATCH.get(preferred, 1) >= count:
+        images, engine = await generate(prompt, aspect_ratio, preferred, num_images=count, **options)
+        return images[:count], engine
+
+    # С фиксированным seed все варианты были бы одинаковыми - у каждого свой seed
+    seed = options.pop("seed", None)
+    results = await asyncio.gather(
+        *(
+            generate(prompt, aspect_ratio, preferred, seed=None if seed is None else (seed + index) % 4294967295, **options)
+            for index in range(count)
+        ),
+        return_exceptions=True
+    )
+    images, engine, last_error = [], None, None
+    for result in results:
+        if isinstance(result, BaseException):
+            last_error = result
+            continue
+        images.extend(result[0][:1])
+        engine = engine or result[1]
+    if not images:
+        raise last_error
+    return images, engine
+
+
+async def send_variants(bot, chat_id: int, images: list, caption: str = None, parse_mode: str = None):
+    """
+    Отправляет варианты одним альбомом (media group), подпись - у первого изображения
+
+    Одно изображение отправляется обычным send_photo.
+    """
+    from telegram import InputMediaPhoto
+
+    if len(images) == 1:
+        return [await bot.send_photo(chat_id, images[0], caption=caption, parse_mode=parse_mode)]
+
+    media = [
+        InputMediaPhoto(media=image, caption=caption if index == 0 else None, parse_mode=parse_mode)
+        for index, image in enumerate(images[:10])
+    ]
+    return await bot.send_media_group(chat_id, media)
+
+
+def stats() -> dict:
+    """Статистика движков: запросы, ошибки, перцентили задержки, hedged-запросы"""
+    result = {}
+    for name, engine_stats in _stats.items():
+        if not engine_stats.requests:
+            continue
+        result[name] = {
+            "requests": engine_stats.requests,
+            "failures": engine_stats.failures,
+            "error_rate": engine_stats.error_rate(),
+            "p50": engine_stats.percentile(50),
+            "p90": engine_stats.percentile(90),
+            "hedges": engine_stats.hedges,
+            "wins": engine_stats.wins,
+            "healthy": is_healthy(name),
+        }
+    return result
@@ -0,0 +1,178 @@
+"""
+Экспорт библиотеки пользователя в ZIP архивы
+
+Изображения скачиваются из GCS параллельно (не более EXPORT_CONCURRENCY
+загрузок на один экспорт, в общем пуле потоков провайдера GCS) и сразу
+записываются в архив без сжатия (PNG/JPEG уже сжаты). Архив собирается
+во временном файле (SpooledTemporaryFile), а не целиком в памяти, и
+делится на части не больше EXPORT_PART_MAX_MB - лимита Telegram на
+размер документа. Готовые части отдаются по мере сборки, пока
+следующие изображения продолжают скачиваться.
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import time
+import zipfile
+from collections import deque
+
+import gcs_helper as gcs
+import gcs_advanced as gcsa
+from providers import GCS, get_executor, run_blocking
+from settings import EXPORT_CONCURRENCY, EXPORT_PART_MAX_MB
+import log
+
+logger = log.get_logger(__name__)
+
+PART_MAX_BYTES = EXPORT_PART_MAX_MB * 1024 * 1024
+SPOOL_MAX_BYTES = 8 * 1024 * 1024  # До этого размера часть архива хранится в памяти
+PROGRESS_INTERVAL = 3  # Минимальный интервал между обновлениями прогресса (сек)
+
+# Размер служебных структур ZIP: local file header + central directory (без имени файла)
+_ZIP_ENTRY_OVERHEAD = 30 + 46
+_ZIP_END_OVERHEAD = 22
+
+
+def _entry_size(arcname: str, data_len: int) -> int:
+    """Размер записи в архиве без сжатия (имя файла хранится дважды)"""
+    return data_len + _ZIP_ENTRY_OVERHEAD + 2 * len(arcname.encode('utf-8'))
+
+
+def _meta_name(arcname: str) -> str:
+    return os.path.splitext(arcname)[0] + '.json'
+
+
+def _entries(arcname: str, data: bytes, metadata: dict) -> list:
+    """Записи архива для изображения: само изображение и JSON с метаданными"""
+    entries = [(arcname, data)]
+    if metadata:
+        meta = json.dumps(metadata, ensure_ascii=False, indent=2, default=str).encode('utf-8')
+        entries.append((_meta_name(arcname), meta))
+    return entries
+
+
+class _PartWriter:
+    """Текущая часть архива во временном файле"""
+
+    def __init__(self):
+        self.file = None
+        self.zip = None
+        self.size = 0
+        self.count = 0
+
+    def fits(self, entries: list) -> bool:
+        # Пустая часть принимает любое изображение, даже больше лимита
+        entries_size = sum(_entry_size(name, len(data)) for name, data in entries)
+        return self.count == 0 or self.size + entries_size <= PART_MAX_BYTES
+
+    def write(self, entries: list):
+        if self.zip is None:
+            self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+            self.zip = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_STORED)
+            self.size = _ZIP_END_OVERHEAD
+            self.count = 0
+
+        for name, data in entries:
+            self.zip.writestr(name, data)
+            self.size += _entry_size(name, len(data))
+        self.count += 1
+
+    def close(self):
+        """Завершает часть и возвращает файл, готовый к чтению"""
+        self.zip.close()
+        part = self.file
+        part.seek(0)
+        self.file = None
+        self.zip = None
+        self.count = 0
+        return part
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.zip = None
+
+
+def _download(bucket, blob_name: str) -> bytes:
+    return bucket.blob(blob_name).download_as_bytes()
+
+
+async def export_user_images(user_id: int, category=None, progress=None):
+    """
+    Экспорт изображений пользователя в ZIP архивы (async generator)
+
+    Args:
+        user_id: ID пользователя
+        category: Категория (None - все изображения)
+        progress: async callback(done, total) для отображения прогресса
+
+    Yields:
+        (номер части, файл архива, количество изображений в части).
+        Файл нужно закрыть после отправки.
+    """
+    total = gcsa.count_user_images(user_id, category=category)
+    if not total:
+        return
+    images = gcsa.get_user_images_filtered(user_id, category=category, limit=total)
+
+    bucket = await run_blocking(GCS, gcs.get_bucket)
+    if not bucket:
+        return
+
+    loop = asyncio.get_running_loop()
+    executor = get_executor(GCS)
+    pending = deque()
+    remaining = iter(images)
+
+    def schedule():
+        # Держим не больше EXPORT_CONCURRENCY загрузок одновременно: память
+        # ограничена окном загрузок, а не размером всей библиотеки
+        while len(pending) < EXPORT_CONCURRENCY:
+            img = next(remaining, None)
+            if img is None:
+                return
+            pending.append((img, loop.run_in_executor(executor, _download, bucket, img['storage_blob'])))
+
+    writer = _PartWriter()
+    part_number = 0
+    done = 0
+    last_progress = time.monotonic()
+
+    try:
+        schedule()
+        while pending:
+            img, future = pending.popleft()
+            try:
+                data = await future
+            except Exception as e:
+                logger.error("Failed to download %s for export: %s", img['blob_name'], e)
+                data = None
+            schedule()
+
+            if data is not None:
+                arcname = img['blob_name'].replace(f'users/{user_id}/', '')
+                entries = _entries(arcname, data, img.get('metadata'))
+                if not writer.fits(entries):
+                    part_number += 1
+                    count = writer.count
+                    yield part_number, await loop.run_in_executor(None, writer.close), count
+                await loop.run_in_executor(None, writer.write, entries)
+
+            done += 1
+            if progress and time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                await progress(done, total)
+
+        if writer.count:
+            part_number += 1
+            count = writer.count
+            yield part_number, await loop.run_in_executor(None, writer.close), count
+
+        logger.info("Exported %s images for user %s in %s part(s)", done, user_id, part_number)
+    finally:
+        for _, future in pending:
+            future.cancel()
+        writer.discard()
@@ -1,40 +1,72 @@
 """
 Google Cloud Storage Helper
 Управление изображениями в Google Cloud Storage
+
+Изображения пользователей хранятся по хешу содержимого (upload_content):
+одинаковые байты загружаются в bucket один раз, а библиотека пользователя,
+избранное и Mini App ссылаются на один и тот же blob (см. gcs_index).
 """
 
 import os
 import io
+import hashlib
+import threading
 import uuid
 from typing import Optional, Union
 from datetime import datetime, timedelta
-from google.cloud import storage
-from PIL import Image
 from settings import GCS_BUCKET_NAME, GCS_CREDENTIALS_PATH
+import log
+
+logger = log.get_logger(__name__)
 
 # Настройки
 CREDENTIALS_PATH = GCS_CREDENTIALS_PATH
 BUCKET_NAME = GCS_BUCKET_NAME
 PUBLIC_URL_BASE = f"https://storage.googleapis.com/{BUCKET_NAME}"
 
-# Инициализация клиента GCS
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = CREDENTIALS_PATH
-storage_client = storage.Client()
+# Клиент GCS создаётся при первом обращении: импорт google.cloud.storage и
+# чтение ключей занимают заметное время, а при USE_GCS=false не нужны вовсе
+_storage_client = None
+_bucket = None
+_client_lock = threading.Lock()
+
+# Хранилище по содержимому: objects/{sha256[:2]}/{sha256}.{расширение}
+CONTENT_FOLDER = "objects"
+EDITOR_HOLD_SECONDS = 7 * 24 * 3600  # Сколько изображение, открытое в Mini App, не удаляется из bucket
+
+_content_stats = {"uploads": 0, "uploaded_bytes": 0, "dedup_hits": 0, "dedup_bytes": 0, "refreshes": 0}
+_content_stats_lock = threading.Lock()
+
+
+def get_client():
+    """Получить клиент GCS (создаётся при первом вызове)"""
+    global _storage_client
+    if _storage_client is None:
+        with _client_lock:
+            if _storage_client is None:
+                from google.cloud import storage
+                os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = CREDENTIALS_PATH
+                _storage_client = storage.Client()
+    return _storage_client
 
 
 def get_bucket():
-    """Получить bucket для хранения изображений"""
+    """Получить bucket для хранения изображений (существование проверяется один раз)"""
+    global _bucket
+    if _bucket is not None:
+        return _bucket
     try:
-        bucket = storage_client.bucket(BUCKET_NAME)
-        
+        bucket = get_client().bucket(BUCKET_NAME)
+
         # Проверяем существует ли bucket
         if not bucket.exists():
-            print(f"[ERROR] Bucket {BUCKET_NAME} does not exist!")
+            logger.error("Bucket %s does not exist!", BUCKET_NAME)
             return None
-        
+
+        _bucket = bucket
         return bucket
     except Exception as e:
-        print(f"[ERROR] Failed to get bucket: {e}")
+        logger.error("Failed to get bucket: %s", e)
         return None
 
 
@@ -68,10 +100,10 @@ def upload_image(image_data: Union[bytes, io.BytesIO], folder: str = "images",
         # Создаем blob
         blob = bucket.blob(blob_name)
 
-        # Конвертируем BytesIO в bytes если нужно
+        # Конвертируем BytesIO в bytes если нужно (getvalue не копирует
+        # неизменённые буферы, в том числе ImageBuffer)
         if isinstance(image_data, io.BytesIO):
-            image_data.seek(0)
-            data = image_data.read()
+            data = image_data.getvalue()
         else:
             data = image_data
 
@@ -81,15 +113,120 @@ def upload_image(image_data: Union[bytes, io.BytesIO], folder: str = "images",
         # Формируем публичный URL (bucket уже публичный через IAM)
         public_url = f"{PUBLIC_URL_BASE}/{blob_name}"
 
-        print(f"[OK] Image uploaded to GCS: {public_url}")
+        logger.info("Image uploaded to GCS: %s", public_url)
         return public_url
 
     except Exception as e:
-        print(f"[ERROR] Failed to upload image to GCS: {e}")
+        logger.error("Failed to upload image to GCS: %s", e)
         return None
 
 
-def upload_pil_image(pil_image: Image.Image, folder: str = "images",
+# Расширение имени файла по MIME-типу
+EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp"}
+
+
+def detect_content_type(data: bytes, default: str = "image/png") -> str:
+    """MIME-тип изображения по сигнатуре (watermark может вернуть JPEG или WEBP вместо PNG)"""
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return default
+
+
+def content_blob_name(data: bytes, content_type: str = "image/png") -> str:
+    """Имя blob для содержимого: одинаковые байты - одно имя"""
+    digest = hashlib.sha256(data).hexdigest()
+    extension = EXTENSIONS.get(content_type, content_type.split('/')[-1])
+    return f"{CONTENT_FOLDER}/{digest[:2]}/{digest}.{extension}"
+
+
+def _count(**increments):
+    with _content_stats_lock:
+        for key, value in increments.items():
+            _content_stats[key] += value
+
+
+def content_stats() -> dict:
+    """Загрузки в хранилище по содержимому и сэкономленные повторы (для /metrics)"""
+    with _content_stats_lock:
+        return dict(_content_stats)
+
+
+def refresh_content(bucket, name: str, size: int = 0) -> bool:
+    """
+    Продлевает жизнь blob перед новой ссылкой на него
+
+    Правило lifecycle удаляет объекты по дате создания, поэтому blob, загруженный
+    давно, копируется сам в себя (на стороне GCS, без передачи байтов) - дата
+    создания обновляется. Blob, загруженный недавно, не трогается.
+
+    Returns:
+        False, если blob в bucket не найден
+    """
+    import gcs_index
+
+    if gcs_index.content_is_fresh(name):
+        return True
+    blob = bucket.blob(name)
+    if not blob.exists():
+        return False
+    copy = bucket.copy_blob(blob, bucket, name)
+    gcs_index.mark_content_uploaded(name, size, copy.generation)
+    _count(refreshes=1)
+    return True
+
+
+def upload_content(image_data: Union[bytes, io.BytesIO], content_type: Optional[str] = None,
+                   holder: Optional[str] = None, hold_seconds: Optional[int] = None) -> Optional[str]:
+    """
+    Загрузить изображение в хранилище по содержимому
+
+    Если такие же байты уже есть в bucket (по индексу), повторная загрузка
+    не выполняется. Без content_type формат определяется по байтам.
+
+    Blob удерживается от удаления (gcs_index.hold_content) от имени holder:
+    будущей ссылки, которая снимет удержание при записи в индекс, или
+    владельца (редактор Mini App). Без holder удержание истекает через
+    gcs_index.PENDING_HOLD_SECONDS.
+
+    Returns:
+        Имя blob содержимого (objects/...) или None при ошибке
+    """
+    import gcs_index
+
+    try:
+        bucket = get_bucket()
+        if not bucket:
+            return None
+
+        data = image_data.getvalue() if isinstance(image_data, io.BytesIO) else image_data
+        content_type = content_type or detect_content_type(data)
+        name = content_blob_name(data, content_type)
+
+        uploaded = gcs_index.hold_content(
+            name, holder or f"pending:{uuid.uuid4().hex}", hold_seconds or gcs_index.PENDING_HOLD_SECONDS
+        )
+        if uploaded is not None and refresh_content(bucket, name, len(data)):
+            _count(dedup_hits=1, dedup_bytes=len(data))
+            logger.debug("Image already in GCS: %s", name)
+            return name
+
+        blob = bucket.blob(name)
+        blob.upload_from_string(data, content_type=content_type)
+        gcs_index.mark_content_uploaded(name, len(data), blob.generation)
+        _count(uploads=1, uploaded_bytes=len(data))
+        logger.info("Image uploaded to GCS: %s", name)
+        return name
+
+    except Exception as e:
+        logger.error("Failed to upload image to GCS: %s", e)
+        return None
+
+
+def upload_pil_image(pil_image: "Image.Image", folder: str = "images",
                      filename: Optional[str] = None, format: str = "PNG") -> Optional[str]:
     """
     Загрузить PIL Image в GCS
@@ -115,7 +252,7 @@ def upload_pil_image(pil_image: Image.Image, folder: str = "images",
         return upload_image(img_byte_arr, folder=folder, filename=filename, content_type=content_type)
 
     except Exception as e:
-        print(f"[ERROR] Failed to upload PIL image: {e}")
+        logger.error("Failed to upload PIL image: %s", e)
         return None
 
 
@@ -137,11 +274,11 @@ def delete_image(blob_name: str) -> bool:
         blob = bucket.blob(blob_name)
         blob.delete()
 
-        print(f"[OK] Image deleted from GCS: {blob_name}")
+        logger.info("Image deleted from GCS: %s", blob_name)
         return True
 
     except Exception as e:
-        print(f"[ERROR] Failed to delete image: {e}")
+        logger.error("Failed to delete image: %s", e)
         return False
 
 
@@ -172,13 +309,13 @@ def delete_old_images(folder: str = "images", days_old: int = 7) -> int:
             if blob.time_created.replace(tzinfo=None) < cutoff_date:
                 blob.delete()
                 deleted_count += 1
-                print(f"[INFO] Deleted old image: {blob.name}")
+                logger.info("Deleted old image: %s", blob.name)
 
-        print(f"[OK] Deleted {deleted_count} old images")
+        logger.info("Deleted %s old images", deleted_count)
         return deleted_count
 
     except Exception as e:
-        print(f"[ERROR] Failed to delete old images: {e}")
+        logger.error("Failed to delete old images: %s", e)
         return 0
 
 
@@ -195,6 +332,12 @@ def get_public_url(blob_name: str) -> str:
     return f"{PUBLIC_URL_BASE}/{blob_name}"
 
 
+def get_image_url(blob_name: str) -> str:
+    """Публичный URL изображения из библиотеки (ссылка users/... ведёт на blob содержимого)"""
+    import gcs_index
+    return get_public_url(gcs_index.storage_blob(blob_name))
+
+
 def list_images(folder: str = "images", limit: int = 100) -> list:
     """
     Получить список изображений в папке
@@ -215,69 +358,76 @@ def list_images(folder: str = "images", limit: int = 100) -> list:
         return [f"{PUBLIC_URL_BASE}/{blob.name}" for blob in blobs]
 
     except Exception as e:
-        print(f"[ERROR] Failed to list images: {e}")
+        logger.error("Failed to list images: %s", e)
         return []
 
 
 # Тестовая функция
 
 # Save user image functions
-def save_user_image(user_id: int, image_data, category: str = 'generated', filename = None):
+def save_user_image(user_id: int, image_data, category: str = 'generated', filename = None, file_id = None):
+    """
+    Сохраняет изображение в библиотеку пользователя
+
+    Байты загружаются по содержимому (upload_content), а в индекс
+    записывается ссылка users/{id}/{category}/{filename} на них.
+    Расширение и MIME-тип определяются по байтам изображения.
+    Возвращает публичный URL изображения или None.
+    """
     import uuid
     from datetime import datetime
+    import gcs_index
+    data = image_data.getvalue() if isinstance(image_data, io.BytesIO) else image_data
+    content_type = detect_content_type(data)
     if not filename:
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f'{timestamp}_{uuid.uuid4().hex[:8]}.png'
-    folder = f'users/{user_id}/{category}'
-    return upload_image(image_data, folder=folder, filename=filename)
+        filename = f'{timestamp}_{uuid.uuid4().hex[:8]}.{EXTENSIONS[content_type]}'
+    blob_name = f'users/{user_id}/{category}/{filename}'
+    content = upload_content(data, content_type, holder=blob_name)
+    if not content:
+        return None
+    try:
+        gcs_index.record_image(user_id, blob_name, size=len(data), file_id=file_id, content=content)
+    except Exception as e:
+        logger.error("Failed to index image: %s", e)
+    return get_public_url(content)
 
 def get_user_images(user_id: int, category = None, limit: int = 100):
-    bucket = get_bucket()
-    if not bucket:
-        return []
-    prefix = f'users/{user_id}/{category}/' if category else f'users/{user_id}/'
-    blobs = bucket.list_blobs(prefix=prefix, max_results=limit)
-    images = []
-    for blob in blobs:
-        if blob.name.endswith('/'):
-            continue
-        parts = blob.name.split('/')
-        img_category = parts[2] if len(parts) > 2 else 'unknown'
-        images.append({
-            'url': f'{PUBLIC_URL_BASE}/{blob.name}',
-            'name': blob.name.split('/')[-1],
-            'category': img_category,
-            'size': blob.size,
-            'created': blob.time_created,
-            'blob_name': blob.name
-        })
-    images.sort(key=lambda x: x['created'], reverse=True)
-    return images
+    import gcs_index
+    return gcs_index.list_images(user_id, PUBLIC_URL_BASE, category=category, limit=limit)
 
 def get_user_stats(user_id: int):
-    bucket = get_bucket()
-    if not bucket:
-        return {'generated': 0, 'uploaded': 0, 'edited': 0, 'total': 0}
+    import gcs_index
+    counts = gcs_index.category_counts(user_id)
     stats = {'generated': 0, 'uploaded': 0, 'edited': 0, 'total': 0}
     for category in ['generated', 'uploaded', 'edited']:
-        prefix = f'users/{user_id}/{category}/'
-        blobs = list(bucket.list_blobs(prefix=prefix))
-        count = sum(1 for b in blobs if not b.name.endswith('/'))
-        stats[category] = count
-        stats['total'] += count
+        stats[category] = counts.get(category, 0)
+        stats['total'] += stats[category]
     return stats
 
 def delete_user_image(user_id: int, blob_name: str):
+    """Удаляет ссылку пользователя; blob удаляется, когда на него не осталось ссылок"""
+    import gcs_index
     if not blob_name.startswith(f'users/{user_id}/'):
         return False
     bucket = get_bucket()
     if not bucket:
         return False
-    blob = bucket.blob(blob_name)
-    blob.delete()
+    unreferenced = gcs_index.remove_reference(blob_name)
+    if unreferenced:
+        storage_blob, generation = unreferenced
+        # Условие на generation: если тем временем содержимое загрузили заново
+        # под новую ссылку, удаление не выполнится. Если удаление не удалось,
+        # blob без ссылок удалит правило lifecycle
+        try:
+            bucket.blob(storage_blob).delete(if_generation_match=generation)
+        except Exception as e:
+            logger.warning("Failed to delete unreferenced blob %s: %s", storage_blob, e)
     return True
 
 if __name__ == "__main__":
+    from PIL import Image
+
     print("Testing GCS Helper...")
 
     # Создаем тестовое изображение
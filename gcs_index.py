@@ -0,0 +1,512 @@
+"""
+Локальный индекс изображений пользователей в GCS
+
+Для каждого изображения хранится строка в SQLite (db.py): имя blob, категория,
+размер, дата создания, метаданные, теги, флаг избранного и file_id Telegram
+(после первой отправки изображение показывается по file_id, без повторной
+загрузки в Telegram). Индекс обновляется
+при записи (save_user_image, save_image_metadata, избранное, удаление), поэтому
+просмотр библиотеки, подсчёт страниц, поиск по тегам и статистика не
+перечисляют bucket и не скачивают JSON-метаданные по одному.
+
+Изображения, сохранённые до появления индекса, подтягиваются из bucket
+один раз при первом обращении к библиотеке пользователя (sync_user).
+
+Строка индекса - ссылка пользователя на изображение. Сами байты хранятся
+один раз по хешу содержимого (objects/..., см. gcs_helper.upload_content) и
+указываются в колонке content; избранное - ещё одна ссылка на то же
+содержимое. Blob содержимого удаляется, когда на него не остаётся ссылок
+(remove_reference). У старых изображений content пуст: байты лежат по
+самому blob_name.
+
+Пока ссылка ещё не записана (между проверкой дубликата и record_image) или
+blob открыт в редакторе Mini App, содержимое удерживается строкой в
+gcs_content_holds (hold_content) и тоже не удаляется.
+"""
+
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+import db
+import log
+
+logger = log.get_logger(__name__)
+
+CATEGORIES = ['generated', 'uploaded', 'edited', 'favorites']
+LIFECYCLE_DAYS = 60  # Правило lifecycle bucket: изображения удаляются через 60 дней
+# Возраст blob содержимого, после которого новая ссылка на него обновляет дату
+# создания (копированием на месте) - иначе lifecycle удалит его раньше ссылки
+CONTENT_REFRESH_DAYS = 1
+PENDING_HOLD_SECONDS = 600  # Удержание содержимого до записи ссылки (если она так и не появится)
+
+_sync_lock = threading.Lock()
+
+
+def _init_schema(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS gcs_images (
+            blob_name TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            category TEXT NOT NULL,
+            name TEXT NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0,
+            created TEXT NOT NULL,
+            metadata TEXT NOT NULL DEFAULT '{}',
+            favorite INTEGER NOT NULL DEFAULT 0,
+            file_id TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_gcs_images_user_created
+            ON gcs_images (user_id, created DESC);
+        CREATE INDEX IF NOT EXISTS idx_gcs_images_user_category
+            ON gcs_images (user_id, category, created DESC);
+        CREATE INDEX IF NOT EXISTS idx_gcs_images_user_name
+            ON gcs_images (user_id, name);
+
+        CREATE TABLE IF NOT EXISTS gcs_image_tags (
+            blob_name TEXT NOT NULL REFERENCES gcs_images (blob_name) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL,
+            tag TEXT NOT NULL,
+            PRIMARY KEY (blob_name, tag)
+        );
+        CREATE INDEX IF NOT EXISTS idx_gcs_image_tags_user_tag
+            ON gcs_image_tags (user_id, tag);
+
+        CREATE TABLE IF NOT EXISTS gcs_index_users (
+            user_id INTEGER PRIMARY KEY,
+            synced_at TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS gcs_contents (
+            content TEXT PRIMARY KEY,
+            size INTEGER NOT NULL DEFAULT 0,
+            uploaded TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS gcs_content_holds (
+            content TEXT NOT NULL,
+            holder TEXT NOT NULL,
+            expires TEXT NOT NULL,
+            PRIMARY KEY (content, holder)
+        );
+    """)
+
+    # file_id и content добавлены позже - дополняем существующую таблицу
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(gcs_images)")}
+    if "file_id" not in columns:
+        conn.execute("ALTER TABLE gcs_images ADD COLUMN file_id TEXT")
+    if "content" not in columns:
+        conn.execute("ALTER TABLE gcs_images ADD COLUMN content TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_gcs_images_content ON gcs_images (content)")
+    # generation blob содержимого - удаление не затронет загруженный заново blob
+    content_columns = {row["name"] for row in conn.execute("PRAGMA table_info(gcs_contents)")}
+    if "generation" not in content_columns:
+        conn.execute("ALTER TABLE gcs_contents ADD COLUMN generation INTEGER")
+
+
+def _conn():
+    db.ensure_schema("gcs_index", _init_schema)
+    return db.get_connection()
+
+
+def _split_blob_name(blob_name: str):
+    """users/{id}/{category}/{filename} -> (category, filename)"""
+    parts = blob_name.split('/')
+    category = parts[2] if len(parts) > 3 else 'unknown'
+    return category, parts[-1]
+
+
+def _to_iso(created) -> str:
+    if created is None:
+        created = datetime.now(timezone.utc)
+    if created.tzinfo is None:
+        created = created.replace(tzinfo=timezone.utc)
+    return created.astimezone(timezone.utc).isoformat()
+
+
+def _row_to_image(row, public_url_base: str) -> Dict:
+    storage_blob = row['content'] or row['blob_name']
+    return {
+        'url': f"{public_url_base}/{storage_blob}",
+        'name': row['name'],
+        'category': row['category'],
+        'size': row['size'],
+        'created': datetime.fromisoformat(row['created']),
+        'blob_name': row['blob_name'],
+        'storage_blob': storage_blob,
+        'metadata': json.loads(row['metadata'] or '{}'),
+        'in_favorites': bool(row['favorite']) or row['category'] == 'favorites',
+        'file_id': row['file_id']
+    }
+
+
+def _set_tags(conn, user_id: int, blob_name: str, metadata: dict):
+    conn.execute("DELETE FROM gcs_image_tags WHERE blob_name = ?", (blob_name,))
+    for tag in set(metadata.get('tags') or []):
+        conn.execute(
+            "INSERT OR IGNORE INTO gcs_image_tags (blob_name, user_id, tag) VALUES (?, ?, ?)",
+            (blob_name, user_id, str(tag).lower())
+        )
+
+
+# ===== Запись =====
+
+def record_image(user_id: int, blob_name: str, size: int = 0, created=None,
+                 metadata: Optional[dict] = None, favorite: bool = False, file_id: Optional[str] = None,
+                 content: Optional[str] = None):
+    """
+    Добавляет (или обновляет) изображение в индексе (content - blob с байтами изображения)
+
+    Удержание содержимого, взятое под эту ссылку (hold_content с holder=blob_name),
+    снимается в той же транзакции.
+    """
+    category, name = _split_blob_name(blob_name)
+    metadata = metadata or {}
+    _conn()
+    with db.transaction() as conn:
+        if content:
+            conn.execute("DELETE FROM gcs_content_holds WHERE content = ? AND holder = ?", (content, blob_name))
+        conn.execute(
+            """INSERT INTO gcs_images (blob_name, user_id, category, name, size, created, metadata, favorite, file_id, content)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (blob_name) DO UPDATE SET
+                   size = excluded.size, created = excluded.created,
+                   metadata = excluded.metadata, favorite = excluded.favorite,
+                   file_id = COALESCE(excluded.file_id, gcs_images.file_id),
+                   content = COALESCE(excluded.content, gcs_images.content)""",
+            (blob_name, user_id, category, name, size, _to_iso(created),
+             json.dumps(metadata, ensure_ascii=False), 1 if favorite else 0, file_id, content)
+        )
+        _set_tags(conn, user_id, blob_name, metadata)
+
+
+def update_metadata(user_id: int, blob_name: str, metadata: dict):
+    """Обновляет метаданные и теги изображения в индексе"""
+    _conn()
+    with db.transaction() as conn:
+        cursor = conn.execute(
+            "UPDATE gcs_images SET metadata = ? WHERE blob_name = ?",
+            (json.dumps(metadata, ensure_ascii=False, default=str), blob_name)
+        )
+        if cursor.rowcount:
+            _set_tags(conn, user_id, blob_name, metadata)
+
+
+def set_file_ids(file_ids: Dict[str, str]):
+    """Запоминает file_id Telegram для изображений {blob_name: file_id}"""
+    if not file_ids:
+        return
+    _conn()
+    with db.transaction() as conn:
+        conn.executemany(
+            "UPDATE gcs_images SET file_id = ? WHERE blob_name = ?",
+            [(file_id, blob_name) for blob_name, file_id in file_ids.items()]
+        )
+
+
+def set_favorite(user_id: int, source_blob_name: str, favorite_blob_name: str, is_favorite: bool, size: int = 0):
+    """
+    Отмечает изображение как избранное (или снимает отметку)
+
+    Избранное - ссылка users/{id}/favorites/{имя} на то же содержимое, что
+    и у исходного изображения (копия в bucket не создаётся), а у исходного
+    изображения выставляется флаг favorite.
+    """
+    _conn()
+    with db.transaction() as conn:
+        if is_favorite:
+            source = conn.execute(
+                "SELECT size, metadata, file_id, content FROM gcs_images WHERE blob_name = ?", (source_blob_name,)
+            ).fetchone()
+            metadata = source['metadata'] if source else '{}'
+            content = (source['content'] if source else None) or source_blob_name
+            conn.execute(
+                """INSERT OR REPLACE INTO gcs_images (blob_name, user_id, category, name, size, created, metadata, favorite, file_id, content)
+                   VALUES (?, ?, 'favorites', ?, ?, ?, ?, 1, ?, ?)""",
+                (favorite_blob_name, user_id, favorite_blob_name.split('/')[-1],
+                 source['size'] if source else size, _to_iso(None), metadata,
+                 source['file_id'] if source else None, content)
+            )
+            _set_tags(conn, user_id, favorite_blob_name, json.loads(metadata))
+            conn.execute("DELETE FROM gcs_content_holds WHERE content = ? AND holder = ?", (content, favorite_blob_name))
+        else:
+            conn.execute("DELETE FROM gcs_images WHERE blob_name = ?", (favorite_blob_name,))
+
+        # Флаг у всех изображений пользователя с тем же именем файла
+        conn.execute(
+            "UPDATE gcs_images SET favorite = ? WHERE user_id = ? AND name = ? AND category != 'favorites'",
+            (1 if is_favorite else 0, user_id, favorite_blob_name.split('/')[-1])
+        )
+
+
+def remove_reference(blob_name: str) -> Optional[tuple]:
+    """
+    Удаляет ссылку из индекса
+
+    Returns:
+        (blob с байтами изображения, его generation или None), если на blob
+        больше нет ссылок и удержаний (его нужно удалить из bucket), иначе None
+    """
+    _conn()
+    with db.transaction() as conn:
+        row = conn.execute("SELECT content FROM gcs_images WHERE blob_name = ?", (blob_name,)).fetchone()
+        storage_blob = (row['content'] if row else None) or blob_name
+        conn.execute("DELETE FROM gcs_images WHERE blob_name = ?", (blob_name,))
+        conn.execute("DELETE FROM gcs_content_holds WHERE expires < ?", (_to_iso(None),))
+        # Старое изображение (content пуст) может оставаться целью ссылок избранного
+        referenced = conn.execute(
+            "SELECT 1 FROM gcs_images WHERE content = ? OR blob_name = ? LIMIT 1", (storage_blob, storage_blob)
+        ).fetchone() or conn.execute(
+            "SELECT 1 FROM gcs_content_holds WHERE content = ? LIMIT 1", (storage_blob,)
+        ).fetchone()
+        if referenced:
+            return None
+        content = conn.execute("SELECT generation FROM gcs_contents WHERE content = ?", (storage_blob,)).fetchone()
+        conn.execute("DELETE FROM gcs_contents WHERE content = ?", (storage_blob,))
+        return storage_blob, content['generation'] if content else None
+
+
+def hold_content(content: str, holder: str, seconds: int = PENDING_HOLD_SECONDS) -> Optional[datetime]:
+    """
+    Удерживает blob содержимого от удаления на seconds секунд
+
+    Проверка, известен ли blob индексу, и удержание выполняются в одной
+    транзакции: remove_reference после неё blob не удалит, даже если ссылка
+    ещё не записана. holder - будущая ссылка (её record_image / set_favorite
+    снимет удержание) или владелец, например редактор Mini App.
+
+    Returns:
+        Когда blob был загружен (или обновлён), None - неизвестен индексу
+    """
+    expires = _to_iso(datetime.now(timezone.utc) + timedelta(seconds=seconds))
+    _conn()
+    with db.transaction() as conn:
+        row = conn.execute("SELECT uploaded FROM gcs_contents WHERE content = ?", (content,)).fetchone()
+        conn.execute(
+            """INSERT INTO gcs_content_holds (content, holder, expires) VALUES (?, ?, ?)
+               ON CONFLICT (content, holder) DO UPDATE SET expires = MAX(excluded.expires, gcs_content_holds.expires)""",
+            (content, holder, expires)
+        )
+    return datetime.fromisoformat(row['uploaded']) if row else None
+
+
+def content_uploaded(content: str) -> Optional[datetime]:
+    """Когда blob содержимого был загружен (или обновлён), None - неизвестен индексу"""
+    row = _conn().execute("SELECT uploaded FROM gcs_contents WHERE content = ?", (content,)).fetchone()
+    return datetime.fromisoformat(row['uploaded']) if row else None
+
+
+def content_is_fresh(content: str) -> bool:
+    """Загружен ли blob содержимого недавно (новая ссылка может использовать его без обновления)"""
+    uploaded = content_uploaded(content)
+    return uploaded is not None and datetime.now(timezone.utc) - uploaded < timedelta(days=CONTENT_REFRESH_DAYS)
+
+
+def mark_content_uploaded(content: str, size: int = 0, generation: Optional[int] = None):
+    """Запоминает загрузку (или обновление) blob содержимого и его generation"""
+    _conn()
+    with db.transaction() as conn:
+        conn.execute(
+            """INSERT INTO gcs_contents (content, size, uploaded, generation) VALUES (?, ?, ?, ?)
+               ON CONFLICT (content) DO UPDATE SET
+                   size = MAX(excluded.size, gcs_contents.size), uploaded = excluded.uploaded,
+                   generation = COALESCE(excluded.generation, gcs_contents.generation)""",
+            (content, size, _to_iso(None), generation)
+        )
+
+
+def storage_blob(blob_name: str) -> str:
+    """Blob с байтами изображения для ссылки blob_name"""
+    row = _conn().execute("SELECT content FROM gcs_images WHERE blob_name = ?", (blob_name,)).fetchone()
+    return (row['content'] if row else None) or blob_name
+
+
+# ===== Синхронизация с bucket =====
+
+def is_synced(user_id: int) -> bool:
+    row = _conn().execute("SELECT 1 FROM gcs_index_users WHERE user_id = ?", (user_id,)).fetchone()
+    return row is not None
+
+
+def sync_user(user_id: int, force: bool = False) -> int:
+    """
+    Заполняет индекс пользователя из bucket (один раз)
+
+    Выполняется только для библиотек, созданных до появления индекса,
+    или при force=True (ручная пересборка).
+
+    Returns:
+        Количество проиндексированных изображений
+    """
+    if not force and is_synced(user_id):
+        return 0
+
+    with _sync_lock:
+        if not force and is_synced(user_id):
+            return 0
+
+        import gcs_helper as gcs
+        import gcs_advanced as gcsa
+
+        bucket = gcs.get_bucket()
+        if not bucket:
+            return 0
+
+        blobs = [
+            blob for blob in bucket.list_blobs(prefix=f'users/{user_id}/')
+            if not blob.name.endswith('/') and not blob.name.endswith('.json')
+        ]
+        favorite_names = {
+            blob.name.split('/')[-1] for blob in blobs
+            if _split_blob_name(blob.name)[0] == 'favorites'
+        }
+
+        _conn()
+        rows = []
+        for blob in blobs:
+            metadata = gcsa.get_image_metadata(blob.name, use_index=False) or {}
+            rows.append((blob, metadata))
+
+        with db.transaction() as conn:
+            # file_id не хранится в bucket - сохраняем уже известные при пересборке
+            file_ids = {
+                row['blob_name']: row['file_id'] for row in conn.execute(
+                    "SELECT blob_name, file_id FROM gcs_images WHERE user_id = ? AND file_id IS NOT NULL", (user_id,)
+                )
+            }
+            # Ссылки на содержимое (content) есть только в индексе - их не трогаем
+            kept_favorites = {
+                row['name'] for row in conn.execute(
+                    "SELECT name FROM gcs_images WHERE user_id = ? AND content IS NOT NULL AND category = 'favorites'",
+                    (user_id,)
+                )
+            }
+            favorite_names |= kept_favorites
+            conn.execute("DELETE FROM gcs_images WHERE user_id = ? AND content IS NULL", (user_id,))
+            for blob, metadata in rows:
+                category, name = _split_blob_name(blob.name)
+                conn.execute(
+                    """INSERT OR REPLACE INTO gcs_images (blob_name, user_id, category, name, size, created, metadata, favorite, file_id)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (blob.name, user_id, category, name, blob.size or 0, _to_iso(blob.time_created),
+                     json.dumps(metadata, ensure_ascii=False, default=str),
+                     1 if name in favorite_names else 0, file_ids.get(blob.name))
+                )
+                _set_tags(conn, user_id, blob.name, metadata)
+            conn.execute(
+                "INSERT OR REPLACE INTO gcs_index_users (user_id, synced_at) VALUES (?, ?)",
+                (user_id, datetime.now().isoformat())
+            )
+
+        logger.info("Index built for user %s: %s images", user_id, len(rows))
+        return len(rows)
+
+
+def _ensure_synced(user_id: int):
+    try:
+        sync_user(user_id)
+    except Exception as e:
+        logger.error("Failed to sync GCS index for user %s: %s", user_id, e)
+
+
+# ===== Чтение =====
+
+def _where(user_id: int, category=None, days=None):
+    # Изображения старше LIFECYCLE_DAYS уже удалены правилом lifecycle bucket
+    clauses = ["user_id = ?", "created >= ?"]
+    params = [user_id, _to_iso(datetime.now(timezone.utc) - timedelta(days=LIFECYCLE_DAYS))]
+    if category:
+        clauses.append("category = ?")
+        params.append(category)
+    if days:
+        clauses.append("created >= ?")
+        params.append(_to_iso(datetime.now(timezone.utc) - timedelta(days=days)))
+    return " AND ".join(clauses), params
+
+
+def list_images(user_id: int, public_url_base: str, category=None, days=None,
+                limit: int = 100, offset: int = 0) -> List[Dict]:
+    """Страница изображений пользователя (новые первыми)"""
+    _ensure_synced(user_id)
+    where, params = _where(user_id, category, days)
+    rows = _conn().execute(
+        f"SELECT * FROM gcs_images WHERE {where} ORDER BY created DESC LIMIT ? OFFSET ?",
+        params + [limit, offset]
+    ).fetchall()
+    return [_row_to_image(row, public_url_base) for row in rows]
+
+
+def count_images(user_id: int, category=None, days=None) -> int:
+    """Количество изображений пользователя"""
+    _ensure_synced(user_id)
+    where, params = _where(user_id, category, days)
+    row = _conn().execute(f"SELECT COUNT(*) AS total FROM gcs_images WHERE {where}", params).fetchone()
+    return row['total']
+
+
+def category_counts(user_id: int) -> Dict[str, int]:
+    """Количество изображений по категориям"""
+    _ensure_synced(user_id)
+    rows = _conn().execute(
+        "SELECT category, COUNT(*) AS total FROM gcs_images WHERE user_id = ? GROUP BY category",
+        (user_id,)
+    ).fetchall()
+    return {row['category']: row['total'] for row in rows}
+
+
+def get_metadata(blob_name: str) -> Optional[dict]:
+    """Метаданные изображения из индекса (None если изображения нет в индексе)"""
+    row = _conn().execute("SELECT metadata FROM gcs_images WHERE blob_name = ?", (blob_name,)).fetchone()
+    if row is None:
+        return None
+    return json.loads(row['metadata'] or '{}')
+
+
+def is_favorite(user_id: int, filename: str) -> bool:
+    """Есть ли изображение в избранном"""
+    row = _conn().execute(
+        "SELECT 1 FROM gcs_images WHERE user_id = ? AND category = 'favorites' AND name = ?",
+        (user_id, filename)
+    ).fetchone()
+    return row is not None
+
+
+def search_by_tags(user_id: int, tags: list, public_url_base: str, category=None) -> List[Dict]:
+    """Изображения, у которых есть хотя бы один из тегов"""
+    _ensure_synced(user_id)
+    tags = [str(tag).lower() for tag in tags]
+    if not tags:
+        return []
+    where, params = _where(user_id, category)
+    placeholders = ", ".join("?" for _ in tags)
+    rows = _conn().execute(
+        f"""SELECT * FROM gcs_images WHERE {where} AND blob_name IN (
+                SELECT blob_name FROM gcs_image_tags WHERE user_id = ? AND tag IN ({placeholders})
+            ) ORDER BY created DESC""",
+        params + [user_id] + tags
+    ).fetchall()
+    return [_row_to_image(row, public_url_base) for row in rows]
+
+
+def operation_stats(user_id: int, days=30) -> Dict[str, int]:
+    """Количество изображений по operation_type из метаданных"""
+    _ensure_synced(user_id)
+    where, params = _where(user_id, days=days)
+    rows = _conn().execute(
+        f"""SELECT COALESCE(json_extract(metadata, '$.operation_type'), 'unknown') AS operation, COUNT(*) AS total
+            FROM gcs_images WHERE {where} GROUP BY operation""",
+        params
+    ).fetchall()
+    return {row['operation']: row['total'] for row in rows}
+
+
+def images_older_than(user_id: int, cutoff: datetime, public_url_base: str) -> List[Dict]:
+    """Изображения, созданные раньше cutoff"""
+    _ensure_synced(user_id)
+    where, params = _where(user_id)
+    rows = _conn().execute(
+        f"SELECT * FROM gcs_images WHERE {where} AND created < ? ORDER BY created",
+        params + [_to_iso(cutoff)]
+    ).fetchall()
+    return [_row_to_image(row, public_url_base) for row in rows]
@@ -4,12 +4,16 @@ Google Gemini Vision API для анализа изображений
 """
 
 import requests
-import base64
 from io import BytesIO
-from settings import GOOGLE_AI_API_KEY
+from settings import GOOGLE_AI_API_KEY, GOOGLE_AI_API_BASE
+from providers import get_session, GOOGLE
+from image_buffer import to_base64
+import log
+
+logger = log.get_logger(__name__)
 
 # Gemini Vision endpoint (используем gemini-2.5-flash для vision)
-GEMINI_VISION_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent"
+GEMINI_VISION_URL = f"{GOOGLE_AI_API_BASE}/v1beta/models/gemini-2.5-flash:generateContent"
 
 # Промпт для анализа изображения
 PROMPT_EXTRACTION_TEMPLATE = """Проанализируй это изображение и создай детальный промпт для AI-генератора изображений, который мог бы создать похожее изображение.
@@ -53,10 +57,8 @@ def analyze_image_for_prompt(image_data: BytesIO) -> str:
         "Content-Type": "application/json"
     }
 
-    # Кодируем изображение в base64
-    image_data.seek(0)
-    img_bytes = image_data.read()
-    img_base64 = base64.b64encode(img_bytes).decode('utf-8')
+    # Кодируем изображение в base64 (без копирования буфера; для ImageBuffer - из кеша)
+    img_base64 = to_base64(image_data)
 
     # Формируем payload для Gemini
     payload = {
@@ -83,21 +85,21 @@ def analyze_image_for_prompt(image_data: BytesIO) -> str:
         }
     }
 
-    print(f"[Gemini Vision] Analyzing image for prompt extraction...")
+    logger.info("Analyzing image for prompt extraction...")
 
     try:
-        response = requests.post(
+        response = get_session(GOOGLE).post(
             url,
             headers=headers,
             json=payload,
             timeout=60
         )
 
-        print(f"[Gemini Vision] Response status: {response.status_code}")
+        logger.debug("Response status: %s", response.status_code)
 
         if response.status_code != 200:
             error_text = response.text
-            print(f"[Gemini Vision] Error: {error_text}")
+            logger.error("Error: %.500s", error_text)
             raise Exception(f"Gemini Vision API error: {response.status_code} - {error_text}")
 
         data = response.json()
@@ -105,27 +107,27 @@ def analyze_image_for_prompt(image_data: BytesIO) -> str:
         # Извлекаем текст из ответа
         candidates = data.get("candidates", [])
         if not candidates:
-            print(f"[Gemini Vision] No candidates in response: {data}")
+            logger.warning("No candidates in response: %.500s", data)
             raise Exception("No response from Gemini Vision")
 
         content = candidates[0].get("content", {})
         parts = content.get("parts", [])
 
         if not parts:
-            print(f"[Gemini Vision] No parts in response: {data}")
+            logger.warning("No parts in response: %.500s", data)
             raise Exception("Empty response from Gemini Vision")
 
         # Получаем текст промпта
         prompt_text = parts[0].get("text", "").strip()
 
-        print(f"[Gemini Vision] Generated prompt length: {len(prompt_text)} chars")
+        logger.info("Generated prompt length: %s chars", len(prompt_text))
         return prompt_text
 
     except requests.exceptions.Timeout:
-        print("[Gemini Vision] Request timeout")
+        logger.error("Request timeout")
         raise Exception("Gemini Vision API request timeout (60s)")
     except requests.exceptions.RequestException as e:
-        print(f"[Gemini Vision] Request error: {e}")
+        logger.error("Request error: %s", e)
         raise Exception(f"Gemini Vision API request failed: {e}")
 
 
@@ -3,16 +3,29 @@ Google Sheets Logger
 Логирование активности пользователей бота в Google Таблицу
 """
 
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from contextlib import contextmanager
 from datetime import datetime
+import atexit
+import fcntl
+import json
 import os
+import threading
+import time
 from typing import Optional, Dict, Any
+import log
+
+logger = log.get_logger(__name__)
 
 # Настройки
 CREDENTIALS_FILE = os.getenv("GSHEETS_CREDENTIALS_PATH", "tgbots-google-sheets.json")
 SPREADSHEET_ID = os.getenv("GSHEETS_SPREADSHEET_ID", "1TsPo12VGW8u9YmcEhWHcIL-6yWCZ0_svBgku9fTaE0s")
 ENABLED = os.getenv("GSHEETS_LOGGING", "true").lower() == "true"
+FLUSH_INTERVAL = float(os.getenv("GSHEETS_FLUSH_INTERVAL", "5"))  # Секунд между отправками
+MAX_BACKOFF = 300  # Максимальная пауза после ошибок API (сек)
+BUFFER_MAX = int(os.getenv("GSHEETS_BUFFER_MAX", "5000"))  # Событий в памяти до сброса в журнал
+JOURNAL_FILE = os.getenv("GSHEETS_JOURNAL_PATH", "gsheets_journal.jsonl")
+LOCK_FILE = os.getenv("GSHEETS_LOCK_PATH", "gsheets.lock")  # Общий для всех процессов хоста (режим webhook)
+USER_INDEX_TTL = 3600  # Как часто перечитывать индекс вкладки Users (сек)
 
 # Scopes для Google Sheets API
 SCOPES = [
@@ -23,6 +36,20 @@ SCOPES = [
 # Глобальный клиент
 _client = None
 _spreadsheet = None
+_worksheets = {}
+
+# Буфер событий и состояние фоновой отправки
+_buffer = []
+_buffer_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_journal_lock = threading.Lock()
+_flush_wakeup = threading.Event()
+_flusher = None
+_init_thread = None
+
+# Кэш вкладки Users: user_id -> номер строки
+_user_rows = None
+_user_index_loaded_at = 0.0
 
 
 def get_client():
@@ -34,6 +61,10 @@ def get_client():
 
     try:
         if _client is None:
+            # gspread и oauth2client загружаются только при первом обращении к таблице
+            import gspread
+            from oauth2client.service_account import ServiceAccountCredentials
+
             # Авторизация
             creds = ServiceAccountCredentials.from_json_keyfile_name(
                 CREDENTIALS_FILE,
@@ -41,11 +72,11 @@ def get_client():
             )
             _client = gspread.authorize(creds)
             _spreadsheet = _client.open_by_key(SPREADSHEET_ID)
-            print(f"[OK] Google Sheets Logger initialized: {_spreadsheet.title}")
+            logger.info("Google Sheets Logger initialized: %s", _spreadsheet.title)
 
         return _spreadsheet
     except Exception as e:
-        print(f"[ERROR] Failed to initialize Google Sheets: {e}")
+        logger.error("Failed to initialize Google Sheets: %s", e)
         return None
 
 
@@ -95,7 +126,7 @@ def init_sheets_structure():
                     rows=1000,
                     cols=len(headers)
                 )
-                print(f"[OK] Created sheet: {sheet_name}")
+                logger.info("Created sheet: %s", sheet_name)
             else:
                 worksheet = spreadsheet.worksheet(sheet_name)
 
@@ -119,89 +150,330 @@ def init_sheets_structure():
                 # Замораживаем первую строку
                 worksheet.freeze(rows=1)
 
-                print(f"[OK] Set headers for sheet: {sheet_name}")
+                logger.info("Set headers for sheet: %s", sheet_name)
 
-        print("[OK] Google Sheets structure initialized")
+        logger.info("Google Sheets structure initialized")
         return True
 
     except Exception as e:
-        print(f"[ERROR] Failed to initialize sheets structure: {e}")
+        logger.error("Failed to initialize sheets structure: %s", e)
         return False
 
 
-def log_user(user_id: int, username: str, first_name: str, last_name: str = "",
-             language: str = "ru", referrer_id: int = None):
-    """
-    Логировать нового пользователя или обновить существующего
-    """
-    if not ENABLED:
-        return
+# ===== Буфер логов и фоновая отправка =====
+#
+# Функции log_* не обращаются к API: они кладут событие в буфер и сразу
+# возвращаются. Фоновый поток раз в FLUSH_INTERVAL секунд отправляет
+# накопленные строки пачками (append_rows), объединяет обновления
+# счётчиков одного пользователя в один batch_update и хранит кэш
+# user_id -> номер строки во вкладке Users. Если API недоступно или
+# упёрлось в квоту, события сохраняются в журнал и отправляются позже.
 
-    try:
+def _worksheet(name: str):
+    """Возвращает вкладку по имени (с кэшированием объекта)"""
+    worksheet = _worksheets.get(name)
+    if worksheet is None:
         spreadsheet = get_client()
         if not spreadsheet:
-            return
+            raise RuntimeError("Google Sheets client is not available")
+        worksheet = spreadsheet.worksheet(name)
+        _worksheets[name] = worksheet
+    return worksheet
 
-        worksheet = spreadsheet.worksheet("Users")
 
-        # Ищем пользователя
-        try:
-            cell = worksheet.find(str(user_id), in_column=1)
-            # Пользователь существует - обновляем Last Active
-            row_num = cell.row
-            worksheet.update_cell(row_num, 7, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-        except:
-            # Новый пользователь - добавляем
-            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            row = [
-                user_id,
-                username or "",
-                first_name or "",
-                last_name or "",
-                language,
-                now,  # Registration Date
-                now,  # Last Active
-                0,    # Total Generations
-                10,   # Generations Left
-                referrer_id or "",
-                0,    # Referrals Count
-                "Active"
-            ]
-            worksheet.append_row(row)
-            print(f"[GSHEETS] New user logged: {user_id} (@{username})")
+def _now() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _to_int(value) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _enqueue(event: dict):
+    """Добавляет событие в буфер и при необходимости запускает фоновый поток"""
+    if not ENABLED:
+        return
+
+    overflow = None
+    with _buffer_lock:
+        _buffer.append(event)
+        if len(_buffer) > BUFFER_MAX:
+            # Sheets не успевает - старые события уходят в журнал, память не растёт
+            overflow = _buffer[:len(_buffer) - BUFFER_MAX]
+            del _buffer[:len(overflow)]
+
+    if overflow:
+        _spill_to_journal(overflow)
+
+    _ensure_flusher()
 
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is not None and _flusher.is_alive():
+        return
+    with _buffer_lock:
+        if _flusher is not None and _flusher.is_alive():
+            return
+        _flusher = threading.Thread(target=_flush_loop, name="gsheets-flusher", daemon=True)
+        _flusher.start()
+
+
+def _flush_loop():
+    # Первая отправка - после проверки вкладок (иначе строки могут уйти в таблицу без заголовков)
+    if _init_thread is not None:
+        _init_thread.join(timeout=60)
+    delay = FLUSH_INTERVAL
+    while True:
+        _flush_wakeup.wait(delay)
+        _flush_wakeup.clear()
+        if flush():
+            delay = FLUSH_INTERVAL
+        else:
+            # Ошибка или квота API - увеличиваем паузу между попытками
+            delay = min(delay * 2, MAX_BACKOFF)
+
+
+def _spill_to_journal(events: list):
+    """Дописывает события в локальный журнал"""
+    try:
+        with _journal_lock, open(JOURNAL_FILE, 'a', encoding='utf-8') as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+        logger.info("%s events spilled to %s", len(events), JOURNAL_FILE)
     except Exception as e:
-        print(f"[ERROR] Failed to log user: {e}")
+        logger.error("Failed to write Google Sheets journal: %s", e)
+
+
+def _take_journal() -> list:
+    """Читает и очищает журнал"""
+    with _journal_lock:
+        if not os.path.exists(JOURNAL_FILE):
+            return []
+        events = []
+        with open(JOURNAL_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        continue
+        os.remove(JOURNAL_FILE)
+    return events
+
+
+@contextmanager
+def _process_lock():
+    """
+    Блокировка отправки между процессами одного хоста
 
+    В режиме webhook события пишут несколько воркеров: чтение и запись
+    счётчиков вкладки Users не должны перемежаться.
+    """
+    with open(LOCK_FILE, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
-def log_activity(user_id: int, username: str, action: str, details: str = "", success: bool = True):
+
+def flush() -> bool:
     """
-    Логировать активность пользователя
+    Отправляет накопленные события в Google Sheets
+
+    Returns:
+        True если всё отправлено (или нечего отправлять)
     """
     if not ENABLED:
-        return
+        return True
+
+    with _flush_lock:
+        with _buffer_lock:
+            events = _buffer[:]
+            _buffer.clear()
+
+        events = _take_journal() + events
+        if not events:
+            return True
 
+        with _process_lock():
+            pending = _send(events)
+        if pending:
+            _spill_to_journal(pending)
+            return False
+        return True
+
+
+def _load_user_index(worksheet):
+    """Загружает кэш user_id -> номер строки вкладки Users"""
+    global _user_rows, _user_index_loaded_at
+    values = worksheet.get_all_values()
+    _user_rows = {}
+    for row_num, row in enumerate(values[1:], start=2):
+        if row and row[0]:
+            _user_rows[row[0]] = row_num
+    _user_index_loaded_at = time.monotonic()
+    logger.info("User index loaded: %s users", len(_user_rows))
+
+
+def _first_appended_row(response) -> Optional[int]:
+    """Номер первой добавленной строки из ответа append_rows ("Users!A5:L7" -> 5)"""
     try:
-        spreadsheet = get_client()
-        if not spreadsheet:
-            return
+        updated_range = response["updates"]["updatedRange"]
+        start = updated_range.split("!")[1].split(":")[0]
+        return int("".join(ch for ch in start if ch.isdigit()))
+    except Exception:
+        return None
 
-        worksheet = spreadsheet.worksheet("Activity")
 
-        row = [
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+def _send(events: list) -> list:
+    """
+    Отправляет события группами: новые пользователи, строки вкладок, счётчики
+
+    Returns:
+        События, которые не удалось отправить (пустой список при успехе)
+    """
+    global _user_rows
+
+    user_events = [e for e in events if e["type"] == "user"]
+    append_events = [e for e in events if e["type"] == "append"]
+    counter_events = [e for e in events if e["type"] == "counter"]
+
+    try:
+        users_ws = _worksheet("Users")
+        if _user_rows is None or time.monotonic() - _user_index_loaded_at > USER_INDEX_TTL:
+            _load_user_index(users_ws)
+
+        # 1. Пользователи: новые добавляем одной пачкой, существующим обновляем Last Active
+        new_rows = []
+        for event in user_events:
+            user_key = str(event["row"][0])
+            if user_key in _user_rows or any(str(r[0]) == user_key for r in new_rows):
+                counter_events.append({"type": "counter", "user_id": user_key, "last_active": event["row"][6]})
+            else:
+                new_rows.append(event["row"])
+
+        if new_rows:
+            response = users_ws.append_rows(new_rows)
+            first_row = _first_appended_row(response)
+            if first_row is None:
+                _user_rows = None  # Перечитаем индекс при следующей отправке
+            else:
+                for offset, row in enumerate(new_rows):
+                    _user_rows[str(row[0])] = first_row + offset
+            logger.info("%s new user(s) logged", len(new_rows))
+        user_events = []
+
+        # 2. Строки остальных вкладок - по одному append_rows на вкладку
+        by_sheet = {}
+        for event in append_events:
+            by_sheet.setdefault(event["sheet"], []).append(event)
+
+        for sheet_name, sheet_events in list(by_sheet.items()):
+            _worksheet(sheet_name).append_rows([e["row"] for e in sheet_events])
+            logger.info("%s row(s) appended to %s", len(sheet_events), sheet_name)
+            for event in sheet_events:
+                append_events.remove(event)
+
+        # 3. Счётчики: объединяем все изменения пользователя в одно обновление
+        if counter_events:
+            if _user_rows is None:
+                _load_user_index(users_ws)
+
+            merged = {}
+            for event in counter_events:
+                user_key = str(event["user_id"])
+                item = merged.setdefault(user_key, {"generations": 0, "referrals": 0, "remaining": None, "last_active": None})
+                item["generations"] += event.get("generations", 0)
+                item["referrals"] += event.get("referrals", 0)
+                if event.get("remaining") is not None:
+                    item["remaining"] = event["remaining"]
+                if event.get("last_active"):
+                    item["last_active"] = event["last_active"]
+
+            # Пользователь мог быть добавлен другим процессом после загрузки индекса
+            if any(user_key not in _user_rows for user_key in merged):
+                _load_user_index(users_ws)
+
+            # Счётчики увеличивают и другие процессы - берём текущие значения из таблицы, а не из кэша
+            rows = {user_key: _user_rows[user_key] for user_key in merged if user_key in _user_rows}
+            current = users_ws.batch_get([f"H{row_num}:K{row_num}" for row_num in rows.values()]) if rows else []
+
+            updates = []
+            for (user_key, row_num), values in zip(rows.items(), current):
+                item = merged[user_key]
+                cells = values[0] if values else []
+                if item["last_active"]:
+                    updates.append({"range": f"G{row_num}", "values": [[item["last_active"]]]})
+                if item["generations"]:
+                    total = (_to_int(cells[0]) if cells else 0) + item["generations"]
+                    updates.append({"range": f"H{row_num}", "values": [[total]]})
+                if item["remaining"] is not None:
+                    updates.append({"range": f"I{row_num}", "values": [[item["remaining"]]]})
+                if item["referrals"]:
+                    total = (_to_int(cells[3]) if len(cells) > 3 else 0) + item["referrals"]
+                    updates.append({"range": f"K{row_num}", "values": [[total]]})
+
+            if updates:
+                users_ws.batch_update(updates)
+                logger.info("Counters updated for %s user(s)", len(rows))
+            counter_events = []
+
+        return []
+
+    except Exception as e:
+        logger.error("Failed to flush Google Sheets log: %s", e)
+        # Индекс мог устареть (строки удалены вручную и т.п.) - перечитаем
+        _user_rows = None
+        return user_events + append_events + counter_events
+
+
+def log_user(user_id: int, username: str, first_name: str, last_name: str = "",
+             language: str = "ru", referrer_id: int = None):
+    """
+    Логировать нового пользователя или обновить существующего
+    """
+    now = _now()
+    _enqueue({
+        "type": "user",
+        "row": [
+            user_id,
+            username or "",
+            first_name or "",
+            last_name or "",
+            language,
+            now,  # Registration Date
+            now,  # Last Active
+            0,    # Total Generations
+            10,   # Generations Left
+            referrer_id or "",
+            0,    # Referrals Count
+            "Active"
+        ]
+    })
+
+
+def log_activity(user_id: int, username: str, action: str, details: str = "", success: bool = True):
+    """
+    Логировать активность пользователя
+    """
+    _enqueue({
+        "type": "append",
+        "sheet": "Activity",
+        "row": [
+            _now(),
             user_id,
             username or "",
             action,
             details,
             "✅" if success else "❌"
         ]
-
-        worksheet.append_row(row)
-        print(f"[GSHEETS] Activity logged: {action} by {user_id}")
-
-    except Exception as e:
-        print(f"[ERROR] Failed to log activity: {e}")
+    })
 
 
 def log_generation(user_id: int, username: str, engine: str, model: str,
@@ -211,36 +483,29 @@ def log_generation(user_id: int, username: str, engine: str, model: str,
     """
     Логировать генерацию изображения
     """
-    if not ENABLED:
-        return
-
-    try:
-        spreadsheet = get_client()
-        if not spreadsheet:
-            return
-
-        worksheet = spreadsheet.worksheet("Generations")
-
-        # Форматируем дополнительные параметры
-        params_str = ""
-        if additional_params:
-            params_list = []
-            if additional_params.get("shot"):
-                params_list.append(f"Shot: {additional_params['shot']}")
-            if additional_params.get("angle"):
-                params_list.append(f"Angle: {additional_params['angle']}")
-            if additional_params.get("lighting"):
-                params_list.append(f"Light: {additional_params['lighting']}")
-            params_str = ", ".join(params_list)
-
-        row = [
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    # Форматируем дополнительные параметры
+    params_str = ""
+    if additional_params:
+        params_list = []
+        if additional_params.get("shot"):
+            params_list.append(f"Shot: {additional_params['shot']}")
+        if additional_params.get("angle"):
+            params_list.append(f"Angle: {additional_params['angle']}")
+        if additional_params.get("lighting"):
+            params_list.append(f"Light: {additional_params['lighting']}")
+        params_str = ", ".join(params_list)
+
+    _enqueue({
+        "type": "append",
+        "sheet": "Generations",
+        "row": [
+            _now(),
             user_id,
             username or "",
             engine,
             model,
-            prompt_ru[:500],  # Ограничиваем длину
-            prompt_en[:500],
+            (prompt_ru or "")[:500],  # Ограничиваем длину
+            (prompt_en or "")[:500],
             format_ratio,
             style,
             params_str,
@@ -248,15 +513,10 @@ def log_generation(user_id: int, username: str, engine: str, model: str,
             "✅" if success else "❌",
             error[:200] if error else ""
         ]
+    })
 
-        worksheet.append_row(row)
-        print(f"[GSHEETS] Generation logged: {engine}/{model} by {user_id}")
-
-        # Обновляем счетчик генераций у пользователя
-        update_user_generations(user_id, increment=1)
-
-    except Exception as e:
-        print(f"[ERROR] Failed to log generation: {e}")
+    # Обновляем счетчик генераций у пользователя
+    update_user_generations(user_id, increment=1)
 
 
 def log_referral(referrer_id: int, referrer_username: str,
@@ -264,33 +524,21 @@ def log_referral(referrer_id: int, referrer_username: str,
     """
     Логировать реферальную активность
     """
-    if not ENABLED:
-        return
-
-    try:
-        spreadsheet = get_client()
-        if not spreadsheet:
-            return
-
-        worksheet = spreadsheet.worksheet("Referrals")
-
-        row = [
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    _enqueue({
+        "type": "append",
+        "sheet": "Referrals",
+        "row": [
+            _now(),
             referrer_id,
             referrer_username or "",
             referred_id,
             referred_username or "",
             reward
         ]
+    })
 
-        worksheet.append_row(row)
-        print(f"[GSHEETS] Referral logged: {referrer_id} -> {referred_id}")
-
-        # Обновляем счетчик рефералов
-        update_user_referrals(referrer_id, increment=1)
-
-    except Exception as e:
-        print(f"[ERROR] Failed to log referral: {e}")
+    # Обновляем счетчик рефералов
+    update_user_referrals(referrer_id, increment=1)
 
 
 def log_payment(user_id: int, username: str, package: str, amount: float,
@@ -299,18 +547,11 @@ def log_payment(user_id: int, username: str, package: str, amount: float,
     """
     Логировать оплату
     """
-    if not ENABLED:
-        return
-
-    try:
-        spreadsheet = get_client()
-        if not spreadsheet:
-            return
-
-        worksheet = spreadsheet.worksheet("Payments")
-
-        row = [
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    _enqueue({
+        "type": "append",
+        "sheet": "Payments",
+        "row": [
+            _now(),
             user_id,
             username or "",
             package,
@@ -321,73 +562,21 @@ def log_payment(user_id: int, username: str, package: str, amount: float,
             invoice_id,
             generations_added
         ]
-
-        worksheet.append_row(row)
-        print(f"[GSHEETS] Payment logged: {package} by {user_id} - {status}")
-
-    except Exception as e:
-        print(f"[ERROR] Failed to log payment: {e}")
+    })
 
 
 def update_user_generations(user_id: int, increment: int = 1, remaining: int = None):
     """
     Обновить счетчик генераций пользователя
     """
-    if not ENABLED:
-        return
-
-    try:
-        spreadsheet = get_client()
-        if not spreadsheet:
-            return
-
-        worksheet = spreadsheet.worksheet("Users")
-
-        # Ищем пользователя
-        cell = worksheet.find(str(user_id), in_column=1)
-        if cell:
-            row_num = cell.row
-
-            # Обновляем Total Generations (колонка 8)
-            if increment:
-                current_total = worksheet.cell(row_num, 8).value or "0"
-                new_total = int(current_total) + increment
-                worksheet.update_cell(row_num, 8, new_total)
-
-            # Обновляем Generations Left (колонка 9)
-            if remaining is not None:
-                worksheet.update_cell(row_num, 9, remaining)
-
-    except Exception as e:
-        print(f"[ERROR] Failed to update user generations: {e}")
+    _enqueue({"type": "counter", "user_id": str(user_id), "generations": increment, "remaining": remaining})
 
 
 def update_user_referrals(user_id: int, increment: int = 1):
     """
     Обновить счетчик рефералов пользователя
     """
-    if not ENABLED:
-        return
-
-    try:
-        spreadsheet = get_client()
-        if not spreadsheet:
-            return
-
-        worksheet = spreadsheet.worksheet("Users")
-
-        # Ищем пользователя
-        cell = worksheet.find(str(user_id), in_column=1)
-        if cell:
-            row_num = cell.row
-
-            # Обновляем Referrals Count (колонка 11)
-            current_count = worksheet.cell(row_num, 11).value or "0"
-            new_count = int(current_count) + increment
-            worksheet.update_cell(row_num, 11, new_count)
-
-    except Exception as e:
-        print(f"[ERROR] Failed to update user referrals: {e}")
+    _enqueue({"type": "counter", "user_id": str(user_id), "referrals": increment})
 
 
 def log_daily_stats(date: str = None, new_users: int = 0, total_gens: int = 0,
@@ -396,20 +585,13 @@ def log_daily_stats(date: str = None, new_users: int = 0, total_gens: int = 0,
     """
     Логировать дневную статистику
     """
-    if not ENABLED:
-        return
-
-    try:
-        spreadsheet = get_client()
-        if not spreadsheet:
-            return
-
-        worksheet = spreadsheet.worksheet("Daily_Stats")
-
-        if not date:
-            date = datetime.now().strftime("%Y-%m-%d")
+    if not date:
+        date = datetime.now().strftime("%Y-%m-%d")
 
-        row = [
+    _enqueue({
+        "type": "append",
+        "sheet": "Daily_Stats",
+        "row": [
             date,
             new_users,
             total_gens,
@@ -418,25 +600,44 @@ def log_daily_stats(date: str = None, new_users: int = 0, total_gens: int = 0,
             total_payments,
             active_users
         ]
+    })
 
-        worksheet.append_row(row)
-        print(f"[GSHEETS] Daily stats logged for {date}")
 
-    except Exception as e:
-        print(f"[ERROR] Failed to log daily stats: {e}")
+def shutdown():
+    """Отправляет остаток буфера (вызывается при остановке бота)"""
+    if ENABLED and (_buffer or os.path.exists(JOURNAL_FILE)):
+        flush()
+
+
+atexit.register(shutdown)
 
 
-# Инициализация при импорте модуля
-if ENABLED:
+def _init_in_background():
     try:
         init_sheets_structure()
     except Exception as e:
-        print(f"[ERROR] Failed to auto-initialize sheets: {e}")
+        logger.error("Failed to auto-initialize sheets: %s", e)
+
+
+def start_background_init():
+    """
+    Проверяет вкладки и заголовки в фоновом потоке
+
+    Раньше это делалось при импорте модуля и задерживало старт бота на
+    несколько запросов к Sheets API. События, поступившие до окончания
+    проверки, ждут в буфере.
+    """
+    global _init_thread
+    if not ENABLED or _init_thread is not None:
+        return
+    _init_thread = threading.Thread(target=_init_in_background, name="gsheets-init", daemon=True)
+    _init_thread.start()
 
 
 # Тестовая функция
 if __name__ == "__main__":
     print("Testing Google Sheets Logger...")
+    init_sheets_structure()
 
     # Тест логирования пользователя
     log_user(12345, "test_user", "Test", "User", "en")
@@ -453,4 +654,5 @@ if __name__ == "__main__":
         "ugly, bad", True
     )
 
+    flush()
     print("Test completed!")
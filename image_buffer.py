@@ -0,0 +1,136 @@
+"""
+Неизменяемый буфер изображения и разбор ответов API с изображениями в base64
+
+ImageBuffer - BytesIO поверх одного объекта bytes: BytesIO не копирует
+исходные bytes, пока в буфер не пишут, поэтому getvalue() и getbuffer()
+возвращают те же данные без копирования. Запись запрещена, так что один
+буфер можно передавать в watermark, загрузку в GCS, отправку в Telegram
+и в user_state без копий. Там, где ожидается BytesIO, ImageBuffer
+работает как обычный BytesIO.
+
+loads_with_images() разбирает JSON-ответ Imagen / Gemini, не превращая
+мегабайты base64 в строки Python: base64 декодируется (binascii) прямо из
+тела ответа в один bytes того размера, что нужен изображению, а JSON
+разбирается уже без них.
+"""
+
+import base64
+import binascii
+import io
+import json
+import re
+
+# Поля ответов Google API, в которых приходят изображения
+IMAGE_FIELDS = (b"bytesBase64Encoded", b"data")
+MIN_PAYLOAD = 1024  # Более короткие значения полей остаются строками
+
+_PLACEHOLDER = "@@image_buffer:{}@@"
+_PLACEHOLDER_RE = re.compile(r"^@@image_buffer:(\d+)@@$")
+
+
+class ImageBuffer(io.BytesIO):
+    """Изображение в памяти только для чтения (см. описание модуля)"""
+
+    def __init__(self, data=b""):
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        super().__init__(data)
+        self._b64 = None
+
+    @classmethod
+    def from_base64(cls, data) -> "ImageBuffer":
+        """Декодирует base64 (str, bytes или memoryview) без промежуточных копий"""
+        if isinstance(data, str):
+            data = data.encode("ascii")
+        return cls(binascii.a2b_base64(data))
+
+    def write(self, data):
+        raise io.UnsupportedOperation("ImageBuffer is read-only")
+
+    def writelines(self, lines):
+        raise io.UnsupportedOperation("ImageBuffer is read-only")
+
+    def truncate(self, size=None):
+        raise io.UnsupportedOperation("ImageBuffer is read-only")
+
+    def getbuffer(self):
+        # BytesIO.getbuffer() копирует общие bytes, чтобы разрешить запись;
+        # буферу только для чтения достаточно memoryview над теми же bytes
+        return memoryview(self.getvalue())
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.getvalue())
+
+    def b64(self) -> str:
+        """base64 содержимого (кодируется один раз - буфер не меняется)"""
+        if self._b64 is None:
+            self._b64 = base64.b64encode(self.getvalue()).decode("ascii")
+        return self._b64
+
+
+def as_image_buffer(image) -> ImageBuffer:
+    """Приводит BytesIO / bytes к ImageBuffer (ImageBuffer возвращается как есть)"""
+    if isinstance(image, ImageBuffer):
+        return image
+    if isinstance(image, io.BytesIO):
+        return ImageBuffer(image.getvalue())
+    return ImageBuffer(image)
+
+
+def to_base64(image) -> str:
+    """base64 изображения для запроса к API (для ImageBuffer - из кеша)"""
+    return as_image_buffer(image).b64()
+
+
+def loads_with_images(body: bytes, fields=IMAGE_FIELDS):
+    """
+    json.loads() для ответа с изображениями в base64
+
+    Строковые значения полей fields длиннее MIN_PAYLOAD заменяются на
+    ImageBuffer; остальная структура ответа та же, что у json.loads(body).
+    """
+    pattern = re.compile(rb'"(?:' + b"|".join(re.escape(field) for field in fields) + rb')"\s*:\s*"')
+    view = memoryview(body)
+    images = []
+    skeleton = []
+    pos = 0
+
+    for match in pattern.finditer(body):
+        start = match.end()
+        if start <= pos:
+            continue  # Совпадение внутри уже обработанного значения
+        end = body.find(b'"', start)
+        if end < 0:
+            break
+        if end - start < MIN_PAYLOAD:
+            continue
+
+        if body.find(b"\\", start, end) >= 0:
+            # Экранированные символы (например, "\/" или "\n") - строку разбирает json
+            image = ImageBuffer.from_base64(json.loads(bytes(view[start - 1:end + 1])))
+        else:
+            image = ImageBuffer.from_base64(view[start:end])
+
+        skeleton.append(view[pos:start])
+        skeleton.append(_PLACEHOLDER.format(len(images)).encode("ascii"))
+        pos = end
+        images.append(image)
+
+    if not images:
+        return json.loads(body)
+
+    skeleton.append(view[pos:])
+    return _substitute(json.loads(b"".join(skeleton)), images)
+
+
+def _substitute(node, images):
+    if isinstance(node, dict):
+        return {key: _substitute(value, images) for key, value in node.items()}
+    if isinstance(node, list):
+        return [_substitute(value, images) for value in node]
+    if isinstance(node, str):
+        match = _PLACEHOLDER_RE.match(node)
+        if match:
+            return images[int(match.group(1))]
+    return node
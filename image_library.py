@@ -1,16 +1,136 @@
 """
 Модуль для управления библиотекой изображений пользователей
+
+История хранится в SQLite (db.py) с ключом (user_id, id) и полнотекстовым
+индексом FTS5 по prompt/english_prompt: выборка страницы, поиск и доступ
+к записи по id затрагивают только строки одного пользователя.
+При первом запуске данные переносятся из image_library.json.
 """
 import json
 import os
 from datetime import datetime
 
+import db
+import log
+
+logger = log.get_logger(__name__)
+
 LIBRARY_FILE = "image_library.json"
 MAX_HISTORY_PER_USER = 50  # Максимум записей в истории на пользователя
 
+_COLUMNS = "id, date, prompt, english_prompt, model, format, style, negative_prompt, image_url, is_favorite, seed, file_id"
+
+
+def _init_schema(conn):
+    """Создаёт таблицу истории, FTS-индекс и переносит данные из JSON (один раз)"""
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS library_history (
+            user_id INTEGER NOT NULL,
+            id REAL NOT NULL,
+            date TEXT NOT NULL,
+            prompt TEXT NOT NULL DEFAULT '',
+            english_prompt TEXT NOT NULL DEFAULT '',
+            model TEXT NOT NULL DEFAULT '',
+            format TEXT NOT NULL DEFAULT '',
+            style TEXT NOT NULL DEFAULT 'none',
+            negative_prompt TEXT NOT NULL DEFAULT '',
+            image_url TEXT,
+            is_favorite INTEGER NOT NULL DEFAULT 0,
+            seed INTEGER,
+            file_id TEXT,
+            PRIMARY KEY (user_id, id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_library_history_favorites
+            ON library_history (user_id, is_favorite, id);
+
+        CREATE VIRTUAL TABLE IF NOT EXISTS library_history_fts USING fts5(
+            prompt, english_prompt,
+            content='library_history', content_rowid='rowid',
+            tokenize='unicode61'
+        );
+
+        CREATE TRIGGER IF NOT EXISTS library_history_ai AFTER INSERT ON library_history BEGIN
+            INSERT INTO library_history_fts (rowid, prompt, english_prompt)
+            VALUES (new.rowid, new.prompt, new.english_prompt);
+        END;
+        CREATE TRIGGER IF NOT EXISTS library_history_ad AFTER DELETE ON library_history BEGIN
+            INSERT INTO library_history_fts (library_history_fts, rowid, prompt, english_prompt)
+            VALUES ('delete', old.rowid, old.prompt, old.english_prompt);
+        END;
+        CREATE TRIGGER IF NOT EXISTS library_history_au AFTER UPDATE OF prompt, english_prompt ON library_history BEGIN
+            INSERT INTO library_history_fts (library_history_fts, rowid, prompt, english_prompt)
+            VALUES ('delete', old.rowid, old.prompt, old.english_prompt);
+            INSERT INTO library_history_fts (rowid, prompt, english_prompt)
+            VALUES (new.rowid, new.prompt, new.english_prompt);
+        END;
+    """)
+
+    # seed и file_id добавлены позже - дополняем существующую таблицу
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(library_history)")}
+    if "seed" not in columns:
+        conn.execute("ALTER TABLE library_history ADD COLUMN seed INTEGER")
+    if "file_id" not in columns:
+        conn.execute("ALTER TABLE library_history ADD COLUMN file_id TEXT")
+
+    if db.get_meta("image_library_migrated") is None:
+        _migrate_from_json(conn)
+
+
+def _migrate_from_json(conn):
+    """Переносит историю из image_library.json в SQLite"""
+    library = load_library()
+    total = 0
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for user_key, user_data in library.items():
+            for gen in user_data.get("history", []):
+                _insert(conn, int(user_key), gen)
+                total += 1
+        db.set_meta("image_library_migrated", datetime.now().isoformat())
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    if total:
+        logger.info("Migrated %s history records from %s to SQLite", total, LIBRARY_FILE)
+
+
+def _conn():
+    db.ensure_schema("image_library", _init_schema)
+    return db.get_connection()
+
+
+def _insert(conn, user_id, gen):
+    conn.execute(
+        f"INSERT OR REPLACE INTO library_history (user_id, {_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            user_id,
+            gen["id"],
+            gen["date"],
+            gen.get("prompt") or "",
+            gen.get("english_prompt") or "",
+            gen.get("model") or "",
+            gen.get("format") or "",
+            gen.get("style") or "none",
+            gen.get("negative_prompt") or "",
+            gen.get("image_url"),
+            1 if gen.get("is_favorite") else 0,
+            gen.get("seed"),
+            gen.get("file_id"),
+        )
+    )
+
+
+def _row_to_generation(row):
+    generation = dict(row)
+    generation["is_favorite"] = bool(generation["is_favorite"])
+    return generation
+
 
 def load_library():
-    """Загружает библиотеку из файла"""
+    """Загружает библиотеку из старого JSON-файла (используется для миграции)"""
     if os.path.exists(LIBRARY_FILE):
         try:
             with open(LIBRARY_FILE, 'r', encoding='utf-8') as f:
@@ -20,13 +140,7 @@ def load_library():
     return {}
 
 
-def save_library(library_data):
-    """Сохраняет библиотеку в файл"""
-    with open(LIBRARY_FILE, 'w', encoding='utf-8') as f:
-        json.dump(library_data, f, ensure_ascii=False, indent=2)
-
-
-def add_to_history(user_id, prompt, english_prompt, params, image_url=None, negative_prompt=""):
+def add_to_history(user_id, prompt, english_prompt, params, image_url=None, negative_prompt="", seed=None, file_id=None):
     """
     Добавляет генерацию в историю пользователя
 
@@ -37,16 +151,9 @@ def add_to_history(user_id, prompt, english_prompt, params, image_url=None, nega
         params: Параметры генерации (model, format, style)
         image_url: URL изображения (опционально)
         negative_prompt: Negative prompt (что НЕ должно быть)
+        seed: Seed генерации (для точного повтора из истории)
+        file_id: file_id отправленного в Telegram изображения (повторная отправка без загрузки)
     """
-    library = load_library()
-    user_key = str(user_id)
-
-    if user_key not in library:
-        library[user_key] = {
-            "history": [],
-            "favorites": []
-        }
-
     # Создаем запись генерации
     generation = {
         "id": datetime.now().timestamp(),  # Уникальный ID
@@ -58,17 +165,25 @@ def add_to_history(user_id, prompt, english_prompt, params, image_url=None, nega
         "style": params.get("style", "none"),
         "negative_prompt": negative_prompt,
         "image_url": image_url,
-        "is_favorite": False
+        "is_favorite": False,
+        "seed": seed,
+        "file_id": file_id
     }
 
-    # Добавляем в начало списка (новые сверху)
-    library[user_key]["history"].insert(0, generation)
+    _conn()
+    with db.transaction() as conn:
+        _insert(conn, user_id, generation)
 
-    # Ограничиваем размер истории
-    if len(library[user_key]["history"]) > MAX_HISTORY_PER_USER:
-        library[user_key]["history"] = library[user_key]["history"][:MAX_HISTORY_PER_USER]
+        # Ограничиваем размер истории (новые сверху)
+        conn.execute(
+            """DELETE FROM library_history
+               WHERE user_id = ? AND id < (
+                   SELECT id FROM library_history WHERE user_id = ?
+                   ORDER BY id DESC LIMIT 1 OFFSET ?
+               )""",
+            (user_id, user_id, MAX_HISTORY_PER_USER - 1)
+        )
 
-    save_library(library)
     return generation["id"]
 
 
@@ -84,44 +199,56 @@ def get_user_history(user_id, limit=10, offset=0):
     Returns:
         List of generations
     """
-    library = load_library()
-    user_key = str(user_id)
+    rows = _conn().execute(
+        f"SELECT {_COLUMNS} FROM library_history WHERE user_id = ? ORDER BY id DESC LIMIT ? OFFSET ?",
+        (user_id, limit, offset)
+    ).fetchall()
+    return [_row_to_generation(row) for row in rows]
 
-    if user_key not in library:
-        return []
 
-    history = library[user_key]["history"]
-    return history[offset:offset+limit]
+def get_generation(user_id, generation_id):
+    """
+    Получает одну запись истории по ID
+
+    Returns:
+        Dict с генерацией или None
+    """
+    row = _conn().execute(
+        f"SELECT {_COLUMNS} FROM library_history WHERE user_id = ? AND id = ?",
+        (user_id, generation_id)
+    ).fetchone()
+    return _row_to_generation(row) if row else None
 
 
 def get_favorites(user_id):
     """Получает избранные генерации пользователя"""
-    library = load_library()
-    user_key = str(user_id)
-
-    if user_key not in library:
-        return []
-
-    # Возвращаем только помеченные как избранные
-    return [gen for gen in library[user_key]["history"] if gen.get("is_favorite", False)]
+    rows = _conn().execute(
+        f"SELECT {_COLUMNS} FROM library_history WHERE user_id = ? AND is_favorite = 1 ORDER BY id DESC",
+        (user_id,)
+    ).fetchall()
+    return [_row_to_generation(row) for row in rows]
 
 
 def toggle_favorite(user_id, generation_id):
     """Добавляет/удаляет генерацию из избранного"""
-    library = load_library()
-    user_key = str(user_id)
+    _conn()
+    with db.transaction() as conn:
+        conn.execute(
+            "UPDATE library_history SET is_favorite = 1 - is_favorite WHERE user_id = ? AND id = ?",
+            (user_id, generation_id)
+        )
+        row = conn.execute(
+            "SELECT is_favorite FROM library_history WHERE user_id = ? AND id = ?",
+            (user_id, generation_id)
+        ).fetchone()
 
-    if user_key not in library:
-        return False
+    return bool(row["is_favorite"]) if row else False
 
-    # Ищем генерацию по ID
-    for gen in library[user_key]["history"]:
-        if gen["id"] == generation_id:
-            gen["is_favorite"] = not gen.get("is_favorite", False)
-            save_library(library)
-            return gen["is_favorite"]
 
-    return False
+def _fts_query(query):
+    """Преобразует текст запроса в FTS5-запрос: все слова, с поиском по началу слова"""
+    terms = [term.replace('"', '') for term in query.split()]
+    return " ".join(f'"{term}"*' for term in terms if term)
 
 
 def search_history(user_id, query):
@@ -135,30 +262,42 @@ def search_history(user_id, query):
     Returns:
         List of matching generations
     """
-    library = load_library()
-    user_key = str(user_id)
-
-    if user_key not in library:
-        return []
-
-    query_lower = query.lower()
+    conn = _conn()
+    fts_query = _fts_query(query)
     results = []
 
-    for gen in library[user_key]["history"]:
-        # Ищем в промпте
-        if query_lower in gen.get("prompt", "").lower() or \
-           query_lower in gen.get("english_prompt", "").lower():
-            results.append(gen)
-
-    return results
+    if fts_query:
+        rows = conn.execute(
+            f"""SELECT {', '.join('h.' + c.strip() for c in _COLUMNS.split(','))}
+                FROM library_history_fts f
+                JOIN library_history h ON h.rowid = f.rowid
+                WHERE library_history_fts MATCH ? AND h.user_id = ?
+                ORDER BY h.id DESC""",
+            (fts_query, user_id)
+        ).fetchall()
+        results = [_row_to_generation(row) for row in rows]
+
+    if results:
+        return results
+
+    # Поиск по части слова (FTS ищет по началу слов): история пользователя
+    # ограничена MAX_HISTORY_PER_USER записями, поэтому проверяем их напрямую
+    query_lower = query.lower()
+    return [
+        gen for gen in get_user_history(user_id, limit=MAX_HISTORY_PER_USER)
+        if query_lower in gen["prompt"].lower() or query_lower in gen["english_prompt"].lower()
+    ]
 
 
 def get_history_stats(user_id):
     """Получает статистику по истории пользователя"""
-    library = load_library()
-    user_key = str(user_id)
+    conn = _conn()
+    counts = conn.execute(
+        "SELECT COUNT(*) AS total, COALESCE(SUM(is_favorite), 0) AS favorites FROM library_history WHERE user_id = ?",
+        (user_id,)
+    ).fetchone()
 
-    if user_key not in library:
+    if not counts["total"]:
         return {
             "total": 0,
             "favorites": 0,
@@ -166,41 +305,29 @@ def get_history_stats(user_id):
             "most_used_style": None
         }
 
-    history = library[user_key]["history"]
-
-    # Считаем статистику
-    models = {}
-    styles = {}
-
-    for gen in history:
-        model = gen.get("model", "unknown")
-        style = gen.get("style", "none")
-
-        models[model] = models.get(model, 0) + 1
-        styles[style] = styles.get(style, 0) + 1
-
-    most_used_model = max(models.items(), key=lambda x: x[1])[0] if models else None
-    most_used_style = max(styles.items(), key=lambda x: x[1])[0] if styles else None
+    def most_used(column):
+        row = conn.execute(
+            f"SELECT {column} FROM library_history WHERE user_id = ? GROUP BY {column} ORDER BY COUNT(*) DESC LIMIT 1",
+            (user_id,)
+        ).fetchone()
+        return row[column] if row else None
 
     return {
-        "total": len(history),
-        "favorites": len(get_favorites(user_id)),
-        "most_used_model": most_used_model,
-        "most_used_style": most_used_style
+        "total": counts["total"],
+        "favorites": counts["favorites"],
+        "most_used_model": most_used("model"),
+        "most_used_style": most_used("style")
     }
 
 
 def clear_history(user_id):
     """Очищает историю пользователя (кроме избранного)"""
-    library = load_library()
-    user_key = str(user_id)
-
-    if user_key not in library:
-        return False
-
-    # Оставляем только избранное
-    favorites = get_favorites(user_id)
-    library[user_key]["history"] = favorites
-
-    save_library(library)
+    _conn()
+    with db.transaction() as conn:
+        exists = conn.execute("SELECT 1 FROM library_history WHERE user_id = ? LIMIT 1", (user_id,)).fetchone()
+        if not exists:
+            return False
+
+        # Оставляем только избранное
+        conn.execute("DELETE FROM library_history WHERE user_id = ? AND is_favorite = 0", (user_id,))
     return True
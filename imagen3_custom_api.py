@@ -5,14 +5,18 @@ Supports: Subject conditioning (person, animal, product) with reference images
 """
 
 import requests
-import base64
-from io import BytesIO
-from settings import GOOGLE_AI_API_KEY
+from settings import GOOGLE_AI_API_KEY, GOOGLE_AI_API_BASE
+from providers import get_session, GOOGLE
+from image_buffer import ImageBuffer, loads_with_images
+from reference_images import payload as reference_payload
+import log
+
+logger = log.get_logger(__name__)
 
 # ВРЕМЕННО ОТКЛЮЧЕНО: Imagen 3 Custom API не доступен
 # Google изменил API, модель imagen-3.0-capability-001 больше не поддерживается
 # Нужно найти актуальную модель или использовать другой endpoint
-IMAGEN3_CUSTOM_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/imagen-3.0-generate-001:predict"
+IMAGEN3_CUSTOM_API_URL = f"{GOOGLE_AI_API_BASE}/v1beta/models/imagen-3.0-generate-001:predict"
 
 # Маппинг форматов
 ASPECT_RATIO_MAP = {
@@ -49,7 +53,7 @@ def generate_with_imagen3_custom(
         subject_type: Тип субъекта - "person", "animal", "product", "default"
 
     Returns:
-        Список BytesIO объектов с сгенерированными изображениями
+        Список ImageBuffer (BytesIO только для чтения) с сгенерированными изображениями
     """
     # ВРЕМЕННОЕ ОТКЛЮЧЕНИЕ
     raise Exception(
@@ -84,10 +88,8 @@ def generate_with_imagen3_custom(
     # Подготавливаем референсные изображения
     reference_configs = []
     for idx, ref_img in enumerate(reference_images, start=1):
-        # Конвертируем BytesIO в base64
-        ref_img.seek(0)
-        img_bytes = ref_img.read()
-        img_base64 = base64.b64encode(img_bytes).decode('utf-8')
+        # Подготовленный референс (reference_images.prepare()): base64 из кеша
+        _, img_base64 = reference_payload(ref_img, "imagen3_custom")
 
         reference_configs.append({
             "referenceId": idx,
@@ -111,46 +113,48 @@ def generate_with_imagen3_custom(
         }
     }
 
-    print(f"[Imagen 3 Custom] Generating with prompt: {prompt[:100]}...")
-    print(f"[Imagen 3 Custom] Reference images: {len(reference_images)}")
-    print(f"[Imagen 3 Custom] Subject type: {subject_type}")
-    print(f"[Imagen 3 Custom] Aspect ratio: {aspect_ratio} -> {imagen_ratio}")
+    logger.debug("Generating with prompt: %s...", prompt[:100])
+    logger.debug("Reference images: %s", len(reference_images))
+    logger.debug("Subject type: %s", subject_type)
+    logger.debug("Aspect ratio: %s -> %s", aspect_ratio, imagen_ratio)
 
     try:
-        response = requests.post(
+        response = get_session(GOOGLE).post(
             url,
             headers=headers,
             json=payload,
             timeout=180  # 3 минуты для customization
         )
 
-        print(f"[Imagen 3 Custom] Response status: {response.status_code}")
+        logger.debug("Response status: %s", response.status_code)
 
         if response.status_code != 200:
             error_text = response.text
-            print(f"[Imagen 3 Custom] Error: {error_text}")
+            logger.error("Error: %.500s", error_text)
             raise Exception(f"Imagen 3 Custom API error: {response.status_code} - {error_text}")
 
-        data = response.json()
+        # base64 декодируется прямо из тела ответа, без строк Python
+        data = loads_with_images(response.content)
 
         # Извлекаем изображения
         images = []
         predictions = data.get("predictions", [])
 
         for prediction in predictions:
-            image_b64 = prediction.get("bytesBase64Encoded")
-            if image_b64:
-                image_bytes = base64.b64decode(image_b64)
-                images.append(BytesIO(image_bytes))
+            image = prediction.get("bytesBase64Encoded")
+            if isinstance(image, ImageBuffer):
+                images.append(image)
+            elif image:
+                images.append(ImageBuffer.from_base64(image))
 
-        print(f"[Imagen 3 Custom] Generated {len(images)} image(s)")
+        logger.info("Generated %s image(s)", len(images))
         return images
 
     except requests.exceptions.Timeout:
-        print("[Imagen 3 Custom] Request timeout")
+        logger.error("Request timeout")
         raise Exception("Imagen 3 Custom API request timeout (180s)")
     except requests.exceptions.RequestException as e:
-        print(f"[Imagen 3 Custom] Request error: {e}")
+        logger.error("Request error: %s", e)
         raise Exception(f"Imagen 3 Custom API request failed: {e}")
 
 
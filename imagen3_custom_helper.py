@@ -3,6 +3,11 @@ Helper function for generating images with Google Imagen 3 Customization (Subjec
 Supports reference images for persons, animals, and products
 """
 
+import log
+
+logger = log.get_logger(__name__)
+
+
 async def generate_imagen3_custom_image(query, uid):
     """Генерирует изображение через Google Imagen 3 Customization с референсными фото"""
     from state import user_state
@@ -12,6 +17,11 @@ async def generate_imagen3_custom_image(query, uid):
     from image_library import add_to_history
     from keyboards import actions_kb
     from openai_helper import translate_to_english
+    from providers import run_blocking, GOOGLE, OPENAI
+    from telegram_files import sent_file_id
+    from settings import USE_GCS
+    import gcs_helper as gcs
+    import metrics
     import gsheets_logger as gsl
 
     st = user_state[uid]
@@ -64,7 +74,8 @@ async def generate_imagen3_custom_image(query, uid):
     gpt_model = st.get("gpt_model", "gpt-4o")
 
     await query.edit_message_text("🎨 Перевод промпта с помощью ChatGPT...")
-    english_prompt = translate_to_english(prompt, gpt_model)
+    with metrics.span("translate", engine="imagen3_custom", model=gpt_model):
+        english_prompt = await run_blocking(OPENAI, translate_to_english, prompt, gpt_model)
 
     # Сохраняем английский промпт
     st["last_english_prompt"] = english_prompt
@@ -78,13 +89,14 @@ async def generate_imagen3_custom_image(query, uid):
 
     try:
         # Генерируем через Imagen 3 Customization
-        images = generate_with_imagen3_custom(
-            english_prompt,
-            reference_images,
-            imagen_format,
-            1,
-            subject_type
-        )
+        with metrics.span("provider", engine="imagen3_custom", model="imagen-3.0-capability-001", references=len(reference_images)):
+            images = await run_blocking(GOOGLE, generate_with_imagen3_custom,
+                english_prompt,
+                reference_images,
+                imagen_format,
+                1,
+                subject_type
+            )
 
         if not images:
             await query.edit_message_text("❌ Не удалось сгенерировать изображение. Попробуйте другой промпт или фото.")
@@ -94,7 +106,7 @@ async def generate_imagen3_custom_image(query, uid):
 
     except Exception as e:
         error_msg = str(e)
-        print(f"[Imagen 3 Custom Error] {error_msg}")
+        logger.error(error_msg)
         await query.edit_message_text(f"❌ Ошибка генерации: {error_msg}")
         return
 
@@ -103,7 +115,8 @@ async def generate_imagen3_custom_image(query, uid):
 
     # Добавляем watermark
     result.seek(0)
-    watermarked = add_watermark(result)
+    with metrics.span("watermark", engine="imagen3_custom", model="imagen-3.0-capability-001"):
+        watermarked = add_watermark(result)
 
     # Сохраняем последнее изображение
     result.seek(0)
@@ -118,31 +131,44 @@ async def generate_imagen3_custom_image(query, uid):
         "default": "🎨"
     }.get(subject_type, "🎨")
 
-    await query.message.reply_photo(
-        photo=watermarked,
-        caption=f"{subject_emoji} <b>Imagen 3 Custom</b>\n\n"
-                f"<b>Промпт:</b> {st.get('prompt', '')}\n"
-                f"<b>Референсов:</b> {len(reference_images)}\n"
-                f"<b>Формат:</b> {imagen_format}\n\n"
-                f"💎 Осталось генераций: {remaining}",
-        reply_markup=actions_kb(),
-        parse_mode="HTML"
-    )
+    with metrics.span("telegram_upload", engine="imagen3_custom", model="imagen-3.0-capability-001"):
+        message = await query.message.reply_photo(
+            photo=watermarked,
+            caption=f"{subject_emoji} <b>Imagen 3 Custom</b>\n\n"
+                    f"<b>Промпт:</b> {st.get('prompt', '')}\n"
+                    f"<b>Референсов:</b> {len(reference_images)}\n"
+                    f"<b>Формат:</b> {imagen_format}\n\n"
+                    f"💎 Осталось генераций: {remaining}",
+            reply_markup=actions_kb(),
+            parse_mode="HTML"
+        )
+
+    file_id = sent_file_id(message)  # Повторная отправка из библиотеки - без загрузки
 
     # Сохраняем в историю
-    add_to_history(uid, st.get("prompt", ""), "imagen-3.0-custom", "Imagen 3 Custom")
+    with metrics.span("history", engine="imagen3_custom", model="imagen-3.0-capability-001"):
+        add_to_history(uid, st.get("prompt", ""), english_prompt, {"model": "imagen-3.0-custom", "format": imagen_format}, file_id=file_id)
+
+    # Сохраняем в GCS библиотеку
+    if USE_GCS:
+        with metrics.span("gcs_save", engine="imagen3_custom", model="imagen-3.0-capability-001"):
+            try:
+                gcs.save_user_image(uid, result, category='generated', file_id=file_id)
+            except Exception as e:
+                logger.error("Failed to save to library: %s", e)
 
     # Логируем в Google Sheets
     try:
-        gsl.log_generation(
-            uid,
-            st.get("prompt", ""),
-            "imagen-3.0-capability-001",
-            imagen_format,
-            f"Imagen 3 Custom ({subject_type})"
-        )
+        with metrics.span("sheets_log", engine="imagen3_custom", model="imagen-3.0-capability-001"):
+            gsl.log_generation(
+                uid,
+                st.get("prompt", ""),
+                "imagen-3.0-capability-001",
+                imagen_format,
+                f"Imagen 3 Custom ({subject_type})"
+            )
     except Exception as e:
-        print(f"[GSL Error] {e}")
+        logger.error(e)
 
     # Сохраняем параметры для повторной генерации
     st["saved_params"] = {
@@ -5,13 +5,16 @@ Uses Gemini API predict endpoint
 """
 
 import requests
-import base64
-from io import BytesIO
-from settings import GOOGLE_AI_API_KEY
+from settings import GOOGLE_AI_API_KEY, GOOGLE_AI_API_BASE
+from providers import get_session, GOOGLE
+from image_buffer import ImageBuffer, loads_with_images
 from imagen_models import get_model_endpoint, get_model_emoji
+import log
+
+logger = log.get_logger(__name__)
 
 # Legacy URL (для обратной совместимости)
-IMAGEN_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/imagen-4.0-generate-001:predict"
+IMAGEN_API_URL = f"{GOOGLE_AI_API_BASE}/v1beta/models/imagen-4.0-generate-001:predict"
 
 # Маппинг форматов из нашего бота в форматы Imagen
 ASPECT_RATIO_MAP = {
@@ -40,7 +43,7 @@ def generate_with_imagen(prompt: str, aspect_ratio: str = "1:1", num_images: int
         model: Модель Imagen ("imagen-4", "imagen-4-ultra", "imagen-4-fast")
 
     Returns:
-        Список BytesIO объектов с изображениями
+        Список ImageBuffer (BytesIO только для чтения) с изображениями
     """
     if not GOOGLE_AI_API_KEY:
         raise ValueError("GOOGLE_AI_API_KEY not configured")
@@ -74,46 +77,48 @@ def generate_with_imagen(prompt: str, aspect_ratio: str = "1:1", num_images: int
         }
     }
 
-    print(f"[Imagen API] {emoji} Generating with model: {model}")
-    print(f"[Imagen API] Prompt: {prompt[:100]}...")
-    print(f"[Imagen API] Aspect ratio: {aspect_ratio} -> {imagen_ratio}")
+    logger.info("%s Generating with model: %s", emoji, model)
+    logger.debug("Prompt: %s...", prompt[:100])
+    logger.debug("Aspect ratio: %s -> %s", aspect_ratio, imagen_ratio)
 
     try:
-        response = requests.post(
+        response = get_session(GOOGLE).post(
             url,
             headers=headers,
             json=payload,
             timeout=120  # 2 минуты таймаут
         )
 
-        print(f"[Imagen API] Response status: {response.status_code}")
+        logger.debug("Response status: %s", response.status_code)
 
         if response.status_code != 200:
             error_text = response.text
-            print(f"[Imagen API] Error: {error_text}")
+            logger.error("Error: %.500s", error_text)
             raise Exception(f"Imagen API error: {response.status_code} - {error_text}")
 
-        data = response.json()
+        # base64 декодируется прямо из тела ответа, без строк Python
+        data = loads_with_images(response.content)
 
         # Извлекаем изображения из ответа (формат predict)
         images = []
         predictions = data.get("predictions", [])
 
         for prediction in predictions:
-            # Изображение в base64
-            image_b64 = prediction.get("bytesBase64Encoded")
-            if image_b64:
-                image_bytes = base64.b64decode(image_b64)
-                images.append(BytesIO(image_bytes))
-
-        print(f"[Imagen API] Generated {len(images)} image(s)")
+            # Изображение (ImageBuffer, декодированный из base64)
+            image = prediction.get("bytesBase64Encoded")
+            if isinstance(image, ImageBuffer):
+                images.append(image)
+            elif image:
+                images.append(ImageBuffer.from_base64(image))
+
+        logger.info("Generated %s image(s)", len(images))
         return images
 
     except requests.exceptions.Timeout:
-        print("[Imagen API] Request timeout")
+        logger.error("Request timeout")
         raise Exception("Imagen API request timeout (120s)")
     except requests.exceptions.RequestException as e:
-        print(f"[Imagen API] Request error: {e}")
+        logger.error("Request error: %s", e)
         raise Exception(f"Imagen API request failed: {e}")
 
 
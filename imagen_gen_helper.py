@@ -2,15 +2,30 @@
 Helper function for generating images with Google Imagen 4 (Nano Banana 4)
 """
 
-async def generate_imagen_image(query, uid):
-    """Генерирует изображение через Google Imagen 4 (Nano Banana 4)"""
+import log
+
+logger = log.get_logger(__name__)
+
+
+async def generate_imagen_image(query, uid, variants=1):
+    """
+    Генерирует изображение через Google Imagen 4 (Nano Banana 4)
+
+    variants - количество вариантов, выбранное при нажатии кнопки формата
+    (настройка может измениться, пока задача ждёт в очереди)
+    """
     from state import user_state
-    from user_limits import can_generate, use_generation
-    from imagen_api import generate_with_imagen
+    from user_limits import try_use_generation, refund_generation
+    import engine_router
+    import metrics
     from watermark import add_watermark
     from image_library import add_to_history
     from keyboards import actions_kb
     from openai_helper import translate_to_english
+    from providers import run_blocking, ProviderBusyError, OPENAI
+    from telegram_files import sent_file_id
+    from settings import USE_GCS
+    import gcs_helper as gcs
     import gsheets_logger as gsl
 
     st = user_state[uid]
@@ -19,9 +34,13 @@ async def generate_imagen_image(query, uid):
     prompt = st.get("prompt", "")
     imagen_format = st.get("imagen_format", "1:1")
 
-    # Проверяем лимит
-    can_gen, remaining = can_generate(uid)
-    if not can_gen:
+    # Списываем генерации заранее и атомарно (каждый вариант - отдельная генерация);
+    # если на все варианты не хватает остатка, делаем один
+    reserved, remaining = try_use_generation(uid, variants)
+    if not reserved and variants > 1:
+        variants = 1
+        reserved, remaining = try_use_generation(uid)
+    if not reserved:
         await query.edit_message_text(
             f"❌ Лимит бесплатных генераций исчерпан!\n\n"
             f"💎 Осталось: {remaining} генераций\n\n"
@@ -30,80 +49,131 @@ async def generate_imagen_image(query, uid):
         )
         return
 
-    # Переводим промпт на английский
-    gpt_model = st.get("gpt_model", "gpt-4o")
-
-    await query.edit_message_text("🍌 Перевод промпта с помощью ChatGPT...")
-    english_prompt = translate_to_english(prompt, gpt_model)
-
-    # Сохраняем английский промпт
-    st["last_english_prompt"] = english_prompt
-
-    # Получаем выбранную модель (по умолчанию imagen-4)
-    imagen_model = st.get("imagen_model", "imagen-4")
-
-    # Эмодзи в зависимости от модели
-    model_emoji = {
-        "imagen-4": "🍌",
-        "imagen-4-ultra": "💎",
-        "imagen-4-fast": "⚡"
-    }.get(imagen_model, "🍌")
-
-    model_name = {
-        "imagen-4": "Imagen 4",
-        "imagen-4-ultra": "Imagen 4 Ultra",
-        "imagen-4-fast": "Imagen 4 Fast"
-    }.get(imagen_model, "Imagen 4")
-
-    await query.edit_message_text(f"{model_emoji} Генерация через {model_name}...\n\nФормат: {imagen_format}")
-
+    delivered = False
     try:
-        # Генерируем через Imagen 4 с выбранной моделью
-        images = generate_with_imagen(english_prompt, imagen_format, 1, model=imagen_model)
-
-        if not images:
-            await query.edit_message_text("❌ Не удалось сгенерировать изображение. Попробуйте другой промпт.")
+        # Переводим промпт на английский
+        gpt_model = st.get("gpt_model", "gpt-4o")
+
+        await query.edit_message_text("🍌 Перевод промпта с помощью ChatGPT...")
+        with metrics.span("translate", engine="imagen", model=gpt_model):
+            english_prompt = await run_blocking(OPENAI, translate_to_english, prompt, gpt_model)
+
+        # Сохраняем английский промпт
+        st["last_english_prompt"] = english_prompt
+
+        # Получаем выбранную модель (по умолчанию imagen-4)
+        imagen_model = st.get("imagen_model", "imagen-4")
+
+        # Эмодзи в зависимости от модели
+        model_emoji = {
+            "imagen-4": "🍌",
+            "imagen-4-ultra": "💎",
+            "imagen-4-fast": "⚡"
+        }.get(imagen_model, "🍌")
+
+        model_name = {
+            "imagen-4": "Imagen 4",
+            "imagen-4-ultra": "Imagen 4 Ultra",
+            "imagen-4-fast": "Imagen 4 Fast"
+        }.get(imagen_model, "Imagen 4")
+
+        await query.edit_message_text(f"{model_emoji} Генерация через {model_name}...\n\nФормат: {imagen_format}")
+
+        try:
+            # Генерируем выбранной моделью; при ошибке или долгом ответе - резервным движком.
+            # Варианты Imagen возвращает одним запросом (sampleCount)
+            with metrics.span("provider", engine="imagen", model=imagen_model, variants=variants):
+                images, served_model = await engine_router.generate_variants(
+                    english_prompt, imagen_format, preferred=imagen_model, count=variants
+                )
+
+            if not images:
+                await query.edit_message_text("❌ Не удалось сгенерировать изображение. Попробуйте другой промпт.")
+                return
+
+            result = images[0]
+
+        except ProviderBusyError as e:
+            await query.edit_message_text(str(e))
+            return
+        except Exception as e:
+            error_msg = str(e)
+            logger.error(error_msg)
+            await query.edit_message_text(f"❌ Ошибка генерации: {error_msg}")
             return
 
-        result = images[0]
-
-    except Exception as e:
-        error_msg = str(e)
-        print(f"[Imagen Error] {error_msg}")
-        await query.edit_message_text(f"❌ Ошибка генерации: {error_msg}")
-        return
+        # Изображение мог вернуть резервный движок
+        if served_model != imagen_model:
+            imagen_model = served_model
+            model_emoji, model_name = engine_router.engine_label(served_model).split(" ", 1)
+        served_engine = engine_router.engine_family(served_model, default="imagen")
+
+        # Провайдер вернул меньше вариантов - лишние генерации возвращаем
+        images = images[:variants]
+        if len(images) < variants:
+            remaining = refund_generation(uid, variants - len(images))
+            variants = len(images)
+
+        # Добавляем watermark
+        watermarked_images = []
+        with metrics.span("watermark", engine=served_engine, model=imagen_model):
+            for image in images:
+                image.seek(0)
+                watermarked_images.append(add_watermark(image))
+
+        # Сохраняем последнее изображение
+        result.seek(0)
+        st["last_image"] = result
+        st["images"] = [result]
+
+        caption = (
+            f"{model_emoji} <b>{model_name}</b>\n\n"
+            f"<b>Промпт:</b> {prompt}\n"
+            f"<b>Формат:</b> {imagen_format}\n\n"
+            f"💎 Осталось генераций: {remaining}"
+        )
 
-    # Используем генерацию
-    remaining = use_generation(uid)
-
-    # Добавляем watermark
-    result.seek(0)
-    watermarked = add_watermark(result)
-
-    # Сохраняем последнее изображение
-    result.seek(0)
-    st["last_image"] = result
-    st["images"] = [result]
-
-    # Отправляем изображение
-    await query.message.reply_photo(
-        photo=watermarked,
-        caption=f"{model_emoji} <b>{model_name}</b>\n\n"
-                f"<b>Промпт:</b> {prompt}\n"
-                f"<b>Формат:</b> {imagen_format}\n\n"
-                f"💎 Осталось генераций: {remaining}",
-        reply_markup=actions_kb(),
-        parse_mode="HTML"
-    )
+        # Отправляем изображение (несколько вариантов - одним альбомом; у альбома нет кнопок)
+        with metrics.span("telegram_upload", engine=served_engine, model=imagen_model):
+            if len(watermarked_images) > 1:
+                messages = await engine_router.send_variants(query.get_bot(), query.message.chat_id, watermarked_images)
+                await query.message.reply_text(caption, reply_markup=actions_kb(), parse_mode="HTML")
+            else:
+                messages = [await query.message.reply_photo(
+                    photo=watermarked_images[0],
+                    caption=caption,
+                    reply_markup=actions_kb(),
+                    parse_mode="HTML"
+                )]
+        delivered = True
+    finally:
+        # Генерация не удалась или результат не отправлен - возвращаем списанные попытки
+        if not delivered:
+            refund_generation(uid, variants)
+
+    # file_id отправленных вариантов - повторная отправка из библиотеки без загрузки
+    file_ids = [sent_file_id(message) for message in messages]
 
     # Сохраняем в историю
-    add_to_history(uid, prompt, imagen_model, model_name)
+    with metrics.span("history", engine=served_engine, model=imagen_model):
+        add_to_history(uid, prompt, english_prompt, {"model": imagen_model, "format": imagen_format},
+                       file_id=file_ids[-1] if file_ids else None)
+
+    # Сохраняем в GCS библиотеку (каждый вариант)
+    if USE_GCS:
+        with metrics.span("gcs_save", engine=served_engine, model=imagen_model):
+            for image, file_id in zip(images, file_ids):
+                try:
+                    gcs.save_user_image(uid, image, category='generated', file_id=file_id)
+                except Exception as e:
+                    logger.error("Failed to save to library: %s", e)
 
     # Логируем в Google Sheets
     try:
-        gsl.log_generation(uid, prompt, imagen_model, imagen_format, model_name)
+        with metrics.span("sheets_log", engine=served_engine, model=imagen_model):
+            gsl.log_generation(uid, prompt, imagen_model, imagen_format, model_name)
     except Exception as e:
-        print(f"[GSL Error] {e}")
+        logger.error(e)
 
     # Сохраняем параметры для повторной генерации
     st["saved_params"] = {
@@ -3,6 +3,8 @@ Google Imagen 4 Models Configuration
 Поддерживаемые модели на основе актуального API
 """
 
+from settings import GOOGLE_AI_API_BASE
+
 # Доступные Imagen модели
 IMAGEN_MODELS = {
     "imagen-4": {
@@ -40,7 +42,7 @@ def get_model_endpoint(model_key: str = None) -> str:
         model_key = DEFAULT_IMAGEN_MODEL
 
     model_id = IMAGEN_MODELS[model_key]["id"]
-    return f"https://generativelanguage.googleapis.com/v1beta/models/{model_id}:predict"
+    return f"{GOOGLE_AI_API_BASE}/v1beta/models/{model_id}:predict"
 
 def get_model_name(model_key: str = None) -> str:
     """Получить красивое имя модели"""
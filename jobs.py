@@ -0,0 +1,264 @@
+"""
+Очередь задач генерации изображений
+
+Обработчик callback создаёт GenerationJob, ставит его в очередь и сразу
+возвращается, не удерживая обновление Telegram на время генерации.
+Ограниченный пул асинхронных воркеров забирает задачи по порядку с учётом
+лимита одновременных запросов к каждому провайдеру. Пока задача ждёт,
+её сообщение обновляется на месте: "Вы #N в очереди".
+"""
+
+import asyncio
+import time
+import uuid
+from collections import deque, defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional
+
+import metrics
+from providers import ProviderBusyError
+from settings import JOB_WORKERS, JOB_QUEUE_MAX, JOB_MAX_PER_USER, JOB_PROVIDER_LIMITS
+import log
+
+logger = log.get_logger(__name__)
+
+# Минимальный интервал между обновлениями позиции в одном сообщении (сек)
+POSITION_UPDATE_INTERVAL = 3.0
+
+
+class QueueFullError(Exception):
+    """Очередь переполнена или у пользователя слишком много задач"""
+
+
+@dataclass
+class GenerationJob:
+    """Задача генерации: кто, через какой провайдер и что выполнить"""
+    user_id: int
+    provider: str
+    run: Callable[["GenerationJob"], Awaitable[Any]]
+    query: Any = None  # CallbackQuery, сообщение которого обновляется
+    bot: Any = None
+    username: str = ""
+    params: dict = field(default_factory=dict)  # Снимок параметров на момент постановки
+    job_id: str = field(default_factory=lambda: uuid.uuid4().hex[:12])
+    created_at: float = field(default_factory=time.monotonic)
+    started_at: Optional[float] = None
+    position: int = 0
+    last_position_update: float = 0.0
+
+
+def queue_position_text(position: int) -> str:
+    """Текст сообщения о месте в очереди"""
+    if position <= 1:
+        return "⏳ Вы #1 в очереди — генерация скоро начнётся..."
+    return f"⏳ Вы #{position} в очереди\n\nСообщение обновится, когда подойдёт ваша очередь."
+
+
+class GenerationQueue:
+    """
+    Очередь задач с пулом воркеров и лимитами по провайдерам
+
+    Воркер берёт первую задачу, для провайдера которой есть свободный слот,
+    поэтому задачи к перегруженному провайдеру не блокируют остальные.
+    """
+
+    def __init__(self, workers: int, max_pending: int, max_per_user: int, provider_limits: dict):
+        self.workers_count = workers
+        self.max_pending = max_pending
+        self.max_per_user = max_per_user
+        self.provider_limits = provider_limits
+
+        self._pending = deque()
+        self._in_flight = defaultdict(int)
+        self._user_jobs = defaultdict(int)
+        self._workers = []
+        self._cond = None
+
+    def start(self):
+        """Запускает воркеры (вызывается из post_init, внутри event loop)"""
+        if self._workers:
+            return
+        self._cond = asyncio.Condition()
+        for idx in range(self.workers_count):
+            self._workers.append(asyncio.create_task(self._worker(idx)))
+        logger.info("Generation queue started: %s workers, limits=%s", self.workers_count, self.provider_limits)
+
+    async def stop(self):
+        """Останавливает воркеры"""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logger.info("Generation queue stopped")
+
+    async def submit(self, job: GenerationJob) -> int:
+        """
+        Ставит задачу в очередь
+
+        Returns:
+            Позиция задачи в очереди (1 = следующая)
+
+        Raises:
+            QueueFullError: очередь переполнена или превышен лимит задач пользователя
+        """
+        if self._cond is None:
+            raise RuntimeError("Generation queue is not started")
+
+        async with self._cond:
+            if len(self._pending) >= self.max_pending:
+                raise QueueFullError("⏳ Сервис перегружен, попробуйте через минуту.")
+            if self._user_jobs[job.user_id] >= self.max_per_user:
+                raise QueueFullError(
+                    f"⏳ У вас уже {self._user_jobs[job.user_id]} задачи в работе. "
+                    f"Дождитесь их завершения."
+                )
+
+            self._pending.append(job)
+            self._user_jobs[job.user_id] += 1
+            job.position = len(self._pending)
+            self._cond.notify()
+
+        logger.info("Job %s (%s) from user %s queued at #%s", job.job_id, job.provider, job.user_id, job.position)
+        return job.position
+
+    def _has_slot(self, provider: str) -> bool:
+        limit = self.provider_limits.get(provider)
+        return limit is None or self._in_flight[provider] < limit
+
+    def _take_next(self) -> Optional[GenerationJob]:
+        for job in self._pending:
+            if self._has_slot(job.provider):
+                self._pending.remove(job)
+                return job
+        return None
+
+    async def _worker(self, idx: int):
+        while True:
+            async with self._cond:
+                job = self._take_next()
+                while job is None:
+                    await self._cond.wait()
+                    job = self._take_next()
+                self._in_flight[job.provider] += 1
+
+            job.started_at = time.monotonic()
+            self._refresh_positions()
+
+            wait_time = job.started_at - job.created_at
+            logger.info("Worker %s started job %s (%s), waited %.1fs", idx, job.job_id, job.provider, wait_time)
+            engine = job.params.get("engine") or job.provider
+            metrics.observe("queue_wait", wait_time, engine, job.params.get("model", ""))
+
+            try:
+                # Этапы задачи (span в обработчиках) получают общий trace_id
+                with log.context(job_id=job.job_id, user_id=job.user_id), \
+                        metrics.trace("job", engine=engine, model=job.params.get("model", ""), job_id=job.job_id):
+                    await job.run(job)
+            except asyncio.CancelledError:
+                raise
+            except ProviderBusyError as e:
+                # Провайдер перегружен - трассировка не нужна, пользователю показываем понятное сообщение
+                logger.warning("Job %s rejected: %s is busy", job.job_id, job.provider)
+                await self._notify_failure(job, e)
+            except Exception as e:
+                logger.exception("Job %s failed: %s", job.job_id, e)
+                await self._notify_failure(job, e)
+            finally:
+                async with self._cond:
+                    self._in_flight[job.provider] -= 1
+                    self._user_jobs[job.user_id] -= 1
+                    if self._user_jobs[job.user_id] <= 0:
+                        del self._user_jobs[job.user_id]
+                    self._cond.notify_all()
+
+            logger.info("Job %s done in %.1fs", job.job_id, time.monotonic() - job.started_at)
+
+    def _refresh_positions(self):
+        """Пересчитывает позиции ожидающих задач и обновляет их сообщения"""
+        for position, job in enumerate(self._pending, start=1):
+            if job.position != position:
+                job.position = position
+                asyncio.create_task(self.report_position(job))
+
+    async def report_position(self, job: GenerationJob, force: bool = False):
+        """Обновляет сообщение задачи текущей позицией в очереди"""
+        if job.query is None or job.started_at is not None:
+            return
+
+        now = time.monotonic()
+        if not force and job.position > 1 and now - job.last_position_update < POSITION_UPDATE_INTERVAL:
+            return
+        job.last_position_update = now
+
+        try:
+            await job.query.edit_message_text(queue_position_text(job.position))
+        except Exception as e:
+            # Сообщение не изменилось или уже удалено - не критично
+            logger.warning("Failed to update queue position for job %s: %s", job.job_id, e)
+
+    async def _notify_failure(self, job: GenerationJob, error: Exception):
+        if job.query is None:
+            return
+        try:
+            if isinstance(error, ProviderBusyError):
+                await job.query.edit_message_text(str(error))
+            else:
+                await job.query.edit_message_text(f"❌ Ошибка генерации: {error}")
+        except Exception:
+            pass
+
+    def user_jobs(self, user_id: int) -> int:
+        """Количество задач пользователя в очереди и в работе"""
+        return self._user_jobs.get(user_id, 0)
+
+    def stats(self) -> dict:
+        """Текущее состояние очереди"""
+        return {
+            "pending": len(self._pending),
+            "in_flight": dict(self._in_flight),
+            "workers": len(self._workers),
+        }
+
+
+# Глобальная очередь бота
+generation_queue = GenerationQueue(
+    workers=JOB_WORKERS,
+    max_pending=JOB_QUEUE_MAX,
+    max_per_user=JOB_MAX_PER_USER,
+    provider_limits=JOB_PROVIDER_LIMITS,
+)
+
+
+async def enqueue_generation(query, uid: int, provider: str, run, params: dict = None) -> bool:
+    """
+    Создаёт задачу генерации из callback и ставит её в очередь
+
+    Args:
+        query: CallbackQuery нажатой кнопки (его сообщение показывает позицию)
+        uid: ID пользователя
+        provider: Провайдер, к которому обратится задача (providers.STABILITY и т.д.)
+        run: async-функция run(job), выполняющая генерацию
+        params: Снимок параметров генерации
+
+    Returns:
+        True если задача поставлена в очередь
+    """
+    job = GenerationJob(
+        user_id=uid,
+        provider=provider,
+        run=run,
+        query=query,
+        bot=query.get_bot(),
+        username=query.from_user.username or "",
+        params=params or {},
+    )
+
+    try:
+        await query.edit_message_text("⏳ Задача поставлена в очередь...")
+        await generation_queue.submit(job)
+    except QueueFullError as e:
+        await query.edit_message_text(str(e))
+        return False
+
+    await generation_queue.report_position(job, force=True)
+    return True
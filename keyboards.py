@@ -1,4 +1,17 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from settings import VARIANTS_COUNT
+
+def plural_ru(count, one, few, many):
+    """Форма слова для числа: 1 вариант, 2 варианта, 5 вариантов"""
+    if count % 10 == 1 and count % 100 != 11:
+        return one
+    if 2 <= count % 10 <= 4 and not 12 <= count % 100 <= 14:
+        return few
+    return many
+
+def variants_text(count):
+    """Количество вариантов словами: 4 варианта, 5 вариантов"""
+    return f"{count} {plural_ru(count, 'вариант', 'варианта', 'вариантов')}"
 
 def gpt_model_kb():
     """Клавиатура для выбора GPT модели"""
@@ -25,15 +38,23 @@ def imagen_model_kb():
         [InlineKeyboardButton("⚡ Imagen 4 Fast (скорость)", callback_data="imagen_model_fast")]
     ])
 
-def imagen_format_kb():
-    """Клавиатура для выбора формата Imagen 3 (Nano Banana 3)"""
-    return InlineKeyboardMarkup([
+def imagen_format_kb(variants=None):
+    """
+    Клавиатура для выбора формата Imagen 3 (Nano Banana 3)
+
+    variants - текущее количество вариантов (если задано, добавляется переключатель)
+    """
+    keyboard = [
         [InlineKeyboardButton("1:1 Квадрат", callback_data="imgfmt_1:1")],
         [InlineKeyboardButton("16:9 Горизонтальный", callback_data="imgfmt_16:9"),
          InlineKeyboardButton("9:16 Вертикальный", callback_data="imgfmt_9:16")],
         [InlineKeyboardButton("4:3 Пейзаж", callback_data="imgfmt_4:3"),
          InlineKeyboardButton("3:4 Портрет", callback_data="imgfmt_3:4")]
-    ])
+    ]
+    if variants is not None:
+        label = f"🎲 {variants_text(VARIANTS_COUNT)} ✅" if variants > 1 else f"🎲 {variants_text(VARIANTS_COUNT)}"
+        keyboard.append([InlineKeyboardButton(label, callback_data="imgvariants")])
+    return InlineKeyboardMarkup(keyboard)
 
 def dalle_model_kb():
     """Клавиатура для выбора модели OpenAI Image Generation"""
@@ -187,7 +208,8 @@ def confirm_kb():
     """Клавиатура для подтверждения/редактирования промпта"""
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("✏️ Редактировать", callback_data="edit_prompt"),
-         InlineKeyboardButton("✅ Создать", callback_data="generate")]
+         InlineKeyboardButton("✅ Создать", callback_data="generate")],
+        [InlineKeyboardButton(f"🎲 Создать {variants_text(VARIANTS_COUNT)}", callback_data="generate_variants")]
     ])
 
 def actions_kb():
@@ -199,6 +221,10 @@ def actions_kb():
          InlineKeyboardButton("🔄 Перегенерировать", callback_data="action_reload")],
         [InlineKeyboardButton("🔍 Увеличить", callback_data="action_upscale"),
          InlineKeyboardButton("🎭 Вариации", callback_data="action_variations")],
+        [InlineKeyboardButton(
+            f"🎭 {VARIANTS_COUNT} {plural_ru(VARIANTS_COUNT, 'вариация', 'вариации', 'вариаций')}",
+            callback_data="action_variations_n"
+        )],
         [InlineKeyboardButton("🖌️ Убрать фон", callback_data="action_remove_bg"),
          InlineKeyboardButton("👤 Восстановить лицо", callback_data="action_face_restore")],
         [InlineKeyboardButton("🎨 Дорисовать", callback_data="action_inpaint")],
@@ -0,0 +1,165 @@
+"""
+Логирование: уровни, логгер на модуль, неблокирующая запись, JSON
+
+    logger = log.get_logger(__name__)
+    logger.info("Image saved: %s", blob_name)
+
+Записи кладутся в очередь (QueueHandler), а форматирует и пишет их в
+stdout отдельный поток (QueueListener) - обработчики бота не ждут вывода.
+Если очередь (LOG_QUEUE_SIZE) переполнена, запись отбрасывается и
+учитывается в stats().
+
+Уровни: LOG_LEVEL для всех логгеров и LOG_LEVELS для отдельных модулей
+("gcs_helper:WARNING,httpx:WARNING"). LOG_SAMPLE ("watermark:0.05")
+оставляет только долю записей ниже WARNING у частых модулей.
+
+LOG_FORMAT=json - строка JSON на запись: ts, level, logger, msg и
+идентификаторы корреляции из context()/bind() (update_id, user_id, job_id,
+trace_id). В текстовом формате они дописываются в конце строки.
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+from contextlib import contextmanager
+
+from settings import LOG_LEVEL, LOG_LEVELS, LOG_FORMAT, LOG_SAMPLE, LOG_QUEUE_SIZE
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_context = contextvars.ContextVar("log_context", default={})
+_listener = None
+_setup_lock = threading.Lock()
+_stats = {"dropped": 0, "sampled_out": 0}
+
+
+# ===== Идентификаторы корреляции =====
+
+@contextmanager
+def context(**fields):
+    """Добавляет поля ко всем записям внутри блока (и вложенных задач/потоков)"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def bind(**fields):
+    """Добавляет поля до конца текущей задачи asyncio (например, на время обработки update)"""
+    _context.set({**_context.get(), **fields})
+
+
+def current(name: str, default=None):
+    """Значение поля корреляции в текущем контексте"""
+    return _context.get().get(name, default)
+
+
+# ===== Обработчики =====
+
+class _ContextFilter(logging.Filter):
+    """Сохраняет поля корреляции в записи: форматирование идёт в другом потоке"""
+
+    def filter(self, record):
+        record.context = _context.get()
+        return True
+
+
+class _SampleFilter(logging.Filter):
+    """Пропускает долю LOG_SAMPLE записей ниже WARNING у указанных модулей"""
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = LOG_SAMPLE.get(record.name.split(".", 1)[0])
+        if rate is None or random.random() < rate:
+            return True
+        _stats["sampled_out"] += 1
+        return False
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Сообщение и трассировка форматируются в потоке вывода, а не в обработчике
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _stats["dropped"] += 1
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **getattr(record, "context", {}),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "context", None)
+        if fields:
+            line += " [" + " ".join(f"{key}={value}" for key, value in fields.items()) + "]"
+        return line
+
+
+def setup():
+    """Настраивает корневой логгер (повторные вызовы ничего не делают)"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(_JsonFormatter() if LOG_FORMAT == "json" else _TextFormatter(TEXT_FORMAT))
+
+        handler = _QueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+        handler.addFilter(_ContextFilter())
+        handler.addFilter(_SampleFilter())
+
+        root = logging.getLogger()
+        root.handlers = [handler]
+        root.setLevel(LOG_LEVEL)
+        for name, level in LOG_LEVELS.items():
+            logging.getLogger(name).setLevel(level)
+
+        _listener = logging.handlers.QueueListener(handler.queue, stream, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown)
+
+
+def shutdown():
+    """Дописывает оставшиеся в очереди записи и останавливает поток вывода"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Логгер модуля (logging настраивается при первом вызове)"""
+    setup()
+    return logging.getLogger(name)
+
+
+def stats() -> dict:
+    """Отброшенные при переполнении очереди и отсеянные выборкой записи"""
+    pending = _listener.queue.qsize() if _listener is not None else 0
+    return dict(_stats, pending=pending)
@@ -4,6 +4,9 @@ import base64
 import uuid
 import os
 from datetime import datetime, timedelta
+import log
+
+logger = log.get_logger("mask_server")
 
 app = Flask(__name__)
 CORS(app)
@@ -48,12 +51,12 @@ def upload_mask():
             'timestamp': datetime.now()
         }
         
-        print(f'[MASK] Uploaded mask_id={mask_id} for user_id={user_id}')
+        logger.info("Uploaded mask_id=%s for user_id=%s", mask_id, user_id)
         
         return jsonify({'mask_id': mask_id, 'status': 'ok'})
         
     except Exception as e:
-        print(f'[ERROR] Upload failed: {e}')
+        logger.error("Upload failed: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/get_mask/<mask_id>', methods=['GET'])
@@ -72,7 +75,7 @@ def get_mask(mask_id):
         return jsonify(data)
         
     except Exception as e:
-        print(f'[ERROR] Get mask failed: {e}')
+        logger.error("Get mask failed: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/health', methods=['GET'])
@@ -95,11 +98,11 @@ def send_mask_id():
             app.pending_masks = {}
         app.pending_masks[user_id] = mask_id
         
-        print(f'[PENDING] Saved mask_id={mask_id} for user_id={user_id}')
+        logger.info("Saved mask_id=%s for user_id=%s", mask_id, user_id)
         return jsonify({'status': 'ok'})
         
     except Exception as e:
-        print(f'[ERROR] Send failed: {e}')
+        logger.error("Send failed: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
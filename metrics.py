@@ -0,0 +1,230 @@
+"""
+Метрики этапов генерации: Prometheus /metrics и JSON-трассировка
+
+Этапы конвейера оборачиваются в span():
+
+    with metrics.span("translate", engine="sd", model=st['model']):
+        prompt = await run_blocking(OPENAI, build_final_prompt, ...)
+
+Длительность попадает в гистограмму imagegen_stage_duration_seconds с
+метками stage / engine / model / outcome (ok или error). Задача очереди
+открывает trace(): у всех её этапов общий trace_id, и при заданном
+METRICS_TRACE_FILE каждый этап записывается туда строкой JSON.
+
+/metrics отдаётся встроенным HTTP-сервером на METRICS_LISTEN:METRICS_PORT
+(0 - выключен). Кроме гистограмм, на каждый запрос опрашиваются
+зарегистрированные источники статистики (register_collector) - очередь,
+движки, кеши, сессии - и выводятся как gauge.
+"""
+
+import json
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from settings import METRICS_PORT, METRICS_LISTEN, METRICS_TRACE_FILE
+import log
+
+logger = log.get_logger(__name__)
+
+PREFIX = "imagegen"
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+LABELS = ("stage", "engine", "model", "outcome")
+
+_histograms = {}  # (stage, engine, model, outcome) -> [счётчики по BUCKETS, сумма, количество]
+_collectors = {}  # имя -> (функция, возвращающая dict; метка)
+_lock = threading.Lock()
+_trace_lock = threading.Lock()
+_server = None
+
+
+def observe(stage: str, seconds: float, engine: str = "", model: str = "", outcome: str = "ok"):
+    """Добавляет длительность этапа в гистограмму"""
+    key = (stage, engine or "", model or "", outcome)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[0][index] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+
+@contextmanager
+def trace(name: str, **attrs):
+    """Общий trace_id для этапов одной задачи (его получают вложенные span() и записи лога)"""
+    with log.context(trace_id=uuid.uuid4().hex[:16]), span(name, **attrs):
+        yield
+
+
+@contextmanager
+def span(stage: str, engine: str = "", model: str = "", **attrs):
+    """
+    Замеряет этап конвейера
+
+    Исключение внутри блока отмечается outcome="error" и пробрасывается дальше.
+    Дополнительные attrs попадают только в JSON-трассировку.
+    """
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        observe(stage, elapsed, engine, model, outcome)
+        if METRICS_TRACE_FILE:
+            _write_trace({
+                "ts": round(time.time(), 3),
+                "trace_id": log.current("trace_id"),
+                "stage": stage,
+                "engine": engine,
+                "model": model,
+                "outcome": outcome,
+                "duration_ms": round(elapsed * 1000, 1),
+                **attrs,
+            })
+
+
+def _write_trace(record: dict):
+    try:
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with _trace_lock, open(METRICS_TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        logger.warning("Failed to write trace: %s", e)
+
+
+def register_collector(name: str, func, label: str = None):
+    """
+    Регистрирует источник статистики для /metrics
+
+    func() возвращает dict. Без label: числа выводятся как gauge
+    {PREFIX}_{name}_{ключ}, словари чисел - с меткой key. С label: словарь
+    вида {объект: {поле: число}} (например, по движкам) выводится как
+    {PREFIX}_{name}_{поле} с меткой label=объект.
+    """
+    _collectors[name] = (func, label)
+
+
+# ===== Экспорт =====
+
+def _metric_name(*parts) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", "_".join(str(part) for part in parts if part))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    return None
+
+
+def _collect_gauges(lines: list):
+    gauges = {}  # имя метрики -> [(метки, значение)]
+
+    def add(metric, labels, value):
+        if _number(value) is not None:
+            gauges.setdefault(metric, []).append((labels, _number(value)))
+
+    for name, (func, label) in list(_collectors.items()):
+        try:
+            data = func() or {}
+        except Exception as e:
+            logger.warning("Metrics collector %s failed: %s", name, e)
+            continue
+        for key, value in data.items():
+            if label:
+                for field, field_value in (value or {}).items():
+                    add(_metric_name(PREFIX, name, field), {label: key}, field_value)
+            elif isinstance(value, dict):
+                for sub_key, sub_value in value.items():
+                    add(_metric_name(PREFIX, name, key), {"key": sub_key}, sub_value)
+            else:
+                add(_metric_name(PREFIX, name, key), {}, value)
+
+    for metric, samples in sorted(gauges.items()):
+        lines.append(f"# TYPE {metric} gauge")
+        for labels, value in samples:
+            lines.append(f"{metric}{_labels(**labels)} {value}")
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    with _lock:
+        histograms = {key: (list(buckets), total, count) for key, (buckets, total, count) in _histograms.items()}
+
+    metric = f"{PREFIX}_stage_duration_seconds"
+    lines.append(f"# HELP {metric} Duration of generation pipeline stages")
+    lines.append(f"# TYPE {metric} histogram")
+    for key, (buckets, total, count) in sorted(histograms.items()):
+        labels = dict(zip(LABELS, key))
+        for bound, value in zip(BUCKETS, buckets):
+            lines.append(f"{metric}_bucket{_labels(**labels, le=bound)} {value}")
+        lines.append(f"{metric}_bucket{_labels(**labels, le='+Inf')} {count}")
+        lines.append(f"{metric}_sum{_labels(**labels)} {total:.6f}")
+        lines.append(f"{metric}_count{_labels(**labels)} {count}")
+
+    _collect_gauges(lines)
+    return "\n".join(lines) + "\n"
+
+
+# ===== HTTP-сервер =====
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        payload = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_server(port: int = None):
+    """Запускает /metrics в фоновом потоке (port 0 - не запускать)"""
+    global _server
+    port = METRICS_PORT if port is None else port
+    if not port or _server is not None:
+        return
+    try:
+        _server = ThreadingHTTPServer((METRICS_LISTEN, port), _MetricsHandler)
+    except OSError as e:
+        logger.warning("Metrics endpoint not started on %s:%s: %s", METRICS_LISTEN, port, e)
+        return
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Metrics endpoint: http://%s:%s/metrics", METRICS_LISTEN, port)
+
+
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
@@ -5,12 +5,16 @@ Supports: Text-to-image with reference images (multimodal)
 """
 
 import requests
-import base64
-from io import BytesIO
-from settings import GOOGLE_AI_API_KEY
+from settings import GOOGLE_AI_API_KEY, GOOGLE_AI_API_BASE
+from providers import get_session, GOOGLE
+from image_buffer import ImageBuffer, loads_with_images
+from reference_images import payload as reference_payload
+import log
+
+logger = log.get_logger(__name__)
 
 # Nano Banana Pro API endpoint
-NANO_BANANA_PRO_URL = "https://generativelanguage.googleapis.com/v1beta/models/nano-banana-pro-preview:generateContent"
+NANO_BANANA_PRO_URL = f"{GOOGLE_AI_API_BASE}/v1beta/models/nano-banana-pro-preview:generateContent"
 
 # Маппинг форматов
 ASPECT_RATIO_MAP = {
@@ -44,7 +48,7 @@ def generate_with_nano_banana_pro(
         num_images: Количество изображений (1-4)
 
     Returns:
-        Список BytesIO объектов с изображениями
+        Список ImageBuffer (BytesIO только для чтения) с изображениями
     """
     if not GOOGLE_AI_API_KEY:
         raise ValueError("GOOGLE_AI_API_KEY not configured")
@@ -66,13 +70,12 @@ def generate_with_nano_banana_pro(
     # Если есть референсные изображения, добавляем их
     if reference_images:
         for idx, ref_img in enumerate(reference_images, start=1):
-            ref_img.seek(0)
-            img_bytes = ref_img.read()
-            img_base64 = base64.b64encode(img_bytes).decode('utf-8')
+            # Подготовленный референс (reference_images.prepare()): base64 из кеша, исходный MIME-тип
+            mime_type, img_base64 = reference_payload(ref_img, "nano_banana_pro")
 
             parts.append({
                 "inlineData": {
-                    "mimeType": "image/png",
+                    "mimeType": mime_type,
                     "data": img_base64
                 }
             })
@@ -107,27 +110,28 @@ def generate_with_nano_banana_pro(
         }
     }
 
-    print(f"[Nano Banana Pro] 🍌💎 Generating with prompt: {prompt[:100]}...")
+    logger.debug("🍌💎 Generating with prompt: %s...", prompt[:100])
     if reference_images:
-        print(f"[Nano Banana Pro] Using {len(reference_images)} reference image(s)")
-    print(f"[Nano Banana Pro] Aspect ratio: {aspect_ratio} -> {imagen_ratio}")
+        logger.debug("Using %s reference image(s)", len(reference_images))
+    logger.debug("Aspect ratio: %s -> %s", aspect_ratio, imagen_ratio)
 
     try:
-        response = requests.post(
+        response = get_session(GOOGLE).post(
             url,
             headers=headers,
             json=payload,
             timeout=180  # 3 минуты для мультимодальной генерации
         )
 
-        print(f"[Nano Banana Pro] Response status: {response.status_code}")
+        logger.debug("Response status: %s", response.status_code)
 
         if response.status_code != 200:
             error_text = response.text
-            print(f"[Nano Banana Pro] Error: {error_text}")
+            logger.error("Error: %.500s", error_text)
             raise Exception(f"Nano Banana Pro API error: {response.status_code} - {error_text}")
 
-        data = response.json()
+        # base64 декодируется прямо из тела ответа, без строк Python
+        data = loads_with_images(response.content)
 
         # Извлекаем изображения из ответа
         images = []
@@ -140,23 +144,24 @@ def generate_with_nano_banana_pro(
             for part in parts:
                 # Изображение может быть в inlineData (camelCase)
                 if "inlineData" in part:
-                    image_b64 = part["inlineData"].get("data")
-                    if image_b64:
-                        image_bytes = base64.b64decode(image_b64)
-                        images.append(BytesIO(image_bytes))
+                    image = part["inlineData"].get("data")
+                    if isinstance(image, ImageBuffer):
+                        images.append(image)
+                    elif image:
+                        images.append(ImageBuffer.from_base64(image))
 
         if not images:
-            print(f"[Nano Banana Pro] No images in response: {data}")
+            logger.warning("No images in response: %.500s", data)
             raise Exception("No images generated")
 
-        print(f"[Nano Banana Pro] Generated {len(images)} image(s)")
+        logger.info("Generated %s image(s)", len(images))
         return images
 
     except requests.exceptions.Timeout:
-        print("[Nano Banana Pro] Request timeout")
+        logger.error("Request timeout")
         raise Exception("Nano Banana Pro API request timeout (180s)")
     except requests.exceptions.RequestException as e:
-        print(f"[Nano Banana Pro] Request error: {e}")
+        logger.error("Request error: %s", e)
         raise Exception(f"Nano Banana Pro API request failed: {e}")
 
 
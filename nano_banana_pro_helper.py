@@ -3,6 +3,11 @@ Helper function for generating images with Nano Banana Pro (Gemini 3 Pro Image)
 Supports: Text-to-image with optional reference images
 """
 
+import log
+
+logger = log.get_logger(__name__)
+
+
 async def generate_nano_banana_pro_image(query, uid):
     """Генерирует изображение через Nano Banana Pro с поддержкой референсов"""
     from state import user_state
@@ -12,6 +17,11 @@ async def generate_nano_banana_pro_image(query, uid):
     from image_library import add_to_history
     from keyboards import actions_kb
     from openai_helper import translate_to_english
+    from providers import run_blocking, GOOGLE, OPENAI
+    from telegram_files import sent_file_id
+    from settings import USE_GCS
+    import gcs_helper as gcs
+    import metrics
     import gsheets_logger as gsl
 
     st = user_state[uid]
@@ -43,7 +53,8 @@ async def generate_nano_banana_pro_image(query, uid):
     else:
         await query.edit_message_text("🍌💎 Перевод промпта с помощью ChatGPT...")
 
-    english_prompt = translate_to_english(prompt, gpt_model)
+    with metrics.span("translate", engine="nano_banana_pro", model=gpt_model):
+        english_prompt = await run_blocking(OPENAI, translate_to_english, prompt, gpt_model)
 
     # Сохраняем английский промпт
     st["last_english_prompt"] = english_prompt
@@ -62,12 +73,13 @@ async def generate_nano_banana_pro_image(query, uid):
 
     try:
         # Генерируем через Nano Banana Pro
-        images = generate_with_nano_banana_pro(
-            english_prompt,
-            reference_images=reference_images if reference_images else None,
-            aspect_ratio=imagen_format,
-            num_images=1
-        )
+        with metrics.span("provider", engine="nano_banana_pro", model="nano-banana-pro-preview", references=len(reference_images)):
+            images = await run_blocking(GOOGLE, generate_with_nano_banana_pro,
+                english_prompt,
+                reference_images=reference_images if reference_images else None,
+                aspect_ratio=imagen_format,
+                num_images=1
+            )
 
         if not images:
             await query.edit_message_text("❌ Не удалось сгенерировать изображение. Попробуйте другой промпт.")
@@ -77,7 +89,7 @@ async def generate_nano_banana_pro_image(query, uid):
 
     except Exception as e:
         error_msg = str(e)
-        print(f"[Nano Banana Pro Error] {error_msg}")
+        logger.error(error_msg)
         await query.edit_message_text(f"❌ Ошибка генерации: {error_msg}")
         return
 
@@ -86,7 +98,8 @@ async def generate_nano_banana_pro_image(query, uid):
 
     # Добавляем watermark
     result.seek(0)
-    watermarked = add_watermark(result)
+    with metrics.span("watermark", engine="nano_banana_pro", model="nano-banana-pro-preview"):
+        watermarked = add_watermark(result)
 
     # Сохраняем последнее изображение
     result.seek(0)
@@ -114,21 +127,34 @@ async def generate_nano_banana_pro_image(query, uid):
         )
 
     # Отправляем изображение
-    await query.message.reply_photo(
-        photo=watermarked,
-        caption=caption,
-        reply_markup=actions_kb(),
-        parse_mode="HTML"
-    )
+    with metrics.span("telegram_upload", engine="nano_banana_pro", model="nano-banana-pro-preview"):
+        message = await query.message.reply_photo(
+            photo=watermarked,
+            caption=caption,
+            reply_markup=actions_kb(),
+            parse_mode="HTML"
+        )
+
+    file_id = sent_file_id(message)  # Повторная отправка из библиотеки - без загрузки
 
     # Сохраняем в историю
-    add_to_history(uid, prompt, "nano-banana-pro", "Nano Banana Pro")
+    with metrics.span("history", engine="nano_banana_pro", model="nano-banana-pro-preview"):
+        add_to_history(uid, prompt, english_prompt, {"model": "nano-banana-pro", "format": imagen_format}, file_id=file_id)
+
+    # Сохраняем в GCS библиотеку
+    if USE_GCS:
+        with metrics.span("gcs_save", engine="nano_banana_pro", model="nano-banana-pro-preview"):
+            try:
+                gcs.save_user_image(uid, result, category='generated', file_id=file_id)
+            except Exception as e:
+                logger.error("Failed to save to library: %s", e)
 
     # Логируем в Google Sheets
     try:
-        gsl.log_generation(uid, prompt, "nano-banana-pro-preview", imagen_format, "Nano Banana Pro")
+        with metrics.span("sheets_log", engine="nano_banana_pro", model="nano-banana-pro-preview"):
+            gsl.log_generation(uid, prompt, "nano-banana-pro-preview", imagen_format, "Nano Banana Pro")
     except Exception as e:
-        print(f"[GSL Error] {e}")
+        logger.error(e)
 
     # Сохраняем параметры для повторной генерации
     st["saved_params"] = {
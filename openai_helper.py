@@ -6,17 +6,145 @@
 - Перевода промптов на английский
 """
 
-from openai import OpenAI
-from settings import OPENAI_API_KEY
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+from providers import guarded_call, OPENAI
+from settings import OPENAI_API_KEY, OPENAI_BASE_URL, TRANSLATION_CACHE_SIZE, TRANSLATION_CACHE_TTL
+import log
+
+logger = log.get_logger(__name__)
+
+# Клиент OpenAI (общий с dalle_api) создаётся при первом запросе - импорт openai не замедляет старт
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Клиент OpenAI (создаётся при первом вызове)"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from openai import OpenAI
+                # Повторы выполняет providers.guarded_call - собственные повторы SDK выключены
+                _client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, max_retries=0)
+    return _client
+
+
+# Кеш переводов: LRU в памяти + таблица в SQLite (db.py) со сроком хранения
+_translation_cache = OrderedDict()
+_translation_lock = threading.Lock()
+
+# Частые английские слова: ASCII-текст с ними считается уже английским.
+# Слова, совпадающие с русским транслитом ("a", "to", "on", "by", "i"), не учитываются
+_ENGLISH_WORDS = {
+    "an", "the", "and", "or", "of", "in", "at", "with", "for", "from",
+    "is", "are", "was", "be", "it", "its", "this", "that", "as", "into", "over", "under",
+    "near", "without", "behind", "front", "very", "style", "portrait", "photo", "image",
+    # Частые слова промптов - чтобы короткие английские промпты не уходили на перевод
+    "city", "cat", "dog", "girl", "boy", "man", "woman", "landscape", "forest", "mountain",
+    "mountains", "sunset", "sky", "night", "beach", "ocean", "castle", "dragon", "flowers",
+    "car", "street", "house", "beautiful", "cute", "realistic", "cinematic", "fantasy",
+    "cyberpunk", "painting", "watercolor", "anime", "art", "logo", "background",
+}
+_WORD_RE = re.compile(r"[a-z']+")
+
+
+def _normalize_text(text: str) -> str:
+    """Нормализует текст для ключа кеша (Unicode NFC, без лишних пробелов)"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def is_ascii_english(text: str) -> bool:
+    """
+    Быстрая проверка: текст уже на английском и перевод не нужен
+
+    Текст должен состоять только из ASCII-символов и содержать хотя бы
+    одно частое английское слово (_ENGLISH_WORDS). Длина текста сама по себе
+    ничего не решает: "kot na kryshe" уйдёт на перевод.
+    """
+    if not text.isascii():
+        return False
+    return any(word in _ENGLISH_WORDS for word in _WORD_RE.findall(text.lower()))
+
+
+def _init_translation_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS translation_cache (
+            key TEXT PRIMARY KEY,
+            result TEXT NOT NULL,
+            created REAL NOT NULL
+        )
+    """)
+
+
+def _disk_get(key: str):
+    if TRANSLATION_CACHE_TTL <= 0:
+        return None
+    try:
+        import db
+        db.ensure_schema("translation_cache", _init_translation_schema)
+        row = db.get_connection().execute(
+            "SELECT result FROM translation_cache WHERE key = ? AND created >= ?",
+            (key, time.time() - TRANSLATION_CACHE_TTL)
+        ).fetchone()
+        return row["result"] if row else None
+    except Exception as e:
+        logger.warning("Translation cache read failed: %s", e)
+        return None
+
+
+def _disk_put(key: str, result: str):
+    if TRANSLATION_CACHE_TTL <= 0:
+        return
+    try:
+        import db
+        db.ensure_schema("translation_cache", _init_translation_schema)
+        conn = db.get_connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO translation_cache (key, result, created) VALUES (?, ?, ?)",
+            (key, result, time.time())
+        )
+        # Удаляем устаревшие записи
+        conn.execute("DELETE FROM translation_cache WHERE created < ?", (time.time() - TRANSLATION_CACHE_TTL,))
+    except Exception as e:
+        logger.warning("Translation cache write failed: %s", e)
+
+
+def _cache_get(key: str):
+    with _translation_lock:
+        result = _translation_cache.get(key)
+        if result is not None:
+            _translation_cache.move_to_end(key)
+            return result
+
+    result = _disk_get(key)
+    if result is not None:
+        _cache_put(key, result, persist=False)
+    return result
+
+
+def _cache_put(key: str, result: str, persist: bool = True):
+    with _translation_lock:
+        _translation_cache[key] = result
+        _translation_cache.move_to_end(key)
+        while len(_translation_cache) > TRANSLATION_CACHE_SIZE:
+            _translation_cache.popitem(last=False)
+    if persist:
+        _disk_put(key, result)
 
 def improve_prompt(text: str, model: str = "gpt-4o") -> str:
     """
     Улучшает промпт для генерации изображений с помощью ChatGPT-4o
     """
     try:
-        response = client.chat.completions.create(
+        response = guarded_call(
+            OPENAI, get_client().chat.completions.create,
             model=model,
             messages=[
                 {
@@ -39,20 +167,38 @@ def improve_prompt(text: str, model: str = "gpt-4o") -> str:
         )
 
         improved = response.choices[0].message.content.strip()
-        print(f"[OK] Prompt improved by ChatGPT: {improved[:100]}...")
+        logger.debug("Prompt improved by ChatGPT: %s...", improved[:100])
         return improved
 
     except Exception as e:
-        print(f"[ERROR] Improve prompt failed: {e}")
+        logger.error("Improve prompt failed: %s", e)
         return text  # Возвращаем оригинал при ошибке
 
 
 def translate_to_english(text: str, model: str = "gpt-4o") -> str:
     """
     Переводит текст на английский язык
+
+    Текст, который уже на английском (is_ascii_english), возвращается без
+    обращения к OpenAI. Переводы кешируются по нормализованному тексту и модели.
     """
+    normalized = _normalize_text(text)
+    if not normalized:
+        return text
+
+    if is_ascii_english(normalized):
+        logger.info("Text is already in English, translation skipped")
+        return text
+
+    key = hashlib.sha256(f"{model}\n{normalized}".encode("utf-8")).hexdigest()
+    cached = _cache_get(key)
+    if cached is not None:
+        logger.debug("Translation cache hit: %s...", cached[:100])
+        return cached
+
     try:
-        response = client.chat.completions.create(
+        response = guarded_call(
+            OPENAI, get_client().chat.completions.create,
             model=model,
             messages=[
                 {
@@ -66,7 +212,7 @@ def translate_to_english(text: str, model: str = "gpt-4o") -> str:
                 },
                 {
                     "role": "user",
-                    "content": text
+                    "content": normalized
                 }
             ],
             temperature=0.3,
@@ -74,13 +220,13 @@ def translate_to_english(text: str, model: str = "gpt-4o") -> str:
         )
 
         translated = response.choices[0].message.content.strip()
-        print(f"[OK] Translated to English: {translated[:100]}...")
+        logger.debug("Translated to English: %s...", translated[:100])
+        if translated:
+            _cache_put(key, translated)
         return translated
 
     except Exception as e:
-        print(f"[ERROR] Translation failed: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Translation failed: %s", e)
         return text  # Возвращаем оригинал при ошибке
 
 
@@ -89,10 +235,11 @@ def summarize_url_content(url: str, text_content: str, model: str = "gpt-4o") ->
     Создает краткое саммари текста со страницы для создания обложки НА РУССКОМ ЯЗЫКЕ
     """
     try:
-        print(f"[INFO] Calling ChatGPT to summarize URL content...")
-        print(f"[INFO] Text length: {len(text_content)} characters")
+        logger.info("Calling ChatGPT to summarize URL content...")
+        logger.info("Text length: %s characters", len(text_content))
 
-        response = client.chat.completions.create(
+        response = guarded_call(
+            OPENAI, get_client().chat.completions.create,
             model=model,
             messages=[
                 {
@@ -115,13 +262,11 @@ def summarize_url_content(url: str, text_content: str, model: str = "gpt-4o") ->
         )
 
         summary = response.choices[0].message.content.strip()
-        print(f"[OK] Summary created for URL (in Russian): {summary[:100]}...")
+        logger.debug("Summary created for URL (in Russian): %s...", summary[:100])
         return summary
 
     except Exception as e:
-        print(f"[ERROR] Summary creation failed: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Summary creation failed: %s", e)
         return f"Создай обложку для этой статьи"  # Fallback на русском
 
 
@@ -139,7 +284,7 @@ def build_final_prompt(base_prompt: str, params: dict, model: str = "gpt-4o") ->
         Финальный промпт на английском для Stable Diffusion
     """
     # Переводим ТОЛЬКО основной текст на английский
-    print(f"[INFO] Translating base prompt to English...")
+    logger.info("Translating base prompt to English...")
     english_prompt = translate_to_english(base_prompt, model)
 
     # Style передается через API параметры (style_preset)
@@ -162,7 +307,7 @@ def build_final_prompt(base_prompt: str, params: dict, model: str = "gpt-4o") ->
     # Собираем все вместе
     final_prompt = ', '.join(components)
 
-    print(f"[OK] Final prompt for generation: {final_prompt[:200]}...")
+    logger.debug("Final prompt for generation: %s...", final_prompt[:200])
     return final_prompt
 
 
@@ -1,8 +1,11 @@
 """
 Модуль для обработки платежей через Telegram Stars и CryptoBot
 """
-import requests
 from settings import CRYPTOBOT_TOKEN, CRYPTOBOT_CURRENCY
+from providers import get_session, CRYPTOBOT
+import log
+
+logger = log.get_logger(__name__)
 
 # Пакеты генераций
 # Цены в Telegram Stars и USDT
@@ -76,18 +79,18 @@ def create_cryptobot_invoice(user_id, package_id):
             "paid_btn_url": f"https://t.me/imageGenBot"
         }
 
-        response = requests.post(api_url, json=payload, headers=headers)
+        response = get_session(CRYPTOBOT).post(api_url, json=payload, headers=headers, timeout=30)
 
         if response.status_code == 200:
             data = response.json()
             if data.get("ok"):
                 return data.get("result")
 
-        print(f"[ERROR] CryptoBot API error: {response.text}")
+        logger.error("CryptoBot API error: %.500s", response.text)
         return None
 
     except Exception as e:
-        print(f"[ERROR] Failed to create CryptoBot invoice: {e}")
+        logger.error("Failed to create CryptoBot invoice: %s", e)
         return None
 
 
@@ -112,7 +115,7 @@ def check_cryptobot_invoice(invoice_id):
             "invoice_ids": invoice_id
         }
 
-        response = requests.get(api_url, params=params, headers=headers)
+        response = get_session(CRYPTOBOT).get(api_url, params=params, headers=headers, timeout=30)
 
         if response.status_code == 200:
             data = response.json()
@@ -124,7 +127,7 @@ def check_cryptobot_invoice(invoice_id):
         return None
 
     except Exception as e:
-        print(f"[ERROR] Failed to check CryptoBot invoice: {e}")
+        logger.error("Failed to check CryptoBot invoice: %s", e)
         return None
 
 
@@ -0,0 +1,434 @@
+"""
+Слой провайдеров внешних API (Stability.ai, Google AI, OpenAI, CryptoBot)
+
+Каждый провайдер получает:
+- общую requests.Session с пулом keep-alive соединений (без повторного TLS-рукопожатия);
+- собственный пул потоков, в котором выполняются блокирующие HTTP-вызовы.
+
+Асинхронные обработчики бота вызывают API только через run_blocking(),
+поэтому медленный ответ одного провайдера не останавливает event loop
+и не мешает обработке обновлений остальных пользователей.
+
+Запросы через сессию провайдера (и вызовы через guarded_call) проходят
+через ограничители:
+- token bucket (PROVIDER_RATE_LIMITS, запросов в секунду);
+- максимум одновременных запросов (PROVIDER_MAX_IN_FLIGHT);
+- повторы с экспоненциальной задержкой и jitter при 429/502/503/504;
+- circuit breaker: после BREAKER_FAILURE_THRESHOLD ошибок подряд запросы
+  к провайдеру сразу завершаются ProviderBusyError ("engine temporarily
+  busy"), пока не пройдёт пауза и пробный запрос не окажется успешным.
+"""
+
+import asyncio
+import contextvars
+import functools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from settings import (
+    PROVIDER_MAX_WORKERS, PROVIDER_RATE_LIMITS, PROVIDER_MAX_IN_FLIGHT,
+    PROVIDER_MAX_RETRIES, BREAKER_FAILURE_THRESHOLD, BREAKER_COOLDOWN
+)
+import log
+
+logger = log.get_logger(__name__)
+
+# Идентификаторы провайдеров
+STABILITY = "stability"
+GOOGLE = "google"
+OPENAI = "openai"
+CRYPTOBOT = "cryptobot"
+WEB = "web"  # Прочие HTTP-запросы (загрузка страниц, Mini App, маски)
+GCS = "gcs"  # Скачивание изображений из Google Cloud Storage (экспорт библиотеки)
+
+# Названия провайдеров для сообщений пользователю
+PROVIDER_NAMES = {
+    STABILITY: "Stability AI",
+    GOOGLE: "Google AI",
+    OPENAI: "OpenAI",
+    CRYPTOBOT: "CryptoBot",
+}
+
+# Размер пула потоков (и пула соединений) для каждого провайдера
+DEFAULT_MAX_WORKERS = 16
+
+RETRY_STATUSES = {429, 502, 503, 504}  # Провайдер перегружен - запрос можно повторить
+# Ошибкой провайдера для circuit breaker считаются RETRY_STATUSES, любой 5xx и таймауты
+BACKOFF_BASE = 1.0  # Базовая задержка повтора (сек)
+BACKOFF_MAX = 20.0  # Максимальная задержка повтора (сек)
+BREAKER_MAX_COOLDOWN = 300  # Максимальная пауза circuit breaker (сек)
+RATE_LIMIT_MAX_WAIT = 30  # Дольше ждать токен не имеет смысла - провайдер занят
+
+_sessions = {}
+_executors = {}
+_governors = {}
+_lock = threading.Lock()
+
+
+class ProviderBusyError(Exception):
+    """Провайдер временно недоступен: открыт circuit breaker или превышен лимит запросов"""
+
+    def __init__(self, provider: str, retry_after: float):
+        self.provider = provider
+        self.retry_after = retry_after
+        name = PROVIDER_NAMES.get(provider, provider)
+        super().__init__(
+            f"⏳ {name} временно перегружен (engine temporarily busy). "
+            f"Попробуйте через {max(1, int(retry_after + 0.5))} сек."
+        )
+
+
+class _TokenBucket:
+    """Ограничение частоты запросов: rate токенов в секунду, запас - burst"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Резервирует токен и возвращает, сколько секунд нужно подождать"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def cancel(self):
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class _CircuitBreaker:
+    """closed -> (N ошибок подряд) -> open -> (пауза) -> один пробный запрос -> closed/open"""
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.failures = 0
+        self.opened_until = 0.0
+        self.cooldown = BREAKER_COOLDOWN
+        self.probe_in_flight = False
+        self.lock = threading.Lock()
+
+    def check(self):
+        """Проверяет, можно ли обращаться к провайдеру (без резервирования пробного запроса)"""
+        remaining = self.opened_until - time.monotonic()
+        if remaining > 0:
+            raise ProviderBusyError(self.provider, remaining)
+
+    def before_call(self) -> bool:
+        """Возвращает True, если этот вызов - пробный запрос после паузы"""
+        with self.lock:
+            if self.failures < BREAKER_FAILURE_THRESHOLD:
+                return False
+            remaining = self.opened_until - time.monotonic()
+            if remaining > 0 or self.probe_in_flight:
+                raise ProviderBusyError(self.provider, max(remaining, 1))
+            # Пауза прошла - пропускаем один пробный запрос
+            self.probe_in_flight = True
+            return True
+
+    def release_probe(self):
+        """Снимает отметку пробного запроса, исход которого не учтён (иначе breaker останется занятым)"""
+        with self.lock:
+            self.probe_in_flight = False
+
+    def record_success(self):
+        with self.lock:
+            if self.failures >= BREAKER_FAILURE_THRESHOLD:
+                logger.info("%s: circuit closed", self.provider)
+            self.failures = 0
+            self.cooldown = BREAKER_COOLDOWN
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probe_in_flight:
+                # Пробный запрос не удался - увеличиваем паузу
+                self.cooldown = min(self.cooldown * 2, BREAKER_MAX_COOLDOWN)
+            if self.failures >= BREAKER_FAILURE_THRESHOLD:
+                self.opened_until = time.monotonic() + self.cooldown
+                self.probe_in_flight = False
+                logger.info("%s: circuit open for %ss after %s failures", self.provider, self.cooldown, self.failures)
+
+
+class _Governor:
+    """Ограничители одного провайдера"""
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        rate = PROVIDER_RATE_LIMITS.get(provider)
+        self.bucket = _TokenBucket(rate) if rate else None
+        self.in_flight = threading.BoundedSemaphore(PROVIDER_MAX_IN_FLIGHT.get(provider, _max_workers(provider)))
+        self.breaker = _CircuitBreaker(provider)
+
+    @contextmanager
+    def slot(self):
+        """
+        Проверка circuit breaker, ожидание токена и места среди одновременных запросов
+
+        Исход запроса (record_success/record_failure) учитывает вызывающий код.
+        Если пробный запрос завершился без учёта исхода (ограничитель не дал
+        места, неожиданное исключение), отметка пробного запроса снимается.
+        """
+        probe = self.breaker.before_call()
+        try:
+            if self.bucket:
+                wait = self.bucket.reserve()
+                if wait > RATE_LIMIT_MAX_WAIT:
+                    self.bucket.cancel()
+                    raise ProviderBusyError(self.provider, wait)
+                if wait:
+                    time.sleep(wait)
+
+            if not self.in_flight.acquire(timeout=RATE_LIMIT_MAX_WAIT):
+                raise ProviderBusyError(self.provider, RATE_LIMIT_MAX_WAIT)
+            try:
+                yield
+            finally:
+                self.in_flight.release()
+        finally:
+            if probe:
+                self.breaker.release_probe()
+
+
+def _governor(provider: str) -> _Governor:
+    governor = _governors.get(provider)
+    if governor is None:
+        with _lock:
+            governor = _governors.get(provider)
+            if governor is None:
+                governor = _governors[provider] = _Governor(provider)
+    return governor
+
+
+def _backoff(attempt: int, retry_after=None) -> float:
+    """Экспоненциальная задержка с jitter (full jitter), не меньше Retry-After"""
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    if retry_after:
+        try:
+            delay = max(delay, min(float(retry_after), BACKOFF_MAX))
+        except ValueError:
+            pass
+    return delay
+
+
+def _is_provider_failure(status) -> bool:
+    """Ответ означает сбой или перегрузку провайдера (учитывается circuit breaker)"""
+    return status in RETRY_STATUSES or (isinstance(status, int) and status >= 500)
+
+
+def _is_transport_error(e: Exception) -> bool:
+    """Сбой соединения или таймаут (в том числе APIConnectionError/APITimeoutError OpenAI SDK)"""
+    if isinstance(e, (ConnectionError, TimeoutError, requests.ConnectionError, requests.Timeout)):
+        return True
+    return any(cls.__name__ == "APIConnectionError" for cls in type(e).__mro__)
+
+
+def _is_timeout(e: Exception) -> bool:
+    """Таймаут ожидания ответа (в том числе APITimeoutError OpenAI SDK)"""
+    if isinstance(e, (TimeoutError, requests.Timeout)):
+        return True
+    return any(cls.__name__ == "APITimeoutError" for cls in type(e).__mro__)
+
+
+def _retry_after(e: Exception):
+    """Заголовок Retry-After из ответа, приложенного к исключению SDK (или None)"""
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    return headers.get("Retry-After") if headers is not None else None
+
+
+def _file_positions(kwargs) -> list:
+    """Позиции файлов multipart-запроса, чтобы повторный запрос отправил их заново"""
+    files = kwargs.get("files")
+    if isinstance(files, dict):
+        files = files.values()
+    positions = []
+    for value in files or []:
+        if isinstance(value, tuple) and len(value) == 2 and isinstance(value[0], str) and isinstance(value[1], tuple):
+            value = value[1]  # Список пар (имя поля, (имя файла, файл, ...))
+        fileobj = value[1] if isinstance(value, tuple) and len(value) > 1 else value
+        if hasattr(fileobj, "seek") and hasattr(fileobj, "tell"):
+            positions.append((fileobj, fileobj.tell()))
+    return positions
+
+
+class _GovernedSession(requests.Session):
+    """requests.Session, запросы которой проходят через ограничители провайдера"""
+
+    def __init__(self, provider: str):
+        super().__init__()
+        self.provider = provider
+
+    def request(self, method, url, *args, **kwargs):
+        governor = _governor(self.provider)
+        positions = _file_positions(kwargs)
+
+        for attempt in range(PROVIDER_MAX_RETRIES + 1):
+            for fileobj, position in positions:
+                fileobj.seek(position)
+
+            delay = None
+            with governor.slot():
+                try:
+                    response = super().request(method, url, *args, **kwargs)
+                except requests.ConnectionError:
+                    # В том числе ConnectTimeout: запрос не дошёл до провайдера, повтор безопасен
+                    governor.breaker.record_failure()
+                    if attempt == PROVIDER_MAX_RETRIES:
+                        raise
+                    delay = _backoff(attempt)
+                except requests.Timeout:
+                    # ReadTimeout не повторяем: провайдер мог уже выполнить (платный) запрос
+                    governor.breaker.record_failure()
+                    raise
+                else:
+                    if not _is_provider_failure(response.status_code):
+                        # 4xx - ошибка запроса, а не провайдера
+                        governor.breaker.record_success()
+                        return response
+                    governor.breaker.record_failure()
+                    if attempt == PROVIDER_MAX_RETRIES or response.status_code not in RETRY_STATUSES:
+                        return response
+                    delay = _backoff(attempt, response.headers.get("Retry-After"))
+                    response.close()
+
+            logger.info("%s: retry %s/%s in %.1fs", self.provider, attempt + 1, PROVIDER_MAX_RETRIES, delay)
+            time.sleep(delay)
+
+
+def is_available(provider: str) -> bool:
+    """False, если circuit breaker провайдера открыт (запросы сейчас завершатся ProviderBusyError)"""
+    try:
+        _governor(provider).breaker.check()
+    except ProviderBusyError:
+        return False
+    return True
+
+
+def guarded_call(provider: str, func, *args, **kwargs):
+    """
+    Вызывает func через ограничители провайдера (для SDK, которые не используют get_session)
+
+    Ошибки с кодом 429/5xx (атрибут status_code, как у исключений OpenAI SDK),
+    сбои соединения и таймауты учитываются circuit breaker как сбой
+    провайдера, остальные ответы с кодом (4xx) - как успешный ответ.
+    Повторы - как у запросов через сессию: RETRY_STATUSES и сбои соединения,
+    но не таймауты. Собственные повторы SDK должны быть выключены
+    (max_retries=0), иначе запрос повторяется дважды.
+    """
+    governor = _governor(provider)
+
+    for attempt in range(PROVIDER_MAX_RETRIES + 1):
+        with governor.slot():
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                status = getattr(e, "status_code", None)
+                if status is not None and not _is_provider_failure(status):
+                    # 4xx - ошибка запроса, а не провайдера
+                    governor.breaker.record_success()
+                    raise
+                if status is None and not _is_transport_error(e):
+                    raise
+                governor.breaker.record_failure()
+                # Таймаут не повторяем: провайдер мог уже выполнить (платный) запрос
+                if attempt == PROVIDER_MAX_RETRIES or _is_timeout(e) or (status is not None and status not in RETRY_STATUSES):
+                    raise
+                delay = _backoff(attempt, _retry_after(e))
+            else:
+                governor.breaker.record_success()
+                return result
+
+        logger.info("%s: retry %s/%s in %.1fs", provider, attempt + 1, PROVIDER_MAX_RETRIES, delay)
+        time.sleep(delay)
+
+
+def _max_workers(provider: str) -> int:
+    """Возвращает размер пула для провайдера (из PROVIDER_MAX_WORKERS или по умолчанию)"""
+    return PROVIDER_MAX_WORKERS.get(provider, DEFAULT_MAX_WORKERS)
+
+
+def get_session(provider: str) -> requests.Session:
+    """
+    Возвращает общую HTTP-сессию провайдера
+
+    Сессия создаётся один раз и переиспользует соединения между запросами.
+    Размер пула соединений совпадает с размером пула потоков провайдера.
+    """
+    session = _sessions.get(provider)
+    if session is not None:
+        return session
+
+    with _lock:
+        session = _sessions.get(provider)
+        if session is None:
+            size = _max_workers(provider)
+            session = _GovernedSession(provider)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[provider] = session
+            logger.info("HTTP session created for provider '%s' (pool=%s)", provider, size)
+    return session
+
+
+def get_executor(provider: str) -> ThreadPoolExecutor:
+    """Возвращает пул потоков провайдера (создаётся при первом обращении)"""
+    executor = _executors.get(provider)
+    if executor is not None:
+        return executor
+
+    with _lock:
+        executor = _executors.get(provider)
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=_max_workers(provider),
+                thread_name_prefix=f"provider-{provider}"
+            )
+            _executors[provider] = executor
+    return executor
+
+
+async def run_blocking(provider: str, func, *args, **kwargs):
+    """
+    Выполняет блокирующую функцию в пуле потоков провайдера
+
+    Args:
+        provider: Идентификатор провайдера (STABILITY, GOOGLE, OPENAI, ...)
+        func: Синхронная функция (например, generate_dream)
+        *args, **kwargs: Аргументы функции
+
+    Returns:
+        Результат func(*args, **kwargs)
+    """
+    # Circuit breaker открыт - не занимаем место в пуле потоков
+    _governor(provider).breaker.check()
+
+    loop = asyncio.get_running_loop()
+    # Контекст (идентификаторы корреляции логов, trace_id) переходит в поток пула
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await loop.run_in_executor(get_executor(provider), call)
+
+
+def shutdown():
+    """Закрывает все сессии и пулы потоков (вызывается при остановке бота)"""
+    with _lock:
+        for executor in _executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        for session in _sessions.values():
+            session.close()
+        _executors.clear()
+        _sessions.clear()
+    logger.info("Provider sessions closed")
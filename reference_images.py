@@ -0,0 +1,155 @@
+"""
+Подготовка референсных фото для Nano Banana Pro и Imagen 3 Custom
+
+Telegram присылает фото в полном разрешении, а модели всё равно уменьшают
+референсы до своего предела. prepare() один раз при загрузке:
+- уменьшает фото до REFERENCE_MAX_SIDE движка (больше модели не используют);
+- сохраняет исходный формат и MIME-тип (JPEG из Telegram остаётся JPEG,
+  а не объявляется как image/png);
+- возвращает ImageBuffer с атрибутами mime_type и digest (sha256).
+
+Подготовленные буферы хранятся в LRU (REFERENCE_CACHE_MB) по sha256
+исходных и подготовленных байтов, поэтому повторная загрузка того же фото
+и повторные генерации с теми же референсами не декодируют и не кодируют
+изображение заново: payload() отдаёт готовый base64.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from image_buffer import ImageBuffer
+from settings import REFERENCE_MAX_SIDE, REFERENCE_JPEG_QUALITY, REFERENCE_CACHE_MB
+import log
+
+logger = log.get_logger(__name__)
+
+DEFAULT_MAX_SIDE = 2048
+
+# Форматы, которые принимают API Google; остальные перекодируются в PNG
+MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+}
+
+_cache = OrderedDict()  # (sha256, движок) -> ImageBuffer
+_cache_bytes = 0
+_lock = threading.Lock()
+
+
+def digest(image) -> str:
+    """sha256 содержимого изображения (для подготовленных буферов - сохранённый)"""
+    value = getattr(image, "digest", None)
+    if value:
+        return value
+    data = image.getvalue() if isinstance(image, BytesIO) else bytes(image)
+    return hashlib.sha256(data).hexdigest()
+
+
+def max_side(engine: str) -> int:
+    """Максимальная сторона референса, которую использует движок"""
+    return REFERENCE_MAX_SIDE.get(engine, DEFAULT_MAX_SIDE)
+
+
+def _cache_get(key):
+    with _lock:
+        buffer = _cache.get(key)
+        if buffer is not None:
+            _cache.move_to_end(key)
+        return buffer
+
+
+def _cache_put(keys, buffer):
+    global _cache_bytes
+    budget = REFERENCE_CACHE_MB * 1024 * 1024
+    with _lock:
+        for key in keys:
+            if key not in _cache:
+                _cache_bytes += buffer.nbytes
+            _cache[key] = buffer
+        while _cache and _cache_bytes > budget:
+            _, evicted = _cache.popitem(last=False)
+            _cache_bytes -= evicted.nbytes
+
+
+def _encode(data: bytes, side: int):
+    """Уменьшает изображение при необходимости; возвращает (bytes, mime_type)"""
+    from PIL import Image
+
+    with Image.open(BytesIO(data)) as img:
+        fmt = img.format
+        if fmt in MIME_TYPES and max(img.size) <= side:
+            return data, MIME_TYPES[fmt]  # Исходные байты без пересжатия
+
+        if fmt not in MIME_TYPES:
+            fmt = "PNG"
+        img.thumbnail((side, side), Image.Resampling.LANCZOS)
+
+        output = BytesIO()
+        if fmt == "JPEG":
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            img.save(output, format="JPEG", quality=REFERENCE_JPEG_QUALITY, optimize=True)
+        elif fmt == "WEBP":
+            img.save(output, format="WEBP", quality=REFERENCE_JPEG_QUALITY)
+        else:
+            img.save(output, format="PNG", optimize=True)
+        return output.getvalue(), MIME_TYPES[fmt]
+
+
+def prepare(image, engine: str) -> ImageBuffer:
+    """
+    Подготавливает референс для движка (блокирующая функция, вызывать в executor)
+
+    Args:
+        image: bytes / bytearray / BytesIO с загруженным фото
+        engine: "nano_banana_pro" или "imagen3_custom"
+
+    Returns:
+        ImageBuffer с атрибутами mime_type и digest
+    """
+    data = image.getvalue() if isinstance(image, BytesIO) else bytes(image)
+    source_digest = digest(image)
+    cached = _cache_get((source_digest, engine))
+    if cached is not None:
+        return cached
+
+    side = max_side(engine)
+    try:
+        output, mime_type = _encode(data, side)
+    except Exception as e:
+        # Не удалось разобрать изображение - отправляем как есть, как раньше
+        logger.warning("Reference preprocessing failed: %s", e)
+        output, mime_type = data, "image/png"
+
+    buffer = ImageBuffer(output)
+    buffer.mime_type = mime_type
+    buffer.digest = hashlib.sha256(output).hexdigest() if output is not data else source_digest
+    _cache_put({(source_digest, engine), (buffer.digest, engine)}, buffer)
+
+    if output is not data:
+        logger.info("%s KB -> %s KB (%s, max side %s)", len(data) // 1024, len(output) // 1024, mime_type, side)
+    return buffer
+
+
+def payload(image, engine: str):
+    """
+    MIME-тип и base64 референса для запроса к API
+
+    Для подготовленных буферов base64 берётся из кеша; буфер, восстановленный
+    с диска (state.py) или переданный без подготовки, проходит prepare().
+
+    Returns:
+        (mime_type, base64 str)
+    """
+    if not getattr(image, "mime_type", None):
+        image = prepare(image, engine)
+    return image.mime_type, image.b64()
+
+
+def is_duplicate(references, image) -> bool:
+    """Есть ли такое же фото среди уже загруженных референсов"""
+    value = digest(image)
+    return any(digest(ref) == value for ref in references)
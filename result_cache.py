@@ -0,0 +1,185 @@
+"""
+Кеш результатов генерации для повторных запросов
+
+Включается настройкой RESULT_CACHE. Ключ - sha256 канонического JSON из
+(движок, модель, английский промпт, формат, стиль, negative prompt, seed).
+Кешируются только детерминированные запросы - с зафиксированным seed:
+повтор генерации из истории (lib_reuse_) или режим /seed получают то же
+изображение сразу, без обращения к Stability.
+
+Изображения хранятся в RESULT_CACHE_DIR (<sha[:2]>/<sha>), записи - в
+таблице result_cache (db.py) со своим сроком хранения у каждого ключа.
+При превышении RESULT_CACHE_MAX_MB удаляются давно не использованные записи.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from io import BytesIO
+
+import db
+from settings import RESULT_CACHE, RESULT_CACHE_TTL, RESULT_CACHE_DIR, RESULT_CACHE_MAX_MB
+import log
+
+logger = log.get_logger(__name__)
+
+MAX_SEED = 4294967294  # Максимальный seed Stability API
+PURGE_INTERVAL = 600  # Как часто удалять устаревшие записи (сек)
+
+_next_purge = 0.0
+
+
+def _init_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS result_cache (
+            key TEXT PRIMARY KEY,
+            engine TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            expires REAL NOT NULL,
+            last_used REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_result_cache_expires ON result_cache (expires)")
+
+
+def _conn():
+    db.ensure_schema("result_cache", _init_schema)
+    return db.get_connection()
+
+
+def _path(key: str) -> str:
+    return os.path.join(RESULT_CACHE_DIR, key[:2], key)
+
+
+def cache_key(engine: str, model: str, prompt: str, aspect_ratio: str, style=None, negative_prompt="", seed=None):
+    """
+    Канонический ключ запроса генерации
+
+    Returns:
+        sha256 в hex или None, если запрос не детерминированный (seed не задан)
+    """
+    if seed is None:
+        return None
+    params = {
+        "engine": engine,
+        "model": model,
+        "prompt": " ".join(prompt.split()),
+        "aspect_ratio": aspect_ratio,
+        "style": style if style and style != "none" else None,
+        "negative_prompt": " ".join((negative_prompt or "").split()),
+        "seed": int(seed),
+    }
+    canonical = json.dumps(params, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get(key):
+    """Возвращает сохранённое изображение (BytesIO) или None"""
+    if not RESULT_CACHE or key is None:
+        return None
+    try:
+        conn = _conn()
+        row = conn.execute("SELECT expires FROM result_cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row["expires"] < time.time():
+            return None
+        with open(_path(key), "rb") as f:
+            data = f.read()
+        conn.execute(
+            "UPDATE result_cache SET hits = hits + 1, last_used = ? WHERE key = ?",
+            (time.time(), key)
+        )
+    except FileNotFoundError:
+        _conn().execute("DELETE FROM result_cache WHERE key = ?", (key,))
+        return None
+    except Exception as e:
+        logger.warning("Result cache read failed: %s", e)
+        return None
+
+    logger.info("Result cache hit: %s", key[:12])
+    return BytesIO(data)
+
+
+def put(key, image, engine: str, ttl: int = None):
+    """
+    Сохраняет изображение в кеш
+
+    Args:
+        key: Ключ из cache_key() (None - ничего не делать)
+        image: BytesIO или bytes
+        engine: Движок, который создал изображение
+        ttl: Срок хранения этого ключа (сек), по умолчанию RESULT_CACHE_TTL
+    """
+    if not RESULT_CACHE or key is None:
+        return
+    data = image.getvalue() if isinstance(image, BytesIO) else bytes(image)
+    now = time.time()
+    try:
+        path = _path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        _conn().execute(
+            "INSERT OR REPLACE INTO result_cache (key, engine, size, created, expires, last_used, hits) "
+            "VALUES (?, ?, ?, ?, ?, ?, 0)",
+            (key, engine, len(data), now, now + (ttl if ttl is not None else RESULT_CACHE_TTL), now)
+        )
+    except Exception as e:
+        logger.warning("Result cache write failed: %s", e)
+        return
+
+    _maybe_purge()
+
+
+def _maybe_purge():
+    global _next_purge
+    if time.monotonic() < _next_purge:
+        return
+    _next_purge = time.monotonic() + PURGE_INTERVAL
+    try:
+        purge()
+    except Exception as e:
+        logger.warning("Result cache purge failed: %s", e)
+
+
+def purge():
+    """Удаляет устаревшие записи и давно не использованные сверх RESULT_CACHE_MAX_MB"""
+    budget = RESULT_CACHE_MAX_MB * 1024 * 1024
+    removed = []
+    _conn()
+    with db.transaction() as conn:
+        removed += [row["key"] for row in conn.execute(
+            "SELECT key FROM result_cache WHERE expires < ?", (time.time(),)
+        )]
+        total = 0
+        for row in conn.execute(
+            "SELECT key, size FROM result_cache WHERE expires >= ? ORDER BY last_used DESC", (time.time(),)
+        ):
+            total += row["size"]
+            if total > budget:
+                removed.append(row["key"])
+        conn.executemany("DELETE FROM result_cache WHERE key = ?", [(key,) for key in removed])
+
+    for key in removed:
+        try:
+            os.remove(_path(key))
+        except FileNotFoundError:
+            pass
+    if removed:
+        logger.info("Result cache purged: %s entries", len(removed))
+
+
+def stats() -> dict:
+    """Количество записей, размер и число попаданий"""
+    row = _conn().execute(
+        "SELECT COUNT(*) AS entries, COALESCE(SUM(size), 0) AS bytes, COALESCE(SUM(hits), 0) AS hits "
+        "FROM result_cache WHERE expires >= ?",
+        (time.time(),)
+    ).fetchone()
+    return dict(row)
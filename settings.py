@@ -26,6 +26,13 @@ GOOGLE_AI_API_KEY = os.getenv("GOOGLE_AI_API_KEY", "")
 CRYPTOBOT_TOKEN = os.getenv("CRYPTOBOT_TOKEN", "")
 CRYPTOBOT_CURRENCY = os.getenv("CRYPTOBOT_CURRENCY", "USDT")
 
+# Базовые адреса API провайдеров (по умолчанию - настоящие сервисы;
+# benchmarks/load_bench.py подставляет локальные заглушки)
+STABILITY_API_BASE = os.getenv("STABILITY_API_BASE", "https://api.stability.ai")
+GOOGLE_AI_API_BASE = os.getenv("GOOGLE_AI_API_BASE", "https://generativelanguage.googleapis.com")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None  # None - адрес по умолчанию клиента OpenAI
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "")  # Например http://127.0.0.1:8081 (Bot API сервер), пусто - api.telegram.org
+
 # Mini App Web Server URL для Inpaint Editor
 WEBAPP_URL = os.getenv("WEBAPP_URL", "http://localhost:5000")
 
@@ -38,3 +45,122 @@ GCS_CREDENTIALS_PATH = os.getenv("GCS_CREDENTIALS_PATH", "tgbots-google-cloud.js
 GSHEETS_LOGGING = os.getenv("GSHEETS_LOGGING", "true").lower() == "true"
 GSHEETS_SPREADSHEET_ID = os.getenv("GSHEETS_SPREADSHEET_ID", "1TsPo12VGW8u9YmcEhWHcIL-6yWCZ0_svBgku9fTaE0s")
 GSHEETS_CREDENTIALS_PATH = os.getenv("GSHEETS_CREDENTIALS_PATH", "tgbots-google-sheets.json")
+
+
+def _provider_map(name, default="", cast=int):
+    """Разбирает настройку вида "stability:16,google:8" в словарь {провайдер: значение}"""
+    return {
+        key.strip(): cast(value)
+        for key, value in (
+            item.split(":", 1) for item in os.getenv(name, default).split(",") if ":" in item
+        )
+    }
+
+
+# Количество одновременно обрабатываемых обновлений Telegram
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "256"))
+
+# Пулы потоков для блокирующих вызовов внешних API (по провайдерам)
+# Формат: "stability:16,google:16,openai:16" (неуказанные провайдеры используют значение по умолчанию)
+PROVIDER_MAX_WORKERS = _provider_map("PROVIDER_MAX_WORKERS")
+
+# Ограничения запросов к провайдерам (providers.py)
+# Запросов в секунду (token bucket), формат "stability:10,google:10"; неуказанные провайдеры не ограничены
+PROVIDER_RATE_LIMITS = _provider_map("PROVIDER_RATE_LIMITS", "stability:10,google:10,openai:10,cryptobot:5", float)
+# Максимум одновременных запросов к провайдеру (по умолчанию - размер пула потоков)
+PROVIDER_MAX_IN_FLIGHT = _provider_map("PROVIDER_MAX_IN_FLIGHT")
+PROVIDER_MAX_RETRIES = int(os.getenv("PROVIDER_MAX_RETRIES", "2"))  # Повторы при 429/502/503/504 и ошибках соединения
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))  # Ошибок подряд до отключения провайдера
+BREAKER_COOLDOWN = int(os.getenv("BREAKER_COOLDOWN", "30"))  # Пауза перед пробным запросом (сек), удваивается до 300
+
+# Выбор движка генерации (engine_router.py)
+# Цепочка резервных движков: при ошибке (или недоступности) выбранного пробуется следующий.
+# SD заменяется на Imagen, только если в запросе нет стиля, негативного промпта, исходных изображений и закреплённого seed
+ENGINE_FALLBACK_CHAIN = [
+    name.strip() for name in os.getenv("ENGINE_FALLBACK_CHAIN", "imagen-4-fast,imagen-4,sd3.5-large").split(",") if name.strip()
+]
+ENGINE_FALLBACK = os.getenv("ENGINE_FALLBACK", "true").lower() == "true"
+# Hedging: если движок отвечает дольше своего перцентиля задержки, параллельно запускается
+# следующий (второй платный запрос, который нельзя отменить). Выключено по умолчанию
+ENGINE_HEDGING = os.getenv("ENGINE_HEDGING", "false").lower() == "true"
+ENGINE_HEDGE_PERCENTILE = int(os.getenv("ENGINE_HEDGE_PERCENTILE", "90"))
+ENGINE_HEDGE_MIN_DELAY = float(os.getenv("ENGINE_HEDGE_MIN_DELAY", "5"))  # Не запускать второй движок раньше (сек)
+ENGINE_HEDGE_DEFAULT_DELAY = float(os.getenv("ENGINE_HEDGE_DEFAULT_DELAY", "60"))  # Пока статистики мало (сек)
+ENGINE_MAX_ERROR_RATE = float(os.getenv("ENGINE_MAX_ERROR_RATE", "0.5"))  # Движок с большей долей ошибок пропускается
+# Режим "N вариантов": сколько изображений генерировать за раз (каждое списывает одну генерацию)
+VARIANTS_COUNT = min(10, max(2, int(os.getenv("VARIANTS_COUNT", "4"))))
+
+# Кеш результатов генерации с зафиксированным seed (result_cache.py), по умолчанию выключен
+RESULT_CACHE = os.getenv("RESULT_CACHE", "false").lower() == "true"
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", "604800"))  # Срок хранения результата (сек)
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "result_cache")
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "1024"))  # Размер кеша на диске
+
+# Подготовка референсных фото (reference_images.py)
+# Максимальная сторона по движкам, формат "nano_banana_pro:2048,imagen3_custom:1024"; большие фото уменьшаются
+REFERENCE_MAX_SIDE = _provider_map("REFERENCE_MAX_SIDE", "nano_banana_pro:2048,imagen3_custom:1024")
+REFERENCE_JPEG_QUALITY = int(os.getenv("REFERENCE_JPEG_QUALITY", "90"))  # Качество при пересжатии JPEG/WEBP
+REFERENCE_CACHE_MB = int(os.getenv("REFERENCE_CACHE_MB", "64"))  # Память под подготовленные референсы (LRU)
+
+# Кеш фото, скачанных из Telegram (telegram_files.py), ключ - file_unique_id
+TG_FILE_CACHE_MB = int(os.getenv("TG_FILE_CACHE_MB", "64"))  # Память (LRU)
+TG_FILE_CACHE_DIR = os.getenv("TG_FILE_CACHE_DIR", "tg_file_cache")
+TG_FILE_CACHE_DISK_MB = int(os.getenv("TG_FILE_CACHE_DISK_MB", "512"))  # Размер кеша на диске
+
+# Очередь задач генерации
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "32"))  # Количество воркеров
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "500"))  # Максимум задач в ожидании
+JOB_MAX_PER_USER = int(os.getenv("JOB_MAX_PER_USER", "3"))  # Максимум задач одного пользователя
+# Лимит одновременных генераций по провайдерам, формат: "stability:8,google:8,openai:8"
+JOB_PROVIDER_LIMITS = _provider_map("JOB_PROVIDER_LIMITS", "stability:8,google:8,openai:8")
+
+# Экспорт библиотеки в ZIP
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", "8"))  # Одновременных загрузок из GCS на один экспорт
+EXPORT_PART_MAX_MB = int(os.getenv("EXPORT_PART_MAX_MB", "49"))  # Размер части архива (лимит документа Telegram - 50 МБ)
+
+# Формат изображений с watermark для отправки в Telegram: JPEG, WEBP или PNG
+WATERMARK_OUTPUT_FORMAT = os.getenv("WATERMARK_OUTPUT_FORMAT", "JPEG").upper()
+WATERMARK_QUALITY = int(os.getenv("WATERMARK_QUALITY", "92"))  # Качество для JPEG/WEBP
+
+# Кеш переводов промптов (openai_helper.translate_to_english)
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", "2048"))  # Записей в памяти (LRU)
+TRANSLATION_CACHE_TTL = int(os.getenv("TRANSLATION_CACHE_TTL", "604800"))  # Срок хранения в SQLite (сек), 0 - только память
+
+# Хранилище сессий пользователей (state.user_state)
+SESSION_IDLE_TTL = int(os.getenv("SESSION_IDLE_TTL", "43200"))  # Удалять сессии, неактивные дольше (сек)
+SESSION_MAX_USERS = int(os.getenv("SESSION_MAX_USERS", "5000"))  # Максимум сессий в памяти
+SESSION_MEMORY_MB = int(os.getenv("SESSION_MEMORY_MB", "256"))  # Бюджет памяти на изображения в сессиях
+SESSION_SPILL_AFTER = int(os.getenv("SESSION_SPILL_AFTER", "300"))  # Выносить на диск изображения сессий, неактивных дольше (сек)
+SESSION_CACHE_DIR = os.getenv("SESSION_CACHE_DIR", "session_cache")  # Папка для вынесенных изображений
+
+# Режим работы: polling (один процесс) или webhook (приёмник webhook.py + процессы-воркеры)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный HTTPS адрес, например https://bot.example.com/telegram
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")  # Адрес приёмника (TLS завершается на прокси)
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # secret_token для заголовка X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "100"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))  # Количество процессов-воркеров
+WEBHOOK_WORKER_BASE_PORT = int(os.getenv("WEBHOOK_WORKER_BASE_PORT", "8600"))  # Воркер i слушает порт BASE + i
+# Параметры процесса-воркера (задаются приёмником при запуске, воркеры слушают только 127.0.0.1)
+BOT_WORKER_INDEX = int(os.getenv("BOT_WORKER_INDEX", "0"))
+WEBHOOK_WORKER_PORT = int(os.getenv("WEBHOOK_WORKER_PORT", str(WEBHOOK_WORKER_BASE_PORT + BOT_WORKER_INDEX)))
+
+# Логирование (log.py): уровень, формат text/json, уровни отдельных модулей,
+# доля сохраняемых записей ниже WARNING для частых модулей, размер очереди записи
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_LEVELS = _provider_map("LOG_LEVELS", "httpx:WARNING,httpcore:WARNING", cast=lambda value: value.strip().upper())
+LOG_SAMPLE = _provider_map("LOG_SAMPLE", "watermark:0.05", cast=float)
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Метрики этапов генерации (metrics.py)
+# Prometheus /metrics: воркер webhook с индексом i слушает METRICS_PORT + i; 0 - выключено
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+if METRICS_PORT:
+    METRICS_PORT += BOT_WORKER_INDEX
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_TRACE_FILE = os.getenv("METRICS_TRACE_FILE", "")  # JSON-строка на каждый этап, пусто - не писать
+
+# SQLite база данных бота (лимиты, история генераций)
+DB_PATH = os.getenv("DB_PATH", "bot_data.db")
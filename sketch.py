@@ -2,13 +2,16 @@
 Модуль для Sketch Control через Stability.ai API
 Генерирует изображение на основе наброска
 """
-import requests
 import io
-from settings import STABILITY_API_KEY
+from settings import STABILITY_API_KEY, STABILITY_API_BASE
+from providers import get_session, STABILITY
 from ai_tools import translate_to_english
+import log
 
+logger = log.get_logger(__name__)
 
-def generate_from_sketch(image_path: str, prompt: str,
+
+def generate_from_sketch(image, prompt: str,
                          negative_prompt: str = "",
                          control_strength: float = 0.5,
                          output_format: str = "png"):
@@ -16,7 +19,7 @@ def generate_from_sketch(image_path: str, prompt: str,
     Генерирует изображение на основе наброска/скетча
 
     Args:
-        image_path: Путь к изображению наброска
+        image: BytesIO с наброском или путь к файлу
         prompt: Текстовый промпт (обязательно!)
         negative_prompt: Негативный промпт (опционально)
         control_strength: Сила следования наброску (0.1-1.0)
@@ -26,24 +29,23 @@ def generate_from_sketch(image_path: str, prompt: str,
         BytesIO объект с результатом или строка с ошибкой
     """
     try:
-        print(f"[INFO] Starting sketch generation...")
-        print(f"[INFO] Sketch image: {image_path}")
-        print(f"[INFO] Prompt: {prompt}")
-        print(f"[INFO] Control strength: {control_strength}")
+        logger.info("Starting sketch generation...")
+        logger.debug("Prompt: %s", prompt)
+        logger.debug("Control strength: %s", control_strength)
 
         # Переводим промпт на английский
-        print(f"[INFO] Translating prompt to English...")
+        logger.info("Translating prompt to English...")
         english_prompt = translate_to_english(prompt)
-        print(f"[OK] Translated prompt: {english_prompt}")
+        logger.debug("Translated prompt: %s", english_prompt)
 
         # Переводим negative prompt если указан
         english_negative = ""
         if negative_prompt:
-            print(f"[INFO] Translating negative prompt to English...")
+            logger.info("Translating negative prompt to English...")
             english_negative = translate_to_english(negative_prompt)
-            print(f"[OK] Translated negative prompt: {english_negative}")
+            logger.debug("Translated negative prompt: %s", english_negative)
 
-        api_url = "https://api.stability.ai/v2beta/stable-image/control/sketch"
+        api_url = f"{STABILITY_API_BASE}/v2beta/stable-image/control/sketch"
 
         headers = {
             "Authorization": f"Bearer {STABILITY_API_KEY}",
@@ -62,13 +64,19 @@ def generate_from_sketch(image_path: str, prompt: str,
         if english_negative:
             data["negative_prompt"] = english_negative
 
-        # Открываем файл
+        # Набросок из памяти (telegram_files.download) или с диска
+        if isinstance(image, str):
+            with open(image, 'rb') as f:
+                image_bytes = f.read()
+        else:
+            image_bytes = image.getvalue()
+
         files = {
-            "image": open(image_path, 'rb')
+            "image": ("sketch.png", image_bytes, "image/png")
         }
 
         # Отправляем запрос
-        response = requests.post(
+        response = get_session(STABILITY).post(
             api_url,
             headers=headers,
             files=files,
@@ -76,28 +84,23 @@ def generate_from_sketch(image_path: str, prompt: str,
             timeout=60
         )
 
-        # Закрываем файл
-        files["image"].close()
-
         if response.status_code != 200:
             error_msg = response.text
-            print(f"[ERROR] Sketch API error: {response.status_code}")
-            print(f"[ERROR] Response: {error_msg}")
+            logger.error("Sketch API error: %s", response.status_code)
+            logger.error("Response: %.500s", error_msg)
             return f"Ошибка генерации: {response.status_code}. {error_msg}"
 
         # Проверяем результат
         finish_reason = response.headers.get("finish-reason")
         if finish_reason == 'CONTENT_FILTERED':
-            print(f"[ERROR] Content filtered by NSFW classifier")
+            logger.error("Content filtered by NSFW classifier")
             return "Изображение отклонено фильтром NSFW"
 
         image_bytes = response.content
-        print(f"[OK] Sketch generation complete! Size: {len(image_bytes)} bytes")
+        logger.info("Sketch generation complete! Size: %s bytes", len(image_bytes))
 
         return io.BytesIO(image_bytes)
 
     except Exception as e:
-        print(f"[ERROR] Exception in sketch generation: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Exception in sketch generation: %s", e)
         return f"Ошибка: {str(e)}"
@@ -1,12 +1,369 @@
-from collections import defaultdict
-
-user_state = defaultdict(lambda: {
-    "prompt": "",
-    "images": [],
-    "format": None,
-    "shot": None,
-    "angle": None,
-    "style": None,
-    "lighting": None,
-    "quality": None
-})
+"""
+Состояние диалогов пользователей (user_state)
+
+user_state ведёт себя как defaultdict: user_state[uid] создаёт сессию с
+параметрами по умолчанию, user_state.get(uid, {}) и `uid in user_state`
+её не создают. При этом хранилище ограничено:
+
+- сессии, неактивные дольше SESSION_IDLE_TTL, удаляются;
+- при превышении SESSION_MAX_USERS удаляются давно неактивные сессии (LRU);
+- если изображения в сессиях (BytesIO/bytes) занимают больше SESSION_MEMORY_MB,
+  буферы давно неактивных сессий выносятся на диск в SESSION_CACHE_DIR
+  (имя файла - sha256 содержимого) и заменяются ссылкой SpilledImage.
+  При следующем обращении к сессии изображения загружаются обратно.
+  Сессии пользователей с задачей в очереди или в работе (jobs.py) не
+  выносятся и не удаляются: задача держит ссылку на словарь сессии и
+  читает его напрямую.
+
+Проверка лимитов выполняется в фоновом потоке, запись на диск - без
+удержания блокировки, поэтому обращения к user_state из обработчиков
+не ждут дисковых операций.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from io import BytesIO
+
+from settings import (
+    SESSION_IDLE_TTL, SESSION_MAX_USERS, SESSION_MEMORY_MB,
+    SESSION_SPILL_AFTER, SESSION_CACHE_DIR
+)
+import log
+
+logger = log.get_logger(__name__)
+
+SWEEP_INTERVAL = 30  # Как часто проверять лимиты хранилища (сек)
+DISK_SWEEP_INTERVAL = 600  # Как часто удалять старые файлы из SESSION_CACHE_DIR (сек)
+SPILL_MIN_BYTES = 64 * 1024  # Буферы меньше этого размера остаются в памяти
+
+
+def _new_session():
+    return {
+        "prompt": "",
+        "images": [],
+        "format": None,
+        "shot": None,
+        "angle": None,
+        "style": None,
+        "lighting": None,
+        "quality": None
+    }
+
+
+class SpilledImage:
+    """Ссылка на буфер изображения, вынесенный на диск"""
+
+    __slots__ = ("key", "size", "is_bytes")
+
+    def __init__(self, key: str, size: int, is_bytes: bool):
+        self.key = key
+        self.size = size
+        self.is_bytes = is_bytes
+
+    def __repr__(self):
+        return f"SpilledImage({self.key[:12]}, {self.size} bytes)"
+
+
+def _buffer_size(value) -> int:
+    if isinstance(value, BytesIO):
+        with value.getbuffer() as view:
+            return view.nbytes
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    return 0
+
+
+def _cache_path(key: str) -> str:
+    return os.path.join(SESSION_CACHE_DIR, key[:2], key)
+
+
+def _spill(value):
+    """Сохраняет буфер на диск и возвращает SpilledImage (или исходное значение)"""
+    size = _buffer_size(value)
+    if size < SPILL_MIN_BYTES:
+        return value
+
+    data = value.getvalue() if isinstance(value, BytesIO) else bytes(value)
+    key = hashlib.sha256(data).hexdigest()
+    path = _cache_path(key)
+
+    if os.path.exists(path):
+        os.utime(path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    return SpilledImage(key, size, not isinstance(value, BytesIO))
+
+
+def _restore(ref: SpilledImage):
+    """Загружает буфер с диска (None если файл уже удалён)"""
+    try:
+        with open(_cache_path(ref.key), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        logger.warning("Spilled session image not found: %s", ref.key)
+        return None
+    return data if ref.is_bytes else BytesIO(data)
+
+
+def _map_buffers(session: dict, func):
+    """
+    Применяет func к изображениям сессии (значения и элементы списков)
+
+    Списки заменяются новыми, а не изменяются на месте: обработчики и
+    задачи очереди, которые уже получили ссылку на старый список, не
+    увидят подмены.
+    """
+    for key, value in list(session.items()):
+        if isinstance(value, list):
+            if any(isinstance(item, (BytesIO, bytes, bytearray, SpilledImage)) for item in value):
+                items = [func(item) for item in value]
+                session[key] = [item for item in items if item is not None]
+        elif isinstance(value, (BytesIO, bytes, bytearray, SpilledImage)):
+            session[key] = func(value)
+
+
+def _spill_values(items: list) -> dict:
+    """
+    Выносит на диск изображения из снимка сессии (вызывается без блокировки)
+
+    Returns:
+        {ключ: (старое значение, снимок старого списка или None, новое значение)}
+    """
+    changes = {}
+    for key, value in items:
+        if isinstance(value, list):
+            if any(isinstance(item, (BytesIO, bytes, bytearray)) for item in value):
+                snapshot = list(value)
+                changes[key] = (value, snapshot, [_spill(item) for item in snapshot])
+        elif isinstance(value, (BytesIO, bytes, bytearray)):
+            changes[key] = (value, None, _spill(value))
+    return changes
+
+
+def _session_bytes(session: dict) -> int:
+    total = 0
+    for value in session.values():
+        if isinstance(value, list):
+            total += sum(_buffer_size(item) for item in value)
+        else:
+            total += _buffer_size(value)
+    return total
+
+
+def _has_active_jobs(uid) -> bool:
+    """Есть ли у пользователя задача генерации в очереди или в работе"""
+    import jobs
+    return jobs.generation_queue.user_jobs(uid) > 0
+
+
+class SessionStore(MutableMapping):
+    """Ограниченное хранилище сессий пользователей (см. описание модуля)"""
+
+    def __init__(self, idle_ttl: int, max_sessions: int, memory_budget: int, spill_after: int):
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.memory_budget = memory_budget
+        self.spill_after = spill_after
+
+        self._sessions = OrderedDict()  # uid -> dict, от давно неактивных к недавним
+        self._last_access = {}
+        self._spilled = set()  # uid сессий, в которых есть SpilledImage
+        self._lock = threading.RLock()
+        self._next_sweep = time.monotonic() + SWEEP_INTERVAL
+        self._next_disk_sweep = time.monotonic() + DISK_SWEEP_INTERVAL
+        self._sweeping = False
+        self._bytes_in_memory = 0
+        self._evicted = 0
+        self._spills = 0
+
+    # ===== Интерфейс словаря =====
+
+    def __getitem__(self, uid):
+        with self._lock:
+            session = self._sessions.get(uid)
+            if session is None:
+                session = _new_session()
+                self._sessions[uid] = session
+            self._touch(uid)
+
+            if uid in self._spilled:
+                _map_buffers(session, lambda value: _restore(value) if isinstance(value, SpilledImage) else value)
+                self._spilled.discard(uid)
+
+        self._maybe_sweep()
+        return session
+
+    def __setitem__(self, uid, session):
+        with self._lock:
+            self._sessions[uid] = session
+            self._spilled.discard(uid)
+            self._touch(uid)
+        self._maybe_sweep()
+
+    def __delitem__(self, uid):
+        with self._lock:
+            del self._sessions[uid]
+            self._last_access.pop(uid, None)
+            self._spilled.discard(uid)
+
+    def __contains__(self, uid):
+        return uid in self._sessions
+
+    def __iter__(self):
+        return iter(list(self._sessions))
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, uid, default=None):
+        # В отличие от user_state[uid], не создаёт новую сессию
+        if uid not in self._sessions:
+            return default
+        return self[uid]
+
+    def pop(self, uid, *default):
+        with self._lock:
+            if uid not in self._sessions:
+                if default:
+                    return default[0]
+                raise KeyError(uid)
+            session = self[uid]
+            del self[uid]
+            return session
+
+    # ===== Ограничения хранилища =====
+
+    def _touch(self, uid):
+        self._sessions.move_to_end(uid)
+        self._last_access[uid] = time.monotonic()
+
+    def _maybe_sweep(self):
+        # Проверка лимитов пишет на диск - выполняем её в фоне, а не в обработчике
+        with self._lock:
+            if self._sweeping or time.monotonic() < self._next_sweep:
+                return
+            self._sweeping = True
+        threading.Thread(target=self._sweep_in_background, name="session-sweep", daemon=True).start()
+
+    def _sweep_in_background(self):
+        try:
+            self.sweep()
+        except Exception as e:
+            logger.error("Session sweep failed: %s", e)
+        finally:
+            self._sweeping = False
+
+    def sweep(self):
+        """Удаляет неактивные сессии и выносит изображения на диск при превышении бюджета памяти"""
+        now = time.monotonic()
+        evicted = 0
+        spilled = 0
+
+        with self._lock:
+            self._next_sweep = now + SWEEP_INTERVAL
+
+            # Неактивные дольше idle_ttl и лишние сверх max_sessions (от давно неактивных)
+            for uid in list(self._sessions):
+                idle = now - self._last_access.get(uid, now)
+                if idle < self.idle_ttl and len(self._sessions) <= self.max_sessions:
+                    break
+                if _has_active_jobs(uid):
+                    continue
+                del self[uid]
+                evicted += 1
+
+            # Бюджет памяти: кандидаты на вынос - давно неактивные сессии
+            sizes = {uid: _session_bytes(session) for uid, session in self._sessions.items()}
+            total = sum(sizes.values())
+            excess = total - self.memory_budget
+            candidates = []
+            for uid, session in self._sessions.items():
+                if excess <= 0:
+                    break
+                if now - self._last_access.get(uid, now) < self.spill_after:
+                    break  # Дальше только недавно активные сессии - их не трогаем
+                if not sizes[uid] or _has_active_jobs(uid):
+                    continue
+                candidates.append((uid, session, self._last_access.get(uid), list(session.items())))
+                excess -= sizes[uid]
+
+        # Запись на диск - без блокировки
+        for uid, session, accessed, items in candidates:
+            try:
+                changes = _spill_values(items)
+            except OSError as e:
+                logger.error("Failed to spill session images to disk: %s", e)
+                break
+
+            with self._lock:
+                # Сессию успели открыть или по ней поставлена задача - оставляем в памяти
+                if self._sessions.get(uid) is not session or self._last_access.get(uid) != accessed \
+                        or _has_active_jobs(uid):
+                    continue
+                for key, (old, snapshot, new) in changes.items():
+                    if session.get(key) is old and (snapshot is None or old == snapshot):
+                        session[key] = new
+                self._spilled.add(uid)
+                total -= sizes[uid] - _session_bytes(session)
+                spilled += 1
+
+        with self._lock:
+            self._bytes_in_memory = total
+            self._evicted += evicted
+            self._spills += spilled
+
+        if evicted or spilled:
+            logger.info("Sessions evicted: %s, spilled to disk: %s, live: %s, in memory: %s KB", evicted, spilled, len(self._sessions), total // 1024)
+
+        if now >= self._next_disk_sweep:
+            self._next_disk_sweep = now + DISK_SWEEP_INTERVAL
+            self._sweep_disk()
+
+    def _sweep_disk(self):
+        """Удаляет файлы изображений, к которым не обращались дольше idle_ttl"""
+        if not os.path.isdir(SESSION_CACHE_DIR):
+            return
+        with self._lock:
+            referenced = set()
+            for uid in self._spilled:
+                for value in self._sessions.get(uid, {}).values():
+                    items = value if isinstance(value, list) else [value]
+                    referenced.update(item.key for item in items if isinstance(item, SpilledImage))
+
+        cutoff = time.time() - self.idle_ttl
+        for root, _, files in os.walk(SESSION_CACHE_DIR):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if name not in referenced and os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+    def stats(self) -> dict:
+        """Метрики хранилища: живые сессии, байты изображений в памяти, вытеснения"""
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "spilled_sessions": len(self._spilled),
+                "bytes_in_memory": self._bytes_in_memory,
+                "evicted": self._evicted,
+                "spills": self._spills,
+            }
+
+
+user_state = SessionStore(
+    idle_ttl=SESSION_IDLE_TTL,
+    max_sessions=SESSION_MAX_USERS,
+    memory_budget=SESSION_MEMORY_MB * 1024 * 1024,
+    spill_after=SESSION_SPILL_AFTER,
+)
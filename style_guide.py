@@ -2,10 +2,13 @@
 Модуль для Style Guide через Stability.ai API
 Генерирует новое изображение на основе стиля референсного изображения
 """
-import requests
 import io
-from settings import STABILITY_API_KEY
+from settings import STABILITY_API_KEY, STABILITY_API_BASE
+from providers import get_session, STABILITY
 from ai_tools import translate_to_english
+import log
+
+logger = log.get_logger(__name__)
 
 
 def generate_with_style_guide(image_path: str, prompt: str,
@@ -28,25 +31,25 @@ def generate_with_style_guide(image_path: str, prompt: str,
         BytesIO объект с результатом или строка с ошибкой
     """
     try:
-        print(f"[INFO] Starting style guide generation...")
-        print(f"[INFO] Style image: {image_path}")
-        print(f"[INFO] Prompt: {prompt}")
-        print(f"[INFO] Aspect ratio: {aspect_ratio}")
-        print(f"[INFO] Fidelity: {fidelity}")
+        logger.info("Starting style guide generation...")
+        logger.debug("Style image: %s", image_path)
+        logger.debug("Prompt: %s", prompt)
+        logger.debug("Aspect ratio: %s", aspect_ratio)
+        logger.debug("Fidelity: %s", fidelity)
 
         # Переводим промпт на английский
-        print(f"[INFO] Translating prompt to English...")
+        logger.info("Translating prompt to English...")
         english_prompt = translate_to_english(prompt)
-        print(f"[OK] Translated prompt: {english_prompt}")
+        logger.debug("Translated prompt: %s", english_prompt)
 
         # Переводим negative prompt если указан
         english_negative = ""
         if negative_prompt:
-            print(f"[INFO] Translating negative prompt to English...")
+            logger.info("Translating negative prompt to English...")
             english_negative = translate_to_english(negative_prompt)
-            print(f"[OK] Translated negative prompt: {english_negative}")
+            logger.debug("Translated negative prompt: %s", english_negative)
 
-        api_url = "https://api.stability.ai/v2beta/stable-image/control/style"
+        api_url = f"{STABILITY_API_BASE}/v2beta/stable-image/control/style"
 
         headers = {
             "Authorization": f"Bearer {STABILITY_API_KEY}",
@@ -72,7 +75,7 @@ def generate_with_style_guide(image_path: str, prompt: str,
         }
 
         # Отправляем запрос
-        response = requests.post(
+        response = get_session(STABILITY).post(
             api_url,
             headers=headers,
             files=files,
@@ -85,23 +88,21 @@ def generate_with_style_guide(image_path: str, prompt: str,
 
         if response.status_code != 200:
             error_msg = response.text
-            print(f"[ERROR] Style Guide API error: {response.status_code}")
-            print(f"[ERROR] Response: {error_msg}")
+            logger.error("Style Guide API error: %s", response.status_code)
+            logger.error("Response: %.500s", error_msg)
             return f"Ошибка генерации: {response.status_code}. {error_msg}"
 
         # Проверяем результат
         finish_reason = response.headers.get("finish-reason")
         if finish_reason == 'CONTENT_FILTERED':
-            print(f"[ERROR] Content filtered by NSFW classifier")
+            logger.error("Content filtered by NSFW classifier")
             return "Изображение отклонено фильтром NSFW"
 
         image_bytes = response.content
-        print(f"[OK] Style guide generation complete! Size: {len(image_bytes)} bytes")
+        logger.info("Style guide generation complete! Size: %s bytes", len(image_bytes))
 
         return io.BytesIO(image_bytes)
 
     except Exception as e:
-        print(f"[ERROR] Exception in style guide: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Exception in style guide: %s", e)
         return f"Ошибка: {str(e)}"
@@ -1,9 +1,12 @@
 """
 Модуль для Style Transfer через Stability.ai API
 """
-import requests
 import io
-from settings import STABILITY_API_KEY
+from settings import STABILITY_API_KEY, STABILITY_API_BASE
+from providers import get_session, STABILITY
+import log
+
+logger = log.get_logger(__name__)
 
 
 def apply_style_transfer(init_image_path: str, style_image_path: str,
@@ -29,14 +32,14 @@ def apply_style_transfer(init_image_path: str, style_image_path: str,
         BytesIO объект с результатом или строка с ошибкой
     """
     try:
-        print(f"[INFO] Starting style transfer...")
-        print(f"[INFO] Init image: {init_image_path}")
-        print(f"[INFO] Style image: {style_image_path}")
-        print(f"[INFO] Style strength: {style_strength}")
-        print(f"[INFO] Composition fidelity: {composition_fidelity}")
-        print(f"[INFO] Change strength: {change_strength}")
+        logger.info("Starting style transfer...")
+        logger.debug("Init image: %s", init_image_path)
+        logger.debug("Style image: %s", style_image_path)
+        logger.debug("Style strength: %s", style_strength)
+        logger.debug("Composition fidelity: %s", composition_fidelity)
+        logger.debug("Change strength: %s", change_strength)
 
-        api_url = "https://api.stability.ai/v2beta/stable-image/control/style"
+        api_url = f"{STABILITY_API_BASE}/v2beta/stable-image/control/style"
 
         headers = {
             "Authorization": f"Bearer {STABILITY_API_KEY}",
@@ -65,7 +68,7 @@ def apply_style_transfer(init_image_path: str, style_image_path: str,
         }
 
         # Отправляем запрос
-        response = requests.post(
+        response = get_session(STABILITY).post(
             api_url,
             headers=headers,
             files=files,
@@ -79,23 +82,21 @@ def apply_style_transfer(init_image_path: str, style_image_path: str,
 
         if response.status_code != 200:
             error_msg = response.text
-            print(f"[ERROR] Style transfer API error: {response.status_code}")
-            print(f"[ERROR] Response: {error_msg}")
+            logger.error("Style transfer API error: %s", response.status_code)
+            logger.error("Response: %.500s", error_msg)
             return f"Ошибка переноса стиля: {response.status_code}. {error_msg}"
 
         # Проверяем результат
         finish_reason = response.headers.get("finish-reason")
         if finish_reason == 'CONTENT_FILTERED':
-            print(f"[ERROR] Content filtered by NSFW classifier")
+            logger.error("Content filtered by NSFW classifier")
             return "Изображение отклонено фильтром NSFW"
 
         image_bytes = response.content
-        print(f"[OK] Style transfer complete! Size: {len(image_bytes)} bytes")
+        logger.info("Style transfer complete! Size: %s bytes", len(image_bytes))
 
         return io.BytesIO(image_bytes)
 
     except Exception as e:
-        print(f"[ERROR] Exception in style transfer: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Exception in style transfer: %s", e)
         return f"Ошибка: {str(e)}"
@@ -4,6 +4,9 @@
 """
 from io import BytesIO
 from nano_banana_pro_api import generate_with_nano_banana_pro
+import log
+
+logger = log.get_logger(__name__)
 
 
 def apply_style_transfer_imagen(init_image: BytesIO, style_image: BytesIO,
@@ -21,9 +24,9 @@ def apply_style_transfer_imagen(init_image: BytesIO, style_image: BytesIO,
     Returns:
         Список BytesIO объектов с результатом или raises Exception
     """
-    print(f"[Style Transfer Imagen] Starting...")
-    print(f"[Style Transfer Imagen] Aspect ratio: {aspect_ratio}")
-    print(f"[Style Transfer Imagen] Custom prompt: {prompt if prompt else 'None'}")
+    logger.info("Starting...")
+    logger.debug("Aspect ratio: %s", aspect_ratio)
+    logger.debug("Custom prompt: %s", prompt if prompt else 'None')
 
     # Формируем промпт для style transfer
     if prompt:
@@ -38,7 +41,7 @@ def apply_style_transfer_imagen(init_image: BytesIO, style_image: BytesIO,
             "Preserve the subject and composition while adopting the aesthetic of the style reference."
         )
 
-    print(f"[Style Transfer Imagen] Full prompt: {full_prompt[:100]}...")
+    logger.debug("Full prompt: %s...", full_prompt[:100])
 
     # Используем оба изображения как референсы
     reference_images = [init_image, style_image]
@@ -54,7 +57,7 @@ def apply_style_transfer_imagen(init_image: BytesIO, style_image: BytesIO,
     if not result:
         raise Exception("Failed to generate style transfer image")
 
-    print(f"[Style Transfer Imagen] Success! Generated {len(result)} image(s)")
+    logger.info("Success! Generated %s image(s)", len(result))
     return result
 
 
@@ -71,9 +74,9 @@ def generate_with_style_guide_imagen(style_image: BytesIO, prompt: str,
     Returns:
         Список BytesIO объектов с результатом или raises Exception
     """
-    print(f"[Style Guide Imagen] Starting...")
-    print(f"[Style Guide Imagen] Prompt: {prompt}")
-    print(f"[Style Guide Imagen] Aspect ratio: {aspect_ratio}")
+    logger.info("Starting...")
+    logger.debug("Prompt: %s", prompt)
+    logger.debug("Aspect ratio: %s", aspect_ratio)
 
     # Формируем промпт для style guide
     full_prompt = (
@@ -81,7 +84,7 @@ def generate_with_style_guide_imagen(style_image: BytesIO, prompt: str,
         f"and visual aesthetic from the reference image to create this new image."
     )
 
-    print(f"[Style Guide Imagen] Full prompt: {full_prompt[:100]}...")
+    logger.debug("Full prompt: %s...", full_prompt[:100])
 
     # Используем одно изображение как референс стиля
     reference_images = [style_image]
@@ -97,5 +100,5 @@ def generate_with_style_guide_imagen(style_image: BytesIO, prompt: str,
     if not result:
         raise Exception("Failed to generate style guide image")
 
-    print(f"[Style Guide Imagen] Success! Generated {len(result)} image(s)")
+    logger.info("Success! Generated %s image(s)", len(result))
     return result
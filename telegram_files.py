@@ -0,0 +1,249 @@
+"""
+Загрузка файлов Telegram с кешированием и повторная отправка по file_id
+
+download() скачивает фото из сообщения один раз и отдаёт его из кеша при
+повторных операциях с тем же изображением (редактирование, стиль, маска,
+повторная загрузка того же фото). Ключ - file_unique_id, он одинаков для
+одного файла у всех пользователей и ботов, в отличие от file_id.
+
+Уровни кеша:
+- память: LRU на TG_FILE_CACHE_MB;
+- диск: TG_FILE_CACHE_DIR (<id[:2]>/<id>), самые старые файлы удаляются
+  при превышении TG_FILE_CACHE_DISK_MB.
+
+Одновременные запросы одного файла (например, альбом, который обработчики
+получают параллельно) ждут одну загрузку, а не скачивают его каждый сам.
+
+Отправка: send_photo() возвращает Message, из которого sent_file_id()
+берёт file_id. Он сохраняется в истории (image_library) и индексе GCS
+(gcs_index), и send_library_images() показывает уже отправленные
+изображения по file_id - Telegram не скачивает их заново по URL.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from image_buffer import ImageBuffer
+from settings import TG_FILE_CACHE_MB, TG_FILE_CACHE_DIR, TG_FILE_CACHE_DISK_MB
+import log
+
+logger = log.get_logger(__name__)
+
+PURGE_INTERVAL = 600  # Как часто проверять размер кеша на диске (сек)
+
+_memory = OrderedDict()  # file_unique_id -> bytes
+_memory_bytes = 0
+_inflight = {}  # file_unique_id -> asyncio.Task
+_next_purge = 0.0
+_stats = {"memory_hits": 0, "disk_hits": 0, "downloads": 0, "shared": 0}
+
+
+def select_size(photo_sizes, size="largest"):
+    """
+    Выбирает вариант размера фото
+
+    Args:
+        photo_sizes: update.message.photo (PhotoSize от меньшего к большему)
+        size: "largest", "smallest" или число - длинная сторона в пикселях, как
+              в размерах Telegram 320/800/1280 (берётся самый маленький вариант,
+              у которого длинная сторона не меньше, иначе самый большой)
+    """
+    if size == "largest":
+        return photo_sizes[-1]
+    if size == "smallest":
+        return photo_sizes[0]
+    for photo in photo_sizes:
+        if max(photo.width, photo.height) >= size:
+            return photo
+    return photo_sizes[-1]
+
+
+def _path(key: str) -> str:
+    return os.path.join(TG_FILE_CACHE_DIR, key[:2], key)
+
+
+def _memory_get(key):
+    data = _memory.get(key)
+    if data is not None:
+        _memory.move_to_end(key)
+    return data
+
+
+def _memory_put(key, data: bytes):
+    global _memory_bytes
+    if key not in _memory:
+        _memory_bytes += len(data)
+    _memory[key] = data
+    while _memory and _memory_bytes > TG_FILE_CACHE_MB * 1024 * 1024:
+        _, evicted = _memory.popitem(last=False)
+        _memory_bytes -= len(evicted)
+
+
+def _disk_read(key):
+    try:
+        path = _path(key)
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)  # Для вытеснения по давности использования
+        return data
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.warning("Telegram file cache read failed: %s", e)
+        return None
+
+
+def _disk_write(key, data: bytes):
+    global _next_purge
+    try:
+        path = _path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Telegram file cache write failed: %s", e)
+        return
+
+    if time.monotonic() >= _next_purge:
+        _next_purge = time.monotonic() + PURGE_INTERVAL
+        purge_disk()
+
+
+def purge_disk():
+    """Удаляет самые давно использованные файлы сверх TG_FILE_CACHE_DISK_MB"""
+    files = []
+    for root, _, names in os.walk(TG_FILE_CACHE_DIR):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+    budget = TG_FILE_CACHE_DISK_MB * 1024 * 1024
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    for _, size, path in sorted(files):
+        if total <= budget:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    if removed:
+        logger.info("Telegram file cache purged: %s files", removed)
+
+
+async def _fetch(photo) -> bytes:
+    key = photo.file_unique_id
+    loop = asyncio.get_running_loop()
+
+    data = await loop.run_in_executor(None, _disk_read, key)
+    if data is not None:
+        _stats["disk_hits"] += 1
+    else:
+        file = await photo.get_file()
+        data = bytes(await file.download_as_bytearray())
+        _stats["downloads"] += 1
+        await loop.run_in_executor(None, _disk_write, key, data)
+
+    _memory_put(key, data)
+    return data
+
+
+async def download(photo, size="largest") -> ImageBuffer:
+    """
+    Скачивает фото (или берёт из кеша)
+
+    Args:
+        photo: PhotoSize / Document / Sticker или список PhotoSize (update.message.photo)
+        size: Вариант размера для списка PhotoSize (см. select_size)
+
+    Returns:
+        Новый ImageBuffer над общими bytes - позиция чтения у каждого вызова своя
+    """
+    if isinstance(photo, (list, tuple)):
+        photo = select_size(photo, size)
+    key = photo.file_unique_id
+
+    data = _memory_get(key)
+    if data is not None:
+        _stats["memory_hits"] += 1
+        return ImageBuffer(data)
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch(photo))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        _stats["shared"] += 1
+
+    # shield: отмена одного ожидающего не прерывает загрузку для остальных
+    return ImageBuffer(await asyncio.shield(task))
+
+
+def stats() -> dict:
+    """Попадания в кеш, загрузки и размер кеша в памяти"""
+    return dict(_stats, memory_entries=len(_memory), memory_bytes=_memory_bytes)
+
+
+# ===== Отправка =====
+
+def sent_file_id(message):
+    """file_id самого большого варианта фото из отправленного сообщения (или None)"""
+    if message is None or not message.photo:
+        return None
+    return message.photo[-1].file_id
+
+
+async def send_library_images(bot, chat_id: int, images: list, captions: list = None):
+    """
+    Отправляет изображения библиотеки (gcs_index) одним альбомом
+
+    Изображения с известным file_id отправляются по нему, остальные - по
+    публичному URL; file_id, полученные в ответ, сохраняются в индексе.
+    Если Telegram не принял сохранённый file_id, альбом отправляется по URL.
+    """
+    from telegram import InputMediaPhoto
+    from telegram.error import BadRequest
+    import gcs_index
+
+    images = images[:10]
+    if captions is None:
+        captions = [img['name'] for img in images]
+
+    def media(use_file_ids):
+        return [
+            InputMediaPhoto(media=(img.get('file_id') if use_file_ids else None) or img['url'], caption=caption)
+            for img, caption in zip(images, captions)
+        ]
+
+    use_file_ids = any(img.get('file_id') for img in images)
+    try:
+        messages = await bot.send_media_group(chat_id, media(use_file_ids))
+    except BadRequest as e:
+        if not use_file_ids:
+            raise
+        logger.warning("Cached file_id rejected, resending by URL: %s", e)
+        use_file_ids = False
+        messages = await bot.send_media_group(chat_id, media(False))
+
+    file_ids = {
+        img['blob_name']: sent_file_id(message)
+        for img, message in zip(images, messages)
+        if not (use_file_ids and img.get('file_id')) and sent_file_id(message)
+    }
+    try:
+        gcs_index.set_file_ids(file_ids)
+    except Exception as e:
+        logger.error("Failed to save file_id: %s", e)
+    return messages
@@ -1,16 +1,105 @@
 """
 Модуль для отслеживания лимитов генераций пользователей
+
+Данные хранятся в SQLite (db.py): одна строка на пользователя, поэтому
+проверка и списание генерации - одно обновление по первичному ключу
+вне зависимости от количества пользователей. При первом запуске данные
+переносятся из user_limits.json.
 """
 import json
 import os
 from datetime import datetime
 
+import db
+import log
+
+logger = log.get_logger(__name__)
+
 LIMITS_FILE = "user_limits.json"
 FREE_GENERATIONS_LIMIT = 10
+PREMIUM_REMAINING = 999999  # Неограниченно для премиум пользователей
+REFERRAL_BONUS = 5
+
+
+def _init_schema(conn):
+    """Создаёт таблицы лимитов и переносит данные из JSON (один раз)"""
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS user_limits (
+            user_id INTEGER PRIMARY KEY,
+            used INTEGER NOT NULL DEFAULT 0,
+            first_generation TEXT,
+            referrer_id INTEGER,
+            referral_bonus_given INTEGER NOT NULL DEFAULT 0,
+            premium INTEGER NOT NULL DEFAULT 0,
+            premium_since TEXT
+        );
+        CREATE TABLE IF NOT EXISTS user_referrals (
+            referrer_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (referrer_id, user_id)
+        );
+    """)
+
+    if db.get_meta("user_limits_migrated") is None:
+        _migrate_from_json(conn)
+
+
+def _migrate_from_json(conn):
+    """Переносит данные из user_limits.json в SQLite"""
+    limits = load_limits()
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for user_key, data in limits.items():
+            conn.execute(
+                """INSERT OR REPLACE INTO user_limits
+                   (user_id, used, first_generation, referrer_id, referral_bonus_given, premium, premium_since)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    int(user_key),
+                    data.get("used", 0),
+                    data.get("first_generation"),
+                    data.get("referrer_id"),
+                    1 if data.get("referral_bonus_given") else 0,
+                    1 if data.get("premium") else 0,
+                    data.get("premium_since"),
+                )
+            )
+            for ref_id in data.get("referrals", []):
+                conn.execute(
+                    "INSERT OR IGNORE INTO user_referrals (referrer_id, user_id) VALUES (?, ?)",
+                    (int(user_key), int(ref_id))
+                )
+        db.set_meta("user_limits_migrated", datetime.now().isoformat())
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    if limits:
+        logger.info("Migrated %s users from %s to SQLite", len(limits), LIMITS_FILE)
+
+
+def _conn():
+    db.ensure_schema("user_limits", _init_schema)
+    return db.get_connection()
+
+
+def _ensure_user(conn, user_id, referrer_id=None):
+    conn.execute(
+        "INSERT OR IGNORE INTO user_limits (user_id, referrer_id) VALUES (?, ?)",
+        (user_id, referrer_id)
+    )
+
+
+def _remaining(row):
+    if row["premium"]:
+        return PREMIUM_REMAINING
+    return FREE_GENERATIONS_LIMIT - row["used"]
 
 
 def load_limits():
-    """Загружает данные о лимитах из файла"""
+    """Загружает данные о лимитах из старого JSON-файла (используется для миграции)"""
     if os.path.exists(LIMITS_FILE):
         try:
             with open(LIMITS_FILE, 'r', encoding='utf-8') as f:
@@ -20,78 +109,96 @@ def load_limits():
     return {}
 
 
-def save_limits(limits_data):
-    """Сохраняет данные о лимитах в файл"""
-    with open(LIMITS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(limits_data, f, ensure_ascii=False, indent=2)
-
-
 def get_user_generations(user_id):
     """Получает количество использованных генераций пользователя"""
-    limits = load_limits()
-    user_key = str(user_id)
-
-    if user_key not in limits:
-        limits[user_key] = {
-            "used": 0,
-            "first_generation": None
-        }
-        save_limits(limits)
-
-    return limits[user_key]["used"]
+    row = _conn().execute("SELECT used FROM user_limits WHERE user_id = ?", (user_id,)).fetchone()
+    return row["used"] if row else 0
 
 
 def can_generate(user_id):
     """Проверяет, может ли пользователь генерировать изображение"""
-    limits = load_limits()
-    user_key = str(user_id)
+    row = _conn().execute("SELECT used, premium FROM user_limits WHERE user_id = ?", (user_id,)).fetchone()
 
-    # Премиум пользователи имеют неограниченные генерации
-    if user_key in limits and limits[user_key].get("premium", False):
-        return True, 999999  # Неограниченно
+    if row is None:
+        return True, FREE_GENERATIONS_LIMIT
 
-    used = get_user_generations(user_id)
-    remaining = FREE_GENERATIONS_LIMIT - used
+    remaining = _remaining(row)
     return remaining > 0, remaining
 
 
-def use_generation(user_id):
-    """Использует одну генерацию"""
-    limits = load_limits()
-    user_key = str(user_id)
+def _consume(conn, user_id, check_limit, count=1):
+    """
+    Списывает count генераций внутри открытой транзакции
 
-    if user_key not in limits:
-        limits[user_key] = {
-            "used": 0,
-            "first_generation": None,
-            "referrer_id": None,
-            "referrals": []
-        }
+    Returns:
+        (списано ли, остаток)
+    """
+    _ensure_user(conn, user_id)
 
-    # Проверяем, это первая генерация?
-    is_first_generation = limits[user_key]["first_generation"] is None
+    row = conn.execute("SELECT first_generation FROM user_limits WHERE user_id = ?", (user_id,)).fetchone()
+    is_first_generation = row["first_generation"] is None
 
-    # Записываем время первой генерации
-    if is_first_generation:
-        limits[user_key]["first_generation"] = datetime.now().isoformat()
+    limit_clause = " AND (premium = 1 OR used + ? <= ?)" if check_limit else ""
+    params = [count, datetime.now().isoformat(), user_id]
+    if check_limit:
+        params += [count, FREE_GENERATIONS_LIMIT]
 
-    limits[user_key]["used"] += 1
-    save_limits(limits)
+    cursor = conn.execute(
+        "UPDATE user_limits SET used = used + ?, first_generation = COALESCE(first_generation, ?) "
+        "WHERE user_id = ?" + limit_clause,
+        params
+    )
+    consumed = cursor.rowcount == 1
 
     # Если это первая генерация, начисляем бонус пригласившему
-    if is_first_generation:
-        reward_referrer(user_id)
+    if consumed and is_first_generation:
+        _reward_referrer(conn, user_id)
+
+    row = conn.execute("SELECT used, premium FROM user_limits WHERE user_id = ?", (user_id,)).fetchone()
+    return consumed, _remaining(row)
+
+
+def try_use_generation(user_id, count=1):
+    """
+    Атомарно проверяет лимит и списывает count генераций (например, на N вариантов)
+
+    В отличие от пары can_generate() + use_generation(), две параллельные
+    задачи не могут обе пройти проверку на последней генерации.
+
+    Returns:
+        (True, остаток) если генерации списаны, иначе (False, остаток)
+    """
+    _conn()
+    with db.transaction() as conn:
+        return _consume(conn, user_id, check_limit=True, count=count)
+
+
+def refund_generation(user_id, count=1):
+    """Возвращает списанные генерации (если генерация не удалась)"""
+    _conn()
+    with db.transaction() as conn:
+        conn.execute(
+            "UPDATE user_limits SET used = MAX(0, used - ?) WHERE user_id = ?",
+            (count, user_id)
+        )
+        row = conn.execute("SELECT used, premium FROM user_limits WHERE user_id = ?", (user_id,)).fetchone()
+    return _remaining(row) if row else FREE_GENERATIONS_LIMIT
+
+
+def use_generation(user_id, count=1):
+    """Использует count генераций (по умолчанию одну)"""
+    _conn()
+    with db.transaction() as conn:
+        _, remaining = _consume(conn, user_id, check_limit=False, count=count)
 
-    remaining = FREE_GENERATIONS_LIMIT - limits[user_key]["used"]
     return remaining
 
 
 def get_user_stats(user_id):
     """Получает статистику пользователя"""
-    limits = load_limits()
-    user_key = str(user_id)
+    row = _conn().execute("SELECT * FROM user_limits WHERE user_id = ?", (user_id,)).fetchone()
 
-    if user_key not in limits:
+    if row is None:
         return {
             "used": 0,
             "remaining": FREE_GENERATIONS_LIMIT,
@@ -99,196 +206,156 @@ def get_user_stats(user_id):
             "premium": False
         }
 
-    used = limits[user_key]["used"]
-    is_premium = limits[user_key].get("premium", False)
-
     return {
-        "used": used,
-        "remaining": 999999 if is_premium else (FREE_GENERATIONS_LIMIT - used),
-        "first_generation": limits[user_key].get("first_generation"),
-        "premium": is_premium,
-        "premium_since": limits[user_key].get("premium_since")
+        "used": row["used"],
+        "remaining": _remaining(row),
+        "first_generation": row["first_generation"],
+        "premium": bool(row["premium"]),
+        "premium_since": row["premium_since"]
     }
 
 
 def reset_user_limit(user_id):
     """Сбрасывает лимит пользователя (для админа)"""
-    limits = load_limits()
-    user_key = str(user_id)
-
-    if user_key in limits:
-        limits[user_key] = {
-            "used": 0,
-            "first_generation": None
-        }
-        save_limits(limits)
-        return True
-    return False
+    _conn()
+    with db.transaction() as conn:
+        cursor = conn.execute(
+            "UPDATE user_limits SET used = 0, first_generation = NULL WHERE user_id = ?",
+            (user_id,)
+        )
+    return cursor.rowcount == 1
 
 
 def get_all_users():
     """Получает список всех пользователей с их статистикой (для админа)"""
-    limits = load_limits()
-    users_list = []
-
-    for user_id, data in limits.items():
-        used = data.get("used", 0)
-        remaining = FREE_GENERATIONS_LIMIT - used
-        first_gen = data.get("first_generation", "Не было")
-        referrals = data.get("referrals", [])
-        referrals_count = len(referrals)
-
-        users_list.append({
-            "user_id": user_id,
-            "used": used,
-            "remaining": remaining,
-            "first_generation": first_gen,
-            "referrals_count": referrals_count
-        })
-
-    return users_list
+    rows = _conn().execute("""
+        SELECT u.user_id, u.used, u.first_generation,
+               (SELECT COUNT(*) FROM user_referrals r WHERE r.referrer_id = u.user_id) AS referrals_count
+        FROM user_limits u
+        ORDER BY u.rowid
+    """).fetchall()
+
+    return [
+        {
+            "user_id": str(row["user_id"]),
+            "used": row["used"],
+            "remaining": FREE_GENERATIONS_LIMIT - row["used"],
+            "first_generation": row["first_generation"] or "Не было",
+            "referrals_count": row["referrals_count"]
+        }
+        for row in rows
+    ]
 
 
 def add_generations(user_id, amount):
     """Добавляет генерации пользователю (для админа)"""
-    limits = load_limits()
-    user_key = str(user_id)
+    _conn()
+    with db.transaction() as conn:
+        _ensure_user(conn, user_id)
+        # Уменьшаем количество использованных генераций
+        conn.execute(
+            "UPDATE user_limits SET used = MAX(0, used - ?) WHERE user_id = ?",
+            (amount, user_id)
+        )
+        row = conn.execute("SELECT used FROM user_limits WHERE user_id = ?", (user_id,)).fetchone()
 
-    if user_key not in limits:
-        limits[user_key] = {
-            "used": 0,
-            "first_generation": None,
-            "referrer_id": None,
-            "referrals": []
-        }
-
-    # Уменьшаем количество использованных генераций
-    limits[user_key]["used"] = max(0, limits[user_key]["used"] - amount)
-    save_limits(limits)
-
-    remaining = FREE_GENERATIONS_LIMIT - limits[user_key]["used"]
-    return remaining
+    return FREE_GENERATIONS_LIMIT - row["used"]
 
 
 def set_premium(user_id, is_premium=True):
     """Устанавливает премиум статус пользователю (для админа)"""
-    limits = load_limits()
-    user_key = str(user_id)
-
-    if user_key not in limits:
-        limits[user_key] = {
-            "used": 0,
-            "first_generation": None,
-            "referrer_id": None,
-            "referrals": []
-        }
-
-    limits[user_key]["premium"] = is_premium
-    if is_premium:
-        limits[user_key]["premium_since"] = datetime.now().isoformat()
-    else:
-        limits[user_key].pop("premium_since", None)
-
-    save_limits(limits)
+    _conn()
+    with db.transaction() as conn:
+        _ensure_user(conn, user_id)
+        conn.execute(
+            "UPDATE user_limits SET premium = ?, premium_since = ? WHERE user_id = ?",
+            (1 if is_premium else 0, datetime.now().isoformat() if is_premium else None, user_id)
+        )
     return True
 
 
 def register_referral(user_id, referrer_id):
     """Регистрирует пользователя по реферальной ссылке"""
-    limits = load_limits()
-    user_key = str(user_id)
-    referrer_key = str(referrer_id)
-
     # Нельзя быть своим рефералом
-    if user_key == referrer_key:
+    if str(user_id) == str(referrer_id):
         return False
 
-    # Создаем запись для нового пользователя
-    if user_key not in limits:
-        limits[user_key] = {
-            "used": 0,
-            "first_generation": None,
-            "referrer_id": referrer_id,
-            "referrals": []
-        }
-    else:
-        # Если пользователь уже есть, но у него нет referrer - устанавливаем
-        if limits[user_key].get("referrer_id") is None:
-            limits[user_key]["referrer_id"] = referrer_id
+    _conn()
+    with db.transaction() as conn:
+        row = conn.execute("SELECT referrer_id FROM user_limits WHERE user_id = ?", (user_id,)).fetchone()
+
+        if row is None:
+            # Создаем запись для нового пользователя
+            _ensure_user(conn, user_id, referrer_id)
+        elif row["referrer_id"] is None:
+            # Если пользователь уже есть, но у него нет referrer - устанавливаем
+            conn.execute("UPDATE user_limits SET referrer_id = ? WHERE user_id = ?", (referrer_id, user_id))
         else:
             # У пользователя уже есть реферер
             return False
 
-    # Добавляем в список рефералов пригласившего
-    if referrer_key not in limits:
-        limits[referrer_key] = {
-            "used": 0,
-            "first_generation": None,
-            "referrer_id": None,
-            "referrals": []
-        }
-
-    if user_id not in limits[referrer_key].get("referrals", []):
-        if "referrals" not in limits[referrer_key]:
-            limits[referrer_key]["referrals"] = []
-        limits[referrer_key]["referrals"].append(user_id)
-
-    save_limits(limits)
+        # Добавляем в список рефералов пригласившего
+        _ensure_user(conn, referrer_id)
+        conn.execute(
+            "INSERT OR IGNORE INTO user_referrals (referrer_id, user_id) VALUES (?, ?)",
+            (referrer_id, user_id)
+        )
     return True
 
 
-def reward_referrer(user_id):
-    """Начисляет бонус пригласившему при первой генерации реферала"""
-    limits = load_limits()
-    user_key = str(user_id)
-
-    if user_key not in limits:
-        return None
+def _reward_referrer(conn, user_id):
+    """Начисляет бонус пригласившему внутри открытой транзакции"""
+    row = conn.execute(
+        "SELECT referrer_id, referral_bonus_given FROM user_limits WHERE user_id = ?",
+        (user_id,)
+    ).fetchone()
 
-    referrer_id = limits[user_key].get("referrer_id")
-    if not referrer_id:
+    if row is None or not row["referrer_id"] or row["referral_bonus_given"]:
         return None
 
-    # Проверяем, не начислили ли уже бонус
-    if limits[user_key].get("referral_bonus_given"):
+    referrer_id = row["referrer_id"]
+    exists = conn.execute("SELECT 1 FROM user_limits WHERE user_id = ?", (referrer_id,)).fetchone()
+    if not exists:
         return None
 
-    # Помечаем, что бонус начислен
-    limits[user_key]["referral_bonus_given"] = True
+    # Помечаем, что бонус начислен, и начисляем бонус пригласившему (+5 генераций)
+    conn.execute("UPDATE user_limits SET referral_bonus_given = 1 WHERE user_id = ?", (user_id,))
+    conn.execute(
+        "UPDATE user_limits SET used = MAX(0, used - ?) WHERE user_id = ?",
+        (REFERRAL_BONUS, referrer_id)
+    )
+    return referrer_id
 
-    # Начисляем бонус пригласившему (+5 генераций)
-    referrer_key = str(referrer_id)
-    if referrer_key in limits:
-        limits[referrer_key]["used"] = max(0, limits[referrer_key]["used"] - 5)
-        save_limits(limits)
-        return referrer_id
 
-    return None
+def reward_referrer(user_id):
+    """Начисляет бонус пригласившему при первой генерации реферала"""
+    _conn()
+    with db.transaction() as conn:
+        return _reward_referrer(conn, user_id)
 
 
 def get_referral_stats(user_id):
     """Получает статистику рефералов пользователя"""
-    limits = load_limits()
-    user_key = str(user_id)
+    conn = _conn()
+    row = conn.execute("SELECT referrer_id FROM user_limits WHERE user_id = ?", (user_id,)).fetchone()
 
-    if user_key not in limits:
+    if row is None:
         return {
             "referrals_count": 0,
             "referrals_with_generations": 0,
             "referrer_id": None
         }
 
-    referrals = limits[user_key].get("referrals", [])
-    referrals_with_gen = 0
-
-    # Считаем рефералов, которые сделали хотя бы одну генерацию
-    for ref_id in referrals:
-        ref_key = str(ref_id)
-        if ref_key in limits and limits[ref_key].get("used", 0) > 0:
-            referrals_with_gen += 1
+    counts = conn.execute("""
+        SELECT COUNT(*) AS total,
+               COALESCE(SUM(CASE WHEN u.used > 0 THEN 1 ELSE 0 END), 0) AS with_generations
+        FROM user_referrals r
+        LEFT JOIN user_limits u ON u.user_id = r.user_id
+        WHERE r.referrer_id = ?
+    """, (user_id,)).fetchone()
 
     return {
-        "referrals_count": len(referrals),
-        "referrals_with_generations": referrals_with_gen,
-        "referrer_id": limits[user_key].get("referrer_id")
+        "referrals_count": counts["total"],
+        "referrals_with_generations": counts["with_generations"],
+        "referrer_id": row["referrer_id"]
     }
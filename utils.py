@@ -1,17 +1,22 @@
-import requests
-from bs4 import BeautifulSoup
+from providers import get_session, WEB
 from openai_helper import summarize_url_content
+import log
+
+logger = log.get_logger(__name__)
+
 
 def extract_text_from_url(url):
     """
     Извлекает текст со страницы и создает саммари с помощью ChatGPT-4o
     """
+    from bs4 import BeautifulSoup  # Нужен только для ссылок - не грузим при старте бота
+
     try:
         # Добавляем User-Agent чтобы сайт не блокировал запросы
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
         }
-        r = requests.get(url, headers=headers, timeout=10)
+        r = get_session(WEB).get(url, headers=headers, timeout=10)
         r.raise_for_status()  # Проверяем статус код
         soup = BeautifulSoup(r.text, "html.parser")
 
@@ -32,5 +37,5 @@ def extract_text_from_url(url):
         return summary
 
     except Exception as e:
-        print(f"Ошибка при обработке URL: {e}")
+        logger.error("Ошибка при обработке URL: %s", e)
         return "create a cover image for an article"
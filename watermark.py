@@ -1,15 +1,80 @@
 """
 Модуль для добавления watermark на изображения
+
+Watermark подготавливается один раз (уменьшение, прозрачность 70%) и
+кешируется: на каждое изображение выполняется только наложение в правом
+нижнем углу (paste с маской прозрачности) и кодирование результата.
 """
-from PIL import Image
-from io import BytesIO
 import os
+import threading
+from io import BytesIO
+
+from settings import WATERMARK_OUTPUT_FORMAT, WATERMARK_QUALITY
+import log
+
+logger = log.get_logger(__name__)
 
 WATERMARK_PATH = "usp.png"
 WATERMARK_OFFSET = 25  # Отступ от края в пикселях
+WATERMARK_SCALE = 0.8  # Уменьшаем размер watermark на 20%
+WATERMARK_OPACITY = int(255 * 0.7)  # 70% непрозрачности
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _prepare_watermark(watermark_path):
+    """
+    Возвращает подготовленный watermark: (RGB изображение, маска прозрачности)
+
+    Результат кешируется по пути и времени изменения файла.
+    """
+    key = (watermark_path, os.path.getmtime(watermark_path))
+    prepared = _cache.get(key)
+    if prepared is not None:
+        return prepared
+
+    from PIL import Image
+
+    with _cache_lock:
+        prepared = _cache.get(key)
+        if prepared is not None:
+            return prepared
+
+        watermark = Image.open(watermark_path)
+        if watermark.mode != 'RGBA':
+            watermark = watermark.convert('RGBA')
 
+        new_size = (int(watermark.width * WATERMARK_SCALE), int(watermark.height * WATERMARK_SCALE))
+        watermark = watermark.resize(new_size, Image.Resampling.LANCZOS)
 
-def add_watermark(image_bytes, watermark_path=WATERMARK_PATH, offset=WATERMARK_OFFSET):
+        # Все непрозрачные пиксели получают 70% непрозрачности (таблица вместо цикла по пикселям)
+        alpha = watermark.getchannel('A').point([0] + [WATERMARK_OPACITY] * 255)
+
+        prepared = (watermark.convert('RGB'), alpha)
+        _cache.clear()
+        _cache[key] = prepared
+        logger.info("Watermark prepared: %s %s", watermark_path, new_size)
+        return prepared
+
+
+def _encode(image, output_format):
+    """Кодирует изображение в BytesIO в выбранном формате"""
+    output = BytesIO()
+    if output_format == 'JPEG':
+        image.save(output, format='JPEG', quality=WATERMARK_QUALITY, subsampling=0)
+        output.name = 'image.jpg'
+    elif output_format == 'WEBP':
+        image.save(output, format='WEBP', quality=WATERMARK_QUALITY, method=4)
+        output.name = 'image.webp'
+    else:
+        image.save(output, format='PNG')
+        output.name = 'image.png'
+    output.seek(0)
+    return output
+
+
+def add_watermark(image_bytes, watermark_path=WATERMARK_PATH, offset=WATERMARK_OFFSET, output_format=None):
     """
     Добавляет watermark на изображение
 
@@ -17,95 +82,51 @@ def add_watermark(image_bytes, watermark_path=WATERMARK_PATH, offset=WATERMARK_O
         image_bytes: BytesIO объект с изображением или путь к файлу
         watermark_path: путь к файлу watermark
         offset: отступ от правого нижнего угла в пикселях
+        output_format: JPEG, WEBP или PNG (по умолчанию WATERMARK_OUTPUT_FORMAT)
 
     Returns:
         BytesIO объект с изображением с watermark
     """
-    try:
-        print(f"[INFO] Adding watermark from {watermark_path}")
+    from PIL import Image  # Не при импорте: модуль загружается при старте бота
 
+    output_format = (output_format or WATERMARK_OUTPUT_FORMAT).upper()
+
+    try:
         # Загружаем основное изображение
         if isinstance(image_bytes, str):
             # Если передан путь к файлу
             base_image = Image.open(image_bytes)
-            print(f"[INFO] Loaded base image from file")
         else:
             # Если передан BytesIO
             image_bytes.seek(0)
             base_image = Image.open(image_bytes)
-            print(f"[INFO] Loaded base image from BytesIO")
 
-        # Конвертируем в RGBA если нужно
-        if base_image.mode != 'RGBA':
-            base_image = base_image.convert('RGBA')
+        # Результат сохраняется без прозрачности
+        if base_image.mode != 'RGB':
+            base_image = base_image.convert('RGB')
 
-        # Загружаем watermark
         if not os.path.exists(watermark_path):
-            print(f"[WARNING] Watermark file not found: {watermark_path}")
+            logger.warning("Watermark file not found: %s", watermark_path)
             # Возвращаем оригинал без watermark
-            output = BytesIO()
-            if base_image.mode == 'RGBA':
-                base_image = base_image.convert('RGB')
-            base_image.save(output, format='PNG')
-            output.seek(0)
-            return output
+            return _encode(base_image, output_format)
 
-        watermark = Image.open(watermark_path)
-
-        # Конвертируем watermark в RGBA
-        if watermark.mode != 'RGBA':
-            watermark = watermark.convert('RGBA')
-
-        # Уменьшаем размер watermark на 20% (оставляем 80%)
-        original_size = watermark.size
-        new_size = (int(watermark.width * 0.8), int(watermark.height * 0.8))
-        watermark = watermark.resize(new_size, Image.Resampling.LANCZOS)
-        print(f"[INFO] Watermark resized: {original_size} -> {new_size}")
-
-        # Устанавливаем прозрачность 70% (255 * 0.7 = 178)
-        watermark_data = watermark.getdata()
-        new_data = []
-        for item in watermark_data:
-            r, g, b, a = item
-            # Устанавливаем 70% непрозрачности
-            if a > 0:  # Только для непрозрачных пикселей
-                new_alpha = int(255 * 0.7)  # 70% непрозрачности
-                new_data.append((r, g, b, new_alpha))
-            else:
-                new_data.append((r, g, b, 0))
-        watermark.putdata(new_data)
-        print(f"[INFO] Watermark opacity set to 70%")
-
-        # Вычисляем позицию watermark (правый нижний угол с отступом)
-        base_width, base_height = base_image.size
-        watermark_width, watermark_height = watermark.size
+        watermark, alpha = _prepare_watermark(watermark_path)
 
+        # Позиция watermark (правый нижний угол с отступом)
         position = (
-            base_width - watermark_width - offset,
-            base_height - watermark_height - offset
+            base_image.width - watermark.width - offset,
+            base_image.height - watermark.height - offset
         )
 
-        # Создаем прозрачный слой для watermark
-        transparent = Image.new('RGBA', base_image.size, (0, 0, 0, 0))
-        transparent.paste(watermark, position, watermark)
-
-        # Накладываем watermark на основное изображение
-        watermarked = Image.alpha_composite(base_image, transparent)
-        print(f"[OK] Watermark applied successfully at position {position}")
-
-        # Конвертируем обратно в RGB для сохранения
-        watermarked = watermarked.convert('RGB')
-
-        # Сохраняем в BytesIO
-        output = BytesIO()
-        watermarked.save(output, format='PNG', quality=95)
-        output.seek(0)
+        # Смешивание только в области watermark, без полноразмерного слоя
+        base_image.paste(watermark, position, alpha)
 
-        print(f"[OK] Watermarked image saved, size: {len(output.getvalue())} bytes")
+        output = _encode(base_image, output_format)
+        logger.info("Watermark applied at %s, %s %s bytes", position, output_format, output.getbuffer().nbytes)
         return output
 
     except Exception as e:
-        print(f"[ERROR] Watermark error: {e}")
+        logger.error("Watermark error: %s", e)
         # В случае ошибки возвращаем оригинал
         if isinstance(image_bytes, str):
             with open(image_bytes, 'rb') as f:
@@ -129,7 +150,10 @@ def add_watermark_to_file(input_path, output_path, watermark_path=WATERMARK_PATH
         True если успешно, False если ошибка
     """
     try:
-        watermarked_bytes = add_watermark(input_path, watermark_path, offset)
+        # Формат результата определяется по расширению файла
+        extension = os.path.splitext(output_path)[1].lower()
+        output_format = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.webp': 'WEBP'}.get(extension, 'PNG')
+        watermarked_bytes = add_watermark(input_path, watermark_path, offset, output_format=output_format)
 
         with open(output_path, 'wb') as f:
             f.write(watermarked_bytes.read())
@@ -137,5 +161,5 @@ def add_watermark_to_file(input_path, output_path, watermark_path=WATERMARK_PATH
         return True
 
     except Exception as e:
-        print(f"[ERROR] Failed to add watermark to file: {e}")
+        logger.error("Failed to add watermark to file: %s", e)
         return False
@@ -10,6 +10,9 @@ import base64
 from io import BytesIO
 from PIL import Image
 import secrets
+import log
+
+logger = log.get_logger("webapp_server")
 
 app = Flask(__name__)
 CORS(app)
@@ -106,7 +109,7 @@ def upload_image():
         })
 
     except Exception as e:
-        print(f"Error uploading image: {e}")
+        logger.error("Error uploading image: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
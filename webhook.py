@@ -0,0 +1,318 @@
+"""
+Режим webhook: приём обновлений Telegram и распределение по процессам-воркерам
+
+Запуск (BOT_MODE=webhook):
+    python webhook.py
+
+Приёмник (этот модуль) регистрирует WEBHOOK_URL в Telegram, принимает
+обновления по HTTP и пересылает каждое воркеру с номером user_id % N.
+Воркер - обычный bot.py (BOT_MODE=webhook, BOT_WORKER_INDEX=i), который
+вместо polling получает обновления от приёмника (run_worker).
+
+Все обновления одного пользователя попадают в один и тот же процесс,
+поэтому user_state и очередь задач пользователя остаются в памяти
+одного воркера. Лимиты и история хранятся в общей SQLite базе (DB_PATH),
+которую процессы одного хоста используют совместно, счётчики Google Sheets
+обновляются под общей файловой блокировкой (gsheets_logger).
+
+Приёмник сам запускает WEBHOOK_WORKERS локальных воркеров и перезапускает
+их при падении. Воркеры на других хостах не поддерживаются: SQLite в
+режиме WAL нельзя разделять между машинами.
+"""
+
+import asyncio
+import http.client
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from settings import (
+    TELEGRAM_BOT_TOKEN, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET,
+    WEBHOOK_MAX_CONNECTIONS, WEBHOOK_WORKERS, WEBHOOK_WORKER_BASE_PORT,
+    BOT_WORKER_INDEX, WEBHOOK_WORKER_PORT
+)
+import log
+
+logger = log.get_logger("webhook")
+
+WORKER_PATH = "/update"  # Путь, на который приёмник пересылает обновления воркеру
+WORKER_START_TIMEOUT = 120  # Сколько ждать запуска локальных воркеров (сек)
+WORKER_RESTART_DELAY = 5  # Пауза перед перезапуском упавшего воркера (сек)
+FORWARD_TIMEOUT = 10
+
+_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+# ===== Распределение обновлений =====
+
+def update_user_id(update: dict):
+    """
+    Возвращает ID пользователя, к которому относится обновление
+
+    У всех типов обновлений (message, callback_query, inline_query,
+    pre_checkout_query и т.д.) объект лежит в единственном поле помимо
+    update_id; пользователь - в поле "from", иначе берётся чат.
+    """
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return user["id"]
+        chat = value.get("chat") or value.get("message", {}).get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return chat["id"]
+    return None
+
+
+def worker_for(update: dict, workers: int) -> int:
+    """Номер воркера для обновления (обновления одного пользователя - всегда одному воркеру)"""
+    key = update_user_id(update)
+    if key is None:
+        key = update.get("update_id", 0)
+    return abs(key) % workers
+
+
+# ===== Приёмник =====
+
+class _Forwarder:
+    """Пересылка обновлений воркерам через keep-alive соединения (по одному на поток и воркер)"""
+
+    def __init__(self, addresses):
+        self.addresses = addresses
+        self._local = threading.local()
+
+    def _connection(self, index, fresh=False):
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+        if fresh and index in connections:
+            connections.pop(index).close()
+        if index not in connections:
+            host, port = self.addresses[index].rsplit(":", 1)
+            connections[index] = http.client.HTTPConnection(host, int(port), timeout=FORWARD_TIMEOUT)
+        return connections[index]
+
+    def forward(self, index: int, body: bytes) -> bool:
+        headers = {"Content-Type": "application/json", _SECRET_HEADER: WEBHOOK_SECRET}
+        for attempt in range(2):
+            try:
+                conn = self._connection(index, fresh=attempt > 0)
+                conn.request("POST", WORKER_PATH, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                return response.status == 200
+            except (OSError, http.client.HTTPException) as e:
+                if attempt:
+                    logger.warning("Worker %s (%s) unavailable: %s", index, self.addresses[index], e)
+        return False
+
+
+def _make_ingress_handler(forwarder: _Forwarder, path: str):
+    class IngressHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            if self.path != path:
+                return self._reply(404)
+            if WEBHOOK_SECRET and self.headers.get(_SECRET_HEADER) != WEBHOOK_SECRET:
+                return self._reply(403)
+
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                update = json.loads(body)
+            except Exception:
+                # Обновление, которое не разбирается, повторять бесполезно
+                return self._reply(400)
+
+            index = worker_for(update, len(forwarder.addresses))
+            # 503 - Telegram повторит доставку обновления позже
+            self._reply(200 if forwarder.forward(index, body) else 503)
+
+        def _reply(self, status):
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    return IngressHandler
+
+
+def _spawn_worker(index: int):
+    env = dict(os.environ)
+    env.update({
+        "BOT_MODE": "webhook",
+        "BOT_WORKER_INDEX": str(index),
+        "WEBHOOK_WORKER_PORT": str(WEBHOOK_WORKER_BASE_PORT + index),
+        # У каждого процесса свой журнал неотправленных событий Google Sheets
+        "GSHEETS_JOURNAL_PATH": f"{os.getenv('GSHEETS_JOURNAL_PATH', 'gsheets_journal.jsonl')}.{index}",
+    })
+    bot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    process = subprocess.Popen([sys.executable, bot_path], env=env)
+    logger.info("Worker %s started, PID: %s", index, process.pid)
+    return process
+
+
+def _wait_for_workers(addresses):
+    deadline = time.monotonic() + WORKER_START_TIMEOUT
+    for address in addresses:
+        host, port = address.rsplit(":", 1)
+        while True:
+            try:
+                socket.create_connection((host, int(port)), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    logger.warning("Worker %s is not responding yet", address)
+                    break
+                time.sleep(0.5)
+
+
+def _set_webhook():
+    from providers import get_session, WEB
+
+    payload = {"url": WEBHOOK_URL, "max_connections": WEBHOOK_MAX_CONNECTIONS}
+    if WEBHOOK_SECRET:
+        payload["secret_token"] = WEBHOOK_SECRET
+    response = get_session(WEB).post(
+        f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/setWebhook",
+        json=payload,
+        timeout=30
+    )
+    result = response.json()
+    if not result.get("ok"):
+        raise RuntimeError(f"setWebhook failed: {result}")
+    logger.info("Webhook set: %s", WEBHOOK_URL)
+
+
+def run_ingress():
+    """Запускает приёмник webhook и локальных воркеров"""
+    if not WEBHOOK_URL:
+        logger.error("WEBHOOK_URL is not set")
+        sys.exit(1)
+
+    addresses = [f"127.0.0.1:{WEBHOOK_WORKER_BASE_PORT + i}" for i in range(WEBHOOK_WORKERS)]
+    processes = {index: _spawn_worker(index) for index in range(len(addresses))}
+
+    _wait_for_workers(addresses)
+
+    path = urlsplit(WEBHOOK_URL).path or "/"
+    server = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), _make_ingress_handler(_Forwarder(addresses), path))
+    server.daemon_threads = True
+
+    stopping = threading.Event()
+
+    def supervise():
+        # Перезапускаем упавшие локальные воркеры
+        while not stopping.wait(WORKER_RESTART_DELAY):
+            for index, process in list(processes.items()):
+                if process.poll() is not None and not stopping.is_set():
+                    logger.info("Worker %s exited with code %s, restarting", index, process.returncode)
+                    processes[index] = _spawn_worker(index)
+
+    def stop(signum, frame):
+        stopping.set()
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    threading.Thread(target=supervise, name="webhook-supervisor", daemon=True).start()
+
+    _set_webhook()
+    logger.info("Ingress listening on %s:%s%s, workers: %s", WEBHOOK_LISTEN, WEBHOOK_PORT, path, len(addresses))
+
+    try:
+        server.serve_forever()
+    finally:
+        stopping.set()
+        server.server_close()
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        logger.info("Ingress stopped")
+
+
+# ===== Воркер =====
+
+def _make_worker_handler(application, loop):
+    from telegram import Update
+
+    class WorkerHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            if self.path != WORKER_PATH:
+                return self._reply(404)
+            if WEBHOOK_SECRET and self.headers.get(_SECRET_HEADER) != WEBHOOK_SECRET:
+                return self._reply(403)
+
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                update = Update.de_json(json.loads(body), application.bot)
+            except Exception:
+                # Обновление, которое не разбирается, повторять бесполезно
+                return self._reply(400)
+
+            loop.call_soon_threadsafe(application.update_queue.put_nowait, update)
+            self._reply(200)
+
+        def _reply(self, status):
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    return WorkerHandler
+
+
+async def _serve_worker(application):
+    loop = asyncio.get_running_loop()
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    server = ThreadingHTTPServer(("127.0.0.1", WEBHOOK_WORKER_PORT), _make_worker_handler(application, loop))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="webhook-worker", daemon=True).start()
+    logger.info("Worker %s listening on 127.0.0.1:%s", BOT_WORKER_INDEX, WEBHOOK_WORKER_PORT)
+
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    try:
+        await stop_event.wait()
+    finally:
+        server.shutdown()
+        server.server_close()
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+        logger.info("Worker %s stopped", BOT_WORKER_INDEX)
+
+
+def run_worker(application):
+    """Запускает процесс-воркер: обработчики бота получают обновления от приёмника"""
+    asyncio.run(_serve_worker(application))
+
+
+if __name__ == "__main__":
+    run_ingress()